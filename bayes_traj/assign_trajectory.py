@@ -4,9 +4,108 @@ from argparse import ArgumentParser
 import pandas as pd
 import numpy as np
 from bayes_traj.mult_dp_regression import MultDPRegression
+from bayes_traj.model_registry import load_model
+from bayes_traj.utils import read_group_chunks
 from provenance_tools.write_provenance_data import write_provenance_data
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
 import pdb, pickle
 
+_worker_model = None
+
+def _init_worker(model):
+    """Loads the model in a worker process.
+    """
+    global _worker_model
+    _worker_model = load_model(model) if isinstance(model, str) else model
+
+
+def _assign_chunk(df, groupby, traj_map, mm=None):
+    """Assigns the subjects in a data frame chunk to trajectories.
+    """
+    if mm is None:
+        mm = _worker_model
+    df_out = mm.augment_df_with_traj_info(df, groupby, test_data=True)
+    df_out.replace({'traj': traj_map}, inplace=True)
+
+    return df_out
+
+
+def assign_trajectory_chunked(mm, in_csv, out_csv, groupby=None,
+                              chunksize=100000, traj_map=None, num_workers=1):
+    """Assigns the individuals in a (possibly very large) csv file to
+    trajectories, reading the file in chunks and appending each scored chunk
+    to the output file, so that memory use does not grow with the file size.
+    If 'groupby' is specified, chunks are aligned with subjects (see
+    'read_group_chunks' in bayes_traj.utils), so the file must be sorted by
+    that column. Chunks can be scored in parallel worker processes; the
+    output rows are always written in input order.
+
+    Parameters
+    ----------
+    mm : MultDPRegression or str
+        Trajectory model, or model file path or registered model id (see
+        bayes_traj.model_registry). With worker processes, passing a path
+        lets each worker load the model itself.
+
+    in_csv : str
+        Input csv data file.
+
+    out_csv : str
+        Output csv file. It has the input columns, a 'traj' column and one
+        'traj_<num>' probability column per trajectory, as written by
+        assign_trajectory.
+
+    groupby : str, optional
+        Subject identifier column name.
+
+    chunksize : int, optional
+        Number of rows to read at a time.
+
+    traj_map : dict, optional
+        Mapping from model trajectory numbers to output trajectory numbers.
+
+    num_workers : int, optional
+        Number of worker processes. If 1, chunks are scored in this process.
+    """
+    if traj_map is None:
+        traj_map = {}
+
+    if groupby is not None:
+        chunks = read_group_chunks(in_csv, groupby, chunksize)
+    else:
+        chunks = (cc.reset_index(drop=True) for cc in \
+                  pd.read_csv(in_csv, chunksize=chunksize))
+
+    header = True
+    def write(df_out):
+        nonlocal header
+        df_out.to_csv(out_csv, mode='w' if header else 'a', header=header,
+                      index=False)
+        header = False
+
+    if num_workers <= 1:
+        if isinstance(mm, str):
+            mm = load_model(mm)
+        for chunk in chunks:
+            write(_assign_chunk(chunk, groupby, traj_map, mm))
+    else:
+        # Bound the number of chunks in flight so that memory stays constant
+        with ProcessPoolExecutor(num_workers, initializer=_init_worker,
+                                 initargs=(mm,)) as pool:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(pool.submit(_assign_chunk, chunk, groupby,
+                                           traj_map))
+                if len(pending) >= 2*num_workers:
+                    write(pending.popleft().result())
+            while len(pending) > 0:
+                write(pending.popleft().result())
+
+    if header:
+        raise RuntimeError("No data found in " + in_csv)
+
+
 def main():
     """
     """
@@ -44,14 +143,19 @@ def main():
         E.g.: 3-1,18-2,7-3 would indicate a mapping from 3 to 1, from 18 to 2, \
         and from 7 to 3. Original trajectory values not used in the mapping \
         will be reassigned to NaNs ', type=str, default=None)        
+    args.add_argument('--chunksize', help='If specified, the input file is \
+        read and assigned this many rows at a time, and the output file is \
+        written incrementally, so memory use does not depend on the size of \
+        the input file. If --groupby is specified, the input file must be \
+        sorted by that column. Requires --out_csv.', type=int, default=None)
+    args.add_argument('--num_workers', help='Number of worker processes used \
+        to assign chunks in parallel. Only used if --chunksize is specified.',
+        type=int, default=1)
 
     op = args.parse_args()
     
-    print("Reading data...")
-    df = pd.read_csv(op.in_csv)
-
     print("Reading model...")
-    mm = pickle.load(open(op.model, 'rb'))['MultDPRegression']
+    mm = load_model(op.model)
 
     traj_map = {}
     if op.traj_map is not None:
@@ -63,14 +167,24 @@ def main():
         for ii in np.where(mm.sig_trajs_)[0]:
             traj_map[ii] = ii
     
-    print("Assigning...")    
-    df_out = mm.augment_df_with_traj_info(df, op.groupby, test_data=True)
-    df_out.replace({'traj': traj_map}, inplace=True)
-    
-    if op.out_csv is not None:
-        print("Saving data with trajectory info...")
-        df_out.to_csv(op.out_csv, index=False)
+    if op.chunksize is not None:
+        assert op.out_csv is not None, "--chunksize requires --out_csv"
+        print("Assigning...")
+        assign_trajectory_chunked(op.model if op.num_workers > 1 else mm,
+                                  op.in_csv, op.out_csv, op.groupby,
+                                  op.chunksize, traj_map, op.num_workers)
+    else:
+        print("Reading data...")
+        df = pd.read_csv(op.in_csv)
+
+        print("Assigning...")    
+        df_out = _assign_chunk(df, op.groupby, traj_map, mm)
+
+        if op.out_csv is not None:
+            print("Saving data with trajectory info...")
+            df_out.to_csv(op.out_csv, index=False)
         
+    if op.out_csv is not None:
         print("Saving data file provenance info...")
         provenance_desc = """ """
         write_provenance_data(op.out_csv, generator_args=op,
@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+
+from argparse import ArgumentParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import Future
+import numpy as np
+import pandas as pd
+from bayes_traj.assignment_engine import TrajAssignmentEngine
+from bayes_traj.model_registry import load_model
+import pdb, pickle, json, io, queue, threading, time
+
+ARROW_CONTENT_TYPE = 'application/vnd.apache.arrow.stream'
+
+class AssignmentBatcher:
+    """Scores assignment requests on a pool of worker threads. Each worker
+    takes the next pending request and, before scoring, collects further
+    pending requests for up to 'max_wait' seconds (or until 'max_batch_size'
+    observations have been collected), so that concurrent requests are scored
+    together with a single vectorized call.
+
+    Parameters
+    ----------
+    engine : TrajAssignmentEngine
+        Engine used for scoring.
+
+    groupby : str, optional
+        Column name identifying subjects in the requests. If not specified,
+        each observation is treated as a separate subject.
+
+    num_workers : int, optional
+        Number of worker threads.
+
+    max_batch_size : int, optional
+        Maximum number of observations scored together.
+
+    max_wait : float, optional
+        Maximum time, in seconds, a worker waits for further requests before
+        scoring a batch.
+    """
+    def __init__(self, engine, groupby=None, num_workers=1,
+                 max_batch_size=100000, max_wait=0.005):
+        assert num_workers > 0, "num_workers must be greater than 0"
+        self.engine_ = engine
+        self.groupby_ = groupby
+        self.max_batch_size_ = max_batch_size
+        self.max_wait_ = max_wait
+
+        self.queue_ = queue.Queue()
+        self.workers_ = [threading.Thread(target=self._work, daemon=True) \
+                         for ii in range(num_workers)]
+        for ww in self.workers_:
+            ww.start()
+
+    def submit(self, df):
+        """Queues a data frame of observations for scoring.
+
+        Parameters
+        ----------
+        df : pandas dataframe
+            Observations to score.
+
+        Returns
+        -------
+        future : concurrent.futures.Future
+            Resolves to the data frame returned by
+            TrajAssignmentEngine.assign.
+        """
+        future = Future()
+        self.queue_.put((df, future))
+
+        return future
+
+    def close(self):
+        """Stops the worker threads once the pending requests are scored.
+        """
+        for ww in self.workers_:
+            self.queue_.put(None)
+        for ww in self.workers_:
+            ww.join()
+
+    def _work(self):
+        """Worker thread loop.
+        """
+        done = False
+        while not done:
+            item = self.queue_.get()
+            if item is None:
+                return
+
+            batch = [item]
+            num_obs = item[0].shape[0]
+            deadline = time.monotonic() + self.max_wait_
+            while num_obs < self.max_batch_size_:
+                try:
+                    item = self.queue_.get(\
+                        timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    done = True
+                    break
+                batch.append(item)
+                num_obs += item[0].shape[0]
+
+            self._score(batch)
+
+    def _score(self, batch):
+        """Scores a batch of requests with a single call to the engine and
+        hands each request its share of the result.
+        """
+        try:
+            df = pd.concat([dd.assign(_request=ii) for ii, (dd, ff) \
+                            in enumerate(batch)], ignore_index=True)
+            if self.groupby_ is None:
+                df['_row'] = df.groupby('_request').cumcount()
+                probs = self.engine_.assign(df, ['_request', '_row'])
+            else:
+                probs = self.engine_.assign(df, ['_request', self.groupby_])
+        except Exception as e:
+            # Score the requests one by one so that a bad request does not
+            # fail the rest of the batch
+            if len(batch) > 1:
+                for item in batch:
+                    self._score([item])
+            else:
+                batch[0][1].set_exception(e)
+            return
+
+        for ii, (dd, ff) in enumerate(batch):
+            ff.set_result(probs.xs(ii, level='_request'))
+
+
+class AssignmentRequestHandler(BaseHTTPRequestHandler):
+    """Handles 'POST /assign' requests with a body of JSON lines (one
+    observation per line) or, if pyarrow is installed, an Arrow IPC stream.
+    The response uses the format of the request and has one record per
+    subject, holding the subject identifier, the most probable trajectory
+    ('traj') and the trajectory probabilities ('traj_<num>'). 'GET /health'
+    reports the model's predictors, targets and trajectories.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def _send(self, code, body, content_type='application/json'):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, code, message):
+        self._send(code, (json.dumps({'error': message}) + '\n').encode())
+
+    def do_GET(self):
+        if self.path != '/health':
+            self._send_error(404, 'Unknown path')
+            return
+
+        engine = self.server.batcher.engine_
+        self._send(200, (json.dumps({'status': 'ok',
+            'predictors': engine.predictor_names_,
+            'targets': engine.target_names_,
+            'groupby': self.server.batcher.groupby_,
+            'trajectories': np.where(engine.sig_trajs_)[0].tolist()}) + \
+                         '\n').encode())
+
+    def do_POST(self):
+        if self.path != '/assign':
+            self._send_error(404, 'Unknown path')
+            return
+
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        content_type = self.headers.get('Content-Type', '').split(';')[0]
+        use_arrow = content_type == ARROW_CONTENT_TYPE
+        try:
+            if use_arrow:
+                df = read_arrow(body)
+            else:
+                df = pd.DataFrame.from_records(\
+                    [json.loads(ll) for ll in body.decode().splitlines() \
+                     if ll.strip()])
+        except RuntimeError as e:
+            self._send_error(415, str(e))
+            return
+        except ValueError as e:
+            self._send_error(400, 'Could not parse request: ' + str(e))
+            return
+
+        groupby = self.server.batcher.groupby_
+        missing = [cc for cc in self.server.batcher.engine_.predictor_names_ \
+                   + ([groupby] if groupby is not None else []) \
+                   if cc not in df.columns]
+        if df.shape[0] == 0 or len(missing) > 0:
+            self._send_error(400, 'Missing columns: ' + ', '.join(missing))
+            return
+        if groupby is not None and df[groupby].isnull().any():
+            self._send_error(400, 'Missing values in column ' + groupby)
+            return
+
+        try:
+            probs = self.server.batcher.submit(df).result()
+        except Exception as e:
+            self._send_error(500, str(e))
+            return
+
+        if groupby is None:
+            probs.index.name = 'row'
+        probs = probs.reset_index()
+
+        if use_arrow:
+            self._send(200, write_arrow(probs), ARROW_CONTENT_TYPE)
+        else:
+            self._send(200, ''.join([json.dumps(rr) + '\n' for rr in \
+                json.loads(probs.to_json(orient='records'))]).encode(),
+                       'application/x-ndjson')
+
+
+def read_arrow(body):
+    """Reads an Arrow IPC stream into a data frame.
+    """
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise RuntimeError("pyarrow is required for Arrow requests")
+
+    return pa.ipc.open_stream(body).read_all().to_pandas()
+
+
+def write_arrow(df):
+    """Writes a data frame as an Arrow IPC stream.
+    """
+    import pyarrow as pa
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sink = io.BytesIO()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+
+    return sink.getvalue()
+
+
+def make_server(mm, host='127.0.0.1', port=0, groupby=None, num_workers=1,
+                max_batch_size=100000, max_wait=0.005, verbose=False):
+    """Creates an HTTP server that assigns subjects to the trajectories of a
+    model. The model's training data is not needed once the server has been
+    created. Call 'serve_forever' on the returned server to start serving,
+    and 'shutdown' followed by 'server_close' to stop.
+
+    Parameters
+    ----------
+    mm : MultDPRegression or str
+        Fitted trajectory model, or a model file path or registered model id
+        (see bayes_traj.model_registry).
+
+    host : str, optional
+        Address to bind to. Defaults to the loopback interface.
+
+    port : int, optional
+        Port to bind to. If 0, a free port is chosen; it is available as
+        'server.server_address[1]'.
+
+    groupby, num_workers, max_batch_size, max_wait
+        See AssignmentBatcher.
+
+    verbose : bool, optional
+        If true, requests are logged to stderr.
+
+    Returns
+    -------
+    server : ThreadingHTTPServer
+        The server. Its 'batcher' attribute is the AssignmentBatcher used.
+    """
+    server = ThreadingHTTPServer((host, port), AssignmentRequestHandler)
+    server.daemon_threads = True
+    server.verbose = verbose
+    server.batcher = AssignmentBatcher(TrajAssignmentEngine(mm), groupby,
+                                       num_workers, max_batch_size, max_wait)
+
+    server_close = server.server_close
+    def close():
+        server_close()
+        server.batcher.close()
+    server.server_close = close
+
+    return server
+
+
+def main():
+    """
+    """
+    desc = """Loads a trajectory model once and serves trajectory assignment \
+    requests over HTTP. POST observations to /assign as JSON lines (one \
+    observation per line, keyed by column name) or as an Arrow IPC stream \
+    (Content-Type application/vnd.apache.arrow.stream; requires pyarrow). The \
+    response has one record per subject with the most probable trajectory \
+    (traj) and the probability of each trajectory (traj_<num>). As with \
+    assign_trajectory, only the fixed effects are used for assignment."""
+
+    parser = ArgumentParser(description=desc)
+    parser.add_argument('--model', help='Pickled trajectory model to use for \
+        assigning data instances to trajectories', type=str, required=True)
+    parser.add_argument('--groupby', help='Subject identifier column name in \
+        the requests. If not specified, each observation is assigned \
+        separately.', type=str, default=None)
+    parser.add_argument('--host', help='Address to bind to', type=str,
+        default='127.0.0.1')
+    parser.add_argument('--port', help='Port to listen on', type=int,
+        default=8642)
+    parser.add_argument('--num_workers', help='Number of scoring worker \
+        threads', type=int, default=1)
+    parser.add_argument('--max_batch_size', help='Maximum number of \
+        observations scored together', type=int, default=100000)
+    parser.add_argument('--max_wait', help='Maximum time (in seconds) a \
+        worker waits to batch concurrent requests', type=float,
+        default=0.005)
+    parser.add_argument('--verbose', help='Log requests', action='store_true')
+
+    op = parser.parse_args()
+
+    print("Reading model...")
+    mm = load_model(op.model, cache=False)
+
+    server = make_server(mm, op.host, op.port, op.groupby, op.num_workers,
+                         op.max_batch_size, op.max_wait, op.verbose)
+    del mm
+
+    print("Serving on http://{}:{}/assign".format(*server.server_address[0:2]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+    print("DONE.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,334 @@
+import torch
+import numpy as np
+import pandas as pd
+import hashlib
+from bayes_traj.model_registry import load_model
+from bayes_traj.traj_scorer import build_scorer
+import pdb
+
+class TrajAssignmentEngine:
+    """Maintains trajectory assignment probabilities of individual subjects
+    as their visits arrive one at a time. For each subject, the engine keeps
+    the sum over visits of the expected log-likelihood of each trajectory
+    (the same quantity 'get_R_matrix' accumulates over a subject's history),
+    so adding a visit costs O(K*M*D) -- O(K*M^2) for binary targets -- and
+    requires neither the subject's earlier visits nor any pandas groupby.
+
+    Assignment follows MultDPRegression.augment_df_with_traj_info with
+    test_data=True: only fixed effects are used. The expected log-likelihoods
+    and their normalization are computed by bayes_traj.traj_scorer (run
+    without TorchScript compilation), so the engine and the compiled scorer
+    give the same probabilities. For binary targets the expectation
+    E[log(1 + exp(x^T w))] is computed with Gauss-Hermite quadrature rather
+    than Monte Carlo sampling, so probabilities are deterministic and agree
+    with 'get_R_matrix' up to its Monte Carlo error.
+
+    Parameters
+    ----------
+    mm : MultDPRegression or str
+        Fitted trajectory model, or a model file path or registered model id
+        to resolve through bayes_traj.model_registry.
+
+    num_quad_points : int, optional
+        Number of Gauss-Hermite quadrature points used for binary targets.
+    """
+    def __init__(self, mm, num_quad_points=32):
+        if isinstance(mm, str):
+            mm = load_model(mm)
+
+        self.scorer_ = build_scorer(mm, num_quad_points, script=False)
+
+        self.target_names_ = list(mm.target_names_)
+        self.predictor_names_ = list(mm.predictor_names_)
+        self.K_ = mm.K_
+        self.prob_thresh_ = mm.prob_thresh_
+        self.sig_trajs_ = self.scorer_.sig_trajs.numpy()
+        self.target_type_ = [mm.target_type_[d] for d in range(mm.D_)]
+
+        self.expec_ln_v_terms_ = self.scorer_.expec_ln_v_terms.numpy()
+        self.w_mu_ = self.scorer_.w_mu.numpy()
+        self.w_var_ = self.scorer_.w_var.numpy()
+        self.w_covmat_ = self.scorer_.w_covmat.numpy()
+        self.prec_ = self.scorer_.prec.numpy()
+
+        self.model_digest_ = self._get_model_digest()
+
+        self.subject_index_ = {}
+        self.subject_ids_ = []
+        self._set_store(np.zeros([0, self.K_]), np.zeros(0, dtype=int))
+
+    def _get_model_digest(self):
+        """Computes a digest of the model quantities that assignment depends
+        on. Used to check that a persisted store belongs to this model.
+        """
+        h = hashlib.sha1()
+        for aa in [self.expec_ln_v_terms_, self.w_mu_, self.w_var_,
+                   np.nan_to_num(self.w_covmat_), self.prec_,
+                   self.sig_trajs_.astype(float)]:
+            h.update(np.ascontiguousarray(aa, dtype=float).tobytes())
+        return h.hexdigest()
+
+    def log_likelihood(self, X, Y):
+        """Computes the expected log-likelihood of each data instance under
+        each trajectory.
+
+        Parameters
+        ----------
+        X : array, shape ( n, M )
+            Predictor values.
+
+        Y : array, shape ( n, D )
+            Target values. NaN entries do not contribute.
+
+        Returns
+        -------
+        log_like : array, shape ( n, K )
+            Expected log-likelihoods.
+        """
+        X = np.atleast_2d(np.asarray(X, dtype=float))
+        Y = np.atleast_2d(np.asarray(Y, dtype=float))
+        with torch.no_grad():
+            return self.scorer_.log_likelihood(torch.from_numpy(X),
+                                               torch.from_numpy(Y)).numpy()
+
+    def _set_store(self, log_like, num_visits):
+        """Replaces the per-subject store. log_like_ and num_visits_ are
+        views of the first rows of buffers that grow geometrically as
+        subjects are added (see '_get_subject_rows').
+        """
+        self._log_like_buf = log_like
+        self._num_visits_buf = num_visits
+        self.log_like_ = log_like
+        self.num_visits_ = num_visits
+
+    def _get_subject_rows(self, subject_ids):
+        """Returns the store rows of the specified subjects, adding subjects
+        that are not yet in the store. The store buffers at least double in
+        size when they fill up, so adding subjects one at a time costs
+        amortized O(K) per subject rather than a copy of the whole store.
+        """
+        rows = np.zeros(len(subject_ids), dtype=int)
+        for ii, ss in enumerate(subject_ids):
+            row = self.subject_index_.setdefault(ss, len(self.subject_ids_))
+            if row == len(self.subject_ids_):
+                self.subject_ids_.append(ss)
+            rows[ii] = row
+
+        num = len(self.subject_ids_)
+        num_old = self.log_like_.shape[0]
+        if num > self._log_like_buf.shape[0]:
+            capacity = max(num, 2*self._log_like_buf.shape[0])
+            log_like = np.zeros([capacity, self.K_])
+            log_like[0:num_old] = self.log_like_
+            num_visits = np.zeros(capacity, dtype=int)
+            num_visits[0:num_old] = self.num_visits_
+            self._log_like_buf = log_like
+            self._num_visits_buf = num_visits
+        self.log_like_ = self._log_like_buf[0:num]
+        self.num_visits_ = self._num_visits_buf[0:num]
+
+        return rows
+
+    def _normalize(self, log_like):
+        """Turns accumulated log-likelihoods into assignment probabilities,
+        the same way 'get_R_matrix' does.
+        """
+        log_like = np.ascontiguousarray(np.atleast_2d(log_like), dtype=float)
+        with torch.no_grad():
+            return self.scorer_.normalize(torch.from_numpy(log_like)).numpy()
+
+    def add_visit(self, subject_id, visit):
+        """Adds a single visit of a subject and returns the subject's updated
+        assignment probabilities.
+
+        Parameters
+        ----------
+        subject_id : hashable
+            Subject identifier.
+
+        visit : dict or pandas Series
+            Predictor and target values of the visit, keyed by name. Missing
+            or NaN targets do not contribute.
+
+        Returns
+        -------
+        probs : array, shape ( K )
+            Probability of each trajectory.
+        """
+        x = np.array([visit[pp] for pp in self.predictor_names_], dtype=float)
+        y = np.array([visit[tt] if tt in visit else np.nan \
+                      for tt in self.target_names_], dtype=float)
+
+        row = self._get_subject_rows([subject_id])[0]
+        self.log_like_[row] += self.log_likelihood(x, y)[0]
+        self.num_visits_[row] += 1
+
+        return self._normalize(self.log_like_[row])[0]
+
+    def add_visits(self, df, groupby):
+        """Adds all the visits in a data frame, e.g. to initialize the store
+        from subjects' histories.
+
+        Parameters
+        ----------
+        df : pandas dataframe
+            Data frame containing predictor, target, and subject information.
+
+        groupby : str
+            Data frame column name of the subject identifier. Rows with a
+            missing identifier are rejected.
+        """
+        # np.unique would pool rows with a missing identifier into a single
+        # subject that can not be looked up afterwards
+        if df[groupby].isnull().values.any():
+            raise RuntimeError("Missing subject identifiers in " + \
+                               str(groupby))
+
+        keys, codes = np.unique(df[groupby].values, return_inverse=True)
+        rows = self._get_subject_rows(keys.tolist())
+
+        log_like = self.log_likelihood(df[self.predictor_names_].values,
+                                       df[self.target_names_].values)
+        np.add.at(self.log_like_, rows[codes], log_like)
+        np.add.at(self.num_visits_, rows[codes], 1)
+
+    def get_probs(self, subject_ids=None):
+        """Gets the current assignment probabilities of subjects.
+
+        Parameters
+        ----------
+        subject_ids : list, optional
+            Subject identifiers. By default, all subjects in the store.
+
+        Returns
+        -------
+        probs : pandas dataframe
+            Indexed by subject identifier, with a 'traj' column holding the
+            most probable trajectory and 'traj_<num>' columns holding the
+            probabilities of the significant trajectories, as in
+            'augment_df_with_traj_info'.
+        """
+        if subject_ids is None:
+            subject_ids = self.subject_ids_
+        rows = [self.subject_index_[ss] for ss in subject_ids]
+
+        return self._probs_to_df(pd.Index(subject_ids),
+                                 self._normalize(self.log_like_[rows]))
+
+    def _probs_to_df(self, index, probs):
+        """Formats assignment probabilities the way
+        'augment_df_with_traj_info' does.
+        """
+        df = pd.DataFrame(index=index)
+        df['traj'] = np.argmax(probs, 1)
+        for s in np.where(self.sig_trajs_)[0]:
+            df['traj_{}'.format(s)] = probs[:, s]
+
+        return df
+
+    def assign(self, df, groupby=None):
+        """Computes assignment probabilities for a batch of subjects from
+        their observations, without touching the per-subject store.
+
+        Parameters
+        ----------
+        df : pandas dataframe
+            Data frame containing predictor, target, and subject information.
+            Missing target columns are treated as unobserved.
+
+        groupby : str or list of str, optional
+            Data frame column name(s) identifying subjects. If not specified,
+            each row is treated as a separate subject. Rows with a missing
+            identifier are rejected.
+
+        Returns
+        -------
+        probs : pandas dataframe
+            Indexed by subject (in order of first appearance), or by row if
+            'groupby' is not specified. Columns as in 'get_probs'.
+        """
+        Y = np.full([df.shape[0], len(self.target_names_)], np.nan)
+        for d, tt in enumerate(self.target_names_):
+            if tt in df.columns:
+                Y[:, d] = df[tt].values
+        log_like = self.log_likelihood(df[self.predictor_names_].values, Y)
+
+        if groupby is None:
+            return self._probs_to_df(df.index, self._normalize(log_like))
+
+        # groupby would give rows with a missing identifier the code -1, and
+        # np.add.at would then add them to the last subject
+        missing = df[groupby].isnull()
+        if missing.values.any():
+            raise RuntimeError("Missing subject identifiers in " + \
+                               str(groupby))
+
+        keys = df[groupby].drop_duplicates()
+        codes = df.groupby(groupby, sort=False).ngroup().values
+        log_like_g = np.zeros([keys.shape[0], self.K_])
+        np.add.at(log_like_g, codes, log_like)
+
+        if isinstance(keys, pd.DataFrame):
+            index = pd.MultiIndex.from_frame(keys)
+        else:
+            index = pd.Index(keys.values, name=groupby)
+
+        return self._probs_to_df(index, self._normalize(log_like_g))
+
+    def remove_subject(self, subject_id):
+        """Removes a subject from the store.
+
+        Parameters
+        ----------
+        subject_id : hashable
+            Subject identifier.
+        """
+        row = self.subject_index_.pop(subject_id)
+        keep = np.arange(len(self.subject_ids_)) != row
+        self._set_store(self.log_like_[keep], self.num_visits_[keep])
+        del self.subject_ids_[row]
+        for ii, ss in enumerate(self.subject_ids_[row:]):
+            self.subject_index_[ss] = row + ii
+
+    def save(self, file_name):
+        """Writes the per-subject store to a compressed numpy (.npz) file:
+        one row of K accumulated log-likelihoods and a visit count per
+        subject. The subject identifiers must all be numbers or all be
+        strings, so that they are read back unchanged by 'load'.
+
+        Parameters
+        ----------
+        file_name : str
+            Output file name.
+        """
+        # numpy would turn mixed identifiers, e.g. [1, 'a'], into strings
+        subject_ids = np.array(self.subject_ids_)
+        if subject_ids.ndim != 1 or \
+           subject_ids.tolist() != list(self.subject_ids_):
+            raise RuntimeError("Subject identifiers must all be numbers or " + \
+                               "all be strings to be saved")
+
+        np.savez_compressed(file_name, subject_ids=subject_ids,
+                            log_like=self.log_like_,
+                            num_visits=self.num_visits_,
+                            model_digest=np.array(self.model_digest_))
+
+    def load(self, file_name):
+        """Replaces the per-subject store with one written by 'save'. The
+        store must have been computed with the same model.
+
+        Parameters
+        ----------
+        file_name : str
+            Input file name.
+        """
+        with np.load(file_name, allow_pickle=False) as store:
+            if str(store['model_digest']) != self.model_digest_:
+                raise RuntimeError(\
+                    "Store {} was computed with a different model".\
+                    format(file_name))
+            self.subject_ids_ = store['subject_ids'].tolist()
+            self._set_store(store['log_like'], store['num_visits'])
+
+        self.subject_index_ = \
+            {ss: ii for ii, ss in enumerate(self.subject_ids_)}
@@ -8,7 +8,9 @@ from bayes_traj.mult_dp_regression import MultDPRegression
 from bayes_traj.mult_pyro import MultPyro
 from bayes_traj.prior_from_model import prior_from_model
 from bayes_traj.utils import *
-from bayes_traj.fit_stats import compute_waic2
+from bayes_traj.fit_stats import get_fit_metrics, get_looic
+from bayes_traj.coreset import fit_coreset
+from bayes_traj.model_io import save_model
 import torch
 import pyro
 from bayes_traj.pyro_helper import *
@@ -17,6 +19,35 @@ import pickle, sys, warnings
 
 torch.set_default_dtype(torch.double) # TODO -- may not be desirable to set this globally
 
+def compute_criterion(mm, criterion):
+    """Computes the fit criterion used to select among repeats. Lower is
+    better.
+
+    Parameters
+    ----------
+    mm : MultDPRegression
+        Post-fit trajectory model
+
+    criterion : str
+        'waic2' or 'loo'
+
+    Returns
+    -------
+    value : float
+        WAIC2, or LOOIC (-2 times the PSIS-LOO log predictive density). The
+        value is also recorded in the model's fit metrics (see
+        bayes_traj.fit_stats.get_fit_metrics), from which WAIC2 is read if
+        they are current.
+    """
+    if criterion == 'loo':
+        looic = get_looic(mm)
+        if looic['num_bad_k'] > 0:
+            print("Pareto k > 0.7 for {} of {} subjects: LOOIC may be \
+unreliable".format(looic['num_bad_k'], looic['num_groups']))
+        return looic['value']
+
+    return get_fit_metrics(mm)['waic2']['value']
+
 def main():
     """
     """
@@ -57,16 +88,24 @@ def main():
         type=float, default=1.0)    
     parser.add_argument('--alpha', help='If specified, over-rides the value in \
         the prior file', dest='alpha', metavar=float, default=None)
-    parser.add_argument('--out_model', help='Pickle file name. If specified, \
-        the model object will be written to this file.', dest='out_model',
+    parser.add_argument('--out_model', help='Model file name. If specified, \
+        the model object will be written to this file. Files with a .p, .pkl \
+        or .pickle extension are pickled; other files use the bayes_traj \
+        model format (see bayes_traj.model_io).', dest='out_model',
         metavar='<string>', default=None, required=False)
     parser.add_argument('--iters', help='Number of inference iterations',
         dest='iters', metavar='<int>', default=100)
     parser.add_argument('--repeats', help='Number of repeats to attempt. If a \
-        value greater than 1 is specified, the WAIC2 fit criterion will be \
-        computed at the end of each repeat. If, for a given repeat, the WAIC2 \
-        score is lower than the lowest score seen at that point, the model \
-        will be saved to file.', type=int, metavar='<int>', default=1)
+        value greater than 1 is specified, the fit criterion selected with \
+        --criterion will be computed at the end of each repeat. If, for a \
+        given repeat, the score is lower than the lowest score seen at that \
+        point, the model will be saved to file.', type=int, metavar='<int>',
+        default=1)
+    parser.add_argument('--criterion', help='Fit criterion used to select \
+        among repeats: waic2 (computed without sampling) or loo (LOOIC, -2 \
+        times the subject-level PSIS-LOO log predictive density). For loo, \
+        the number of subjects with unreliable estimates (Pareto k > 0.7) is \
+        reported.', choices=['waic2', 'loo'], default='waic2')
     parser.add_argument('-k', help='Number of columns in the truncated \
         assignment matrix', metavar='<int>', default=30)
     parser.add_argument('--prob_thresh', help='If during data fitting the \
@@ -110,6 +149,66 @@ def main():
         subgroups differs. By using this flag, the proportions of previously \
         determined trajectory subgroups will be determined for the current \
         data set.', action='store_true')
+    parser.add_argument('--num_workers', help='If greater than 1, subjects \
+        will be sharded (by the groupby column) across this many local worker \
+        processes, and the coordinate ascent updates will be distributed \
+        across them. Requires --groupby.', type=int, default=None)
+    parser.add_argument('--batch_size', help='If specified, stochastic \
+        variational inference is used instead of coordinate ascent, with \
+        minibatches of this many subjects. In this case --iters is the number \
+        of passes through the data.', type=int, default=None)
+    parser.add_argument('--step_delay', help='Delay of the stochastic \
+        variational inference step size schedule, (step_delay + \
+        t)^(-forgetting_rate). Must be >= 0. Only used if --batch_size is \
+        specified.', type=float, default=1.)
+    parser.add_argument('--forgetting_rate', help='Forgetting rate of the \
+        stochastic variational inference step size schedule. Must be in \
+        (0.5, 1]. Only used if --batch_size is specified.', type=float,
+        default=0.7)
+    parser.add_argument('--num_blocks', help='If specified, incremental \
+        variational EM is used instead of coordinate ascent: subjects are \
+        partitioned into this many blocks, and the trajectory parameters are \
+        updated after each block. In this case --iters is the number of \
+        passes through the data. Cannot be combined with --batch_size.',
+        type=int, default=None)
+    parser.add_argument('--chunksize', help='If specified, the input data is \
+        not loaded into memory. Instead it is read this many rows at a time on \
+        every iteration, and the trajectory assignment probabilities are kept \
+        in a disk-backed file (see --R_file). The input file must be sorted by \
+        the --groupby column, and may be csv or parquet. Cannot be combined \
+        with --repeats, --num_workers, --batch_size or --num_blocks.',
+        type=int, default=None)
+    parser.add_argument('--R_file', help='Only used with --chunksize. File \
+        (.npy) in which to store the trajectory assignment probabilities. The \
+        output model refers to this file rather than containing the \
+        probabilities itself. If not specified, <out_model>.R.npy is used \
+        when --out_model is given, and a temporary file otherwise.', type=str,
+        default=None)
+    parser.add_argument('--coreset_size', help='If specified, the model is \
+        first fit to a weighted subset (coreset) of subjects drawn this many \
+        times with sensitivity sampling, and the result is then refined on the \
+        full data set for --iters iterations. Requires --groupby. Cannot be \
+        combined with --num_workers, --batch_size, --num_blocks or \
+        --chunksize.', type=int, default=None)
+    parser.add_argument('--coreset_iters', help='Number of inference \
+        iterations on the coreset. Only used if --coreset_size is specified.',
+        type=int, default=100)
+    parser.add_argument('--coreset_error', help='If set, a reference model is \
+        also fit to the full data set (for --coreset_iters + --iters \
+        iterations), and the WAIC2 of the coreset solution and of the refined \
+        solution are reported with their relative error with respect to the \
+        WAIC2 of the reference fit. WAIC2 is computed without sampling. This \
+        takes longer than the fit itself. Only used if --coreset_size is \
+        specified.', action='store_true')
+    parser.add_argument('--checkpoint', help='If specified, the state of the \
+        fit is periodically written to this file, as well as when the process \
+        receives SIGINT or SIGTERM. An interrupted fit can be continued with \
+        bayes_traj_refiner --resume. Cannot be combined with --repeats, \
+        --num_workers, --chunksize or --coreset_size.', metavar='<string>',
+        default=None)
+    parser.add_argument('--checkpoint_interval', help='Number of iterations \
+        between checkpoints. Only used if --checkpoint is specified.',
+        type=int, default=10)
 #    parser.add_argument('--use_pyro', help='Use Pyro for inference',
 #        action='store_true')
     
@@ -210,13 +309,30 @@ def main():
     if op.alpha is not None:
         prior_data['alpha'] = float(op.alpha)
 
-    print("Reading data...")
-    df = pd.read_csv(in_csv)
+    if op.checkpoint is not None:
+        assert repeats == 1, "--repeats is not supported with --checkpoint"
+        assert op.chunksize is None and op.coreset_size is None, \
+            "--checkpoint cannot be combined with --chunksize or --coreset_size"
+
+    if op.chunksize is None:
+        print("Reading data...")
+        df = pd.read_csv(in_csv)
     
-    if np.sum(np.isnan(np.sum(df[preds].values, 1))) > 0:
-        print("Warning: identified NaNs in predictor set. \
-        Proceeding with non-NaN data")
-        df = df.dropna(subset=preds).reset_index()
+        if np.sum(np.isnan(np.sum(df[preds].values, 1))) > 0:
+            print("Warning: identified NaNs in predictor set. \
+            Proceeding with non-NaN data")
+            df = df.dropna(subset=preds).reset_index()
+        if op.coreset_size is not None:
+            assert op.groupby is not None, "--coreset_size requires --groupby"
+            assert op.num_workers is None and op.batch_size is None and \
+                op.num_blocks is None, "--coreset_size cannot be combined \
+                with --num_workers, --batch_size or --num_blocks"
+    else:
+        assert op.groupby is not None, "--chunksize requires --groupby"
+        assert repeats == 1, "--repeats is not supported with --chunksize"
+        R_file = op.R_file
+        if R_file is None and op.out_model is not None:
+            R_file = op.out_model + '.R.npy'
         
     #---------------------------------------------------------------------------
     # Set up and run the traj alg
@@ -232,7 +348,8 @@ def main():
     print("Fitting...")
     for r in np.arange(repeats):        
         if r > 0:
-            print(f"---------- Repeat {r}, Best WAIC2: {best_waic2} ----------")
+            print(f"---------- Repeat {r}, Best {op.criterion.upper()}: " + \
+                  f"{best_waic2} ----------")
 
         if True: #not op.use_pyro:
             mm = MultDPRegression(prior_data['w_mu0'],
@@ -245,19 +362,65 @@ def main():
                                   ranef_indices=prior_data['ranef_indices'],
                                   prob_thresh=op.prob_thresh)
 
-            mm.fit(target_names=targets, predictor_names=preds, df=df,
-                   groupby=op.groupby, iters=iters, verbose=op.verbose,
-                   R=prior_data['R'],
-                   traj_probs=prior_data['traj_probs'],
-                   traj_probs_weight=op.probs_weight,
-                   v_a=prior_data['v_a'],
-                   v_b=prior_data['v_b'],
-                   w_mu=prior_data['w_mu'],
-                   w_var=prior_data['w_var'],
-                   lambda_a=prior_data['lambda_a'],
-                   lambda_b=prior_data['lambda_b'],
-                   weights_only=op.weights_only,
-                   num_init_trajs=op.num_init_trajs)
+            if op.chunksize is not None:
+                mm.fit_streaming(in_csv, targets, preds, op.groupby,
+                                 iters=iters, chunksize=op.chunksize,
+                                 R_file=R_file,
+                                 traj_probs=prior_data['traj_probs'],
+                                 traj_probs_weight=op.probs_weight,
+                                 v_a=prior_data['v_a'],
+                                 v_b=prior_data['v_b'],
+                                 w_mu=prior_data['w_mu'],
+                                 w_var=prior_data['w_var'],
+                                 lambda_a=prior_data['lambda_a'],
+                                 lambda_b=prior_data['lambda_b'],
+                                 verbose=op.verbose,
+                                 weights_only=op.weights_only,
+                                 num_init_trajs=op.num_init_trajs)
+            elif op.coreset_size is not None:
+                error_info = fit_coreset(mm, targets, preds, df, op.groupby,
+                    op.coreset_size, coreset_iters=op.coreset_iters,
+                    refine_iters=iters, report_error=op.coreset_error,
+                    verbose=op.verbose,
+                    traj_probs=prior_data['traj_probs'],
+                    traj_probs_weight=op.probs_weight,
+                    v_a=prior_data['v_a'],
+                    v_b=prior_data['v_b'],
+                    w_mu=prior_data['w_mu'],
+                    w_var=prior_data['w_var'],
+                    lambda_a=prior_data['lambda_a'],
+                    lambda_b=prior_data['lambda_b'],
+                    weights_only=op.weights_only,
+                    num_init_trajs=op.num_init_trajs)
+                if error_info is not None:
+                    print("Full-data WAIC2: {:.2f}, coreset WAIC2: {:.2f} \
+(relative error {:.4f}), refined WAIC2: {:.2f} (relative error {:.4f})".\
+                          format(error_info['waic2_full'],
+                                 error_info['waic2_coreset'],
+                                 error_info['rel_error_coreset'],
+                                 error_info['waic2_refined'],
+                                 error_info['rel_error_refined']))
+            else:
+                mm.fit(target_names=targets, predictor_names=preds, df=df,
+                     groupby=op.groupby, iters=iters, verbose=op.verbose,
+                     R=prior_data['R'],
+                     traj_probs=prior_data['traj_probs'],
+                     traj_probs_weight=op.probs_weight,
+                     v_a=prior_data['v_a'],
+                     v_b=prior_data['v_b'],
+                     w_mu=prior_data['w_mu'],
+                     w_var=prior_data['w_var'],
+                     lambda_a=prior_data['lambda_a'],
+                     lambda_b=prior_data['lambda_b'],
+                     weights_only=op.weights_only,
+                     num_init_trajs=op.num_init_trajs,
+                     num_workers=op.num_workers,
+                     batch_size=op.batch_size,
+                     step_delay=op.step_delay,
+                     forgetting_rate=op.forgetting_rate,
+                     num_blocks=op.num_blocks,
+                     checkpoint_file=op.checkpoint,
+                     checkpoint_interval=op.checkpoint_interval)
         else:
             restructured_data = get_restructured_data(df, preds, targets, op.groupby)
             model = MultPyro(
@@ -277,9 +440,28 @@ def main():
         if False: #op.use_pyro:
             pass
         elif r == 0:
+            # Fit metrics are saved with the model, so that downstream tools
+            # need not recompute them. Streaming fits do not hold the data
+            # needed to compute them.
+            if op.chunksize is None:
+                if repeats > 1:
+                    best_waic2 = compute_criterion(mm, op.criterion)
+                elif op.out_model is not None:
+                    get_fit_metrics(mm)
+
             if op.out_model is not None:
                 print("Saving model...")
-                pickle.dump({'MultDPRegression': mm}, open(op.out_model, 'wb'))
+                if op.chunksize is not None:
+                    # The responsibilities stay in R_file rather than being
+                    # pulled into memory for pickling
+                    R = mm.R_
+                    mm.R_ = None
+                    save_model(mm, op.out_model)
+                    mm.R_ = R
+                    print("Trajectory assignment probabilities are in " + \
+                          mm.R_file_)
+                else:
+                    save_model(mm, op.out_model)
 
                 print("Saving model provenance info...")
                 provenance_desc = """ """
@@ -289,26 +471,26 @@ def main():
 
             if op.out_csv is not None:
                 print("Saving data file with trajectory info...")
-                mm.to_df().to_csv(op.out_csv, index=False)
+                if op.chunksize is not None:
+                    mm.to_csv_streaming(in_csv, op.out_csv, op.groupby,
+                                        chunksize=op.chunksize)
+                else:
+                    mm.to_df().to_csv(op.out_csv, index=False)
 
                 print("Saving data file provenance info...")
                 provenance_desc = """ """
                 write_provenance_data(op.out_csv, generator_args=op,
                                       desc=provenance_desc,
                                       module_name='bayes_traj')
-                
-            if repeats > 1:
-                best_waic2 = compute_waic2(mm)
         else:
-            waic2 = compute_waic2(mm)
-            print(f"Current WAIC2: {waic2}")
+            waic2 = compute_criterion(mm, op.criterion)
+            print(f"Current {op.criterion.upper()}: {waic2}")
             if waic2 < best_waic2:
                 best_waic2 = waic2
         
                 if op.out_model is not None:
                     print("Saving model...")
-                    pickle.dump({'MultDPRegression': mm},
-                                open(op.out_model, 'wb'))
+                    save_model(mm, op.out_model)
     
                     print("Saving model provenance info...")
                     provenance_desc = """ """
@@ -1,44 +1,74 @@
+#!/usr/bin/env python
+
 from argparse import ArgumentParser
 import numpy as np
 from bayes_traj.mult_dp_regression import MultDPRegression
-from bayes_traj.get_longitudinal_constraints_graph \
-  import get_longitudinal_constraints_graph
-#from bayes_traj.get_constraints_graph import get_constraints_graph
-from provenance_tools.provenance_tracker import write_provenance_data
-import pdb, pickle, sys, git, os
-
-np.set_printoptions(precision = 1, suppress = True, threshold=1e6,
-                    linewidth=300)
-
-desc = """Reads an instance of MultDPRegression and performs additional \
-iterations in order to refine the model"""
-
-parser = ArgumentParser(description=desc)
-parser.add_argument('--in_p', help='Input pickle file containing instance of \
-  MultDPRegression to refine', dest='in_p', metavar='<string>', default=None)
-parser.add_argument('--out_file', help='Pickle file name to which to dump the \
-  refined instance of MultDPRegression', dest='out_file', metavar='<string>',
-  default=None)
-parser.add_argument('--iters', help='Number of iterations to refine',
-    dest='iters', metavar='<int>', default=100)
-
-op = parser.parse_args()
-iters = int(op.iters)
-in_p = op.in_p
-out_file = op.out_file
-
-mm = pickle.load(open(in_p, 'rb'))['MultDPRegression']
-
-#------------------------------------------------------------------------------
-# Set up and run the traj alg
-#------------------------------------------------------------------------------
-mm.fit(mm.X_, mm.Y_, iters=iters, R=mm.R_, v_a=mm.v_a_, v_b=mm.v_b_,
-  w_mu=mm.w_mu_, w_var=mm.w_var_, lambda_a=mm.lambda_a_, lambda_b=mm.lambda_b_,
-  constraints=mm.constraints_, data_names=mm.data_names_,
-  target_names=mm.target_names_, predictor_names=mm.predictor_names_,
-  verbose=True)
-
-with open(out_file, 'wb') as f:
-    pickle.dump({'MultDPRegression': mm}, f)
-
-write_provenance_data(out_file, generator_args=op)
+from bayes_traj.model_registry import load_model
+from bayes_traj.model_io import save_model
+from provenance_tools.write_provenance_data import write_provenance_data
+import pdb, pickle, sys
+
+def main():
+    """
+    """
+    np.set_printoptions(precision = 1, suppress = True, threshold=1e6,
+                        linewidth=300)
+
+    desc = """Reads an instance of MultDPRegression and performs additional \
+    iterations in order to refine the model. Alternatively, continues an \
+    interrupted fit from a checkpoint file (see the --checkpoint option of \
+    bayes_traj_main)."""
+
+    parser = ArgumentParser(description=desc)
+    parser.add_argument('--in_model', help='Input pickle file containing \
+        instance of MultDPRegression to refine, or checkpoint file if \
+        --resume is set', metavar='<string>', required=True)
+    parser.add_argument('--out_model', help='File name to which to save \
+        the refined instance of MultDPRegression. Files with a .p, .pkl or \
+        .pickle extension are pickled; other files use the bayes_traj model \
+        format (see bayes_traj.model_io).', metavar='<string>', default=None)
+    parser.add_argument('--iters', help='Number of iterations to refine. \
+        Ignored if --resume is set: a resumed fit runs to the number of \
+        iterations it was started with.', metavar='<int>', type=int,
+        default=100)
+    parser.add_argument('--resume', help='Treat --in_model as a checkpoint \
+        file and continue the fit that was in progress when it was written, \
+        with the settings it was started with.', action='store_true')
+    parser.add_argument('--checkpoint', help='If specified, the state of the \
+        fit is periodically written to this file, as well as when the process \
+        receives SIGINT or SIGTERM. The fit can then be continued with \
+        --resume. When resuming, defaults to the checkpoint file of the \
+        original fit.', metavar='<string>', default=None)
+    parser.add_argument('--checkpoint_interval', help='Number of iterations \
+        between checkpoints', metavar='<int>', type=int, default=10)
+    parser.add_argument("--verbose", help="Display per-trajectory counts \
+        during optimization", action="store_true")
+
+    op = parser.parse_args()
+
+    print("Reading model...")
+    mm = load_model(op.in_model, cache=False)
+
+    if op.resume:
+        print("Resuming fit...")
+        mm.fit(resume_from=op.in_model, checkpoint_file=op.checkpoint,
+               checkpoint_interval=op.checkpoint_interval)
+    else:
+        print("Refining...")
+        mm.refine(op.iters, verbose=op.verbose, checkpoint_file=op.checkpoint,
+                  checkpoint_interval=op.checkpoint_interval)
+
+    if op.out_model is not None:
+        print("Saving model...")
+        save_model(mm, op.out_model)
+
+        print("Saving model provenance info...")
+        provenance_desc = """ """
+        write_provenance_data(op.out_model, generator_args=op,
+                              desc=provenance_desc,
+                              module_name='bayes_traj')
+
+    print("DONE.")
+
+if __name__ == "__main__":
+    main()
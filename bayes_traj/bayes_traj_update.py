@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+from argparse import ArgumentParser
+import numpy as np
+import pandas as pd
+from bayes_traj.mult_dp_regression import MultDPRegression
+from bayes_traj.model_registry import load_model
+from bayes_traj.model_io import save_model
+from provenance_tools.write_provenance_data import write_provenance_data
+import pdb, pickle, sys
+
+def main():
+    """
+    """
+    np.set_printoptions(precision = 1, suppress = True, threshold=1e6,
+                        linewidth=300)
+
+    desc = """Adds new data -- visits of new subjects and/or new visits of \
+    subjects already in the model -- to a fitted model, and runs a few \
+    warm-started iterations in which only the subjects that appear in the new \
+    data are revisited."""
+
+    parser = ArgumentParser(description=desc)
+    parser.add_argument('--in_model', help='Input pickle file containing \
+        fitted instance of MultDPRegression', metavar='<string>',
+        required=True)
+    parser.add_argument('--in_csv', help='Input csv file containing the new \
+        data. Must contain the predictor and target columns used to fit the \
+        model, as well as the groupby column if one was used. Rows that are \
+        already in the model must not be repeated.', metavar='<string>',
+        required=True)
+    parser.add_argument('--out_model', help='File name to which to save \
+        the updated instance of MultDPRegression. Files with a .p, .pkl or \
+        .pickle extension are pickled; other files use the bayes_traj model \
+        format (see bayes_traj.model_io).', metavar='<string>', default=None)
+    parser.add_argument('--out_csv', help='If specified, an output csv file \
+        will be generated that contains all the data in the updated model \
+        together with trajectory assignments and trajectory probabilities',
+        metavar='<string>', default=None)
+    parser.add_argument('--iters', help='Number of update iterations',
+        metavar='<int>', type=int, default=5)
+    parser.add_argument("--verbose", help="Display per-trajectory counts \
+        during optimization", action="store_true")
+
+    op = parser.parse_args()
+
+    print("Reading model...")
+    mm = load_model(op.in_model, cache=False)
+
+    print("Reading data...")
+    df_new = pd.read_csv(op.in_csv)
+    if np.sum(np.isnan(np.sum(df_new[mm.predictor_names_].values, 1))) > 0:
+        print("Warning: identified NaNs in predictor set. \
+        Proceeding with non-NaN data")
+        df_new = df_new.dropna(subset=mm.predictor_names_).\
+            reset_index(drop=True)
+
+    print("Updating...")
+    mm.update(df_new, iters=op.iters, verbose=op.verbose)
+
+    if op.out_model is not None:
+        print("Saving model...")
+        save_model(mm, op.out_model)
+
+        print("Saving model provenance info...")
+        provenance_desc = """ """
+        write_provenance_data(op.out_model, generator_args=op,
+                              desc=provenance_desc,
+                              module_name='bayes_traj')
+
+    if op.out_csv is not None:
+        print("Saving data file with trajectory info...")
+        mm.to_df().to_csv(op.out_csv, index=False)
+
+        print("Saving data file provenance info...")
+        provenance_desc = """ """
+        write_provenance_data(op.out_csv, generator_args=op,
+                              desc=provenance_desc,
+                              module_name='bayes_traj')
+
+    print("DONE.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+
+from argparse import ArgumentParser
+import numpy as np
+import pandas as pd
+import torch
+from bayes_traj.model_registry import read_model_file
+from bayes_traj.model_io import is_model_file, PICKLE_EXTENSIONS
+from bayes_traj.fit_stats import FitStatistics, get_fit_metrics, get_looic
+from provenance_tools.write_provenance_data import write_provenance_data
+from concurrent.futures import ProcessPoolExecutor
+import pdb, os, glob
+
+def get_model_files(paths):
+    """Lists the model files given by directories, glob patterns and file
+    names. Directories contribute the files they contain (not recursively)
+    that are in the bayes_traj model format or have a pickle extension.
+
+    Parameters
+    ----------
+    paths : list of str
+        Directories, glob patterns or file names.
+
+    Returns
+    -------
+    model_files : list of str
+        Sorted model file names, without duplicates.
+    """
+    model_files = set()
+    for pp in paths:
+        if os.path.isdir(pp):
+            for ff in os.listdir(pp):
+                ff = os.path.join(pp, ff)
+                if os.path.isfile(ff) and \
+                   (os.path.splitext(ff)[1].lower() in PICKLE_EXTENSIONS or \
+                    is_model_file(ff)):
+                    model_files.add(ff)
+        else:
+            matches = glob.glob(pp)
+            if len(matches) == 0:
+                raise RuntimeError("No files match " + pp)
+            model_files.update([ff for ff in matches if os.path.isfile(ff)])
+
+    return sorted(model_files)
+
+
+def _init_worker(num_threads):
+    """Limits the number of threads each worker process uses, so that the
+    workers do not oversubscribe the CPUs.
+    """
+    torch.set_num_threads(num_threads)
+
+
+def score_model_file(file_name, loo=False, S=1000, seed=None,
+                     refresh=False):
+    """Reads a model file and collects the statistics used to compare models.
+    Fit metrics saved with the model (see bayes_traj.fit_stats.get_fit_metrics)
+    are used if they are current; otherwise they are computed.
+
+    Parameters
+    ----------
+    file_name : str
+        Model file name.
+
+    loo : bool, optional
+        If true, subject-level PSIS-LOO is included.
+
+    S : int, optional
+        Number of posterior draws used to compute PSIS-LOO.
+
+    seed : int, optional
+        Random seed for the PSIS-LOO draws.
+
+    refresh : bool, optional
+        If true, the metrics are recomputed even if current ones are saved
+        with the model.
+
+    Returns
+    -------
+    row : dict
+        Statistics of the model, keyed by column name (see
+        'compare_models'). If the model could not be scored, only 'model'
+        and 'error' are set.
+    """
+    row = {'model': file_name}
+    try:
+        mm = read_model_file(file_name)
+        stored = getattr(mm, 'fit_metrics_', None)
+        metrics = get_fit_metrics(mm, refresh=refresh)
+        stats = FitStatistics(mm)
+
+        bic = metrics['bic']
+        ave_pps = np.array(list(metrics['ave_pp'].values()), dtype=float)
+        occs = np.array(list(metrics['occ'].values()), dtype=float)
+
+        row.update({'num_trajs': int(np.sum(np.asarray(mm.sig_trajs_))),
+            'num_groups': stats.num_units_,
+            'waic2': metrics['waic2']['value'],
+            'waic2_se': metrics['waic2']['pointwise_se'],
+            'bic_obs': bic[0],
+            'bic_groups': bic[1] if len(bic) > 1 else np.nan,
+            'min_ave_pp': np.nanmin(ave_pps) if np.any(~np.isnan(ave_pps)) \
+                else np.nan,
+            'min_occ': np.nanmin(occs) if np.any(~np.isnan(occs)) \
+                else np.nan,
+            'iters': metrics['iters'],
+            'wall_time': metrics['wall_time'],
+            'stored_metrics': stored is not None and metrics is stored})
+
+        if loo:
+            looic = get_looic(mm, refresh=refresh, S=S, seed=seed)
+            row.update({'looic': looic['value'], 'looic_se': looic['se'],
+                        'num_bad_k': looic['num_bad_k']})
+    except Exception as e:
+        row['error'] = '{}: {}'.format(type(e).__name__, e)
+
+    return row
+
+
+def compare_models(model_files, num_workers=1, loo=False, S=1000, seed=None,
+                   refresh=False, sort_by=None, ascending=True, query=None):
+    """Scores trajectory models and tabulates the statistics used to compare
+    them, one row per model.
+
+    Parameters
+    ----------
+    model_files : list of str
+        Model file names (see 'get_model_files').
+
+    num_workers : int, optional
+        Number of worker processes. If 1, the models are scored in this
+        process.
+
+    loo, S, seed, refresh
+        See 'score_model_file'.
+
+    sort_by : str, optional
+        Column to sort the table by. By default, the table is sorted by
+        WAIC2 (or by LOOIC, if 'loo' is true).
+
+    ascending : bool, optional
+        Sort order.
+
+    query : str, optional
+        If specified, only the rows satisfying this pandas query expression
+        (e.g. 'num_trajs <= 6 and min_ave_pp > 0.7') are kept.
+
+    Returns
+    -------
+    df : pandas DataFrame
+        Columns 'model' (file name); 'num_trajs' and 'num_groups' (number of
+        trajectories and of subjects); 'waic2' and 'waic2_se' (WAIC2 and its
+        standard error across subjects, computed as for LOOIC); 'looic',
+        'looic_se' and 'num_bad_k' (if 'loo' is true: LOOIC, its standard
+        error across subjects and the number of subjects with Pareto
+        k > 0.7); 'bic_obs' and 'bic_groups' (see
+        MultDPRegression.bic); 'min_ave_pp' and 'min_occ' (smallest average
+        posterior probability of assignment and odds of correct
+        classification over trajectories); 'iters' and 'wall_time' (number
+        of iterations and time in seconds of the fit, if recorded);
+        'stored_metrics' (whether the metrics saved with the model were
+        used); and 'error' (why a model could not be scored, if any could
+        not).
+    """
+    args = [(ff, loo, S, seed, refresh) for ff in model_files]
+    if num_workers <= 1:
+        rows = [score_model_file(*aa) for aa in args]
+    else:
+        num_threads = max(1, (os.cpu_count() or 1)//num_workers)
+        with ProcessPoolExecutor(num_workers, initializer=_init_worker,
+                                 initargs=(num_threads,)) as pool:
+            rows = list(pool.map(score_model_file, *zip(*args)))
+
+    columns = ['model', 'num_trajs', 'num_groups', 'waic2', 'waic2_se'] + \
+        (['looic', 'looic_se', 'num_bad_k'] if loo else []) + \
+        ['bic_obs', 'bic_groups', 'min_ave_pp', 'min_occ', 'iters',
+         'wall_time', 'stored_metrics']
+    if any(['error' in rr for rr in rows]):
+        columns.append('error')
+    df = pd.DataFrame(rows, columns=columns)
+
+    if query is not None:
+        df = df.query(query)
+
+    if sort_by is None:
+        sort_by = 'looic' if loo else 'waic2'
+    assert sort_by in df.columns, "Unknown column: {}".format(sort_by)
+
+    return df.sort_values(sort_by, ascending=ascending, na_position='last').\
+        reset_index(drop=True)
+
+
+def main():
+    """
+    """
+    desc = """Compares trajectory models, e.g. those of a sweep over priors \
+    or settings, and writes a table with one row per model: the number of \
+    trajectories, WAIC2, optionally PSIS-LOO (as LOOIC), with standard \
+    errors, BIC, the smallest average posterior probability of assignment \
+    and odds of correct classification across trajectories, and fit time. \
+    Fit metrics saved with the models (by bayes_traj_main) are used when \
+    current; otherwise they are computed. Models are scored in parallel \
+    worker processes."""
+
+    parser = ArgumentParser(description=desc)
+    parser.add_argument('--models', help='Model files, directories holding \
+        model files, or glob patterns (quote them to prevent shell \
+        expansion)', type=str, nargs='+', required=True)
+    parser.add_argument('--num_workers', help='Number of worker processes',
+        type=int, default=1)
+    parser.add_argument('--loo', help='Include subject-level PSIS-LOO (as \
+        LOOIC, on the scale of WAIC2). It is computed for models whose saved \
+        metrics do not include it, which takes longer than the other \
+        statistics.', action='store_true')
+    parser.add_argument('--S', help='Number of posterior draws used to \
+        compute PSIS-LOO', type=int, default=1000)
+    parser.add_argument('--seed', help='Random seed for the PSIS-LOO draws',
+        type=int, default=None)
+    parser.add_argument('--refresh', help='Recompute all statistics, even if \
+        current ones are saved with the models', action='store_true')
+    parser.add_argument('--sort_by', help='Column to sort by. Defaults to \
+        waic2, or looic if --loo is specified.', type=str, default=None)
+    parser.add_argument('--descending', help='Sort in descending order',
+        action='store_true')
+    parser.add_argument('--query', help='Only list models satisfying this \
+        pandas query expression over the table columns, e.g. "num_trajs <= 6 \
+        and min_ave_pp > 0.7"', type=str, default=None)
+    parser.add_argument('--top', help='Only list this many models (after \
+        sorting)', type=int, default=None)
+    parser.add_argument('--out_csv', help='If specified, the table is written \
+        to this csv file', type=str, default=None)
+
+    op = parser.parse_args()
+
+    model_files = get_model_files(op.models)
+    print("Scoring {} models...".format(len(model_files)))
+    df = compare_models(model_files, op.num_workers, op.loo, op.S, op.seed,
+                        op.refresh, op.sort_by, not op.descending, op.query)
+    if op.top is not None:
+        df = df.head(op.top)
+
+    with pd.option_context('display.max_rows', None, 'display.max_columns',
+                           None, 'display.width', None):
+        print(df.to_string(index=False))
+
+    if op.out_csv is not None:
+        print("Saving table...")
+        df.to_csv(op.out_csv, index=False)
+
+        print("Saving table provenance info...")
+        provenance_desc = """ """
+        write_provenance_data(op.out_csv, generator_args=op,
+                              desc=provenance_desc,
+                              module_name='bayes_traj')
+
+    print("DONE.")
+
+if __name__ == "__main__":
+    main()
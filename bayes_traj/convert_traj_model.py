@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+
+from argparse import ArgumentParser
+from bayes_traj.model_registry import load_model
+from bayes_traj.model_io import save_model
+from provenance_tools.write_provenance_data import write_provenance_data
+import pdb, sys
+
+def main():
+    """
+    """
+    desc = """Converts a trajectory model between the bayes_traj model format \
+    (see bayes_traj.model_io) and pickle files. Model files written by earlier \
+    versions of bayes_traj are pickle files; converting them to the model \
+    format gives files that are smaller, faster to load, and independent of \
+    the pandas version."""
+
+    parser = ArgumentParser(description=desc)
+    parser.add_argument('--in_model', help='Input model file, in either \
+        format', metavar='<string>', required=True)
+    parser.add_argument('--out_model', help='Output model file',
+        metavar='<string>', required=True)
+    parser.add_argument('--format', help='Output format. By default, files \
+        with a .p, .pkl or .pickle extension are pickled, and other files use \
+        the model format.', choices=['model', 'pickle'], default=None)
+
+    op = parser.parse_args()
+
+    print("Reading model...")
+    mm = load_model(op.in_model, cache=False)
+
+    print("Saving model...")
+    save_model(mm, op.out_model, op.format)
+
+    print("Saving model provenance info...")
+    provenance_desc = """ """
+    write_provenance_data(op.out_model, generator_args=op,
+                          desc=provenance_desc,
+                          module_name='bayes_traj')
+
+    print("DONE.")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+import torch
+import numpy as np
+import pandas as pd
+import pdb, copy
+
+def get_subject_coefficients(df, target_names, predictor_names, groupby,
+                             ridge=1e-3):
+    """Computes per-subject least squares regression coefficients for each
+    target variable. A small ridge penalty keeps the problem well posed for
+    subjects with fewer non-NaN observations than predictors. All subjects
+    are solved at once from groupby-summed cross products.
+
+    Parameters
+    ----------
+    df : pandas dataframe
+        Data frame containing predictor, target, and group information.
+
+    target_names : list of strings
+        Data frame column names of the target variables.
+
+    predictor_names : list of strings
+        Data frame column names of the predictors
+
+    groupby : str
+        Data frame column name used to group data instances.
+
+    ridge : float, optional
+        Ridge penalty added to the diagonal of each subject's normal equations.
+
+    Returns
+    -------
+    keys : array, shape ( G )
+        Sorted group keys.
+
+    coefs : array, shape ( G, M*D )
+        Row g holds the coefficients of subject keys[g], target by target.
+    """
+    keys, codes = np.unique(df[groupby].values, return_inverse=True)
+    G = keys.shape[0]
+    M = len(predictor_names)
+    D = len(target_names)
+
+    X = df[predictor_names].values.astype(float)
+    XX = X[:, :, None]*X[:, None, :]
+
+    coefs = np.zeros([G, M*D])
+    for d, target in enumerate(target_names):
+        y = df[target].values.astype(float)
+        ids = ~np.isnan(y)
+
+        XX_g = np.zeros([G, M, M])
+        np.add.at(XX_g, codes[ids], XX[ids])
+        XY_g = np.zeros([G, M])
+        np.add.at(XY_g, codes[ids], X[ids]*y[ids, None])
+
+        XX_g += ridge*np.eye(M)[None, :, :]
+        coefs[:, d*M:(d+1)*M] = \
+            np.linalg.solve(XX_g, XY_g[:, :, None])[:, :, 0]
+
+    return keys, coefs
+
+
+def build_coreset(df, target_names, predictor_names, groupby, coreset_size,
+                  seed=None):
+    """Builds a weighted subset of subjects using lightweight sensitivity
+    sampling on per-subject regression coefficients. Each subject is
+    summarized by its (standardized) least squares coefficients, and is
+    sampled with probability
+
+        q_g = 1/(2G) + d_g^2/(2 sum_g' d_g'^2),
+
+    where d_g is the distance of subject g from the mean coefficient vector.
+    Subjects that lie far from the bulk of the data -- and so are likely to
+    define small trajectory subgroups -- are thereby over-sampled, and the
+    weights 1/(m q_g) correct for it.
+
+    Parameters
+    ----------
+    df : pandas dataframe
+        Data frame containing predictor, target, and group information.
+
+    target_names : list of strings
+        Data frame column names of the target variables.
+
+    predictor_names : list of strings
+        Data frame column names of the predictors
+
+    groupby : str
+        Data frame column name used to group data instances.
+
+    coreset_size : int
+        Number of subjects to draw (with replacement). Subjects drawn more
+        than once appear once in the coreset, with their weights summed.
+
+    seed : int, optional
+        Seed of the random number generator used for sampling.
+
+    Returns
+    -------
+    df_coreset : pandas dataframe
+        The rows of 'df' belonging to the sampled subjects, with a new
+        RangeIndex.
+
+    weights : array, shape ( N_coreset )
+        The weight of the subject each row of 'df_coreset' belongs to.
+
+    References
+    ----------
+    Bachem O, Lucic M, Krause A. Scalable k-means clustering via lightweight
+    coresets. KDD 2018.
+    """
+    assert groupby is not None, "Coreset construction requires groupby"
+    assert coreset_size > 0, "coreset_size must be positive"
+
+    keys, coefs = get_subject_coefficients(df, target_names, predictor_names,
+                                           groupby)
+    G = keys.shape[0]
+
+    std = np.std(coefs, 0)
+    std[std == 0] = 1
+    coefs = (coefs - np.mean(coefs, 0))/std
+    dists = np.sum(coefs**2, 1)
+
+    if np.sum(dists) > 0:
+        q = 0.5/G + 0.5*dists/np.sum(dists)
+    else:
+        q = np.ones(G)/G
+
+    rng = np.random.default_rng(seed)
+    draws = rng.choice(G, size=coreset_size, replace=True, p=q)
+    sampled, counts = np.unique(draws, return_counts=True)
+    subject_weights = pd.Series(counts/(coreset_size*q[sampled]),
+                                index=keys[sampled])
+
+    df_coreset = df[df[groupby].isin(keys[sampled])].reset_index(drop=True)
+    weights = subject_weights.loc[df_coreset[groupby].values].values
+
+    return df_coreset, weights
+
+
+def fit_coreset(mm, target_names, predictor_names, df, groupby, coreset_size,
+                coreset_iters=100, refine_iters=10, report_error=False,
+                seed=None, verbose=False, **kwargs):
+    """Fits a MultDPRegression model to a weighted coreset of subjects, then
+    uses the result to warm-start a short coordinate ascent refinement on the
+    full data set.
+
+    Parameters
+    ----------
+    mm : MultDPRegression
+        Model instance to fit. Updated in place.
+
+    target_names : list of strings
+        Data frame column names of the target variables.
+
+    predictor_names : list of strings
+        Data frame column names of the predictors
+
+    df : pandas dataframe
+        Data frame containing predictor, target, and group information.
+
+    groupby : str
+        Data frame column name used to group data instances.
+
+    coreset_size : int
+        Number of subject draws used to build the coreset. See
+        'build_coreset'.
+
+    coreset_iters : int, optional
+        Number of inference iterations on the coreset.
+
+    refine_iters : int, optional
+        Number of coordinate ascent iterations on the full data set.
+
+    report_error : bool, optional
+        If true, a reference model is fit to the full data set with the same
+        prior and options, for 'coreset_iters' + 'refine_iters' iterations,
+        and the WAIC2 of the coreset solution and of the refined solution are
+        compared with that of the reference fit. WAIC2 is computed without
+        sampling (see MultDPRegression.compute_waic2), so the differences are
+        not Monte Carlo noise. This requires a full-data fit in addition to
+        the coreset fit, and is meant for assessing the approximation.
+
+    seed : int, optional
+        Seed used for coreset sampling.
+
+    verbose : bool, optional
+        Passed on to the fitting routines.
+
+    kwargs : dict
+        Remaining keyword arguments of MultDPRegression.fit used for the
+        coreset fit (traj_probs, v_a, w_mu, num_init_trajs, etc.).
+
+    Returns
+    -------
+    error_info : dict or None
+        If 'report_error' is true, a dictionary with keys 'waic2_full',
+        'waic2_coreset' and 'waic2_refined' (the WAIC2 of the reference
+        full-data fit, of the coreset solution and of the refined solution,
+        all on the full data set), and 'rel_error_coreset' and
+        'rel_error_refined' (the relative differences of the latter two from
+        'waic2_full'). None otherwise.
+    """
+    if report_error:
+        # The reference fit does not affect the random state of the coreset
+        # fit
+        mm_full = copy.deepcopy(mm)
+        np_state = np.random.get_state()
+        with torch.random.fork_rng(devices=[]):
+            print("Fitting full data for reference...")
+            mm_full.fit(target_names=target_names,
+                        predictor_names=predictor_names, df=df,
+                        groupby=groupby, iters=coreset_iters + refine_iters,
+                        verbose=verbose, **kwargs)
+        np.random.set_state(np_state)
+        waic2_full = float(mm_full.compute_waic2(method='analytic'))
+
+    df_coreset, weights = build_coreset(df, target_names, predictor_names,
+                                        groupby, coreset_size, seed)
+    print("Fitting coreset of {} subjects...".\
+          format(df_coreset[groupby].unique().shape[0]))
+    mm.fit(target_names=target_names, predictor_names=predictor_names,
+           df=df_coreset, groupby=groupby, iters=coreset_iters,
+           verbose=verbose, subject_weights=weights, **kwargs)
+
+    # Assign the full data set with the coreset solution, and use it to
+    # initialize the full-data fit
+    df = df.reset_index(drop=True)
+    R = mm.get_R_matrix(df=df, gb_col=groupby)
+    if torch.is_tensor(R):
+        R = R.numpy()
+
+    print("Refining on full data...")
+    mm.fit(target_names=target_names, predictor_names=predictor_names, df=df,
+           groupby=groupby, iters=0, R=R, traj_probs=mm.get_traj_probs(),
+           v_a=mm.v_a_, v_b=mm.v_b_, w_mu=mm.w_mu_.numpy(),
+           w_var=mm.w_var_.numpy(), lambda_a=mm.lambda_a_.numpy(),
+           lambda_b=mm.lambda_b_.numpy(), verbose=verbose,
+           weights_only=kwargs.get('weights_only', False))
+
+    error_info = None
+    if report_error:
+        waic2_coreset = float(mm.compute_waic2(method='analytic'))
+
+    mm.fit_coordinate_ascent(refine_iters, verbose,
+                             kwargs.get('weights_only', False))
+
+    if report_error:
+        waic2_refined = float(mm.compute_waic2(method='analytic'))
+        error_info = {'waic2_full': waic2_full,
+                      'waic2_coreset': waic2_coreset,
+                      'waic2_refined': waic2_refined,
+                      'rel_error_coreset': np.abs(waic2_coreset - \
+                          waic2_full)/np.abs(waic2_full),
+                      'rel_error_refined': np.abs(waic2_refined - \
+                          waic2_full)/np.abs(waic2_full)}
+
+    return error_info
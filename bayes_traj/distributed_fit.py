@@ -0,0 +1,180 @@
+import torch
+import torch.distributed
+import torch.multiprocessing
+import numpy as np
+import pandas as pd
+import os, pickle, tempfile
+import pdb
+
+def shard_groups(df, groupby, num_workers):
+    """Partitions the subjects (groups) in a data frame into contiguous blocks
+    of sorted group keys with approximately equal numbers of data instances.
+    Because the blocks are contiguous in sorted key order, concatenating
+    per-shard group quantities in shard order reproduces the group ordering
+    of a pandas groupby over the full data frame.
+
+    Parameters
+    ----------
+    df : pandas dataframe
+        Data frame containing the data to shard.
+
+    groupby : str
+        Data frame column name used to group data instances.
+
+    num_workers : int
+        Number of shards to produce.
+
+    Returns
+    -------
+    row_ids : list of arrays
+        For each shard, the (positional) row indices of 'df' that belong to
+        that shard.
+    """
+    assert groupby is not None, "Distributed fitting requires groupby"
+
+    keys, counts = np.unique(df[groupby].values, return_counts=True)
+    assert keys.shape[0] >= num_workers, \
+        "Fewer groups than workers"
+
+    # Cut the cumulative instance count into num_workers equal pieces, making
+    # sure that every shard gets at least one group
+    cum_counts = np.cumsum(counts)
+    cuts = np.searchsorted(cum_counts, cum_counts[-1]*\
+                           np.arange(1, num_workers)/num_workers)
+    cuts = np.maximum(cuts, np.arange(1, num_workers))
+    cuts = np.minimum(cuts, keys.shape[0] - np.arange(num_workers - 1, 0, -1))
+    cuts = np.maximum.accumulate(cuts)
+
+    row_ids = []
+    for shard_keys in np.split(keys, cuts):
+        row_ids.append(np.where(df[groupby].isin(shard_keys).values)[0])
+
+    return row_ids
+
+
+def _worker(rank, num_workers, tmp_dir):
+    """Entry point of each worker process. Joins the process group, fits the
+    model to the worker's shard and writes the resulting state to 'tmp_dir'.
+    """
+    torch.set_num_threads(max(1, (os.cpu_count() or 1)//num_workers))
+    torch.distributed.init_process_group('gloo',
+        init_method='file://' + os.path.join(tmp_dir, 'init'),
+        rank=rank, world_size=num_workers)
+    try:
+        with open(os.path.join(tmp_dir, 'job.p'), 'rb') as f:
+            job = pickle.load(f)
+        with open(os.path.join(tmp_dir, 'shard_{}.p'.format(rank)), 'rb') as f:
+            shard = pickle.load(f)
+
+        mm = job['mm']
+        fit_kwargs = job['fit_kwargs']
+        fit_kwargs['df'] = shard['df']
+        fit_kwargs['R'] = shard['R']
+        fit_kwargs['subject_weights'] = shard['subject_weights']
+        mm.fit(**fit_kwargs)
+
+        state = {'R_': mm.R_, 'xi_': mm.xi_, 'u_mu_': mm.u_mu_,
+                 'u_Sig_': mm.u_Sig_}
+        if rank == 0:
+            for kk in ['v_a_', 'v_b_', 'w_mu_', 'w_var_', 'w_covmat_',
+                       'lambda_a_', 'lambda_b_', 'sig_trajs_']:
+                state[kk] = getattr(mm, kk)
+        torch.save(state, os.path.join(tmp_dir, 'state_{}.pt'.format(rank)))
+    finally:
+        torch.distributed.destroy_process_group()
+
+
+def fit_distributed(mm, num_workers, target_names, predictor_names, df,
+                    groupby, R=None, subject_weights=None, **kwargs):
+    """Fits a MultDPRegression model with coordinate ascent, sharding subjects
+    across 'num_workers' local processes. Each worker computes the
+    responsibilities (and, for binary targets and random effects, the
+    associated local variational parameters) of its own subjects. The global
+    updates of v, w and lambda are formed from sufficient statistics that are
+    all-reduced across workers with the gloo backend, so every worker holds
+    identical global parameters throughout. On return, 'mm' is in the same
+    state as it would be after a single-process call to 'fit'.
+
+    Parameters
+    ----------
+    mm : MultDPRegression
+        Model instance to fit. Updated in place.
+
+    num_workers : int
+        Number of worker processes.
+
+    target_names : list of strings
+        Data frame column names of the target variables.
+
+    predictor_names : list of strings
+        Data frame column names of the predictors
+
+    df : pandas dataframe
+        Data frame containing predictor, target, and group information.
+
+    groupby : str
+        Data frame column name used to group data instances. Subjects are
+        sharded by group, so all instances of a group land on one worker.
+
+    R : array, shape ( N, K ), optional
+        Initial responsibility matrix. Rows are sharded along with the data.
+
+    subject_weights : array, shape ( N ), optional
+        Per-instance subject weights. Sharded along with the data.
+
+    kwargs : dict
+        Remaining keyword arguments of MultDPRegression.fit (iters,
+        traj_probs, v_a, w_mu, verbose, etc.).
+    """
+    row_ids = shard_groups(df, groupby, num_workers)
+
+    fit_kwargs = dict(kwargs)
+    fit_kwargs.update({'target_names': target_names,
+                       'predictor_names': predictor_names,
+                       'groupby': groupby, 'num_workers': None})
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        with open(os.path.join(tmp_dir, 'job.p'), 'wb') as f:
+            pickle.dump({'mm': mm, 'fit_kwargs': fit_kwargs}, f)
+        for rank, ids in enumerate(row_ids):
+            shard = {'df': df.iloc[ids].reset_index(drop=True),
+                     'R': R[ids, :] if R is not None else None,
+                     'subject_weights': np.asarray(subject_weights)[ids] \
+                     if subject_weights is not None else None}
+            with open(os.path.join(tmp_dir, 'shard_{}.p'.format(rank)),
+                      'wb') as f:
+                pickle.dump(shard, f)
+
+        torch.multiprocessing.spawn(_worker, args=(num_workers, tmp_dir),
+                                    nprocs=num_workers, join=True)
+
+        states = [torch.load(os.path.join(tmp_dir, 'state_{}.pt'.format(rr)),
+                             weights_only=False) \
+                  for rr in range(num_workers)]
+
+    # Rebuild the data-dependent members over the full data set, then stitch
+    # the per-shard local parameters back together
+    mm._init_data(target_names, predictor_names, df, groupby)
+    mm.subject_weights_ = None
+    if subject_weights is not None:
+        mm.subject_weights_ = \
+            torch.as_tensor(np.asarray(subject_weights, dtype=float))
+    for kk in ['v_a_', 'v_b_', 'w_mu_', 'w_var_', 'w_covmat_', 'lambda_a_',
+               'lambda_b_', 'sig_trajs_']:
+        setattr(mm, kk, states[0][kk])
+    mm.lambda_a0_mod_ = mm.lambda_a0_*mm.prec_prior_weight_
+    mm.lambda_b0_mod_ = mm.lambda_b0_*mm.prec_prior_weight_
+
+    mm.R_ = torch.zeros([mm.N_, mm.K_], dtype=torch.float64)
+    for ids, state in zip(row_ids, states):
+        mm.R_[ids, :] = state['R_']
+
+    mm.xi_ = None
+    if states[0]['xi_'] is not None:
+        mm.xi_ = torch.zeros([mm.N_] + list(states[0]['xi_'].shape[1:]),
+                             dtype=torch.float64)
+        for ids, state in zip(row_ids, states):
+            mm.xi_[ids] = state['xi_']
+
+    mm.u_mu_ = torch.cat([state['u_mu_'] for state in states], dim=0)
+    mm.u_Sig_ = torch.cat([state['u_Sig_'] for state in states], dim=0)
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+
+import torch
+import numpy as np
+from argparse import ArgumentParser
+from bayes_traj.mult_dp_regression import MultDPRegression
+from bayes_traj.model_registry import load_model
+from bayes_traj.model_io import save_model
+from bayes_traj.traj_scorer import save_scorer
+from provenance_tools.write_provenance_data import write_provenance_data
+import pdb, copy
+
+# Attributes an inference model keeps. Everything else describes the
+# training data or the state of the fit and is set to None.
+INFERENCE_ATTRIBUTES = ['w_mu0_', 'w_var0_', 'lambda_a0_', 'lambda_b0_',
+                        'lambda_a0_mod_', 'lambda_b0_mod_',
+                        'prec_prior_weight_', 'alpha_', 'K_', 'M_', 'D_',
+                        'prob_thresh_', 'Sig0_', 'ranef_indices_',
+                        'target_type_', 'num_binary_targets_',
+                        'target_names_', 'predictor_names_', 'sig_trajs_',
+                        'w_mu_', 'w_var_', 'w_covmat_', 'lambda_a_',
+                        'lambda_b_', 'v_a_', 'v_b_']
+
+# Trajectory-indexed attributes, with the axis that indexes trajectories
+_TRAJ_AXES = {'w_mu_': 2, 'w_var_': 2, 'w_covmat_': 3, 'lambda_a_': 1,
+              'lambda_b_': 1, 'v_a_': 0, 'v_b_': 0, 'sig_trajs_': 0}
+
+def get_data_summary(mm):
+    """Summarizes the training data of a model for plotting (see
+    MultDPRegression.plot): the range and mean of the predictors and targets
+    (and of the variables predictors are powers or products of), and the
+    number of subjects (or data points, if the model has no groups) assigned
+    to each trajectory.
+
+    Parameters
+    ----------
+    mm : MultDPRegression
+        Fitted model, with its training data.
+
+    Returns
+    -------
+    summary : dict
+        Keys 'min', 'max' and 'mean' (dictionaries keyed by column name),
+        'traj_probs' (the output of 'get_traj_probs'), 'traj_counts' (number
+        of subjects or data points whose most probable trajectory is each
+        trajectory) and 'num_units' (total number of subjects or data
+        points).
+    """
+    df = mm.df_
+    traj = np.argmax(np.asarray(mm.R_), 1)
+
+    columns = []
+    for cc in mm.predictor_names_ + mm.target_names_:
+        for ss in [cc] + cc.split('^')[0:1] + cc.split('*'):
+            if ss in df.columns and ss not in columns:
+                columns.append(ss)
+
+    if mm.gb_ is not None:
+        traj = traj[mm.group_first_index_.astype(bool)]
+
+    return {'min': {cc: float(np.nanmin(df[cc].values)) for cc in columns},
+            'max': {cc: float(np.nanmax(df[cc].values)) for cc in columns},
+            'mean': {cc: float(np.nanmean(df[cc].values)) for cc in columns},
+            'traj_probs': [float(pp) for pp in mm.get_traj_probs()],
+            'traj_counts': [int(np.sum(traj == k)) for k in range(mm.K_)],
+            'num_units': int(traj.shape[0])}
+
+
+def export_inference_model(mm):
+    """Creates an inference-only copy of a fitted model: one that holds the
+    priors and the trajectory parameters needed to assign data to
+    trajectories, but none of the training data, assignment probabilities or
+    fit state. A small summary of the training data (see 'get_data_summary')
+    is kept so that the model can still be plotted (unless the model was fit
+    without keeping its training data in memory, as with 'fit_streaming').
+
+    Trajectories after the last active one are dropped. Inactive trajectories
+    before it are kept: they take part in the stick-breaking construction of
+    the trajectory weights, and keeping them preserves trajectory numbers.
+
+    Parameters
+    ----------
+    mm : MultDPRegression
+        Fitted model.
+
+    Returns
+    -------
+    mm_inf : MultDPRegression
+        Inference-only model. It can be used with 'augment_df_with_traj_info'
+        (with test_data=True), 'plot' (which then does not show the data) and
+        bayes_traj.assignment_engine, but not for fitting.
+    """
+    sig_trajs = np.where(np.array(mm.sig_trajs_))[0]
+    if sig_trajs.shape[0] == 0:
+        raise RuntimeError("Model has no active trajectories to export")
+
+    state = mm.__getstate__()
+
+    mm_inf = MultDPRegression.__new__(MultDPRegression)
+    for kk in state.keys():
+        mm_inf.__dict__[kk] = None
+    for kk in INFERENCE_ATTRIBUTES:
+        mm_inf.__dict__[kk] = copy.deepcopy(state.get(kk))
+    mm_inf.lower_bounds_ = []
+    mm_inf.data_summary_ = None
+    if mm.df_ is not None:
+        mm_inf.data_summary_ = get_data_summary(mm)
+
+    K = int(sig_trajs[-1]) + 1
+    mm_inf.K_ = K
+    for kk, axis in _TRAJ_AXES.items():
+        mm_inf.__dict__[kk] = torch.narrow(mm_inf.__dict__[kk], axis, 0, K).\
+            clone()
+    if mm_inf.data_summary_ is not None:
+        for kk in ['traj_probs', 'traj_counts']:
+            mm_inf.data_summary_[kk] = mm_inf.data_summary_[kk][0:K]
+
+    return mm_inf
+
+
+def main():
+    """
+    """
+    desc = """Exports an inference-only version of a trajectory model, holding \
+    only what is needed to assign data to trajectories and to plot the \
+    trajectories: the priors, the parameters of the trajectories up to the \
+    last active one, predictor and target names, and a small summary of the \
+    training data. The training data, per-subject assignment probabilities \
+    and fit state are dropped. The exported model can be used with \
+    assign_trajectory, assign_trajectory_server and viz_model_trajs. \
+    Optionally, a TorchScript-compiled scorer (see bayes_traj.traj_scorer) \
+    can be written as well, for low-latency assignment in processes that \
+    only import torch."""
+
+    parser = ArgumentParser(description=desc)
+    parser.add_argument('--in_model', help='Input model file',
+        metavar='<string>', required=True)
+    parser.add_argument('--out_model', help='Output model file. Files with a \
+        .p, .pkl or .pickle extension are pickled; other files use the \
+        bayes_traj model format (see bayes_traj.model_io).',
+        metavar='<string>', default=None)
+    parser.add_argument('--float32', help='Store floating point arrays in \
+        single precision. Only supported for the bayes_traj model format. \
+        Arrays are converted back to double precision when the model is \
+        read.', action='store_true')
+    parser.add_argument('--out_scorer', help='If specified, a compiled \
+        trajectory scorer is written to this file. It can be loaded with \
+        torch.jit.load.', metavar='<string>', default=None)
+
+    op = parser.parse_args()
+    assert op.out_model is not None or op.out_scorer is not None, \
+        "Specify --out_model and/or --out_scorer"
+
+    print("Reading model...")
+    mm = load_model(op.in_model, cache=False)
+
+    print("Exporting...")
+    mm_inf = export_inference_model(mm)
+    if op.out_model is not None:
+        print("Saving model...")
+        save_model(mm_inf, op.out_model, float32=op.float32)
+
+        print("Saving model provenance info...")
+        provenance_desc = """ """
+        write_provenance_data(op.out_model, generator_args=op,
+                              desc=provenance_desc,
+                              module_name='bayes_traj')
+
+    if op.out_scorer is not None:
+        print("Saving scorer...")
+        save_scorer(mm_inf, op.out_scorer)
+
+        print("Saving scorer provenance info...")
+        provenance_desc = """ """
+        write_provenance_data(op.out_scorer, generator_args=op,
+                              desc=provenance_desc,
+                              module_name='bayes_traj')
+
+    print("DONE.")
+
+if __name__ == "__main__":
+    main()
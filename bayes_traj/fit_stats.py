@@ -1,16 +1,119 @@
 import torch
 from bayes_traj.mult_dp_regression import MultDPRegression
 from bayes_traj.psis import psisloo
+from bayes_traj.posterior_cache import get_posterior_digest
 from numpy.random import multivariate_normal, randn, gamma
 import numpy as np
 import pdb
 
+class FitStatistics:
+    """Assignment-based fit statistics of a trajectory model: most probable
+    trajectory assignments, the number of observations and groups (subjects)
+    assigned to each trajectory, average posterior probabilities of
+    assignment, odds of correct classification, and estimated trajectory
+    probabilities versus assigned proportions (see the reference, sections
+    5.5.1-5.5.3). All of them are computed in a single vectorized pass over
+    the model's assignment matrix, R_.
+
+    Statistics are computed at the level of groups (subjects) -- each group
+    counts once, however many observations it has -- or at the level of
+    data points if the model has no groups.
+
+    Parameters
+    ----------
+    mm : MultDPRegression
+        Post-fit trajectory model
+
+    Attributes
+    ----------
+    traj_ : array, shape ( N )
+        Most probable trajectory of each data point.
+
+    group_traj_ : array, shape ( G )
+        Most probable trajectory of each group.
+
+    num_obs_ : array, shape ( K )
+        Number of data points whose most probable trajectory is each
+        trajectory.
+
+    num_groups_ : array, shape ( K )
+        Number of groups whose most probable trajectory is each trajectory.
+
+    num_units_ : int
+        Total number of groups.
+
+    probs_ : array, shape ( K )
+        Estimated probability of each trajectory.
+
+    props_ : array, shape ( K )
+        Proportion of groups assigned to each trajectory.
+
+    ave_pp_ : dict
+        Average posterior probability of assignment of each trajectory in
+        use (keyed by trajectory).
+
+    occ_ : dict
+        Odds of correct classification of each trajectory in use.
+
+    prob_prop_ : dict
+        (proportion, probability) tuple of each trajectory in use.
+
+    References
+    ----------
+    Nagin DS, NAGIN D. Group-based modeling of development. Harvard University 
+    Press; 2005.
+    """
+    def __init__(self, mm):
+        R = np.asarray(mm.R_)
+        K = R.shape[1]
+        self.traj_ = np.argmax(R, 1)
+
+        # Models fit with 'fit_streaming' have no groupby object, but their
+        # group_first_index_ marks the first row of each group
+        if mm.gb_ is not None or \
+           getattr(mm, 'groupby_col_', None) is not None:
+            first = np.asarray(mm.group_first_index_).astype(bool)
+            R = R[first, :]
+            self.group_traj_ = self.traj_[first]
+        else:
+            self.group_traj_ = self.traj_
+
+        self.num_obs_ = np.bincount(self.traj_, minlength=K)
+        self.num_groups_ = np.bincount(self.group_traj_, minlength=K)
+        self.num_units_ = R.shape[0]
+        self.probs_ = np.sum(R, 0)/np.sum(R)
+        self.props_ = self.num_groups_/self.num_units_
+
+        # Sum, over the groups assigned to each trajectory, of the posterior
+        # probability of that trajectory
+        pp_sums = np.bincount(self.group_traj_,
+            weights=R[np.arange(R.shape[0]), self.group_traj_], minlength=K)
+
+        self.ave_pp_ = {}
+        self.occ_ = {}
+        self.prob_prop_ = {}
+        for t in np.where(np.asarray(mm.sig_trajs_))[0]:
+            if self.num_groups_[t] > 0:
+                self.ave_pp_[t] = pp_sums[t]/self.num_groups_[t]
+            else:
+                self.ave_pp_[t] = np.nan
+
+            # Odds of correct classification into trajectory t, relative to
+            # the odds of correct classification based on random assignment
+            with np.errstate(divide='ignore', invalid='ignore'):
+                self.occ_[t] = (self.ave_pp_[t]/(1 - self.ave_pp_[t]))/\
+                    (self.probs_[t]/(1 - self.probs_[t]))
+
+            self.prob_prop_[t] = (self.props_[t], self.probs_[t])
+
+
 def ave_pp(mm):
     """Computes the average posterior probability of assignment. Ideally, 
     the posterior probability (pp) of assignment is 1 for each individual, so 
     the average pp should also be 1 for each trajectory. As a rule of thumb,
     the average pp should be at least .7 for all groups (see ref, section 
-    5.5.1).
+    5.5.1). See FitStatistics, which computes this together with the other
+    assignment-based statistics.
 
     Parameters
     ----------
@@ -29,30 +132,14 @@ def ave_pp(mm):
     Nagin DS, NAGIN D. Group-based modeling of development. Harvard University 
     Press; 2005.
     """
-    df_traj = mm.to_df()
-    ave_pps = {}
-    if torch.is_tensor(mm.sig_trajs_):
-        sig_trajs = mm.sig_trajs_.numpy()
-    else:
-        sig_trajs = mm.sig_trajs_
-
-    if torch.is_tensor(mm.R_):
-        R = mm.R_.numpy()
-    else:
-        R = mm.R_
-        
-    for t in np.where(sig_trajs)[0]:
-        ids = df_traj['traj'] == t
-        ave_pps[t] = np.mean(R[ids, t])
-
-    return ave_pps
+    return FitStatistics(mm).ave_pp_
 
 def odds_correct_classification(mm):
     """Measures the odds of correct classification (OCC) for each trajectory. As 
     the average posterior probability of assignment approaches its ideal value 
     of 1, OCC for a given trajectory increases, indicating better assignment
     accuracy. As a rule of thumb, OCC values should be > 5 for all trajectories.
-    See section 5.5.2 in the reference.
+    See section 5.5.2 in the reference, and FitStatistics.
     
     Parameters
     ----------
@@ -71,27 +158,7 @@ def odds_correct_classification(mm):
     Nagin DS, NAGIN D. Group-based modeling of development. Harvard University 
     Press; 2005.
     """
-    ave_pps = ave_pp(mm)
-
-    if torch.is_tensor(mm.R_):
-        pis = np.sum(mm.R_.numpy(), 0)/np.sum(mm.R_.numpy())
-    else:
-        pis = np.sum(mm.R_, 0)/np.sum(mm.R_)        
-    
-    df_traj = mm.to_df()
-    occs = {}
-    for t in np.where(mm.sig_trajs_)[0]:
-        ids = df_traj['traj'] == t
-
-        # Odds of correct classification into trajectory t:
-        occ_num = ave_pps[t]/(1-ave_pps[t])
-
-        # Odds of correct classification based on random assignment:
-        occ_denom = pis[t]/(1-pis[t])
-        
-        occs[t] = occ_num/occ_denom
-        
-    return occs
+    return FitStatistics(mm).occ_
 
 
 def prob_prop(mm):
@@ -101,7 +168,7 @@ def prob_prop(mm):
     certainty, prob and prop would be identical. As assignment error increases,
     the correspondence may deteriorate. There is no rule for determining what 
     level of disagreement is too much, however. See 5.5.3 of reference for 
-    further information.
+    further information, and FitStatistics.
     
     Parameters
     ----------
@@ -122,179 +189,193 @@ def prob_prop(mm):
     Nagin DS, NAGIN D. Group-based modeling of development. Harvard University 
     Press; 2005.
     """
-    if torch.is_tensor(mm.R_):
-        probs = np.sum(mm.R_.numpy(), 0)/np.sum(mm.R_.numpy())
-    else:
-        probs = np.sum(mm.R_, 0)/np.sum(mm.R_)
-    
-    df_traj = mm.to_df()
-        
-    prop_probs = {}
-    for t in np.where(mm.sig_trajs_)[0]:
-        ids = df_traj['traj'] == t
-        prop = np.sum(ids)/float(mm.N_)
-
-        prop_probs[t] = (prop, probs[t])
-
-    return prop_probs
-
-#def get_group_likelihood_samples(mm, num_samples=100):
-#    """This is a helper function for compute_waic2. It is somewhat memory 
-#    intensive to gather a large number of samples from the posterior 
-#    likelihood, so the strategy is to do it in chunks. This function will be
-#    iteratively called to produce samples.
-#
-#    Parameters
-#    ---------
-#    mm : MultDPRegression
-#        Post-fit trajectory model
-#
-#    num_samples : int, optional
-#        The number of samples to draw
-#
-#    Returns
-#    -------
-#    group_likelihood : array, shape ( Ng, S )
-#        The likelihood. Each row corresponds to an individual (note there may be 
-#        multiple longitudinal observations per individual, as well as multiple
-#        dimensions. The likelihood for an individual is computed as the product
-#        over all time points and target dimensions); each column corresponds to
-#        a sample. Very small values are set to a small constant (1e-300). 
-#    """
-#    # Impute any missing target values by sampling from the posterior
-#    # distribution
-#    if torch.is_tensor(mm.Y_):
-#        Y = mm.Y_.numpy()
-#    else:
-#        Y = mm.Y_
-#        
-#    tmp_indices = np.where(np.isnan(np.sum(Y, 1)))[0]
-#
-#    for tt in tmp_indices:
-#        tmp_sample = mm.sample(index=tt)
-#
-#        if torch.is_tensor(mm.Y_):
-#            Y[tt, np.isnan(mm.Y_[tt, :].numpy())] = \
-#                tmp_sample[0, np.isnan(mm.Y_[tt, :].numpy())]
-#        else:
-#            Y[tt, np.isnan(mm.Y_[tt, :])] = \
-#                tmp_sample[0, np.isnan(mm.Y_[tt, :])]        
-#
-#    # Sampling from the multinomial distribution is done is such a way that the
-#    # last element of the probability vector accounts for the excess prob.
-#    # needed to bring the sum of the vec to 1. This can be a problem if the R_
-#    # matrix in the model doesn't *quite* sum to one. In that case, it's
-#    # possible to get a sample of the Kth trajectory, even if the Kth element
-#    # of the R_ matrix is 0. 
-#    if torch.is_tensor(mm.R_):
-#        mm.R_ = mm.R_ / torch.sum(mm.R_, dim=1, keepdim=True)
-#    else:
-#        mm.R_ = mm.R_/np.sum(mm.R_, 1)[:, np.newaxis]
-#
-#    # Sample from the posterior multinomial distribution -- do it per-group
-#    tmp = np.array([np.random.multinomial(1, \
-#        mm.R_[mm.gb_.indices[ss][0], mm.sig_trajs_], num_samples) \
-#                    for ss in mm.gb_.indices.keys()])
-#
-#    if torch.is_tensor(mm.sig_trajs_):
-#        num_trajs = np.sum(mm.sig_trajs_.numpy())
-#    else:
-#        num_trajs = np.sum(mm.sig_trajs_)
-#        
-#    # Now draw samples from the posterior. Also create 'traj_mat_group, which boils
-#    # 'tmp' down to the trajectory number itself (as opposed to a one-vector draw
-#    # from the multinomial distribution)
-#    sample_sig_mat = np.zeros([mm.D_, num_trajs, num_samples])
-#    sample_co_mat = np.zeros([mm.M_, mm.D_, num_trajs, num_samples])
-#    
-#    sample_mu_mat = np.zeros([mm.N_, mm.D_, num_trajs, num_samples])
-#    traj_mat_group = np.zeros([mm.gb_.ngroups, num_samples])
-#
-#    if torch.is_tensor(mm.sig_trajs_):
-#        sig_trajs = mm.sig_trajs_.numpy()
-#    else:
-#        sig_trajs = mm.sig_trajs_
-#        
-#    for ii, kk in enumerate(np.where(sig_trajs)[0]):
-#        traj_mat_group += ii*tmp[:, :, ii]
-#    
-#        for dd in range(mm.D_):
-#            if torch.is_tensor(mm.lambda_b_):
-#                scale = 1./mm.lambda_b_[dd, kk].numpy()
-#                shape = mm.lambda_a_[dd, kk].numpy()
-#            else:
-#                scale = 1./mm.lambda_b_[dd, kk]
-#                shape = mm.lambda_a_[dd, kk]
-#                
-#            sample_sig_mat[dd, ii, :] = \
-#                np.sqrt(1./gamma(shape, scale, size=num_samples))
-#
-#            if torch.is_tensor(mm.w_mu_):                
-#                sample_co_mat[:, dd, ii, :] = \
-#                    np.random.multivariate_normal(mm.w_mu_[:, dd, kk].numpy(),
-#                                        np.diag(mm.w_var_[:, dd, kk].numpy()),
-#                                                num_samples).T                
-#                sample_mu_mat[:, dd, ii, :] = \
-#                    np.dot(mm.X_.numpy(), sample_co_mat[:, dd, ii, :])
-#            else:
-#                sample_co_mat[:, dd, ii, :] = \
-#                    np.random.multivariate_normal(mm.w_mu_[:, dd, kk],
-#                                        np.diag(mm.w_var_[:, dd, kk]),
-#                                                num_samples).T                
-#                sample_mu_mat[:, dd, ii, :] = \
-#                    np.dot(mm.X_, sample_co_mat[:, dd, ii, :])
-#
-#    del tmp
-#    del sample_co_mat
-#    
-#    # Now create 'traj_mat_n'. Each column corresponds to a sample, and each entry
-#    # refers to a trajectory
-#    traj_mat_n = np.zeros([mm.N_, num_samples])
-#
-#    for ii, ss in enumerate(mm.gb_.indices.keys()):
-#        traj_mat_n[mm.gb_.indices[ss] , :]  = traj_mat_group[ii, :]
-#
-#    del traj_mat_group
-#        
-#    # Populate the sample likelihood
-#    sample_likelihood = np.ones([mm.N_, num_samples])
-#    for ii, kk in enumerate(np.where(mm.sig_trajs_)[0]):    
-#        for dd in range(mm.D_):
-#            co_tmp = 1/(np.sqrt(2*np.pi)*sample_sig_mat[np.newaxis, dd, ii, :]*\
-#                        np.ones([mm.N_, num_samples]))
-#            exp_arg_tmp = -0.5*((Y[:, dd, np.newaxis] - \
-#                sample_mu_mat[:, dd, ii, :])/sample_sig_mat[np.newaxis, dd, ii, :]*\
-#                                np.ones([mm.N_, num_samples]))**2            
-#    
-#            likelihood_tmp = co_tmp*np.exp(exp_arg_tmp)
-#        
-#            ids = traj_mat_n == ii
-#            sample_likelihood[ids] *= likelihood_tmp[ids]    
-#
-#    group_likelihood = np.zeros([mm.gb_.ngroups, num_samples])
-#    for ii, vv in enumerate(mm.gb_.indices.values()):
-#        group_likelihood[ii, :] = np.prod(sample_likelihood[vv, :], 0)
-#
-#    # Set small values to an offset
-#    group_likelihood[group_likelihood < 1e-300] = 1e-300
-#    return group_likelihood
-
-def compute_waic2(mm):
+    return FitStatistics(mm).prob_prop_
+
+def get_group_log_likelihood_samples(mm, S=1000, max_bytes=2**28):
+    """Draws posterior samples of the log likelihood of each group's
+    (subject's) data. See MultDPRegression.iter_group_log_likelihood, which
+    generates the samples a chunk of groups at a time and should be used
+    directly when G x S values do not fit in memory.
+
+    Parameters
+    ---------
+    mm : MultDPRegression
+        Post-fit trajectory model
+
+    S : int, optional
+        The number of samples to draw
+
+    max_bytes : int, optional
+        Approximate memory budget, in bytes, for intermediate quantities.
+
+    Returns
+    -------
+    group_log_likelihood : array, shape ( G, S )
+        The log likelihood. Each row corresponds to a group (the log
+        likelihood of a group is summed over all of its data points and
+        targets); each column corresponds to a sample.
     """
+    return np.concatenate([ll for gg, ll in \
+                           mm.iter_group_log_likelihood(S, max_bytes)])
+
+def compute_waic2(mm, **kwargs):
+    """Computes WAIC2 for a model. Keyword arguments (e.g. 'S', 'sampling',
+    'return_se') are passed to MultDPRegression.compute_waic2.
     """
-    waic2 = mm.compute_waic2()
+    waic2 = mm.compute_waic2(**kwargs)
 
     return waic2
 
-#def compute_psis_loo(mm):
-#    """
-#    """
-#    group_likelihood = np.zeros([mm.gb_.ngroups, 1000])
-#
-#    for i in range(5):
-#        group_likelihood[:, (i*200):(i+1)*200] = \
-#            get_group_likelihood_samples(mm, num_samples=200)
-#
-#    loo, loos, ks = psisloo(np.log(group_likelihood).T)
-#
-#    return loo, loos, ks
+def compute_psis_loo(mm, **kwargs):
+    """Computes subject-level PSIS-LOO for a model. Keyword arguments (e.g.
+    'S', 'max_bytes') are passed to MultDPRegression.compute_psis_loo.
+
+    Returns
+    -------
+    loo : float
+        Sum of the leave-one-out log predictive densities
+
+    loos : array, shape ( G )
+        Leave-one-out log predictive density of each group
+
+    ks : array, shape ( G )
+        Pareto tail index of each group. Values above 0.7 indicate
+        unreliable estimates.
+    """
+    return mm.compute_psis_loo(**kwargs)
+
+def compute_fit_metrics(mm, S=None, seed=None):
+    """Computes a model's fit metrics and stores them, together with a digest
+    of the model's variational state (see
+    bayes_traj.posterior_cache.get_posterior_digest), in its 'fit_metrics_'
+    attribute, so that they are saved with the model.
+
+    Parameters
+    ----------
+    mm : MultDPRegression
+        Post-fit trajectory model
+
+    S : int, optional
+        Number of posterior draws used to compute WAIC2. If not specified,
+        WAIC2 is computed without sampling (method='analytic').
+
+    seed : int, optional
+        Random seed for the WAIC2 draws (only used if S is specified).
+
+    Returns
+    -------
+    metrics : dict
+        Keys 'digest'; 'waic2' (a dictionary with the 'value', its Monte
+        Carlo standard error 'se', its standard error across subjects
+        'pointwise_se', computed as for LOOIC (see 'get_looic'), and the
+        'method', 'S' and 'seed' used);
+        'bic' (list of BIC values, see
+        MultDPRegression.bic); 'elbo' (the lower bound trace, if recorded);
+        'iters' and 'wall_time' (number of iterations and time in seconds of
+        the last fit, if known); 'ave_pp' and 'occ' (dictionaries keyed by
+        trajectory, see 'ave_pp' and 'odds_correct_classification').
+    """
+    if S is None:
+        value, se, pointwise = mm.compute_waic2(method='analytic',
+            return_se=True, return_pointwise=True)
+        waic2 = {'method': 'analytic', 'S': None, 'seed': None}
+    else:
+        value, se, pointwise = mm.compute_waic2(S=S, seed=seed,
+            return_se=True, return_pointwise=True)
+        waic2 = {'method': 'mc', 'S': int(S), 'seed': seed}
+    waic2.update({'value': float(value), 'se': float(se),
+        'pointwise_se': float(np.sqrt(pointwise.shape[0]*np.var(pointwise)))})
+
+    bic = mm.bic()
+    if not isinstance(bic, tuple):
+        bic = (bic,)
+
+    fit_state = getattr(mm, 'fit_state_', None)
+    if fit_state is None:
+        fit_state = {}
+
+    stats = FitStatistics(mm)
+
+    lower_bounds = getattr(mm, 'lower_bounds_', None)
+    if lower_bounds is None:
+        lower_bounds = []
+
+    mm.fit_metrics_ = {'digest': get_posterior_digest(mm),
+        'waic2': waic2,
+        'bic': [float(bb) for bb in bic],
+        'elbo': [float(ll) for ll in lower_bounds],
+        'iters': fit_state.get('iter'),
+        'wall_time': fit_state.get('wall_time'),
+        'ave_pp': {int(kk): float(vv) for kk, vv in stats.ave_pp_.items()},
+        'occ': {int(kk): float(vv) for kk, vv in stats.occ_.items()}}
+
+    return mm.fit_metrics_
+
+def get_fit_metrics(mm, refresh=False, **kwargs):
+    """Returns the fit metrics stored with a model, computing them (see
+    'compute_fit_metrics') if there are none, if the model has changed since
+    they were computed, if they predate the standard error of WAIC2 across
+    subjects, or if a refresh is requested. Keyword arguments are
+    passed to 'compute_fit_metrics'.
+
+    Parameters
+    ----------
+    mm : MultDPRegression
+        Post-fit trajectory model
+
+    refresh : bool, optional
+        If true, the metrics are recomputed even if stored ones are current.
+
+    Returns
+    -------
+    metrics : dict
+        See 'compute_fit_metrics'.
+    """
+    metrics = getattr(mm, 'fit_metrics_', None)
+    if refresh or metrics is None or \
+       metrics['digest'] != get_posterior_digest(mm) or \
+       'pointwise_se' not in metrics['waic2']:
+        metrics = compute_fit_metrics(mm, **kwargs)
+
+    return metrics
+
+def get_looic(mm, refresh=False, S=1000, seed=None):
+    """Returns the subject-level PSIS-LOO information criterion of a model,
+    computing it (see 'compute_psis_loo') unless it is recorded in the
+    model's current fit metrics (see 'get_fit_metrics'), where it is then
+    recorded.
+
+    Parameters
+    ----------
+    mm : MultDPRegression
+        Post-fit trajectory model
+
+    refresh : bool, optional
+        If true, LOOIC is recomputed even if a recorded value is current.
+
+    S : int, optional
+        Number of posterior draws.
+
+    seed : int, optional
+        Random seed for the posterior draws.
+
+    Returns
+    -------
+    looic : dict
+        Keys 'value' (-2 times the sum of the leave-one-out log predictive
+        densities); 'se' (its standard error across subjects); 'num_bad_k'
+        and 'num_groups' (the number of subjects with Pareto k > 0.7, for
+        which the estimate is unreliable, and the number of subjects); and
+        the 'S' and 'seed' used.
+    """
+    metrics = get_fit_metrics(mm)
+    looic = metrics.get('looic')
+    if refresh or looic is None:
+        loo, loos, ks = compute_psis_loo(mm, S=S, seed=seed)
+        looic = {'value': float(-2*loo),
+                 'se': float(2*np.sqrt(loos.shape[0]*np.var(loos))),
+                 'num_bad_k': int(np.sum(ks > 0.7)),
+                 'num_groups': int(ks.shape[0]), 'S': int(S), 'seed': seed}
+        metrics['looic'] = looic
+
+    return looic
@@ -8,6 +8,7 @@ import statsmodels.api as sm
 import numpy as np
 import copy, pdb
 from bayes_traj.get_alpha_estimate import get_alpha_estimate
+from bayes_traj.model_registry import load_model
 from provenance_tools.write_provenance_data import write_provenance_data
 
 def check_covariance_matrix(covmat):
@@ -168,10 +169,12 @@ class PriorGenerator:
         else:         
             self.prior_info_['traj_probs'] = self.mm_.get_traj_probs()
             
-        self.prior_info_['v_a'] = self.mm_.v_a_
-        self.prior_info_['v_b'] = self.mm_.v_b_
-    
-        self.df_traj_model_ = mm.to_df()
+        self.prior_info_['v_a'] = self.mm_.v_a_.clone()
+        self.prior_info_['v_b'] = self.mm_.v_b_.clone()
+
+        # The model may be shared through bayes_traj.model_registry, so it is
+        # left unmodified
+        self.df_traj_model_ = mm.to_df(inplace=False)
         self.update_df_traj_data()
 
         df_traj_data_computed = self.update_df_traj_data()
@@ -622,13 +625,14 @@ class PriorGenerator:
      
         res_tmp = sm.Logit(self.df_data_[target], self.df_data_[self.preds_],
                            missing='drop').fit()
-    
-        samples = np.random.multivariate_normal(res_tmp.params.values,
-            res_tmp.cov_params().values, 10000)
 
+        # The coefficient estimates are asymptotically normal, so their means
+        # and variances are read off directly rather than estimated from
+        # draws
+        cov = res_tmp.cov_params().values
         for (i, m) in enumerate(self.preds_):
-            self.prior_info_['w_mu0'][target][m] = np.mean(samples, 0)[i]
-            self.prior_info_['w_var0'][target][m] = np.var(samples, 0)[i]
+            self.prior_info_['w_mu0'][target][m] = res_tmp.params.values[i]
+            self.prior_info_['w_var0'][target][m] = cov[i, i]
 
     def prior_info_from_df(self, target):
         """
@@ -738,14 +742,13 @@ def main():
     # Read in and process data and models as availabe
     #---------------------------------------------------------------------------
     if op.model is not None:
-        with open(op.model, 'rb') as f:
-            print("Reading model...")
-            mm = pickle.load(f)['MultDPRegression']
-            if op.model_trajs is not None:
-                pg.set_model(mm, \
-                    np.array(op.model_trajs.split(','), dtype='int'))
-            else:
-                pg.set_model(mm)                    
+        print("Reading model...")
+        mm = load_model(op.model)
+        if op.model_trajs is not None:
+            pg.set_model(mm, \
+                np.array(op.model_trajs.split(','), dtype='int'))
+        else:
+            pg.set_model(mm)                    
 
     if op.in_data is not None:
         print("Reading data...")
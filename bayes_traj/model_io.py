@@ -0,0 +1,381 @@
+"""Reading and writing trajectory models in the bayes_traj model format.
+
+A model file consists of:
+
+* an 8 byte magic string, b'BTMODEL\\n';
+* the length, in bytes, of the header, as a little-endian unsigned 64 bit
+  integer;
+* the header: a UTF-8 encoded JSON object (described below);
+* zero padding up to the next multiple of 64 bytes, followed by the array
+  blocks. Each block holds the raw, C-ordered data of one array and starts at
+  a multiple of 64 bytes from the beginning of the file.
+
+The header has the keys:
+
+* 'format' : always 'bayes_traj_model';
+* 'format_version' : version of the format (currently 1). Readers refuse
+  files with a higher version;
+* 'class' : name of the model class ('MultDPRegression');
+* 'attributes' : object mapping each model attribute name to an encoded
+  value;
+* 'arrays' : object mapping array names to their 'dtype' (numpy type string),
+  'shape' and byte 'offset' from the beginning of the file. Arrays stored in
+  reduced precision also have a 'load_dtype', the type they are converted to
+  when read.
+
+Encoded values are JSON objects with a single key that gives their type:
+
+* {'value': v} : None, bool, int, float or str;
+* {'tensor': name} and {'ndarray': name} : torch tensor and numpy array
+  stored in array block 'name';
+* {'list': [...]}, {'tuple': [...]} : lists and tuples of encoded values;
+* {'dict': [[key, value], ...]} : dictionaries, with JSON keys and encoded
+  values;
+* {'data_frame': {'columns': [...], 'index': index}} : pandas data frames.
+  Each column is [name, dtype, array name, encoding]. Columns with a numpy
+  dtype other than 'object' have encoding 'raw' and are stored as arrays;
+  other columns have encoding 'json' and are stored as a JSON list, encoded
+  as UTF-8 text in a 'uint8' array. 'index' is null for a default range
+  index, and a column otherwise;
+* {'groupby': column} : a model's 'gb_' attribute, the grouping of the
+  training data by the named column. The 'df_helper_' data frame used to
+  build it is not stored; both are rebuilt from 'df_' when first used.
+
+Array blocks are read through memory maps, and the model attributes that
+hold arrays or data frames are only read when first accessed, so tools that
+only use the trajectory parameters do not read the training data.
+"""
+
+import torch
+import numpy as np
+import pandas as pd
+import pdb, os, json, struct, threading
+
+MODEL_MAGIC = b'BTMODEL\n'
+MODEL_FORMAT_VERSION = 1
+PICKLE_EXTENSIONS = ['.p', '.pkl', '.pickle']
+
+_ALIGNMENT = 64
+
+class _LazyAttributes:
+    """Loaders for model attributes that are read from a model file when
+    first accessed (see MultDPRegression.__getattr__).
+    """
+    def __init__(self, loaders):
+        self.loaders = loaders
+        self.lock = threading.RLock()
+
+    def load(self, obj, name):
+        with self.lock:
+            if name not in obj.__dict__:
+                obj.__dict__[name] = self.loaders[name]()
+            return obj.__dict__[name]
+
+
+def is_model_file(file_name):
+    """Checks whether a file is in the bayes_traj model format (as opposed to
+    a pickle file).
+
+    Parameters
+    ----------
+    file_name : str
+        File name.
+
+    Returns
+    -------
+    is_model : bool
+        True if the file starts with the model format's magic string.
+    """
+    with open(file_name, 'rb') as f:
+        return f.read(len(MODEL_MAGIC)) == MODEL_MAGIC
+
+
+def save_model(mm, file_name, format=None, float32=False):
+    """Saves a trajectory model.
+
+    Parameters
+    ----------
+    mm : MultDPRegression
+        Model to save.
+
+    file_name : str
+        Output file name.
+
+    format : str, optional
+        Either 'model' (the bayes_traj model format) or 'pickle' (a pickled
+        {'MultDPRegression': mm} dictionary, as written by earlier versions).
+        By default, files with a '.p', '.pkl' or '.pickle' extension are
+        pickled, and other files use the model format.
+
+    float32 : bool, optional
+        If true, double precision arrays are stored in single precision, and
+        converted back to double precision when read. Only supported for the
+        model format.
+    """
+    if format is None:
+        format = 'pickle' if os.path.splitext(file_name)[1].lower() in \
+            PICKLE_EXTENSIONS else 'model'
+    assert format in ['model', 'pickle'], "Unrecognized format"
+    assert not float32 or format == 'model', \
+        "float32 is only supported for the model format"
+
+    if format == 'pickle':
+        import pickle
+        with open(file_name, 'wb') as f:
+            pickle.dump({'MultDPRegression': mm}, f)
+        return
+
+    # Make sure attributes of a lazily loaded model are in memory before the
+    # file they are read from is overwritten
+    state = mm.__getstate__()
+
+    arrays = {}
+    def add_array(name, arr):
+        arrays[name] = np.ascontiguousarray(arr)
+        return name
+
+    def encode(vv, name):
+        if vv is None or isinstance(vv, (bool, int, float, str)):
+            return {'value': vv}
+        elif isinstance(vv, np.generic):
+            return {'value': vv.item()}
+        elif torch.is_tensor(vv):
+            return {'tensor': add_array(name, vv.detach().cpu().numpy())}
+        elif isinstance(vv, np.ndarray):
+            assert vv.dtype != object, \
+                "Cannot save object array " + name
+            return {'ndarray': add_array(name, vv)}
+        elif isinstance(vv, (list, tuple)):
+            return {type(vv).__name__: [encode(ww, name + '.' + str(ii)) \
+                                        for ii, ww in enumerate(vv)]}
+        elif isinstance(vv, dict):
+            return {'dict': [[encode_key(kk), encode(ww, name + '.' + str(kk))] \
+                             for kk, ww in vv.items()]}
+        elif isinstance(vv, pd.DataFrame):
+            return {'data_frame': encode_df(vv, name)}
+        raise RuntimeError("Cannot save attribute " + name + " of type " + \
+                           type(vv).__name__)
+
+    def encode_key(kk):
+        if isinstance(kk, np.generic):
+            kk = kk.item()
+        assert kk is None or isinstance(kk, (bool, int, float, str)), \
+            "Unsupported dictionary key"
+        return kk
+
+    def encode_column(col, col_name, array_name):
+        if isinstance(col.dtype, np.dtype) and col.dtype != object:
+            add_array(array_name, col.values)
+            encoding = 'raw'
+        else:
+            text = json.dumps(col.astype(object).where(col.notna(), None).\
+                              tolist()).encode()
+            add_array(array_name, np.frombuffer(text, dtype=np.uint8))
+            encoding = 'json'
+
+        return [encode_key(col_name), str(col.dtype), array_name, encoding]
+
+    def encode_df(df, name):
+        columns = [encode_column(df[cc], cc, '{}.{}'.format(name, ii)) \
+                   for ii, cc in enumerate(df.columns)]
+
+        index = None
+        if not df.index.equals(pd.RangeIndex(df.shape[0])):
+            index = encode_column(df.index.to_series(), df.index.name,
+                                  name + '.index')
+
+        return {'columns': columns, 'index': index}
+
+    attributes = {}
+    for kk, vv in state.items():
+        if kk == 'df_helper_':
+            continue
+        elif kk == 'gb_' and vv is not None:
+            attributes[kk] = {'groupby': vv.grouper.names[0]}
+        else:
+            attributes[kk] = encode(vv, kk)
+
+    header = {'format': 'bayes_traj_model',
+              'format_version': MODEL_FORMAT_VERSION,
+              'class': type(mm).__name__,
+              'attributes': attributes,
+              'arrays': {}}
+
+    # The array offsets depend on the header length, and vice versa. Offsets
+    # are first computed relative to the start of the data section, and the
+    # data section is placed after the header, padded to the alignment.
+    offset = 0
+    for kk, vv in arrays.items():
+        header['arrays'][kk] = {'dtype': vv.dtype.str, 'shape': list(vv.shape),
+                                'offset': offset}
+        if float32 and vv.dtype == np.float64:
+            arrays[kk] = vv.astype(np.float32)
+            header['arrays'][kk]['dtype'] = arrays[kk].dtype.str
+            header['arrays'][kk]['load_dtype'] = vv.dtype.str
+            vv = arrays[kk]
+        offset += -(-vv.nbytes//_ALIGNMENT)*_ALIGNMENT
+
+    def header_bytes(data_start):
+        hh = dict(header, arrays={kk: dict(vv, offset=vv['offset'] + \
+                                           data_start) \
+                                  for kk, vv in header['arrays'].items()})
+        return json.dumps(hh).encode()
+
+    data_start = 0
+    while True:
+        hh = header_bytes(data_start)
+        start = -(-(len(MODEL_MAGIC) + 8 + len(hh))//_ALIGNMENT)*_ALIGNMENT
+        if start == data_start:
+            break
+        data_start = start
+
+    tmp_file_name = file_name + '.tmp'
+    with open(tmp_file_name, 'wb') as f:
+        f.write(MODEL_MAGIC)
+        f.write(struct.pack('<Q', len(hh)))
+        f.write(hh)
+        for kk, vv in arrays.items():
+            f.write(b'\0'*(data_start + header['arrays'][kk]['offset'] - \
+                           f.tell()))
+            f.write(vv.tobytes())
+    os.replace(tmp_file_name, file_name)
+
+
+def read_model_header(file_name):
+    """Reads the header of a model file.
+
+    Parameters
+    ----------
+    file_name : str
+        Model file name.
+
+    Returns
+    -------
+    header : dict
+        The decoded JSON header.
+    """
+    with open(file_name, 'rb') as f:
+        if f.read(len(MODEL_MAGIC)) != MODEL_MAGIC:
+            raise RuntimeError(file_name + " is not a bayes_traj model file")
+        header_len = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_len).decode())
+
+    if header.get('format') != 'bayes_traj_model':
+        raise RuntimeError(file_name + " is not a bayes_traj model file")
+    if header['format_version'] > MODEL_FORMAT_VERSION:
+        raise RuntimeError("Model file format version {} is newer than the \
+        supported version {}".format(header['format_version'],
+                                     MODEL_FORMAT_VERSION))
+
+    return header
+
+
+def read_model(file_name, lazy=True):
+    """Reads a model saved in the bayes_traj model format.
+
+    Parameters
+    ----------
+    file_name : str
+        Model file name.
+
+    lazy : bool, optional
+        If true, the attributes that hold arrays or data frames are read, via
+        memory maps, when first accessed; the file must then not be rewritten
+        in place while the model is in use ('save_model' replaces files
+        instead). Otherwise, all attributes are read into memory
+        immediately.
+
+    Returns
+    -------
+    mm : MultDPRegression
+        The model.
+    """
+    from bayes_traj.mult_dp_regression import MultDPRegression
+
+    header = read_model_header(file_name)
+    assert header['class'] == 'MultDPRegression', \
+        "Unsupported model class " + header['class']
+
+    def read_array(name):
+        info = header['arrays'][name]
+        shape = tuple(info['shape'])
+        if np.prod(shape) == 0:
+            return np.empty(shape, dtype=info.get('load_dtype', info['dtype']))
+
+        # Copy-on-write, so that arrays can be modified without changing
+        # the file
+        arr = np.memmap(file_name, dtype=info['dtype'], mode='c',
+                        offset=info['offset'], shape=shape)
+        if 'load_dtype' in info:
+            return arr.astype(info['load_dtype'])
+
+        return arr if lazy else np.array(arr)
+
+    def decode(vv):
+        kk, vv = next(iter(vv.items()))
+        if kk == 'value':
+            return vv
+        elif kk == 'tensor':
+            return torch.from_numpy(read_array(vv))
+        elif kk == 'ndarray':
+            return read_array(vv)
+        elif kk == 'list':
+            return [decode(ww) for ww in vv]
+        elif kk == 'tuple':
+            return tuple([decode(ww) for ww in vv])
+        elif kk == 'dict':
+            return {ww[0]: decode(ww[1]) for ww in vv}
+        elif kk == 'data_frame':
+            return decode_df(vv)
+        raise RuntimeError("Unrecognized attribute encoding " + kk)
+
+    def decode_column(name, dtype, array_name, encoding):
+        arr = read_array(array_name)
+        if encoding == 'json':
+            return pd.Series(json.loads(bytes(arr).decode()), dtype=dtype,
+                             name=name)
+        return pd.Series(np.array(arr), dtype=dtype, name=name)
+
+    def decode_df(vv):
+        df = pd.DataFrame({cc[0]: decode_column(*cc) for cc in vv['columns']},
+                          columns=[cc[0] for cc in vv['columns']])
+        if vv['index'] is not None:
+            df.index = pd.Index(decode_column(*vv['index']))
+
+        return df
+
+    mm = MultDPRegression.__new__(MultDPRegression)
+
+    loaders = {}
+    for kk, vv in header['attributes'].items():
+        if 'groupby' in vv:
+            continue
+        elif 'value' in vv or not lazy:
+            mm.__dict__[kk] = decode(vv)
+        else:
+            loaders[kk] = lambda vv=vv: decode(vv)
+
+    # The training data grouping is rebuilt from the training data
+    groupby = header['attributes'].get('gb_', {}).get('groupby')
+    if groupby is not None:
+        def load_df_helper():
+            df_helper = pd.DataFrame(mm.df_[[groupby]])
+            for k in range(mm.K_):
+                df_helper['like_accum_' + str(k)] = \
+                    np.nan*np.zeros(df_helper.shape[0])
+            return df_helper
+        loaders['df_helper_'] = load_df_helper
+        loaders['gb_'] = lambda: mm.df_helper_.groupby(groupby)
+    elif 'gb_' in header['attributes']:
+        mm.__dict__['df_helper_'] = None
+
+    if len(loaders) > 0:
+        mm.__dict__['_lazy_attributes'] = _LazyAttributes(loaders)
+        if not lazy:
+            mm.__getstate__()
+
+    # Streamed models are saved without their responsibilities, which stay
+    # in a separate file (see MultDPRegression.fit_streaming)
+    mm._attach_R_file()
+
+    return mm
@@ -0,0 +1,264 @@
+import torch
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+from bayes_traj.model_io import is_model_file, read_model
+from bayes_traj.posterior_cache import PosteriorSampleCache, \
+    get_cache_file_name
+import pdb, os, pickle, hashlib, threading
+
+def get_model_nbytes(mm):
+    """Estimates the memory held by a model: the sizes of its tensors, arrays
+    and data frames, including those held in dictionaries.
+
+    Parameters
+    ----------
+    mm : MultDPRegression
+        Model instance.
+
+    Returns
+    -------
+    nbytes : int
+        Estimated number of bytes.
+    """
+    def nbytes(vv):
+        if torch.is_tensor(vv):
+            return vv.element_size()*vv.nelement()
+        elif isinstance(vv, np.ndarray):
+            return vv.nbytes
+        elif isinstance(vv, pd.DataFrame):
+            return int(vv.memory_usage(deep=True).sum())
+        elif isinstance(vv, dict):
+            return sum([nbytes(ww) for ww in vv.values()])
+        return 0
+
+    return sum([nbytes(vv) for vv in mm.__dict__.values()])
+
+
+class _Entry:
+    """A model held by the registry, with the file state it was loaded from.
+    """
+    def __init__(self, model, stat, digest, nbytes):
+        self.model = model
+        self.stat = stat
+        self.digest = digest
+        self.nbytes = nbytes
+
+
+class ModelRegistry:
+    """Maps model file paths (or registered model ids) to loaded
+    MultDPRegression instances, so that a process scoring against several
+    models unpickles each one only once.
+
+    Loaded models are kept in least-recently-used order, and the least
+    recently used ones are evicted when the estimated memory of the cached
+    models exceeds 'max_bytes'. Before a cached model is returned, the file's
+    modification time and size are checked; if they have changed, the file
+    is re-read and its SHA-1 digest compared with that of the cached model,
+    which is reloaded only if the contents differ. Access is thread safe, and
+    concurrent requests for the same model load it once.
+
+    Models are shared between callers and must not be modified; in
+    particular, callers that need the model's data with trajectory
+    assignments should use 'to_df' with inplace=False. Use 'load_model' with
+    cache=False to get a private instance. Models in the
+    bayes_traj model format are memory mapped (see bayes_traj.model_io), so
+    their files should be replaced rather than rewritten in place.
+
+    Parameters
+    ----------
+    max_bytes : int, optional
+        Memory budget for cached models, as estimated by 'get_model_nbytes'.
+        A model larger than the budget is still returned, and cached until
+        the next model is loaded.
+    """
+    def __init__(self, max_bytes=2**31):
+        self.max_bytes_ = max_bytes
+        self.lock_ = threading.RLock()
+        self.entries_ = OrderedDict()
+        self.path_locks_ = {}
+        self.ids_ = {}
+        self.hits_ = 0
+        self.misses_ = 0
+
+    def register(self, model_id, path):
+        """Registers an id for a model file, so that the model can be
+        requested by id.
+
+        Parameters
+        ----------
+        model_id : str
+            Model id.
+
+        path : str
+            Model file path.
+        """
+        with self.lock_:
+            self.ids_[model_id] = os.path.realpath(path)
+
+    def resolve(self, model):
+        """Resolves a model id or path to the real path of the model file.
+
+        Parameters
+        ----------
+        model : str
+            Registered model id or model file path.
+
+        Returns
+        -------
+        path : str
+            Real path of the model file.
+        """
+        with self.lock_:
+            if model in self.ids_:
+                return self.ids_[model]
+        return os.path.realpath(model)
+
+    def get(self, model):
+        """Gets a loaded model, loading it if it is not cached or if the file
+        has changed since it was loaded.
+
+        Parameters
+        ----------
+        model : str
+            Registered model id or model file path.
+
+        Returns
+        -------
+        mm : MultDPRegression
+            The model. It is shared and must not be modified.
+        """
+        path = self.resolve(model)
+        with self.lock_:
+            path_lock = self.path_locks_.setdefault(path, threading.Lock())
+
+        with path_lock:
+            stat = os.stat(path)
+            stat = (stat.st_mtime_ns, stat.st_size)
+            with self.lock_:
+                entry = self.entries_.get(path)
+                if entry is not None and entry.stat == stat:
+                    self.entries_.move_to_end(path)
+                    self.hits_ += 1
+                    return entry.model
+
+            # The file is hashed a block at a time rather than read whole
+            sha1 = hashlib.sha1()
+            with open(path, 'rb') as f:
+                for data in iter(lambda: f.read(2**20), b''):
+                    sha1.update(data)
+            digest = sha1.hexdigest()
+
+            with self.lock_:
+                if entry is not None and entry.digest == digest:
+                    entry.stat = stat
+                    self.entries_.move_to_end(path)
+                    self.hits_ += 1
+                    return entry.model
+
+            mm = read_model_file(path)
+            entry = _Entry(mm, stat, digest, get_model_nbytes(mm))
+
+            with self.lock_:
+                self.misses_ += 1
+                self.entries_[path] = entry
+                self.entries_.move_to_end(path)
+                self._evict()
+
+            return mm
+
+    def _evict(self):
+        """Evicts least recently used models until the cached models fit the
+        memory budget, always keeping the most recently used one.
+        """
+        while len(self.entries_) > 1 and self.nbytes() > self.max_bytes_:
+            self.entries_.popitem(last=False)
+
+    def nbytes(self):
+        """Returns the estimated memory of the cached models.
+        """
+        with self.lock_:
+            return sum([ee.nbytes for ee in self.entries_.values()])
+
+    def evict(self, model=None):
+        """Removes a model, or all models, from the cache.
+
+        Parameters
+        ----------
+        model : str, optional
+            Registered model id or model file path. If not specified, all
+            models are removed.
+        """
+        with self.lock_:
+            if model is None:
+                self.entries_.clear()
+            else:
+                self.entries_.pop(self.resolve(model), None)
+
+
+def read_model_file(file_name, lazy=True):
+    """Reads a trajectory model from a file in the bayes_traj model format
+    (see bayes_traj.model_io) or from a pickle file written by earlier
+    versions.
+
+    Parameters
+    ----------
+    file_name : str
+        Model file name.
+
+    lazy : bool, optional
+        If true, the arrays of a model format file are read when first
+        accessed (see bayes_traj.model_io.read_model).
+
+    Returns
+    -------
+    mm : MultDPRegression
+        The model. If posterior draws were persisted alongside the model file
+        (see bayes_traj.posterior_cache), they are available through the
+        model's posterior sample cache.
+    """
+    if is_model_file(file_name):
+        mm = read_model(file_name, lazy)
+    else:
+        with open(file_name, 'rb') as f:
+            mm = pickle.load(f)['MultDPRegression']
+
+    if os.path.exists(get_cache_file_name(file_name)):
+        mm.posterior_cache_ = \
+            PosteriorSampleCache(file_name=get_cache_file_name(file_name))
+
+    return mm
+
+
+default_registry = ModelRegistry()
+
+def load_model(model, cache=True, registry=None):
+    """Loads a trajectory model from a model file written by bayes_traj_main
+    (in the bayes_traj model format or, for earlier versions, a pickle file)
+    or from a checkpoint file, resolving it through a model registry.
+
+    Parameters
+    ----------
+    model : str
+        Registered model id or model file path.
+
+    cache : bool, optional
+        If true, the (shared) model held by the registry is returned. If
+        false, a private instance is loaded that the caller may modify; the
+        registry is only used to resolve 'model'.
+
+    registry : ModelRegistry, optional
+        Registry to use. By default, the module's 'default_registry'.
+
+    Returns
+    -------
+    mm : MultDPRegression
+        The model.
+    """
+    if registry is None:
+        registry = default_registry
+
+    if cache:
+        return registry.get(model)
+
+    return read_model_file(registry.resolve(model), lazy=False)
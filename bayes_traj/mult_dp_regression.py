@@ -1,4 +1,5 @@
 import torch
+import torch.distributed
 from torch.distributions import Normal, Gamma, Beta, constraints
 from torch.distributions import MultivariateNormal, Bernoulli
 import pyro
@@ -13,14 +14,22 @@ from numpy import abs, dot, mean, log, sum, exp, tile, max, sum, isnan, diag, \
      sqrt, pi, newaxis, outer, genfromtxt, where
 from numpy.random import multivariate_normal, randn, gamma, binomial
 from bayes_traj.utils import *
+from bayes_traj.psis import psisloo
+from bayes_traj.posterior_cache import PosteriorSampleCache
 from scipy.optimize import minimize_scalar
-from scipy.special import psi, gammaln, logsumexp
+from scipy.special import psi, gammaln, logsumexp, gammaincinv
 from scipy.stats import norm
 import pandas as pd
-import pdb, sys, pickle, time, warnings
+import pdb, sys, os, pickle, time, warnings, tempfile, signal, threading
 import copy
 
 
+class _FitInterrupted(Exception):
+    """Raised when a fit stops early after writing a checkpoint in response to
+    a termination signal.
+    """
+    pass
+
 
 class MultDPRegression:
     """Uses Dirichlet process mixture modeling to identify mixtures of
@@ -309,6 +318,58 @@ class MultDPRegression:
             self.xi_ = None
 
 
+    def __getattr__(self, name):
+        """Reads attributes of a model loaded from a model file (see
+        bayes_traj.model_io) when they are first accessed.
+        """
+        lazy = self.__dict__.get('_lazy_attributes')
+        if lazy is None or name not in lazy.loaders:
+            raise AttributeError("'MultDPRegression' object has no " + \
+                                 "attribute '" + name + "'")
+
+        return lazy.load(self, name)
+
+
+    def __getstate__(self):
+        """Returns the model state for pickling and copying, reading any
+        attributes of a lazily loaded model that have not been read yet.
+        """
+        lazy = self.__dict__.get('_lazy_attributes')
+        if lazy is not None:
+            for name in lazy.loaders:
+                lazy.load(self, name)
+
+        state = self.__dict__.copy()
+
+        # Attributes extended by 'update' are views of larger buffers, which
+        # would be pickled whole
+        for kk, vv in state.items():
+            if torch.is_tensor(vv) and vv.untyped_storage().nbytes() > \
+               vv.nelement()*vv.element_size():
+                state[kk] = vv.clone()
+
+        state.pop('_lazy_attributes', None)
+        state.pop('posterior_cache_', None)
+        state.pop('log_likelihood_cache_', None)
+        state.pop('traj_df_cache_', None)
+        state.pop('update_cache_', None)
+        state.pop('posterior_digest_cache_', None)
+
+        return state
+
+
+    def __setstate__(self, state):
+        """Restores a pickled model. Models pickled by versions that
+        predate random effects get 'ranef_indices_' set to None, and the
+        responsibilities of streamed models are re-attached (see
+        'fit_streaming').
+        """
+        self.__dict__.update(state)
+        if 'ranef_indices_' not in self.__dict__:
+            self.ranef_indices_ = None
+        self._attach_R_file()
+
+
     def _set_group_first_index(self, df, gb):
         """
         """
@@ -347,10 +408,14 @@ class MultDPRegression:
         return group_first_index
             
             
-    def fit(self, target_names, predictor_names, df, groupby=None, iters=100,
+    def fit(self, target_names=None, predictor_names=None, df=None,
+            groupby=None, iters=100,
             R=None, traj_probs=None, traj_probs_weight=None, v_a=None,
             v_b=None, w_mu=None, w_var=None, lambda_a=None, lambda_b=None,
-            verbose=False, weights_only=False, num_init_trajs=None):
+            verbose=False, weights_only=False, num_init_trajs=None,
+            num_workers=None, batch_size=None, step_delay=1.,
+            forgetting_rate=0.7, num_blocks=None, subject_weights=None,
+            checkpoint_file=None, checkpoint_interval=10, resume_from=None):
         """Performs variational inference (coordinate ascent or SVI) given data
         and provided parameters.
 
@@ -453,59 +518,694 @@ class MultDPRegression:
         num_init_trajs : int, optional
             If specified, the initialization procedure will attempt to ensure 
             that the number of initial trajectories in the fitting routine
-            equals the specified number.       
+            equals the specified number.
+
+        num_workers : int, optional
+            If greater than 1, subjects are sharded (by group) across this
+            many local worker processes. Each worker computes responsibilities
+            and sufficient statistics for its shard, and the global updates
+            are formed from an all-reduce of those statistics (see
+            bayes_traj.distributed_fit). Requires 'groupby'.
+
+        batch_size : int, optional
+            If specified, stochastic variational inference is used instead of
+            coordinate ascent: each update uses a minibatch of this many
+            subjects (groups), and 'iters' is the number of passes through the
+            data. See 'fit_svi'.
+
+        step_delay : float, optional
+            Delay (>= 0) of the SVI step size schedule, rho_t = (step_delay +
+            t)^(-forgetting_rate). Only used if 'batch_size' is specified.
+
+        forgetting_rate : float, optional
+            Forgetting rate, in (0.5, 1], of the SVI step size schedule. Only
+            used if 'batch_size' is specified.
+
+        num_blocks : int, optional
+            If specified, incremental variational EM is used instead of
+            coordinate ascent: subjects are partitioned into this many blocks,
+            and the global parameters are updated after each block is
+            visited. 'iters' is the number of passes through the data. See
+            'fit_incremental'.
+
+        subject_weights : array, shape ( N ), optional
+            Weight of the subject (group) that each data instance belongs to,
+            so it must be constant within a group. Each subject's contribution
+            to the global updates is multiplied by its weight, which is how a
+            weighted subset of subjects (e.g. a coreset, see
+            bayes_traj.coreset) stands in for a larger data set. By default
+            all subjects have weight 1.
+
+        checkpoint_file : str, optional
+            If specified, the full state of the fit (variational and data
+            members, iteration counter and random number generator states) is
+            written to this pickle file every 'checkpoint_interval' iterations
+            and at the end of the fit. SIGINT and SIGTERM are intercepted
+            during the fit: the current iteration is completed, a final
+            checkpoint is written, and the signal is then re-raised. Not
+            supported for distributed fits.
+
+        checkpoint_interval : int, optional
+            Number of iterations between checkpoints.
+
+        resume_from : str, optional
+            Checkpoint file written by an earlier (interrupted) fit. If
+            specified, the model state is restored from it and the fit
+            continues where it stopped, with the settings it was started with;
+            data preprocessing and initialization are not repeated, and all
+            other data and initialization arguments are ignored. Checkpoints
+            continue to be written to 'checkpoint_file' if specified, and to
+            the checkpoint file of the original fit otherwise.
         """
+        if resume_from is not None:
+            self.resume(resume_from, checkpoint_file, checkpoint_interval)
+            return
+
+        assert target_names is not None and predictor_names is not None and \
+            df is not None, "target_names, predictor_names and df must be \
+            specified unless resuming"
         if traj_probs_weight is not None:
             assert traj_probs_weight >= 0 and traj_probs_weight <=1, \
                 "Invalid traj_probs_weightd value"
 
-        self.X_ = torch.tensor(df[predictor_names].values, dtype=torch.float64)
-        self.Y_ = torch.tensor(df[target_names].values, dtype=torch.float64)
+        assert batch_size is None or num_blocks is None, \
+            "Specify at most one of batch_size and num_blocks"
+        if num_workers is not None and num_workers > 1:
+            assert batch_size is None and num_blocks is None, \
+                "SVI and incremental EM are not supported for distributed \
+                fitting"
+            assert checkpoint_file is None, \
+                "Checkpointing is not supported for distributed fitting"
+            from bayes_traj.distributed_fit import fit_distributed
+            fit_distributed(self, num_workers, target_names=target_names,
+                predictor_names=predictor_names, df=df, groupby=groupby,
+                iters=iters, R=R, traj_probs=traj_probs,
+                traj_probs_weight=traj_probs_weight, v_a=v_a, v_b=v_b,
+                w_mu=w_mu, w_var=w_var, lambda_a=lambda_a, lambda_b=lambda_b,
+                verbose=verbose, weights_only=weights_only,
+                num_init_trajs=num_init_trajs, subject_weights=subject_weights)
+            return
+
+        self._init_data(target_names, predictor_names, df, groupby)
+
+        self.subject_weights_ = None
+        if subject_weights is not None:
+            assert len(subject_weights) == self.N_, \
+                "subject_weights must have one entry per data instance"
+            self.subject_weights_ = \
+                torch.as_tensor(np.asarray(subject_weights, dtype=float))
+
+        self._set_init_params(R, v_a, v_b, w_mu, w_var, lambda_a, lambda_b)
 
-        assert len(set(target_names)) == len(target_names), \
-            "Duplicate target name found"
-        self.target_names_ = target_names
-    
-        assert len(set(predictor_names)) == len(predictor_names), \
-            "Duplicate predictor name found"
-        self.predictor_names_ = predictor_names
-    
-        assert self.w_mu0_.shape[0] == self.X_.shape[1], \
-          "Dimension mismatch between mu_ and X_"
-        assert self.X_.shape[0] == self.Y_.shape[0], \
-          "X_ and Y_ do not have the same number of samples"        
-        
-        self.N_ = self.X_.shape[0]
-        self.M_ = self.X_.shape[1]
-        self.D_ = self.Y_.shape[1]
+        print("Initializing parameters...")
+        self.init_traj_params(traj_probs)
+
+        # The prior over the residual precision can get overwhelmed by the
+        # data -- so much so that residual precision posteriors can wind up
+        # in regimes that have near-zero mass in the prior. Given this, we
+        # scale the prior params (essentially lowering the variance of the
+        # prior) by an amount proportional to the number of subjects in the
+        # data set. Note that this step needs to be done AFTER
+        # init_traj_params, which uses the original prior to randomly
+        # initialize trajectory precisions.
+        self.lambda_a0_mod_ = self.lambda_a0_*self.prec_prior_weight_
+        self.lambda_b0_mod_ = self.lambda_b0_*self.prec_prior_weight_
+
+        if self.v_a_ is None:
+            self.v_a_ = torch.ones(self.K_)
+
+        if self.v_b_ is None:
+            self.v_b_ = self.alpha_*torch.ones(self.K_)
+
+        if self.R_ is None:
+            if num_init_trajs is None:
+                self.init_R_mat(traj_probs, traj_probs_weight)
+            else:
+                for ii in range(100):
+                    self.init_R_mat(traj_probs, traj_probs_weight)
+                    if torch.sum(self.sig_trajs_).item() == num_init_trajs:
+                        break
+
+        self.fit_state_ = {'iter': 0, 'iters': iters, 'verbose': verbose,
+                           'weights_only': weights_only,
+                           'batch_size': batch_size, 'step_delay': step_delay,
+                           'forgetting_rate': forgetting_rate,
+                           'num_blocks': num_blocks}
+        self.checkpoint_file_ = checkpoint_file
+        self.checkpoint_interval_ = checkpoint_interval
+        self._continue_fit()
+
+    def _continue_fit(self):
+        """Runs the iterations of the fit described by 'fit_state_', starting
+        after iteration fit_state_['iter']. If checkpointing is enabled,
+        SIGINT and SIGTERM are intercepted for the duration of the loop and
+        handled in '_end_iteration'. The time spent is added to
+        fit_state_['wall_time'] (in seconds).
+        """
+        state = self.fit_state_
+        self._pending_signal = None
+        start_time = time.perf_counter()
+
+        handlers = {}
+        if self.checkpoint_file_ is not None and \
+           threading.current_thread() is threading.main_thread():
+            def handler(signum, frame):
+                self._pending_signal = signum
+            for signum in [signal.SIGINT, signal.SIGTERM]:
+                handlers[signum] = signal.signal(signum, handler)
+
+        try:
+            if state['batch_size'] is not None:
+                self.fit_svi(state['iters'], state['batch_size'],
+                             state['step_delay'], state['forgetting_rate'],
+                             state['verbose'], state['weights_only'],
+                             start_iter=state['iter'])
+            elif state['num_blocks'] is not None:
+                self.fit_incremental(state['iters'], state['num_blocks'],
+                                     state['verbose'], state['weights_only'],
+                                     start_iter=state['iter'])
+            else:
+                self.fit_coordinate_ascent(state['iters'], state['verbose'],
+                                           state['weights_only'],
+                                           start_iter=state['iter'])
+        except _FitInterrupted:
+            pass
+        finally:
+            state['wall_time'] = state.get('wall_time', 0.) + \
+                time.perf_counter() - start_time
+            for signum, hh in handlers.items():
+                signal.signal(signum, hh)
+
+        pending_signal = self._pending_signal
+        self._pending_signal = None
+        if pending_signal is not None:
+            signal.raise_signal(pending_signal)
+
+    def _end_iteration(self, inc):
+        """Records that iteration 'inc' of the current fit has completed, and
+        writes a checkpoint if one is due or if a termination signal has been
+        received. In the latter case the remaining iterations are abandoned
+        (by raising an exception that '_continue_fit' turns back into the
+        original signal).
+
+        Parameters
+        ----------
+        inc : int
+            The number of completed iterations.
+        """
+        if getattr(self, 'fit_state_', None) is None:
+            return
+        self.fit_state_['iter'] = inc
+
+        if getattr(self, 'checkpoint_file_', None) is None:
+            return
+
+        pending_signal = getattr(self, '_pending_signal', None)
+        if pending_signal is not None or \
+           inc % self.checkpoint_interval_ == 0 or \
+           inc == self.fit_state_['iters']:
+            self.save_checkpoint(self.checkpoint_file_)
+
+        if pending_signal is not None:
+            raise _FitInterrupted()
+
+    def save_checkpoint(self, file_name):
+        """Writes the full state of the model, together with the random
+        number generator states, to a pickle file. The file is written to a
+        temporary name first and then moved into place, so an existing
+        checkpoint is never left half-written. Like the model files written by
+        bayes_traj_main, the model is stored under the key
+        'MultDPRegression'.
+
+        Parameters
+        ----------
+        file_name : str
+            Name of the checkpoint file.
+        """
+        pending_signal = getattr(self, '_pending_signal', None)
+        self._pending_signal = None
+        tmp_file_name = file_name + '.tmp'
+        try:
+            with open(tmp_file_name, 'wb') as f:
+                pickle.dump({'MultDPRegression': self,
+                             'torch_rng_state': torch.get_rng_state(),
+                             'np_rng_state': np.random.get_state()}, f)
+        finally:
+            self._pending_signal = pending_signal
+        os.replace(tmp_file_name, file_name)
+
+    def resume(self, file_name, checkpoint_file=None, checkpoint_interval=None):
+        """Restores the model and random number generator states from a
+        checkpoint written by 'save_checkpoint' and continues the fit that
+        was in progress. If that fit had already completed, nothing is done.
+
+        Parameters
+        ----------
+        file_name : str
+            Name of the checkpoint file.
+
+        checkpoint_file : str, optional
+            File to which further checkpoints are written. By default, the
+            checkpoint file of the original fit.
+
+        checkpoint_interval : int, optional
+            Number of iterations between checkpoints. By default, the interval
+            of the original fit.
+        """
+        with open(file_name, 'rb') as f:
+            checkpoint = pickle.load(f)
+        assert 'torch_rng_state' in checkpoint, \
+            "{} is not a checkpoint file".format(file_name)
+
+        self.__dict__.update(checkpoint['MultDPRegression'].__dict__)
+        torch.set_rng_state(checkpoint['torch_rng_state'])
+        np.random.set_state(checkpoint['np_rng_state'])
+
+        if checkpoint_file is not None:
+            self.checkpoint_file_ = checkpoint_file
+        if checkpoint_interval is not None:
+            self.checkpoint_interval_ = checkpoint_interval
+
+        if self.fit_state_['iter'] < self.fit_state_['iters']:
+            self._continue_fit()
+
+    def refine(self, iters, verbose=False, checkpoint_file=None,
+               checkpoint_interval=10):
+        """Performs additional coordinate ascent iterations on a fitted model,
+        starting from its current state. The model must hold its data in
+        memory (i.e. it must not have been fit with 'fit_streaming').
+
+        Parameters
+        ----------
+        iters : int
+            Number of additional iterations.
+
+        verbose : bool, optional
+            If true, a printout of the sum along rows of the R_ matrix will
+            be provided after each iteration.
+
+        checkpoint_file : str, optional
+            If specified, checkpoints are written to this file. See 'fit'.
+
+        checkpoint_interval : int, optional
+            Number of iterations between checkpoints.
+        """
+        assert getattr(self, 'X_', None) is not None, \
+            "Model does not hold its data and cannot be refined"
+
+        self.fit_state_ = {'iter': 0, 'iters': iters, 'verbose': verbose,
+                           'weights_only': False, 'batch_size': None,
+                           'step_delay': 1., 'forgetting_rate': 0.7,
+                           'num_blocks': None}
+        self.checkpoint_file_ = checkpoint_file
+        self.checkpoint_interval_ = checkpoint_interval
+        self._continue_fit()
+
+    def update(self, df_new, iters=5, verbose=False):
+        """Adds data to a fitted model and runs a few warm-started iterations.
+        'df_new' may contain visits of new subjects as well as new visits of
+        subjects that are already in the model. Only the subjects that appear
+        in 'df_new' are revisited: each iteration recomputes their local
+        parameters (responsibilities and, for binary targets, xi_) given the
+        current trajectory parameters, and then updates the trajectory
+        parameters from the global sufficient statistics, in which the
+        contribution of the remaining subjects is held fixed. This is a
+        partial E-step of incremental variational EM.
+
+        The cost of an update depends on the size of the update rather than
+        on the size of the cohort. The model keeps the total sufficient
+        statistics of its data and the rows of each subject from one update
+        to the next (see '_get_update_cache'): an update subtracts the
+        statistics of the subjects it revisits and adds them back once they
+        have been recomputed. The new rows are appended to the data tensors
+        and per-row and per-group arrays (X_, Y_, R_, xi_, u_mu_, u_Sig_,
+        N_to_G_index_map_, group_first_index_), which are views of buffers
+        whose capacity grows geometrically (see '_append_rows'), so that the
+        existing rows are not copied on every update; df_, df_helper_ and
+        gb_ are only rebuilt when they are next accessed. The first update
+        after a fit (or after the model is refined or read from a file)
+        tallies the statistics of all the data once.
+
+        New subjects are numbered after the existing ones, in the order of
+        their first row in 'df_new' (see 'N_to_G_index_map_' and
+        'group_first_index_').
+
+        Parameters
+        ----------
+        df_new : pandas dataframe
+            New data instances. Must contain the predictor and target columns
+            of the model, as well as the groupby column if the model was fit
+            with one. Rows already in the model must not be repeated.
+
+        iters : int, optional
+            Number of iterations to run.
+
+        verbose : bool, optional
+            If true, a printout of the sum along rows of the R_ matrix, over
+            the revisited data instances, will be provided after each
+            iteration.
+        """
+        assert getattr(self, 'X_', None) is not None, \
+            "Model does not hold its data and cannot be updated"
+        assert getattr(self, 'subject_weights_', None) is None, \
+            "Models fit with subject weights cannot be updated"
+        if self.ranef_indices_ is not None:
+            if np.sum(self.ranef_indices_) > 0:
+                raise RuntimeError("Updates do not support random effects")
+
+        groupby = self._get_groupby_col()
+        cache = self._get_update_cache(groupby)
+
+        X_new = torch.tensor(df_new[self.predictor_names_].values,
+                             dtype=torch.float64)
+        Y_new = torch.tensor(df_new[self.target_names_].values,
+                             dtype=torch.float64)
+        for d in range(self.D_):
+            if self.target_type_[d] == 'binary':
+                assert set(Y_new[:, d].tolist()) <= {1.0, 0.0}, \
+                    "New data changes the type of a target variable"
+
+        #-----------------------------------------------------------------------
+        # Map the new rows to existing and new groups
+        #-----------------------------------------------------------------------
+        N_old = self.N_
+        G_old = self.G_
+        n_new = df_new.shape[0]
+        if groupby is None:
+            groups_new = np.arange(G_old, G_old + n_new)
+            first_new = np.ones(n_new, dtype=bool)
+            old_groups = []
+        else:
+            codes, keys = pd.factorize(df_new[groupby])
+            assert np.all(codes >= 0), "Missing group identifiers in df_new"
+            groups = np.array([cache['group_index'].get(kk, -1) \
+                               for kk in keys], dtype=int)
+            is_new = groups < 0
+            groups[is_new] = G_old + np.arange(np.sum(is_new))
+            groups_new = groups[codes]
+            old_groups = groups[~is_new]
+
+            first_new = np.zeros(n_new, dtype=bool)
+            first_new[np.unique(codes, return_index=True)[1][is_new]] = True
+
+        # Rows of the existing subjects that received new visits are revisited
+        # along with the new rows. Their contribution is removed from the
+        # totals before their responsibilities change.
+        old_ids = np.sort(np.concatenate(\
+            [cache['group_rows'][gg] for gg in old_groups] + \
+            [np.zeros(0, dtype=int)]))
+        stats_fixed = cache['stats']
+        sig_count_fixed = cache['sig_count']
+        if old_ids.shape[0] > 0:
+            stats_old = self.compute_suff_stats(old_ids)
+            stats_fixed = {kk: stats_fixed[kk] - stats_old[kk] \
+                           for kk in stats_fixed.keys()}
+            sig_count_fixed = sig_count_fixed - \
+                torch.sum(self.R_[old_ids] > self.prob_thresh_, 0)
+
+        #-----------------------------------------------------------------------
+        # Append the new rows
+        #-----------------------------------------------------------------------
+        G_new = int(np.sum(first_new))
+        self._append_rows('X_', X_new, cache)
+        self._append_rows('Y_', Y_new, cache)
+        self._append_rows('R_', 0., cache, n_new)
+        if getattr(self, 'xi_', None) is not None:
+            self._append_rows('xi_', 1., cache, n_new)
+        self._append_rows('u_mu_', 0., cache, G_new)
+        self._append_rows('u_Sig_', 0., cache, G_new)
+        self._append_rows('N_to_G_index_map_', groups_new, cache)
+        if np.asarray(self.group_first_index_).dtype != bool:
+            self.group_first_index_ = \
+                np.asarray(self.group_first_index_).astype(bool)
+        self._append_rows('group_first_index_', first_new, cache)
+        self.N_ = N_old + n_new
+        self.G_ = G_old + G_new
+        self._append_df(df_new, groupby, cache)
+
+        new_rows = np.arange(N_old, self.N_)
+        if groupby is not None:
+            order = np.argsort(codes, kind='stable')
+            rows_new = np.split(N_old + order,
+                                np.cumsum(np.bincount(codes))[:-1])
+            for kk, gg, rr in zip(keys, groups, rows_new):
+                if gg < G_old:
+                    cache['group_rows'][gg] = \
+                        np.concatenate([cache['group_rows'][gg], rr])
+                else:
+                    cache['group_index'][kk] = gg
+                    cache['group_rows'].append(rr)
+
+        #-----------------------------------------------------------------------
+        # Revisit the affected subjects
+        #-----------------------------------------------------------------------
+        ids = np.sort(np.concatenate([old_ids, new_rows]))
+        df_ids = pd.DataFrame(\
+            torch.cat([self.X_[ids], self.Y_[ids]], 1).numpy(),
+            columns=list(self.predictor_names_) + list(self.target_names_))
+        if groupby is not None:
+            df_ids[groupby] = self.N_to_G_index_map_[ids]
+
+        for inc in range(1, iters + 1):
+            self.update_local(ids, df_ids)
+
+            stats_new = self.compute_suff_stats(ids)
+            stats = {}
+            for kk in stats_new.keys():
+                stats[kk] = stats_fixed[kk] + stats_new[kk]
+
+            self.update_v(stats)
+            if self.num_binary_targets_ > 0:
+                self.update_w_logistic(em_iters=1, ids=ids, stats=stats)
+            if self.D_ - self.num_binary_targets_ > 0:
+                self.update_w_gaussian(stats)
+                self.update_lambda(stats)
+
+            self.sig_trajs_ = sig_count_fixed + \
+                torch.sum(self.R_[ids] > self.prob_thresh_, 0) > 0
+
+            if verbose:
+                torch.set_printoptions(precision=2)
+                print(f"iter {inc}, {torch.sum(self.R_[ids], dim=0).numpy()}")
+
+        # The totals are kept for the next update. xi_ has changed since the
+        # last tally.
+        stats_new = self.compute_suff_stats(ids)
+        cache['stats'] = {kk: stats_fixed[kk] + stats_new[kk] \
+                          for kk in stats_new.keys()}
+        cache['sig_count'] = sig_count_fixed + \
+            torch.sum(self.R_[ids] > self.prob_thresh_, 0)
+        cache['key'] = self._get_update_cache_key()
+
+    def _append_rows(self, name, rows, cache, num_rows=None):
+        """Appends rows to a tensor or array attribute of the model (e.g.
+        X_). The attribute is a view of a buffer kept in the update cache
+        (see '_get_update_cache'), whose capacity is doubled when it runs
+        out, so that appending does not copy the existing rows. A new buffer
+        is made if the attribute is not a view of the current one (e.g. after
+        a fit, or if the attribute was reassigned).
+
+        Parameters
+        ----------
+        name : str
+            Attribute name.
+
+        rows : tensor, array or float
+            Rows to append, or a value to fill them with.
+
+        cache : dict
+            The update cache.
+
+        num_rows : int, optional
+            Number of rows to append, if 'rows' is a fill value.
+        """
+        value = getattr(self, name)
+        num_old = value.shape[0]
+        num = num_old + (rows.shape[0] if num_rows is None else num_rows)
+
+        buffers = cache.setdefault('buffers', {})
+        buf = buffers.get(name)
+        if buf is None or buf[1] is not value or buf[0].shape[0] < num:
+            capacity = int(np.maximum(num, 2*num_old))
+            shape = (capacity,) + tuple(value.shape[1:])
+            if torch.is_tensor(value):
+                data = torch.zeros(shape, dtype=value.dtype)
+            else:
+                data = np.zeros(shape, dtype=value.dtype)
+            data[0:num_old] = value
+        else:
+            data = buf[0]
+
+        data[num_old:num] = rows
+        value = data[0:num]
+        setattr(self, name, value)
+        buffers[name] = (data, value)
+
+    def _get_groupby_col(self):
+        """Returns the name of the data frame column that groups the data
+        instances, or None if they are not grouped. Unlike reading it from
+        gb_, this does not rebuild the grouping of a model that was read from
+        a file or updated (see 'update').
+        """
+        if 'groupby_col_' in self.__dict__:
+            return self.groupby_col_
+        if self.gb_ is not None:
+            return self.gb_.grouper.names[0]
+        return None
+
+    def _get_update_cache_key(self):
+        """Returns the state key (see '_get_state_key') of the data and local
+        parameters that the update cache was computed from.
+        """
+        return self._get_state_key(['R_', 'X_', 'Y_', 'xi_', 'target_type_',
+                                    'N_to_G_index_map_',
+                                    'group_first_index_'],
+                                   identity_names=['N_to_G_index_map_',
+                                                   'group_first_index_'])
+
+    def _get_update_cache(self, groupby):
+        """Returns the bookkeeping that 'update' keeps from one update to the
+        next, computing it with one pass over the data if the data or the
+        local parameters have changed since the last update (for example,
+        after a fit).
+
+        Parameters
+        ----------
+        groupby : str
+            Data frame column name used to group data instances, or None.
+
+        Returns
+        -------
+        cache : dict
+            'stats' : dict
+                Sufficient statistics of all the data (see
+                'compute_suff_stats').
+            'sig_count' : torch.Tensor, shape ( K )
+                Number of data instances whose responsibility for each
+                trajectory exceeds prob_thresh_. A trajectory is significant
+                if this is positive.
+            'group_index' : dict
+                Maps each group identifier to the group's index. None if the
+                data is not grouped.
+            'group_rows' : list of arrays
+                Row indices of each group. None if the data is not grouped.
+            'key' : list
+                State key of the model the cache was computed from.
+        """
+        cache = getattr(self, 'update_cache_', None)
+        if cache is not None and self._state_key_matches(\
+                self._get_update_cache_key(), cache['key']):
+            return cache
+
+        if getattr(self, 'N_to_G_index_map_', None) is None:
+            self._set_N_to_G_index_map()
+
+        cache = {'stats': self.compute_suff_stats(),
+                 'sig_count': torch.sum(self.R_ > self.prob_thresh_, 0),
+                 'group_index': None, 'group_rows': None, 'key': None}
+        if groupby is not None:
+            N_to_G = np.asarray(self.N_to_G_index_map_)
+            order = np.argsort(N_to_G, kind='stable')
+            counts = np.bincount(N_to_G, minlength=self.G_)
+            ends = np.cumsum(counts)
+            cache['group_rows'] = np.split(order, ends[:-1])
+            keys = self.df_[groupby].values[order[ends - counts]]
+            cache['group_index'] = dict(zip(keys.tolist(), range(self.G_)))
+        cache['key'] = self._get_update_cache_key()
+        self.update_cache_ = cache
+
+        return cache
+
+    def _append_df(self, df_new, groupby, cache):
+        """Appends rows to df_ without copying it. df_ is concatenated with
+        the rows appended since it was last read when it is next accessed,
+        and df_helper_ and gb_ are rebuilt from it (see '__getattr__').
+
+        Parameters
+        ----------
+        df_new : pandas dataframe
+            Rows to append.
+
+        groupby : str
+            Data frame column name used to group data instances, or None.
+
+        cache : dict
+            The update cache (see '_get_update_cache'), which keeps the rows
+            that have not been appended yet.
+        """
+        from bayes_traj.model_io import _LazyAttributes
+
+        lazy = self.__dict__.get('_lazy_attributes')
+        loaders = {} if lazy is None else dict(lazy.loaders)
+        pieces = cache.get('df_pieces')
+        if pieces is None or 'df_' in self.__dict__ or \
+           loaders.get('df_') is not cache['df_loader']:
+            pieces = [self.__dict__['df_'] if 'df_' in self.__dict__ \
+                      else loaders['df_']]
+        pieces.append(df_new)
+
+        def load_df():
+            return pd.concat([pp() if callable(pp) else pp for pp in pieces],
+                             ignore_index=True)
+
+        def load_df_helper():
+            if groupby is None:
+                df_helper = pd.DataFrame(index=range(self.df_.shape[0]))
+            else:
+                df_helper = pd.DataFrame(self.df_[[groupby]])
+            for k in range(self.K_):
+                df_helper['like_accum_' + str(k)] = \
+                    np.nan*np.zeros(df_helper.shape[0])
+            return df_helper
+
+        def load_gb():
+            if groupby is None:
+                return None
+            return self.df_helper_.groupby(groupby)
+
+        loaders['df_'] = load_df
+        loaders['df_helper_'] = load_df_helper
+        loaders['gb_'] = load_gb
+        cache['df_pieces'] = pieces
+        cache['df_loader'] = load_df
+        for name in ['df_', 'df_helper_', 'gb_']:
+            self.__dict__.pop(name, None)
+        self.__dict__['_lazy_attributes'] = _LazyAttributes(loaders)
+
+    def _set_init_params(self, R=None, v_a=None, v_b=None, w_mu=None,
+                         w_var=None, lambda_a=None, lambda_b=None):
+        """Sets the variational parameters that 'fit' was given for
+        initialization. See 'fit' for a description of the parameters. Those
+        not specified are initialized by 'init_traj_params' and 'init_R_mat'.
+        """
         if lambda_a is not None:
             self.lambda_a_ = torch.from_numpy(lambda_a).double()
         else:
             self.lambda_a_ is None
-            
+
         if lambda_b is not None:
             self.lambda_b_ = torch.from_numpy(lambda_b).double()
         else:
             self.lambda_b_ is None
-            
+
         if w_mu is not None:
             self.w_mu_ = torch.from_numpy(w_mu).double()
         else:
             self.w_mu_ = None
-            
+
         if w_var is not None:
             self.w_var_ = torch.from_numpy(w_var).double()
         else:
             self.w_var_ is None
-            
+
         if v_a is not None:
-            if torch.is_tensor(v_a):                
+            if torch.is_tensor(v_a):
                 self.v_a_ = v_a.clone().detach()
             else:
-                self.v_a_ = torch.from_numpy(v_a).double()                
+                self.v_a_ = torch.from_numpy(v_a).double()
         else:
             self.v_a_ = None
-            
+
         if v_b is not None:
             if torch.is_tensor(v_b):
                 self.v_b_ = v_b.clone().detach()
@@ -513,13 +1213,54 @@ class MultDPRegression:
                 self.v_b_ = torch.from_numpy(v_b).double()
         else:
             self.v_b_ = None
-            
+
         if R is not None:
             self.R_ = torch.from_numpy(R).double()
         else:
             R = None
 
+    def _init_data(self, target_names, predictor_names, df, groupby=None):
+        """Sets the data-dependent members (X_, Y_, df_, the group index
+        structures, random effect precomputations and target types) from the
+        input data frame. This is the preprocessing portion of 'fit' and does
+        not touch the variational parameters.
+
+        Parameters
+        ----------
+        target_names : list of strings
+            Data frame column names of the target variables.
+
+        predictor_names : list of strings
+            Data frame column names of the predictors
+
+        df : pandas dataframe
+            Data frame containing predictor, target, and group information.
+
+        groupby : str, optional
+            Data frame column name used to group data instances.
+        """
+        self.X_ = torch.tensor(df[predictor_names].values, dtype=torch.float64)
+        self.Y_ = torch.tensor(df[target_names].values, dtype=torch.float64)
+
+        assert len(set(target_names)) == len(target_names), \
+            "Duplicate target name found"
+        self.target_names_ = target_names
+    
+        assert len(set(predictor_names)) == len(predictor_names), \
+            "Duplicate predictor name found"
+        self.predictor_names_ = predictor_names
+    
+        assert self.w_mu0_.shape[0] == self.X_.shape[1], \
+          "Dimension mismatch between mu_ and X_"
+        assert self.X_.shape[0] == self.Y_.shape[0], \
+          "X_ and Y_ do not have the same number of samples"        
+        
+        self.N_ = self.X_.shape[0]
+        self.M_ = self.X_.shape[1]
+        self.D_ = self.Y_.shape[1]
+
         self.df_ = df
+        self.groupby_col_ = groupby
 
         # df_helper_ is introduced as a data structure that will facilitate
         # tallying the likelihood terms during the update of Z parameters.
@@ -578,43 +1319,19 @@ class MultDPRegression:
         self.w_covmat_ = torch.full([self.M_, self.M_, self.D_, self.K_],
                                     torch.tensor(float('nan'))).double()
 
+        # In a distributed fit, a target is only binary if it is binary on
+        # every shard
+        is_binary = self._all_reduce(torch.tensor(\
+            [set(self.Y_[:, d].tolist()) <= {1.0, 0.0} \
+             for d in range(self.D_)], dtype=torch.float64), op='min')
+
         self.num_binary_targets_ = 0
         for d in range(self.D_):
-            if set(self.Y_[:, d].tolist()) <= {1.0, 0.0}:
+            if is_binary[d] > 0:
                 self.target_type_[d] = 'binary'
                 self.num_binary_targets_ += 1
             else:
                 self.target_type_[d] = 'gaussian'
-        print("Initializing parameters...")
-        self.init_traj_params(traj_probs)
-
-        # The prior over the residual precision can get overwhelmed by the
-        # data -- so much so that residual precision posteriors can wind up
-        # in regimes that have near-zero mass in the prior. Given this, we
-        # scale the prior params (essentially lowering the variance of the
-        # prior) by an amount proportional to the number of subjects in the
-        # data set. Note that this step needs to be done AFTER
-        # init_traj_params, which uses the original prior to randomly
-        # initialize trajectory precisions.
-        self.lambda_a0_mod_ = self.lambda_a0_*self.prec_prior_weight_
-        self.lambda_b0_mod_ = self.lambda_b0_*self.prec_prior_weight_
-
-        if self.v_a_ is None:
-            self.v_a_ = torch.ones(self.K_)
-    
-        if self.v_b_ is None:
-            self.v_b_ = self.alpha_*torch.ones(self.K_)
-    
-        if self.R_ is None:
-            if num_init_trajs is None:
-                self.init_R_mat(traj_probs, traj_probs_weight)
-            else:
-                for ii in range(100):
-                    self.init_R_mat(traj_probs, traj_probs_weight)
-                    if torch.sum(self.sig_trajs_).item() == num_init_trajs:
-                        break
-                
-        self.fit_coordinate_ascent(iters, verbose, weights_only)
 
 
     def _set_N_to_G_index_map(self):
@@ -628,7 +1345,8 @@ class MultDPRegression:
             for ii, (kk, vv) in enumerate(self.gb_.groups.items()):
                 self.N_to_G_index_map_[vv] = ii
         
-    def fit_coordinate_ascent(self, iters, verbose, weights_only=False):
+    def fit_coordinate_ascent(self, iters, verbose, weights_only=False,
+                              start_iter=0):
         """This function contains the iteratrion loop for mean-field 
         variational inference using coordinate ascent
     
@@ -653,18 +1371,23 @@ class MultDPRegression:
             different trajectory subgroups differs. By using this flag, the 
             proportions of previously determined trajectory subgroups will be 
             determined for the current data set.
+
+        start_iter : int, optional
+            Number of iterations already completed, when continuing a fit
+            from a checkpoint.
         """
-        inc = 0
+        inc = start_iter
         while inc < iters:
             inc += 1
 
-            self.update_v()
+            stats = self.compute_suff_stats()
+            self.update_v(stats)
             if self.num_binary_targets_ > 0:
-                self.update_w_logistic(em_iters=1)
+                self.update_w_logistic(em_iters=1, stats=stats)
             if (self.D_ - self.num_binary_targets_ > 0) and \
                (not weights_only):
-                self.update_w_gaussian()
-                self.update_lambda() 
+                self.update_w_gaussian(stats)
+                self.update_lambda(stats) 
 
             self.R_ = self.update_z(self.X_, self.Y_)
 
@@ -672,36 +1395,785 @@ class MultDPRegression:
                 if np.sum(self.ranef_indices_) > 0:
                     self.update_u()
             
-            self.sig_trajs_ = \
-                torch.max(self.R_, dim=0).values > self.prob_thresh_
+            self.sig_trajs_ = self._all_reduce(\
+                torch.max(self.R_, dim=0).values, op='max') > self.prob_thresh_
 
             if verbose:
-                torch.set_printoptions(precision=2)
-                print(f"iter {inc}, {torch.sum(self.R_, dim=0).numpy()}")
+                R_sum = self._all_reduce(torch.sum(self.R_, dim=0))
+                if self._rank() == 0:
+                    torch.set_printoptions(precision=2)
+                    print(f"iter {inc}, {R_sum.numpy()}")
+
+            self._end_iteration(inc)
+
+    def fit_svi(self, iters, batch_size, step_delay=1., forgetting_rate=0.7,
+                verbose=False, weights_only=False, start_iter=0):
+        """Stochastic variational inference. Each update samples a minibatch
+        of subjects (groups), sets their responsibilities given the current
+        global parameters, and then takes a natural gradient step on the
+        global variational parameters (v_a_, v_b_, w_mu_, w_var_, lambda_a_,
+        lambda_b_). Following Sato (2001), the step is taken on the expected
+        sufficient statistics: svi_stats_ is a running average of the
+        minibatch statistics scaled up to the full data set, and the global
+        parameters are set to their coordinate ascent optima given
+        svi_stats_. For v and lambda, whose natural parameters are linear in
+        the statistics, this is identical to blending the natural parameters
+        directly. Step sizes follow the Robbins-Monro schedule rho_t =
+        (step_delay + t)^(-forgetting_rate), t = 1, 2, ... The cost of an
+        update depends on the batch size, not on the number of subjects.
 
-                
-    def update_v(self):
-        """Updates the parameters of the Beta distributions for latent
-        variable 'v' in the variational approximation.
-        """
-        self.v_a_ = 1.0 + \
-            torch.sum(self.R_[self.group_first_index_, :], dim=0)        
+        Parameters
+        ----------
+        iters : int
+            Number of passes through the data. Each pass visits every subject
+            once, in random order, in minibatches of 'batch_size' subjects.
 
-        for k in torch.arange(0, self.K_):
-            self.v_b_[k] = self.alpha_ + \
-                torch.sum(self.R_[self.group_first_index_, k+1:])
+        batch_size : int
+            Number of subjects per minibatch.
 
+        step_delay : float, optional
+            Down-weights early iterations. Must be >= 0.
 
-    def get_R_matrix(self, df=None, gb_col=None, df_helper=None,
-                     test_data=False):
-        """For each individual, computes the probability that he/she belongs to
-        each of the trajectories.
-        """        
-        expec_ln_v = psi(self.v_a_) - psi(self.v_a_ + self.v_b_)
-        expec_ln_1_minus_v = psi(self.v_b_) - psi(self.v_a_ + self.v_b_)
-    
-        expec_ln_v_terms = expec_ln_v.clone().detach()
-        for k in range(1, self.K_):
+        forgetting_rate : float, optional
+            Controls how quickly old information is forgotten. Must be in
+            (0.5, 1] for the schedule to satisfy the Robbins-Monro conditions.
+
+        verbose : bool, optional
+            If true, a printout of the sum along rows of the R_ matrix will
+            be provided after each pass.
+
+        weights_only : bool, optional
+            If true, only the trajectory weights will be optimized. See
+            'fit_coordinate_ascent'.
+
+        start_iter : int, optional
+            Number of passes already completed, when continuing a fit from a
+            checkpoint. In that case the running statistics, svi_stats_, are
+            taken from the checkpointed state.
+
+        References
+        ----------
+        Hoffman MD, Blei DM, Wang C, Paisley J. Stochastic variational
+        inference. Journal of Machine Learning Research. 2013;14:1303-47.
+
+        Sato MA. Online model selection based on the variational Bayes. Neural
+        computation. 2001;13(7):1649-81.
+        """
+        assert batch_size > 0, "batch_size must be greater than 0"
+        assert step_delay >= 0, "step_delay must be >= 0"
+        assert forgetting_rate > 0.5 and forgetting_rate <= 1, \
+            "forgetting_rate must be in (0.5, 1]"
+        if self.ranef_indices_ is not None:
+            if np.sum(self.ranef_indices_) > 0:
+                raise RuntimeError("SVI does not support random effects")
+
+        if self.gb_ is not None:
+            group_rows = list(self.gb_.indices.values())
+        else:
+            group_rows = None
+
+        B = min(batch_size, self.G_)
+        num_batches = int(np.ceil(self.G_/B))
+
+        # The running statistics start from those of the initial
+        # responsibilities
+        if start_iter == 0:
+            self.svi_stats_ = self.compute_suff_stats()
+
+        t = start_iter*num_batches
+        for inc in range(start_iter + 1, iters + 1):
+            perm = np.random.permutation(self.G_)
+            for bb in range(num_batches):
+                batch = perm[bb*B:(bb + 1)*B]
+                if group_rows is None:
+                    ids = np.sort(batch)
+                else:
+                    ids = np.concatenate([group_rows[gg] for gg in batch])
+
+                t += 1
+                self.svi_step(ids, self.G_/batch.shape[0],
+                              (step_delay + t)**(-forgetting_rate),
+                              weights_only)
+
+            self.sig_trajs_ = \
+                torch.max(self.R_, dim=0).values > self.prob_thresh_
+
+            if verbose:
+                torch.set_printoptions(precision=2)
+                print(f"iter {inc}, {torch.sum(self.R_, dim=0).numpy()}")
+
+            self._end_iteration(inc)
+
+    def svi_step(self, ids, scale, rho, weights_only=False):
+        """Performs a single SVI update on the data instances in 'ids'.
+
+        Parameters
+        ----------
+        ids : array
+            Row indices of the minibatch. These must cover whole groups.
+
+        scale : float
+            Ratio of the number of groups in the data set to the number of
+            groups in the minibatch.
+
+        rho : float
+            Step size in (0, 1].
+
+        weights_only : bool, optional
+            If true, only the trajectory weights will be updated.
+        """
+        self.update_local(ids)
+
+        # Global step: natural gradient updates from the scaled statistics
+        stats = self.compute_suff_stats(ids)
+        for kk in stats.keys():
+            self.svi_stats_[kk] = (1 - rho)*self.svi_stats_[kk] + \
+                rho*scale*stats[kk]
+
+        self.update_v(self.svi_stats_)
+        if self.num_binary_targets_ > 0:
+            self.update_w_logistic(em_iters=1, ids=ids, scale=scale, rho=rho)
+        if (self.D_ - self.num_binary_targets_ > 0) and (not weights_only):
+            self.update_w_gaussian(self.svi_stats_)
+            self.update_lambda(self.svi_stats_)
+
+    def update_local(self, ids, df=None):
+        """Updates the local variational parameters -- the responsibilities,
+        R_, and for binary targets xi_ -- of a subset of subjects given the
+        current global parameters. The cost depends only on the number of
+        instances in 'ids'.
+
+        Parameters
+        ----------
+        ids : array
+            Row indices of the data instances to update. These must cover
+            whole groups.
+
+        df : pandas dataframe, optional
+            The data instances in 'ids', in the same order, with the predictor
+            and target columns and, if the data is grouped, a column named
+            after the groupby column that identifies their groups. By default
+            these rows are taken from df_.
+        """
+        if self.num_binary_targets_ > 0:
+            d_bin = -1
+            for d in range(self.D_):
+                if self.target_type_[d] == 'binary':
+                    d_bin += 1
+                    for k in range(self.K_):
+                        self.update_xi(d, d_bin, k, ids)
+
+        gb_col = self._get_groupby_col()
+        if df is None:
+            df = self.df_.iloc[ids].reset_index(drop=True)
+        self.R_[ids, :] = self.get_R_matrix(df=df, gb_col=gb_col)
+
+    def get_group_blocks(self, num_blocks):
+        """Randomly partitions the subjects (groups) into blocks.
+
+        Parameters
+        ----------
+        num_blocks : int
+            Number of blocks. Capped at the number of groups.
+
+        Returns
+        -------
+        blocks : list of arrays
+            Row indices of the data instances in each block.
+        """
+        perm = np.random.permutation(self.G_)
+        blocks = np.array_split(perm, min(num_blocks, self.G_))
+        if self.gb_ is None:
+            return [np.sort(bb) for bb in blocks]
+
+        group_rows = list(self.gb_.indices.values())
+        return [np.sort(np.concatenate([group_rows[gg] for gg in bb])) \
+                for bb in blocks]
+
+    def fit_incremental(self, iters, num_blocks, verbose=False,
+                        weights_only=False, start_iter=0):
+        """Incremental variational EM. Subjects are partitioned into blocks,
+        and the sufficient statistics contributed by each block are stored.
+        Each step updates the local parameters of one block, replaces that
+        block's stored contribution to the global statistics with the new
+        one, and then updates the global parameters. Global parameters are
+        therefore refreshed after every block rather than once per pass. The
+        running totals, kept in incremental_stats_, always equal the
+        statistics that 'compute_suff_stats' would compute from scratch given
+        the current local parameters. For binary targets, xi_ is one of the
+        local parameters: it is only refreshed in a block's local step, before
+        the block's contribution is tallied. Each step thus maximizes the
+        variational bound with respect to one block's local parameters or to
+        the global parameters, and the bound does not decrease.
+
+        Parameters
+        ----------
+        iters : int
+            Number of passes through the data. Each pass visits every block
+            once.
+
+        num_blocks : int
+            Number of blocks to partition the subjects into.
+
+        verbose : bool, optional
+            If true, a printout of the sum along rows of the R_ matrix will
+            be provided after each pass.
+
+        weights_only : bool, optional
+            If true, only the trajectory weights will be optimized. See
+            'fit_coordinate_ascent'.
+
+        start_iter : int, optional
+            Number of passes already completed, when continuing a fit from a
+            checkpoint. The block statistics are recomputed from the
+            checkpointed state, over a fresh random partition of the subjects.
+
+        References
+        ----------
+        Neal RM, Hinton GE. A view of the EM algorithm that justifies
+        incremental, sparse, and other variants. In: Learning in graphical
+        models. Springer; 1998. p. 355-68.
+        """
+        assert num_blocks > 0, "num_blocks must be greater than 0"
+        if self.ranef_indices_ is not None:
+            if np.sum(self.ranef_indices_) > 0:
+                raise RuntimeError(\
+                    "Incremental EM does not support random effects")
+
+        blocks = self.get_group_blocks(num_blocks)
+        block_stats = [self.compute_suff_stats(ids) for ids in blocks]
+
+        for inc in range(start_iter + 1, iters + 1):
+            # Re-total the stored contributions once per pass so that round-off
+            # from the running subtract/add does not accumulate
+            stats = {}
+            for kk in block_stats[0].keys():
+                stats[kk] = torch.sum(torch.stack(\
+                    [bs[kk] for bs in block_stats]), 0)
+
+            for bb, ids in enumerate(blocks):
+                self.update_local(ids)
+
+                new_stats = self.compute_suff_stats(ids)
+                for kk in stats.keys():
+                    stats[kk] = stats[kk] - block_stats[bb][kk] + \
+                        new_stats[kk]
+                block_stats[bb] = new_stats
+
+                self.update_v(stats)
+                if self.num_binary_targets_ > 0:
+                    self.update_w_logistic(em_iters=1, ids=ids, stats=stats,
+                                           refresh_xi=False)
+                if (self.D_ - self.num_binary_targets_ > 0) and \
+                   (not weights_only):
+                    self.update_w_gaussian(stats)
+                    self.update_lambda(stats)
+            self.incremental_stats_ = stats
+
+            self.sig_trajs_ = \
+                torch.max(self.R_, dim=0).values > self.prob_thresh_
+
+            if verbose:
+                torch.set_printoptions(precision=2)
+                print(f"iter {inc}, {torch.sum(self.R_, dim=0).numpy()}")
+
+            self._end_iteration(inc)
+
+    def fit_streaming(self, data_file, target_names, predictor_names, groupby,
+                      iters=100, chunksize=100000, R_file=None,
+                      traj_probs=None, traj_probs_weight=None, v_a=None,
+                      v_b=None, w_mu=None, w_var=None, lambda_a=None,
+                      lambda_b=None, verbose=False, weights_only=False,
+                      num_init_trajs=None):
+        """Performs coordinate ascent without holding the data in memory. The
+        data file is read in group-aligned chunks on every pass (see
+        'read_group_chunks' in bayes_traj.utils), so it must be sorted by
+        'groupby'. Each pass computes the responsibilities of each chunk given
+        the current global parameters, writes them to a disk-backed array, and
+        accumulates the chunk's sufficient statistics; the global parameters
+        are then updated from the totals. This performs the same sequence of
+        updates as 'fit', and peak memory depends on the chunk size rather
+        than on the number of data instances.
+
+        After fitting, R_ is a numpy memmap of the disk-backed array, and
+        group_first_index_ spans the whole data set, but the data itself
+        (df_, X_, Y_) is not retained. Rows with NaN predictors are skipped.
+        Random effects are not supported.
+
+        The locations of the data and responsibility files are recorded
+        (data_file_, R_file_, groupby_col_). A streamed model can therefore
+        be saved with R_ set to None: R_ is re-attached from R_file_ when the
+        model is read, and 'to_df' re-reads the data file.
+
+        Parameters
+        ----------
+        data_file : str
+            csv (or parquet) file containing predictor, target, and group
+            information, sorted by 'groupby'.
+
+        target_names : list of strings
+            Data frame column names of the target variables.
+
+        predictor_names : list of strings
+            Data frame column names of the predictors
+
+        groupby : str
+            Data frame column name used to group data instances.
+
+        iters : int, optional
+            Number of variational inference iterations to run. Each iteration
+            is one pass through the data file (plus one final pass to compute
+            the responsibilities).
+
+        chunksize : int, optional
+            Number of rows to read at a time.
+
+        R_file : str, optional
+            File name (.npy) for the disk-backed responsibility matrix. If not
+            specified, a temporary file is created.
+
+        traj_probs, traj_probs_weight, v_a, v_b, w_mu, w_var, lambda_a,
+        lambda_b, verbose, weights_only, num_init_trajs : optional
+            See 'fit'.
+        """
+        assert groupby is not None, "Streaming fit requires groupby"
+        if self.ranef_indices_ is not None:
+            if np.sum(self.ranef_indices_) > 0:
+                raise RuntimeError("Streaming fit does not support random \
+                effects")
+
+        assert len(set(target_names)) == len(target_names), \
+            "Duplicate target name found"
+        assert len(set(predictor_names)) == len(predictor_names), \
+            "Duplicate predictor name found"
+        assert self.w_mu0_.shape[0] == len(predictor_names), \
+          "Dimension mismatch between mu_ and predictors"
+
+        self.target_names_ = target_names
+        self.predictor_names_ = predictor_names
+        self.M_ = len(predictor_names)
+        self.D_ = len(target_names)
+
+        columns = list(dict.fromkeys(predictor_names + target_names + \
+                                     [groupby]))
+        def chunks():
+            for chunk in read_group_chunks(data_file, groupby, chunksize,
+                                           columns):
+                yield chunk.dropna(subset=predictor_names).\
+                    reset_index(drop=True)
+
+        #-----------------------------------------------------------------------
+        # First pass: data set size and target types
+        #-----------------------------------------------------------------------
+        N = 0
+        G = 0
+        is_binary = np.ones(self.D_, dtype=bool)
+        for chunk in chunks():
+            N += chunk.shape[0]
+            G += chunk[groupby].nunique()
+            for d, tt in enumerate(target_names):
+                vals = chunk[tt].values[~np.isnan(chunk[tt].values)]
+                is_binary[d] &= set(vals.tolist()) <= {1.0, 0.0}
+
+        self.N_ = N
+        self.G_ = G
+        self.subject_weights_ = None
+        self.gb_ = None
+        self.df_ = None
+        self.df_helper_ = None
+        self.X_ = None
+        self.Y_ = None
+        self.xi_ = None
+        self.u_mu_ = None
+        self.u_Sig_ = None
+        self.N_to_G_index_map_ = None
+
+        self.num_binary_targets_ = 0
+        for d in range(self.D_):
+            if is_binary[d]:
+                self.target_type_[d] = 'binary'
+                self.num_binary_targets_ += 1
+            else:
+                self.target_type_[d] = 'gaussian'
+
+        self.w_covmat_ = torch.full([self.M_, self.M_, self.D_, self.K_],
+                                    torch.tensor(float('nan'))).double()
+
+        #-----------------------------------------------------------------------
+        # Initialize the global parameters. As in 'fit', every instance starts
+        # with the same trajectory probabilities.
+        #-----------------------------------------------------------------------
+        self._set_init_params(None, v_a, v_b, w_mu, w_var, lambda_a, lambda_b)
+
+        print("Initializing parameters...")
+        self.init_traj_params(traj_probs)
+
+        # 'fit' initializes xi_ (in 'init_traj_params') for the trajectories
+        # that are significant at this point
+        xi_init_trajs = np.where(self.sig_trajs_)[0]
+
+        self.lambda_a0_mod_ = self.lambda_a0_*self.prec_prior_weight_
+        self.lambda_b0_mod_ = self.lambda_b0_*self.prec_prior_weight_
+
+        if self.v_a_ is None:
+            self.v_a_ = torch.ones(self.K_)
+
+        if self.v_b_ is None:
+            self.v_b_ = self.alpha_*torch.ones(self.K_)
+
+        for ii in range(100):
+            init_traj_probs = self.get_init_traj_probs(traj_probs,
+                                                       traj_probs_weight)
+            self.sig_trajs_ = init_traj_probs > self.prob_thresh_
+            if num_init_trajs is None or \
+               torch.sum(self.sig_trajs_).item() == num_init_trajs:
+                break
+
+        if R_file is None:
+            fd, R_file = tempfile.mkstemp(suffix='.npy')
+            os.close(fd)
+        R = np.lib.format.open_memmap(R_file, mode='w+', dtype=np.float64,
+                                      shape=(self.N_, self.K_))
+        self.R_file_ = os.path.abspath(R_file)
+        self.data_file_ = os.path.abspath(data_file)
+        self.groupby_col_ = groupby
+        self.group_first_index_ = np.zeros(self.N_, dtype=bool)
+
+        #-----------------------------------------------------------------------
+        # Pass 0 tallies the statistics of the initial responsibilities. Pass
+        # inc > 0 computes the responsibilities given the parameters of
+        # iteration inc and, except for the last pass, tallies the statistics
+        # for iteration inc + 1.
+        #-----------------------------------------------------------------------
+        for inc in range(iters + 1):
+            stats = None
+            R_max = torch.zeros(self.K_, dtype=torch.float64)
+            R_sum = torch.zeros(self.K_, dtype=torch.float64)
+            row = 0
+            for chunk in chunks():
+                n = chunk.shape[0]
+                self.N_ = n
+                self.X_ = torch.tensor(chunk[predictor_names].values,
+                                       dtype=torch.float64)
+                self.Y_ = torch.tensor(chunk[target_names].values,
+                                       dtype=torch.float64)
+                if inc == 0:
+                    self.group_first_index_[row:row+n] = \
+                        self._get_group_first_index(chunk,
+                                                    chunk.groupby(groupby))
+                    self.R_ = torch.ones([n, self.K_]).double()
+                    self.R_[:] = init_traj_probs
+                else:
+                    self.R_ = self.get_R_matrix(df=chunk, gb_col=groupby)
+                    R[row:row+n, :] = self.R_.numpy()
+                    R_max = torch.maximum(R_max, torch.max(self.R_, 0)[0])
+                    R_sum += torch.sum(self.R_, 0)
+
+                if inc < iters:
+                    group_first_index = self.group_first_index_
+                    self.group_first_index_ = group_first_index[row:row+n]
+                    if self.num_binary_targets_ > 0:
+                        # After pass 0, xi_ is as left by the M-step of
+                        # 'update_w_logistic', which updates all trajectories
+                        self.init_xi(xi_init_trajs if inc == 0 else \
+                                     np.arange(self.K_))
+                    chunk_stats = self.compute_suff_stats()
+                    self.group_first_index_ = group_first_index
+                    if stats is None:
+                        stats = chunk_stats
+                    else:
+                        for kk in stats.keys():
+                            stats[kk] += chunk_stats[kk]
+                row += n
+
+            self.N_ = N
+            self.X_ = None
+            self.Y_ = None
+            self.xi_ = None
+            self.R_ = None
+
+            if inc > 0:
+                self.sig_trajs_ = R_max > self.prob_thresh_
+                if verbose:
+                    torch.set_printoptions(precision=2)
+                    print(f"iter {inc}, {R_sum.numpy()}")
+
+            if inc < iters:
+                self.update_v(stats)
+                if self.num_binary_targets_ > 0:
+                    self.update_w_logistic(em_iters=1, stats=stats)
+                if (self.D_ - self.num_binary_targets_ > 0) and \
+                   (not weights_only):
+                    self.update_w_gaussian(stats)
+                    self.update_lambda(stats)
+
+        R.flush()
+        self.R_ = R
+
+    def _attach_R_file(self):
+        """Re-attaches the responsibilities of a model fit with
+        'fit_streaming' and saved without them: if R_ is None and the model's
+        R_file_ exists, R_ is set to a read-only memmap of it.
+        """
+        R_file = self.__dict__.get('R_file_')
+        if 'R_' in self.__dict__ and self.__dict__['R_'] is None and \
+           R_file is not None and os.path.exists(R_file):
+            self.R_ = np.lib.format.open_memmap(R_file, mode='r')
+
+    def _read_streamed_df(self):
+        """Reads the data a model was fit to with 'fit_streaming', as it was
+        used in the fit: rows with NaN predictors are dropped and the rows are
+        renumbered from 0.
+
+        Returns
+        -------
+        df : pandas DataFrame
+            The data, with a row for each row of R_.
+        """
+        if not os.path.exists(self.data_file_):
+            raise RuntimeError("Data file not found: " + self.data_file_)
+
+        return pd.concat([chunk.dropna(subset=self.predictor_names_) for \
+            chunk in read_group_chunks(self.data_file_, self.groupby_col_)],
+            ignore_index=True)
+
+    def to_csv_streaming(self, data_file, out_csv, groupby, chunksize=100000):
+        """Writes the data used by 'fit_streaming', augmented with trajectory
+        assignments and probabilities (as in 'to_df'), to a csv file one chunk
+        at a time.
+
+        Parameters
+        ----------
+        data_file : str
+            The data file that was passed to 'fit_streaming'.
+
+        out_csv : str
+            Output csv file name.
+
+        groupby : str
+            Column name identifying the groups (subjects).
+
+        chunksize : int, optional
+            Number of rows to read at a time.
+        """
+        row = 0
+        for ii, chunk in enumerate(read_group_chunks(data_file, groupby,
+                                                     chunksize)):
+            chunk = chunk.dropna(subset=self.predictor_names_).\
+                reset_index(drop=True)
+            R = np.asarray(self.R_[row:row+chunk.shape[0], :])
+            chunk['traj'] = np.argmax(R, 1)
+            for s in np.where(self.sig_trajs_)[0]:
+                chunk['traj_{}'.format(s)] = R[:, s]
+            chunk.to_csv(out_csv, index=False, mode='w' if ii == 0 else 'a',
+                         header=(ii == 0))
+            row += chunk.shape[0]
+
+    def _rank(self):
+        """Returns the rank of the current process if fitting is distributed
+        across worker processes, and 0 otherwise.
+        """
+        if torch.distributed.is_available() and \
+           torch.distributed.is_initialized():
+            return torch.distributed.get_rank()
+        return 0
+
+    def _all_reduce(self, tensor, op='sum'):
+        """Reduces 'tensor' in place across worker processes if fitting is
+        distributed (see bayes_traj.distributed_fit). Otherwise 'tensor' is
+        returned unchanged.
+
+        Parameters
+        ----------
+        tensor : torch.Tensor
+            Local (per-shard) quantity to reduce.
+
+        op : str, optional
+            One of 'sum', 'max' or 'min'.
+
+        Returns
+        -------
+        tensor : torch.Tensor
+            The reduced tensor.
+        """
+        if torch.distributed.is_available() and \
+           torch.distributed.is_initialized():
+            ops = {'sum': torch.distributed.ReduceOp.SUM,
+                   'max': torch.distributed.ReduceOp.MAX,
+                   'min': torch.distributed.ReduceOp.MIN}
+            is_bool = tensor.dtype == torch.bool
+            buf = tensor.double() if is_bool else tensor
+            torch.distributed.all_reduce(buf, op=ops[op])
+            tensor = buf.bool() if is_bool else buf
+        return tensor
+
+    def _broadcast(self, tensor):
+        """Overwrites 'tensor' with the value held by rank 0 if fitting is
+        distributed. Used so that randomly initialized global parameters are
+        identical on every worker.
+        """
+        if torch.distributed.is_available() and \
+           torch.distributed.is_initialized() and tensor is not None:
+            torch.distributed.broadcast(tensor, src=0)
+        return tensor
+
+    def compute_suff_stats(self, ids=None):
+        """Computes the R-weighted sufficient statistics needed by the global
+        variational updates (update_v, update_w_gaussian, update_lambda and
+        update_w_logistic). All quantities are sums over data instances, so
+        statistics computed on disjoint sets of subjects can simply be added
+        together; when fitting is distributed, they are all-reduced across
+        workers here.
+
+        Parameters
+        ----------
+        ids : array, optional
+            Row indices of the data instances to tally. These should cover
+            whole groups. If not specified, all instances are used.
+
+        Returns
+        -------
+        stats : dict
+            'R_groups' : torch.Tensor, shape ( K )
+                Sum of R_ over groups (one row per group).
+            'R' : torch.Tensor, shape ( D, K )
+                Sum of R_ over non-NaN instances of each target.
+            'XX' : torch.Tensor, shape ( D, K, M, M )
+                Sum of R_-weighted predictor outer products.
+            'XY' : torch.Tensor, shape ( D, K, M )
+                Sum of R_-weighted products of predictors and target.
+            'YY' : torch.Tensor, shape ( D, K )
+                Sum of R_-weighted squared targets.
+            'XU' : torch.Tensor, shape ( D, K, M )
+                Sum of R_-weighted products of predictors and the random
+                effect prediction (zero if no random effects).
+            'UU' : torch.Tensor, shape ( D, K )
+                Sum of R_-weighted random effect terms of the expected squared
+                residual that do not involve w (zero if no random effects).
+            'XZX' : torch.Tensor, shape ( D, K, M, M )
+                Sum of predictor outer products weighted by R_ and the Polya-
+                gamma expectations implied by xi_.
+            'XRY' : torch.Tensor, shape ( D, K, M )
+                Sum of predictors weighted by R_ and (y - 0.5).
+            'R' through 'UU' are only populated for Gaussian target dimensions,
+            and 'XZX' and 'XRY' only for binary target dimensions.
+        """
+        D, K, M = self.D_, self.K_, self.M_
+        if ids is None:
+            R_all, X_all, Y_all = self.R_, self.X_, self.Y_
+            first_index = self.group_first_index_
+        else:
+            R_all, X_all, Y_all = self.R_[ids], self.X_[ids], self.Y_[ids]
+            first_index = self.group_first_index_[ids]
+
+        # With subject weights, every statistic is a weighted sum, which is
+        # the same as weighting the responsibilities
+        weights = getattr(self, 'subject_weights_', None)
+        if weights is not None:
+            R_all = R_all*(weights if ids is None else weights[ids])[:, None]
+
+        stats = {'R_groups': torch.sum(R_all[first_index, :], 0),
+                 'R': torch.zeros([D, K], dtype=torch.float64),
+                 'XX': torch.zeros([D, K, M, M], dtype=torch.float64),
+                 'XY': torch.zeros([D, K, M], dtype=torch.float64),
+                 'YY': torch.zeros([D, K], dtype=torch.float64),
+                 'XU': torch.zeros([D, K, M], dtype=torch.float64),
+                 'UU': torch.zeros([D, K], dtype=torch.float64),
+                 'XZX': torch.zeros([D, K, M, M], dtype=torch.float64),
+                 'XRY': torch.zeros([D, K, M], dtype=torch.float64)}
+
+        d_bin = -1
+        for d in range(D):
+            if self.target_type_[d] == 'binary':
+                d_bin += 1
+                if getattr(self, 'xi_', None) is not None:
+                    xi_all = self.xi_[:, d_bin, :] if ids is None else \
+                        self.xi_[ids, d_bin, :]
+                    non_nan_ids = ~torch.isnan(Y_all[:, d])
+                    R = R_all[non_nan_ids, :]
+                    X = X_all[non_nan_ids, :]
+                    xi = xi_all[non_nan_ids, :]
+                    Z = 0.5*R*(1/xi)*torch.tanh(0.5*xi)
+
+                    stats['XZX'][d] = torch.mm(Z.T, \
+                        (X[:, :, None]*X[:, None, :]).reshape(-1, M*M)).\
+                        reshape(K, M, M)
+                    stats['XRY'][d] = torch.mm((R*(Y_all[non_nan_ids, d] - \
+                                                   0.5)[:, None]).T, X)
+                continue
+            if self.target_type_[d] != 'gaussian':
+                continue
+            non_nan_ids = ~torch.isnan(Y_all[:, d])
+            R = R_all[non_nan_ids, :]
+            X = X_all[non_nan_ids, :]
+            y = Y_all[non_nan_ids, d]
+
+            stats['R'][d] = torch.sum(R, 0)
+            stats['XX'][d] = torch.mm(R.T, (X[:, :, None]*X[:, None, :]).\
+                                      reshape(-1, M*M)).reshape(K, M, M)
+            stats['XY'][d] = torch.mm(R.T, X*y[:, None])
+            stats['YY'][d] = torch.mv(R.T, y**2)
+
+            if self.ranef_indices_ is not None:
+                g_map = self.N_to_G_index_map_
+                if ids is not None:
+                    g_map = g_map[ids]
+                u_mu = self.u_mu_[g_map, d, :, :]\
+                    [non_nan_ids, :, :].double()
+                X_u = torch.sum(u_mu*X.unsqueeze(1), dim=-1)
+                u_Sig_times_X = torch.einsum('nkij,ni->nkj',
+                    self.u_Sig_[g_map, d, :, :, :][non_nan_ids], X)
+                X_times_u_Sig_times_X = \
+                    torch.einsum('nkj,nj->nk', u_Sig_times_X, X)
+
+                stats['XU'][d] = torch.mm((R*X_u).T, X)
+                stats['UU'][d] = torch.sum(R*(X_times_u_Sig_times_X + \
+                    X_u**2 - 2*y[:, None]*X_u), 0)
+
+        # Flatten into a single buffer so that a distributed fit needs only
+        # one all-reduce per iteration
+        keys = list(stats.keys())
+        flat = self._all_reduce(torch.cat([stats[kk].reshape(-1) \
+                                           for kk in keys]))
+        inc = 0
+        for kk in keys:
+            num = stats[kk].numel()
+            stats[kk] = flat[inc:inc+num].reshape(stats[kk].shape)
+            inc += num
+
+        return stats
+
+    def update_v(self, stats=None):
+        """Updates the parameters of the Beta distributions for latent
+        variable 'v' in the variational approximation.
+
+        Parameters
+        ----------
+        stats : dict, optional
+            Sufficient statistics as returned by 'compute_suff_stats'. If not
+            specified, they will be computed.
+        """
+        if stats is None:
+            stats = self.compute_suff_stats()
+        R_groups = stats['R_groups']
+
+        self.v_a_ = 1.0 + R_groups
+
+        # Tail sums: v_b[k] = alpha + sum_{j > k} R_groups[j]
+        tail = torch.flip(torch.cumsum(torch.flip(R_groups, [0]), 0), [0])
+        self.v_b_ = self.alpha_ + torch.cat([tail[1:],
+            torch.zeros(1, dtype=tail.dtype)])
+
+    def get_R_matrix(self, df=None, gb_col=None, df_helper=None,
+                     test_data=False):
+        """For each individual, computes the probability that he/she belongs to
+        each of the trajectories.
+        """        
+        expec_ln_v = psi(self.v_a_) - psi(self.v_a_ + self.v_b_)
+        expec_ln_1_minus_v = psi(self.v_b_) - psi(self.v_a_ + self.v_b_)
+    
+        expec_ln_v_terms = expec_ln_v.clone().detach()
+        for k in range(1, self.K_):
             expec_ln_v_terms[k] = expec_ln_v_terms[k] + \
                 torch.sum(expec_ln_1_minus_v[0:k])
 
@@ -851,7 +2323,8 @@ class MultDPRegression:
         return self.get_R_matrix(df_helper=self.df_helper_)
 
     
-    def update_w_logistic(self, em_iters=1):
+    def update_w_logistic(self, em_iters=1, ids=None, scale=1., rho=1.,
+                          stats=None, refresh_xi=True):
         """Uses an EM algorithm based on the approach in the reference to update
         the coefficient distributions corresponding to binary targets.
     
@@ -859,6 +2332,30 @@ class MultDPRegression:
         ----------
         em_iters : int, optional
             The number of EM iterations to perform
+
+        ids : array, optional
+            Row indices of the data instances to use. If not specified, all
+            instances are used.
+
+        scale : float, optional
+            Factor applied to the data terms. Used by SVI to scale minibatch
+            sums up to the full data set.
+
+        rho : float, optional
+            Step size in (0, 1]. Values less than 1 blend the precision matrix
+            and precision-weighted mean with their current values (a natural
+            gradient step). The default (1) gives the full update.
+
+        stats : dict, optional
+            Sufficient statistics as returned by 'compute_suff_stats'. If
+            specified, its 'XZX' and 'XRY' entries are used in place of the
+            data sums in the first EM iteration ('ids' and 'scale' then only
+            affect which xi_ are updated).
+
+        refresh_xi : bool, optional
+            If false, xi_ is not updated after the last EM iteration. Used by
+            incremental EM, which refreshes xi_ in the local step so that the
+            stored statistics of each block stay consistent with it.
     
         References
         ----------
@@ -871,137 +2368,177 @@ class MultDPRegression:
                 d_bin += 1
             
                 for k in range(self.K_):
-                    non_nan_ids = torch.isnan(self.Y_[:, d]).logical_not()
+                    # A streaming fit updates from 'stats' with no data in
+                    # memory
+                    if self.Y_ is None:
+                        non_nan_ids = None
+                    elif ids is None:
+                        non_nan_ids = torch.isnan(self.Y_[:, d]).logical_not()
+                    else:
+                        # Row indices rather than a mask over all instances,
+                        # so that the cost depends only on the size of 'ids'
+                        non_nan_ids = torch.as_tensor(ids)
+                        if non_nan_ids.dtype == torch.bool:
+                            non_nan_ids = torch.where(non_nan_ids)[0]
+                        non_nan_ids = non_nan_ids[\
+                            ~torch.isnan(self.Y_[non_nan_ids, d])]
     
                     for i in range(em_iters):
-                        # E-step
-                        Z_vec = 0.5*self.R_[non_nan_ids, k]*\
-                            (1/self.xi_[non_nan_ids, d_bin, k])*\
-                            torch.tanh(0.5*self.xi_[non_nan_ids, d_bin, k])
-                        
                         sig_mat_0 = torch.diag(self.w_var0_[:, d])
                         mu_0 = self.w_mu0_[:, d]
-    
-                        self.w_covmat_[:, :, d, k] = \
-                            torch.inverse(torch.inverse(sig_mat_0) + \
+
+                        # These are sums over data instances; in a
+                        # distributed fit they are all-reduced across workers
+                        if stats is not None and i == 0:
+                            X_Z_X = stats['XZX'][d, k]
+                            X_R_Y = stats['XRY'][d, k]
+                        else:
+                            R_k = self.R_[non_nan_ids, k]
+                            if getattr(self, 'subject_weights_', None) \
+                               is not None:
+                                R_k = R_k*self.subject_weights_[non_nan_ids]
+
+                            # E-step
+                            Z_vec = 0.5*R_k*\
+                                (1/self.xi_[non_nan_ids, d_bin, k])*\
+                                torch.tanh(0.5*self.xi_[non_nan_ids, d_bin, k])
+
+                            X_Z_X = self._all_reduce(\
                                 torch.mm(self.X_[non_nan_ids, :].t(), \
                                     Z_vec[:, None]*self.X_[non_nan_ids, :]))
+                            X_R_Y = self._all_reduce(\
+                                torch.mv(self.X_[non_nan_ids, :].t(),
+                                         R_k*(self.Y_[non_nan_ids, d] - 0.5)))
+
+                        if scale != 1 and (stats is None or i > 0):
+                            X_Z_X = scale*X_Z_X
+                            X_R_Y = scale*X_R_Y
+
+                        if rho < 1:
+                            prec_old = torch.inverse(self.w_covmat_[:, :, d, k])
+                            prec = (1 - rho)*prec_old + \
+                                rho*(torch.inverse(sig_mat_0) + X_Z_X)
+                            prec_mean = (1 - rho)*\
+                                torch.mv(prec_old, self.w_mu_[:, d, k]) + \
+                                rho*(X_R_Y + \
+                                     torch.mv(torch.inverse(sig_mat_0), mu_0))
+                            self.w_covmat_[:, :, d, k] = torch.inverse(prec)
+                            self.w_mu_[:, d, k] = \
+                                torch.mv(self.w_covmat_[:, :, d, k], prec_mean)
+                        else:
+                            self.w_covmat_[:, :, d, k] = \
+                                torch.inverse(torch.inverse(sig_mat_0) + X_Z_X)
+
+                            self.w_mu_[:, d, k] = \
+                                torch.mv(self.w_covmat_[:, :, d, k], X_R_Y + \
+                                    torch.mv(torch.inverse(sig_mat_0), mu_0))
 
                         self.w_var_[:, d, k] = \
                             torch.diag(self.w_covmat_[:, :, d, k])
 
-                        self.w_mu_[:, d, k] = \
-                            torch.mv(self.w_covmat_[:, :, d, k], \
-                                   torch.mv(self.X_[non_nan_ids, :].t(),
-                                self.R_[non_nan_ids, k]*\
-                                      (self.Y_[non_nan_ids, d] - 0.5)) + \
-                                    torch.mv(torch.inverse(sig_mat_0), mu_0))
-
                         # M-step
-                        self.xi_[non_nan_ids, d_bin, k] = \
-                            torch.sqrt(torch.sum((self.X_[non_nan_ids, :]*\
-                                torch.mm(self.w_covmat_[:, :, d, k], \
-                                self.X_[non_nan_ids, :].t()).t()), 1) + \
-                                torch.pow(torch.mv(self.X_[non_nan_ids, :], \
-                                            self.w_mu_[:, d, k]), 2))
+                        if self.xi_ is not None and \
+                           (refresh_xi or i < em_iters - 1):
+                            self.update_xi(d, d_bin, k, non_nan_ids)
+
+    def update_xi(self, d, d_bin, k, ids):
+        """Sets the variational parameters, xi_, of the logistic likelihood
+        bound to their optimal values given the current coefficient
+        distribution of binary target 'd' and trajectory 'k'.
+
+        Parameters
+        ----------
+        d : int
+            Target dimension.
+
+        d_bin : int
+            Index of target 'd' among the binary targets.
+
+        k : int
+            Trajectory index.
+
+        ids : torch.Tensor or array
+            Data instances (boolean mask or row indices) to update.
+        """
+        self.xi_[ids, d_bin, k] = \
+            torch.sqrt(torch.sum((self.X_[ids, :]*\
+                torch.mm(self.w_covmat_[:, :, d, k], \
+                self.X_[ids, :].t()).t()), 1) + \
+                torch.pow(torch.mv(self.X_[ids, :], self.w_mu_[:, d, k]), 2))
   
-    def update_w_gaussian(self):
+    def update_w_gaussian(self, stats=None):
         """ Updates the variational distributions over predictor coefficients 
         corresponding to continuous (Gaussian) target variables. 
+
+        Parameters
+        ----------
+        stats : dict, optional
+            Sufficient statistics as returned by 'compute_suff_stats'. If not
+            specified, they will be computed.
         """
+        if stats is None:
+            stats = self.compute_suff_stats()
+
         mu0_DIV_var0 = self.w_mu0_/self.w_var0_
-        for m in range(0, self.M_):
-            ids = torch.ones(self.M_, dtype=bool)
-            ids[m] = False
-            for d in range(0, self.D_):
-                if self.target_type_[d] == 'gaussian':
-                    non_nan_ids = ~torch.isnan(self.Y_[:, d])
-    
-                    tmp1 = (self.lambda_a_[d, self.sig_trajs_]/\
-                            self.lambda_b_[d, self.sig_trajs_])*\
-                            (torch.sum(self.R_[:, self.sig_trajs_, None]\
-                                    [non_nan_ids, :, :]*\
-                                    self.X_[non_nan_ids, None, :]**2, 0).T)\
-                                    [:, None, :]
-    
-                    self.w_var_[:, :, self.sig_trajs_] = \
-                        (tmp1 + (1.0/self.w_var0_)[:, :, None])**-1
+        for d in range(0, self.D_):
+            if self.target_type_[d] != 'gaussian':
+                continue
 
+            lambda_mean = self.lambda_a_[d, self.sig_trajs_]/\
+                self.lambda_b_[d, self.sig_trajs_]
+            XX = stats['XX'][d, self.sig_trajs_]
 
-                    ranef_terms = torch.zeros(torch.sum(non_nan_ids),
-                                              torch.sum(self.sig_trajs_))
-                    if self.ranef_indices_ is not None:
-                        ranef_terms = torch.einsum('nkm,nm->nk',
-                            self.u_mu_[self.N_to_G_index_map_, d, :, :],
-                            self.X_)[:, self.sig_trajs_]
-                    
-                    sum_term = \
-                        torch.sum(self.R_[non_nan_ids, :][:, self.sig_trajs_]*\
-                                  self.X_[non_nan_ids, m, None]*\
-                                (torch.matmul(self.X_[:, ids][non_nan_ids, :], \
-                                self.w_mu_[ids, d, :][:, self.sig_trajs_]) + \
-                                 ranef_terms - \
-                                   self.Y_[non_nan_ids, d][:, None]), 0)
-
-                    self.w_mu_[m, d, self.sig_trajs_] = \
-                        self.w_var_[m, d, self.sig_trajs_]*\
-                        (-(self.lambda_a_[d, self.sig_trajs_]/\
-                           self.lambda_b_[d, self.sig_trajs_])*\
-                         sum_term + mu0_DIV_var0[m, d])
-
-    def update_lambda(self):
-        """Updates the variational distribution over latent variable lambda.
-        """
-        for d in range(self.D_):
-            if self.target_type_[d] == 'gaussian':
-                non_nan_ids = ~torch.isnan(self.Y_[:, d])
+            self.w_var_[:, d, self.sig_trajs_] = \
+                (lambda_mean[None, :]*\
+                 torch.diagonal(XX, dim1=1, dim2=2).T + \
+                 (1.0/self.w_var0_[:, d])[:, None])**-1
 
-                self.lambda_a_[d, self.sig_trajs_] = \
-                    self.lambda_a0_mod_[d, None] + \
-                    0.5*torch.sum(self.R_[:, self.sig_trajs_][non_nan_ids, :], 0)\
-                    [None, :]
+            for m in range(0, self.M_):
+                ids = torch.ones(self.M_, dtype=bool)
+                ids[m] = False
 
-                #---------------------------------------------------------------
-                # Tally ranef terms
-                #---------------------------------------------------------------
-                ranef_terms = torch.zeros(torch.sum(non_nan_ids), self.K_)
-                if self.ranef_indices_ is not None:
-                    ranef_term1 = -2*(self.Y_[non_nan_ids, d].unsqueeze(-1)*\
-                        torch.sum(self.u_mu_[self.N_to_G_index_map_, d, :, :]\
-                        [non_nan_ids, :, :]*self.X_[non_nan_ids, :].unsqueeze(1),
-                                  dim=-1))
+                # sum_n R_nk x_nm (x_n(-m).w(-m) + x_n.u_n - y_n)
+                sum_term = torch.sum(XX[:, m, ids]*\
+                    self.w_mu_[ids, d, :][:, self.sig_trajs_].T, 1) + \
+                    stats['XU'][d, self.sig_trajs_, m] - \
+                    stats['XY'][d, self.sig_trajs_, m]
 
-                    ranef_term2 = 2*torch.matmul(self.X_[non_nan_ids, :],
-                        self.w_mu_[:, d, :])*\
-                        torch.sum(self.u_mu_[self.N_to_G_index_map_, d, :, :]\
-                        [non_nan_ids, :, :]*self.X_[non_nan_ids, :].unsqueeze(1),
-                                  dim=-1)
+                self.w_mu_[m, d, self.sig_trajs_] = \
+                    self.w_var_[m, d, self.sig_trajs_]*\
+                    (-lambda_mean*sum_term + mu0_DIV_var0[m, d])
 
-                    u_Sig_times_X = torch.einsum('nkij,ni->nkj',
-                        self.u_Sig_[self.N_to_G_index_map_, d, :, :, :],
-                        self.X_[non_nan_ids, :])
-                    X_times_u_Sig_times_X = torch.einsum('nkj,nj->nk', \
-                        u_Sig_times_X, self.X_[non_nan_ids, :])
-                    ranef_term3 = X_times_u_Sig_times_X + \
-                        torch.sum(self.u_mu_[self.N_to_G_index_map_, d, :, :]*\
-                            self.X_[non_nan_ids, :].unsqueeze(1), dim=-1)**2
+    def update_lambda(self, stats=None):
+        """Updates the variational distribution over latent variable lambda.
 
-                    ranef_terms = ranef_term1 + ranef_term2 + ranef_term3
+        Parameters
+        ----------
+        stats : dict, optional
+            Sufficient statistics as returned by 'compute_suff_stats'. If not
+            specified, they will be computed.
+        """
+        if stats is None:
+            stats = self.compute_suff_stats()
 
-                tmp = (torch.mm(self.w_mu_[:, d, self.sig_trajs_].T, \
-                           self.X_[non_nan_ids, :].T)**2).T + \
-                           torch.sum((self.X_[non_nan_ids, None, :]**2)*\
-                                  (self.w_var_[:, d, self.sig_trajs_].T)\
-                                  [None, :, :], 2)
+        for d in range(self.D_):
+            if self.target_type_[d] == 'gaussian':
+                self.lambda_a_[d, self.sig_trajs_] = \
+                    self.lambda_a0_mod_[d, None] + \
+                    0.5*stats['R'][d, self.sig_trajs_]
+
+                # Expected squared residual, sum_n R_nk E[(y_n - x_n.w_k -
+                # x_n.u_n)^2], written in terms of the sufficient statistics
+                w_mu = self.w_mu_[:, d, self.sig_trajs_].T
+                w_var = self.w_var_[:, d, self.sig_trajs_].T
+                XX = stats['XX'][d, self.sig_trajs_]
+                resid = torch.einsum('km,kml,kl->k', w_mu, XX, w_mu) + \
+                    torch.sum(torch.diagonal(XX, dim1=1, dim2=2)*w_var, 1) - \
+                    2*torch.sum(stats['XY'][d, self.sig_trajs_]*w_mu, 1) + \
+                    stats['YY'][d, self.sig_trajs_] + \
+                    2*torch.sum(stats['XU'][d, self.sig_trajs_]*w_mu, 1) + \
+                    stats['UU'][d, self.sig_trajs_]
 
                 self.lambda_b_[d, self.sig_trajs_] = \
-                    self.lambda_b0_mod_[d, None] + \
-                    0.5*torch.sum(self.R_[non_nan_ids, :][:, self.sig_trajs_]*\
-                            (ranef_terms[:, self.sig_trajs_] + tmp - \
-                             2*self.Y_[non_nan_ids, d, None]*\
-                             torch.mm(self.X_[non_nan_ids, :], \
-                                    self.w_mu_[:, d, self.sig_trajs_]) + \
-                             self.Y_[non_nan_ids, d, None]**2), 0)                    
+                    self.lambda_b0_mod_[d, None] + 0.5*resid
 
     def update_u(self):
         """Updates the variational distribution over the random effects
@@ -1247,297 +2784,1026 @@ class MultDPRegression:
             self.v_b_ = torch.from_numpy(self.v_b_)            
             
     
+    def _get_state_key(self, names, identity_names=()):
+        """Returns a key identifying the current values of the named
+        attributes, for caching quantities derived from them (see
+        '_state_key_matches'). The key holds references to the attributes'
+        values, so that a value cannot be freed and its id reused while a
+        cache refers to it. Tensors are identified by object and in-place
+        modification count, so that both reassignment and in-place updates
+        change the key; dictionaries are copied and compared by value; other
+        values are identified by object. Returns None (no caching) if an
+        attribute is a numpy array, whose in-place updates can not be
+        detected, unless it is listed in 'identity_names' (attributes that
+        are only ever replaced, never modified in place).
+        """
+        key = []
+        for name in names:
+            vv = getattr(self, name, None)
+            if torch.is_tensor(vv):
+                key.append(('tensor', vv, vv._version))
+            elif isinstance(vv, dict):
+                key.append(('dict', dict(vv)))
+            elif isinstance(vv, np.ndarray) and name not in identity_names:
+                return None
+            else:
+                key.append(('object', vv))
+
+        return key
+
+    @staticmethod
+    def _state_key_matches(key, other):
+        """Checks whether two keys returned by '_get_state_key' identify the
+        same attribute values. None matches nothing.
+        """
+        if key is None or other is None or len(key) != len(other):
+            return False
+
+        for kk, oo in zip(key, other):
+            if kk[0] != oo[0]:
+                return False
+            elif kk[0] == 'dict':
+                if kk[1] != oo[1]:
+                    return False
+            elif kk[1] is not oo[1] or kk[2:] != oo[2:]:
+                return False
+
+        return True
+
+    def _get_log_likelihood_terms(self):
+        """Computes, for each data instance and trajectory, the log-likelihood
+        of the instance's targets given the expected values of the
+        trajectory's coefficients, random effects and precisions. Missing
+        (NaN) targets do not contribute. The terms are kept until any of the
+        quantities they depend on changes.
+
+        Returns
+        -------
+        terms : torch.Tensor, shape ( N, K )
+            Log-likelihood terms.
+
+        num_obs : torch.Tensor
+            Number of non-missing target values.
+        """
+        if getattr(self, 'G_', None) is None:
+            self.G_ = self.gb_.ngroups
+
+        if getattr(self, 'N_to_G_index_map_', None) is None:
+            self._set_N_to_G_index_map()
+
+        # The index map is only ever replaced, not modified in place
+        key = self._get_state_key(['X_', 'Y_', 'w_mu_', 'lambda_a_',
+                                   'lambda_b_', 'u_mu_', 'target_type_',
+                                   'N_to_G_index_map_'],
+                                  identity_names=['N_to_G_index_map_'])
+        cache = getattr(self, 'log_likelihood_cache_', None)
+        if cache is not None and self._state_key_matches(key, cache[0]):
+            return cache[1], cache[2]
+
+        to_tensor = lambda vv: torch.as_tensor(vv, dtype=torch.float64)
+        X = to_tensor(self.X_)
+        Y = to_tensor(self.Y_)
+        w_mu = to_tensor(self.w_mu_)
+        lambda_a = to_tensor(self.lambda_a_)
+        lambda_b = to_tensor(self.lambda_b_)
+
+        valid = ~torch.isnan(Y)
+        gaussian = torch.tensor([self.target_type_[d] == 'gaussian' \
+                                 for d in range(self.D_)])
+        y = torch.where(valid, Y, torch.zeros_like(Y)).unsqueeze(2)
+
+        # Linear predictor of every instance, target and trajectory. Random
+        # effects only enter the predictor of Gaussian targets.
+        mu = torch.matmul(X, w_mu.reshape(self.M_, -1)).\
+            reshape(self.N_, self.D_, self.K_)
+        if getattr(self, 'u_mu_', None) is not None:
+            u_mu = to_tensor(self.u_mu_)
+            for mm in range(self.M_):
+                mu = mu + torch.where(gaussian[:, None],
+                    X[:, mm, None, None]*\
+                    u_mu[self.N_to_G_index_map_, :, :, mm], 0.)
+
+        v = lambda_b/lambda_a
+        ll_gaussian = -0.5*torch.log(2.*torch.pi*v) - (y - mu)**2/(2.*v)
+        ll_binary = y*mu - torch.nn.functional.softplus(mu)
+        ll = torch.where(gaussian[:, None], ll_gaussian, ll_binary)
+
+        terms = torch.sum(torch.where(valid.unsqueeze(2), ll, 0.), 1)
+        num_obs = torch.sum(valid)
+
+        if key is not None:
+            self.log_likelihood_cache_ = (key, terms, num_obs)
+
+        return terms, num_obs
+
     def log_likelihood(self):
         """Compute the log-likelihood given expected values of the latent 
-        variables.
-    
-        TODO: Test implementation of binary targets
+        variables. The per-instance, per-trajectory terms are computed in a
+        single batched operation and reused while the model is unchanged
+        (see '_get_log_likelihood_terms').
     
         Returns
         -------
         log_likelihood : float
             The log-likelihood
         """
-        if not torch.is_tensor(self.Y_):
-            Y = torch.from_numpy(self.Y_).double()
+        terms, num_obs = self._get_log_likelihood_terms()
+        R = torch.as_tensor(self.R_, dtype=torch.float64)
+
+        return torch.sum(R*terms)
+
+
+    def bic(self):
+        """Computes the Bayesian Information Criterion according to formula 4.1 
+        in the reference. Assumes same number of parameters for each trajectory 
+        and for each target dimension.
+    
+        Returns
+        -------
+        bic_obs[, bic_groups] : float or tuple
+            The BIC values. It 'groupby' was specified during the fitting 
+            routine, the groups will indicate the number of individuals in the 
+            data set. In this case, two BIC values will be computed: one in 
+            which N is taken to be the number of observations (underestimates 
+            true BIC) and one in which N is taken to be the number of subjects 
+            (overstates true BIC). If the number of subjects can not be 
+            ascertained, a single BIC value (where N is taken to be the number 
+            of observations) is returned.
+    
+        References
+        ----------
+        Nagin DS, Group-based modeling of development. Harvard University Press; 
+        2005.
+        """
+        terms, num_obs_tally = self._get_log_likelihood_terms()
+        R = torch.as_tensor(self.R_, dtype=torch.float64)
+
+        ll = torch.sum(R*terms)
+        num_trajs = torch.sum(torch.sum(R, 0) > 0.0)
+    
+        # The first term below tallies the number of predictors for each
+        # trajectory (means and variances) and for each target variable. Here we
+        # assume the same number of predictors for each trajectory and for each
+        # target variable. The second term tallies the number of parameters
+        # derived from the total number of trajectories (i.e. the trajectory
+        # weights). They must sum to one, that's why we subtract by one (the
+        # last parameter value is determined by the sum of the others). We also
+        # include the parameters estimated for each trajectory's residual
+        # variance (2 params estimated for each Gamma distribution)
+        num_params = (2*num_trajs*self.M_*self.D_) + (num_trajs - 1.) + \
+            2*num_trajs*(self.D_ - self.num_binary_targets_)
+
+        # Add estimates of random effects to the total number of parameters if
+        # needed
+        if getattr(self, 'ranef_indices_', None) is not None:
+            num_ranefs = np.sum(self.ranef_indices_)
+            num_params += num_trajs*num_ranefs*\
+                (self.D_ - self.num_binary_targets_)*self.G_
+        
+        # Per recommendation in the reference, two BICs are computed: one in
+        # which N is taken to be the number of observations (overstates true
+        # "N") and one in which N is taken to be the number of subjects
+        # (understates true "N"). Note that when we compute the total number of
+        # observations, we sum across each of the target variable dimensions,
+        # and for each dimension, we only consider those instances with
+        # non-NaN values (the tally is returned with the log-likelihood
+        # terms).
+        bic_obs = ll - 0.5*num_params*torch.log(num_obs_tally)
+        
+        if self.gb_ is not None:
+            num_subjects = self.gb_.ngroups
+            bic_groups = ll - 0.5*num_params*np.log(num_subjects)
+    
+            return (bic_obs, bic_groups)
         else:
-            Y = self.Y_
+            return bic_obs
+
+    def compute_waic2(self, S=100, max_bytes=2**28, sampling='iid',
+                      num_replicates=8, return_se=False, method='mc',
+                      num_quad_points=64, seed=None, return_pointwise=False):
+        """Computes the Watanabe-Akaike (aka widely available) information
+        criterion, using the variance of individual terms in the log predictive
+        density summed over the n data points.
+
+        The posterior draws of the trajectory assignments, coefficients and
+        precisions are made up front; with 'iid' sampling they are made in
+        the same order as earlier versions of this function, so results are
+        the same for a given random seed (for models without random effects).
+        The likelihood of each data point under each draw is then computed in
+        chunks of groups (subjects) and draws whose size is set by
+        'max_bytes', and the log of the mean likelihood and the variance of
+        the log likelihood of each data point are accumulated online (the
+        latter with Welford's algorithm). Random effects are drawn for one
+        chunk of groups at a time, with a random number generator seeded for
+        that chunk, so that the draws are reproducible but depend on the
+        chunking. Memory use is therefore bounded by 'max_bytes' plus the
+        up-front draws, chiefly a G x S matrix of trajectory assignments (G
+        being the number of groups). Missing target values do not contribute.
+
+        With 'antithetic' or 'qmc' sampling, draws are obtained by pushing
+        uniform variates through inverse CDFs: antithetic pairs (u, 1 - u),
+        or randomized (scrambled) Sobol sequences. Both reduce the Monte Carlo
+        error of the estimate for a given S. Sobol sequences are only used for
+        the coefficients and precisions, which need M and T (the number of
+        active trajectories) variates per draw. The trajectory assignments
+        and random effects need variates for every group, a dimension in
+        which Sobol sequences do no better than independent draws, so with
+        'qmc' sampling they are drawn independently.
+
+        With the 'analytic' method, no draws are made. The trajectory
+        assignments are summed over exactly, and for each trajectory the
+        mean and variance of the log likelihood of a data point are computed
+        in closed form (Gaussian targets) or with Gauss-Hermite quadrature
+        over the linear predictor (binary targets), as is the expected
+        likelihood of binary targets. The expected likelihood of Gaussian
+        targets, a normal with variance x^T Var[w] x + 1/lambda averaged over
+        the gamma posterior of the precision lambda, is computed with a
+        midpoint rule over the quantiles of that posterior. The result is
+        deterministic and is what the Monte Carlo estimate converges to as S
+        grows (up to the 1e-45 lower bound the Monte Carlo estimate puts on
+        likelihoods).
+
+        Parameters
+        ----------
+        S : integer, optional
+            The number of draws from the posterior to use when computing the
+            required expectations.
+
+        max_bytes : integer, optional
+            Approximate memory budget, in bytes, for the intermediate
+            quantities computed for a chunk of data points and draws.
+
+        sampling : str, optional
+            'iid' (independent draws), 'antithetic' (antithetic pairs; S must
+            be even) or 'qmc' (randomized quasi-Monte Carlo).
+
+        num_replicates : integer, optional
+            For 'qmc' sampling, the S draws are split into this many
+            independently scrambled Sobol sequences. Needed to estimate the
+            standard error; ignored for other sampling schemes.
+
+        return_se : bool, optional
+            If true, the Monte Carlo standard error of the estimate is
+            returned as well. It is computed with the delta method from the
+            per-draw influence on the criterion, and requires a second pass
+            over the data.
+
+        method : str, optional
+            'mc' (Monte Carlo) or 'analytic'. With 'analytic', 'S',
+            'sampling' and 'num_replicates' are ignored.
+
+        num_quad_points : integer, optional
+            Number of quadrature points used by the 'analytic' method.
+
+        seed : integer, optional
+            If specified, the posterior draws are made with this random seed
+            and are cached (see 'get_posterior_samples').
+
+        return_pointwise : bool, optional
+            If true, the contribution of each group (subject) to the
+            criterion is returned as well.
+
+        Returns
+        -------
+        waic2 : float
+            The Watanable-Akaike information criterion.
+
+        se : float
+            Monte Carlo standard error of 'waic2' (0 for the 'analytic'
+            method). Only returned if 'return_se' is true.
+
+        pointwise : array, shape ( G )
+            Contribution of each group to 'waic2' (they sum to it). Their
+            spread gives the standard error of 'waic2' across subjects, as
+            for PSIS-LOO. Only returned if 'return_pointwise' is true.
+
+        References
+        ----------
+        Gelman et al, 'Bayesian Data Analysis, 3rd Edition'
+
+        Owen, 'Monte Carlo theory, methods and examples', chapters 8 and 17
+        """
+        assert method in ['mc', 'analytic'], \
+            "Unknown method: {}".format(method)
+        assert sampling in ['iid', 'antithetic', 'qmc'], \
+            "Unknown sampling scheme: {}".format(sampling)
+        assert sampling != 'antithetic' or S % 2 == 0, \
+            "S must be even for antithetic sampling"
+        assert sampling != 'qmc' or 1 < num_replicates <= S, \
+            "num_replicates must be between 2 and S"
+
+        if getattr(self, 'N_to_G_index_map_', None) is None:
+            self._set_N_to_G_index_map()            
+
+        if method == 'analytic':
+            lppd, pwaic = self._waic2_analytic_terms(max_bytes,
+                                                     num_quad_points)
+            pointwise = (-2*(lppd - pwaic)).numpy()
+            waic2 = float(np.sum(pointwise))
+
+            return self._waic2_outputs(waic2, 0., pointwise, return_se,
+                                       return_pointwise)
+
+        samples = self.get_posterior_samples(S, seed, sampling, num_replicates)
+
+        # Each (data point, draw) pair needs the sampled coefficients and a
+        # handful of scalars, for each target
+        use_ranefs = samples['ranef_seed'] is not None
+        ranef_dim = self.M_ if use_ranefs else 0
+        elem_bytes = 8*(self.M_ + ranef_dim + 8)
+        S_chunk = int(np.clip(max_bytes//(elem_bytes*min(self.N_, 1024)),
+                              1, S))
+        N_chunk = int(np.clip(max_bytes//(elem_bytes*S_chunk), 1, self.N_))
+
+        # The random effects of a group need M values per draw for each
+        # Gaussian target and active trajectory
+        G = int(np.sum(np.asarray(self.group_first_index_)))
+        ranef_bytes = 8*S*self.M_*np.sum(self.sig_trajs_.numpy())*\
+            np.sum([self.target_type_[dd] == 'gaussian' for dd in range(self.D_)])
+        G_chunk = int(np.clip(max_bytes//ranef_bytes, 1, G)) \
+            if use_ranefs and ranef_bytes > 0 else G
+
+        # Chunks are made of whole groups, so that the random effects of a
+        # group are drawn once; terms are accumulated per group
+        N_to_G = np.asarray(self.N_to_G_index_map_)
+        order = np.argsort(N_to_G, kind='stable')
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(N_to_G,
+                                                            minlength=G))])
+        lppd = torch.zeros(G, dtype=torch.float64)
+        pwaic = torch.zeros(G, dtype=torch.float64)
+        influence = torch.zeros(S, dtype=torch.float64)
+        g0 = 0
+        while g0 < G:
+            g1 = int(np.minimum(np.maximum(np.searchsorted(indptr,
+                indptr[g0] + N_chunk, side='right') - 1, g0 + 1),
+                                g0 + G_chunk))
+            rows = torch.from_numpy(order[indptr[g0]:indptr[g1]])
+            groups = torch.from_numpy(N_to_G[rows.numpy()] - g0)
+            chunk = dict(samples, traj=samples['traj'][g0:g1],
+                ranef=self._sample_ranefs(samples, np.arange(g0, g1),
+                    self._get_ranef_generator(samples, g0)))
+            count = torch.zeros(rows.shape[0], self.D_, dtype=torch.float64)
+            ll_max = torch.full([rows.shape[0], self.D_], -np.inf,
+                                dtype=torch.float64)
+            exp_sum = torch.zeros(rows.shape[0], self.D_, dtype=torch.float64)
+            ll_mean = torch.zeros(rows.shape[0], self.D_, dtype=torch.float64)
+            ll_m2 = torch.zeros(rows.shape[0], self.D_, dtype=torch.float64)
+            for s0 in range(0, S, S_chunk):
+                ll = self._waic2_log_likelihood(chunk, rows, s0,
+                                                min(s0 + S_chunk, S), groups)
+                valid = ~torch.isnan(ll[:, :, 0])
+                ll = torch.nan_to_num(ll)
+                num = ll.shape[2]
+
+                # Log of the sum of the likelihoods
+                chunk_max = torch.max(ll, dim=2).values
+                new_max = torch.maximum(ll_max, chunk_max)
+                exp_sum = exp_sum*torch.exp(ll_max - new_max) + \
+                    torch.sum(torch.exp(ll - new_max.unsqueeze(-1)), 2)
+                ll_max = new_max
+
+                # Variance of the log likelihoods (Welford/Chan update)
+                chunk_mean = torch.mean(ll, 2)
+                chunk_m2 = torch.sum((ll - chunk_mean.unsqueeze(-1))**2, 2)
+                delta = chunk_mean - ll_mean
+                ll_mean = ll_mean + delta*num/(count + num)
+                ll_m2 = ll_m2 + chunk_m2 + delta**2*count*num/(count + num)
+                count = count + valid*num
+
+            valid = count > 0
+            log_mean = ll_max + torch.log(exp_sum/S)
+            lppd.index_add_(0, groups + g0, torch.sum(torch.where(valid,
+                log_mean, torch.zeros_like(log_mean)), 1))
+            pwaic.index_add_(0, groups + g0, torch.sum(torch.where(valid, \
+                ll_m2/count.clamp(min=1), torch.zeros_like(ll_m2)), 1))
+
+            if return_se:
+                # Influence of each draw on the criterion: the gradient of
+                # the criterion with respect to the per-point sample means it
+                # is a function of, dotted with the draw's values
+                for s0 in range(0, S, S_chunk):
+                    ll = self._waic2_log_likelihood(chunk, rows, s0,
+                        min(s0 + S_chunk, S), groups)
+                    terms = torch.exp(ll - log_mean.unsqueeze(-1)) - \
+                        (ll - ll_mean.unsqueeze(-1))**2
+                    influence[s0:s0 + ll.shape[2]] += \
+                        -2*torch.sum(torch.nan_to_num(terms), (0, 1))
+            g0 = g1
+
+        pointwise = (-2*(lppd - pwaic)).numpy()
+        waic2 = float(np.sum(pointwise))
+
+        if not return_se:
+            return self._waic2_outputs(waic2, None, pointwise, return_se,
+                                       return_pointwise)
+
+        # Draws in different blocks are independent
+        blocks = samples['blocks']
+        num_blocks = int(torch.max(blocks)) + 1
+        block_means = torch.zeros(num_blocks, dtype=torch.float64).\
+            index_add_(0, blocks, influence)/\
+            torch.bincount(blocks, minlength=num_blocks)
+        se = (torch.std(block_means)/np.sqrt(num_blocks)).item()
+
+        return self._waic2_outputs(waic2, se, pointwise, return_se,
+                                   return_pointwise)
+
+    @staticmethod
+    def _waic2_outputs(waic2, se, pointwise, return_se, return_pointwise):
+        """Assembles the return value of 'compute_waic2'.
+        """
+        outputs = (waic2,) + ((se,) if return_se else ()) + \
+            ((pointwise,) if return_pointwise else ())
+
+        return outputs if len(outputs) > 1 else waic2
+
+    def _waic2_analytic_terms(self, max_bytes, num_quad_points):
+        """Computes the log pointwise predictive density and the WAIC2
+        penalty without sampling (see the 'analytic' method of
+        'compute_waic2').
+
+        Parameters
+        ----------
+        max_bytes : integer
+            Approximate memory budget, in bytes, for the intermediate
+            quantities computed for a chunk of data points.
+
+        num_quad_points : integer
+            Number of quadrature points.
+
+        Returns
+        -------
+        lppd : torch.Tensor, shape ( G )
+            Log pointwise predictive density of each group, summed over the
+            group's data points and (observed) targets.
+
+        pwaic : torch.Tensor, shape ( G )
+            Sum over each group's data points and (observed) targets of the
+            posterior variance of the log likelihood.
+        """
+        traj_ids = np.where(self.sig_trajs_)[0]
+        T = traj_ids.shape[0]
+        J = num_quad_points
+
+        probs = self.R_[:, self.sig_trajs_][self.group_first_index_, :].\
+            double()
+        log_probs = torch.log(probs)
+
+        nodes, weights = np.polynomial.hermite_e.hermegauss(J)
+        nodes = torch.from_numpy(nodes)
+        log_weights = torch.from_numpy(np.log(weights/np.sqrt(2*np.pi)))
+        quantiles = (np.arange(J) + 0.5)/J
+
+        N_chunk = int(np.clip(max_bytes//(8*T*(J + self.M_ + 8)), 1,
+                              self.N_))
+        G = probs.shape[0]
+        lppd = torch.zeros(G, dtype=torch.float64)
+        pwaic = torch.zeros(G, dtype=torch.float64)
+        for n0 in range(0, self.N_, N_chunk):
+            rows = torch.arange(n0, min(n0 + N_chunk, self.N_))
+            groups = torch.as_tensor(self.N_to_G_index_map_)[rows]
+            X = self.X_[rows, :].double()
+            for dd in range(self.D_):
+                y = self.Y_[rows, dd].double()
+                valid = ~torch.isnan(y)
+                y = torch.nan_to_num(y).unsqueeze(1)
+
+                # Mean and variance of the linear predictor under each
+                # trajectory
+                mu = X@self.w_mu_[:, dd, traj_ids].double()
+                var = (X**2)@self.w_var_[:, dd, traj_ids].double()
+                if self.ranef_indices_ is not None and \
+                   self.target_type_[dd] == 'gaussian':
+                    X_r = X[:, self.ranef_indices_]
+                    for ii, kk in enumerate(traj_ids):
+                        u_mu = self.u_mu_[groups, dd, kk][:, \
+                            self.ranef_indices_].double()
+                        u_Sig = self.u_Sig_[groups, dd, kk][:, \
+                            self.ranef_indices_, :][:, :, \
+                            self.ranef_indices_].double()
+                        mu[:, ii] += torch.sum(X_r*u_mu, 1)
+                        var[:, ii] += torch.einsum('nr,nrl,nl->n', X_r,
+                                                   u_Sig, X_r)
+
+                if self.target_type_[dd] == 'gaussian':
+                    a = self.lambda_a_[dd, traj_ids].double()
+                    b = self.lambda_b_[dd, traj_ids].double()
+                    e = y - mu
+                    e2 = e**2 + var
+                    e4 = e**4 + 6*e**2*var + 3*var**2
+                    mean_ll = 0.5*(torch.digamma(a) - torch.log(b) - \
+                                   np.log(2*np.pi)) - 0.5*(a/b)*e2
+                    var_ll = 0.25*torch.polygamma(1, a) + \
+                        0.25*(a*(a + 1)/b**2*e4 - (a/b*e2)**2) - 0.5*e2/b
+
+                    lam = torch.from_numpy(gammaincinv(a.numpy()[None, :],
+                        quantiles[:, None]))/b
+                    s2 = var.unsqueeze(-1) + 1/lam.T
+                    log_p = torch.logsumexp(-0.5*torch.log(2*np.pi*s2) - \
+                        0.5*e.unsqueeze(-1)**2/s2, 2) - np.log(J)
+                elif self.target_type_[dd] == 'binary':
+                    t = mu.unsqueeze(-1) + \
+                        torch.sqrt(var).unsqueeze(-1)*nodes
+                    ll = y.unsqueeze(-1)*t - \
+                        torch.logaddexp(t, torch.zeros_like(t))
+                    log_p = torch.logsumexp(ll + log_weights, 2)
+                    mean_ll = torch.sum(torch.exp(log_weights)*ll, 2)
+                    var_ll = torch.sum(torch.exp(log_weights)*\
+                                       (ll - mean_ll.unsqueeze(-1))**2, 2)
+                else:
+                    raise AttributeError('Unknown target type')
+
+                # Sum over the trajectory assignments
+                r = probs[groups]
+                mean_ll_mix = torch.sum(r*mean_ll, 1)
+                var_ll_mix = torch.sum(r*(var_ll + mean_ll**2), 1) - \
+                    mean_ll_mix**2
+                lppd.index_add_(0, groups[valid], torch.logsumexp(\
+                    log_probs[groups] + log_p, 1)[valid])
+                pwaic.index_add_(0, groups[valid], var_ll_mix[valid])
+
+        return lppd, pwaic
+
+    def _get_posterior_cache(self):
+        """Returns the model's posterior sample cache, creating it if needed.
+        """
+        cache = getattr(self, 'posterior_cache_', None)
+        if cache is None:
+            cache = PosteriorSampleCache()
+            self.posterior_cache_ = cache
+
+        return cache
+
+    def get_posterior_samples(self, S=1000, seed=None, sampling='iid',
+                              num_replicates=8, group_level=True):
+        """Draws from the posterior: trajectory coefficients and precisions
+        and, optionally, trajectory assignments and random effects of each
+        group. If a seed is given, the draws are made with that seed and
+        kept in the model's posterior sample cache (see
+        bayes_traj.posterior_cache), so that later requests for the same
+        draws -- e.g. from 'compute_waic2', or from 'prior_from_model' -- do
+        not draw again. The cache is not saved with the model, but it can be
+        persisted with 'posterior_cache_.save(file_name)'.
+
+        Parameters
+        ----------
+        S : integer, optional
+            Number of draws.
+
+        seed : integer, optional
+            Random seed. If not specified, the draws are made with the current
+            state of the random number generator and are not cached.
+
+        sampling : str, optional
+            'iid', 'antithetic' or 'qmc'. See 'compute_waic2'.
+
+        num_replicates : integer, optional
+            Number of independently scrambled Sobol sequences ('qmc' only).
+
+        group_level : bool, optional
+            If false, no trajectory assignments or random effects are drawn
+            (the corresponding entries have no groups).
+
+        Returns
+        -------
+        samples : dict
+            See '_sample_waic2_posterior'.
+        """
+        groups = None if group_level else np.arange(0)
+
+        return self._get_posterior_cache().get(self, 'posterior', S, seed,
+            lambda: self._sample_waic2_posterior(S, sampling, num_replicates,
+                                                 groups),
+            sampling=sampling, num_replicates=num_replicates,
+            group_level=group_level)
+
+    def _get_uniform_samples(self, S, dim, sampling, num_replicates):
+        """Draws uniform variates for 'antithetic' or 'qmc' sampling (see
+        'compute_waic2').
+
+        Parameters
+        ----------
+        S : integer
+            Number of draws.
+
+        dim : integer
+            Number of variates per draw.
+
+        sampling : str
+            'antithetic' or 'qmc'.
+
+        num_replicates : integer
+            Number of independently scrambled Sobol sequences ('qmc' only).
+
+        Returns
+        -------
+        u : tensor, shape ( S, dim )
+            Uniform variates, in the open interval (0, 1).
+
+        blocks : tensor, shape ( S )
+            Index of the block each draw belongs to. Draws in different blocks
+            are independent.
+        """
+        if sampling == 'antithetic':
+            u = torch.rand(S//2, dim, dtype=torch.float64)
+            u = torch.cat([u, 1 - u])
+        else:
+            sizes = [len(ii) for ii in np.array_split(np.arange(S),
+                                                      num_replicates)]
+            u = torch.zeros(S, dim, dtype=torch.float64)
+            for rr, s0 in enumerate(np.cumsum([0] + sizes[:-1])):
+                for d0 in range(0, dim, torch.quasirandom.SobolEngine.MAXDIM):
+                    d1 = min(d0 + torch.quasirandom.SobolEngine.MAXDIM, dim)
+                    engine = torch.quasirandom.SobolEngine(d1 - d0,
+                        scramble=True,
+                        seed=int(torch.randint(2**31 - 1, (1,))))
+                    u[s0:s0 + sizes[rr], d0:d1] = \
+                        engine.draw(sizes[rr], dtype=torch.float64)
+
+        eps = np.finfo(float).eps
+        return torch.clamp(u, eps, 1 - eps), \
+            self._get_sample_blocks(S, sampling, num_replicates)
+
+    def _get_sample_blocks(self, S, sampling, num_replicates):
+        """Returns the index of the independent block each of S draws
+        belongs to (see 'compute_waic2'): single draws for 'iid' sampling,
+        antithetic pairs, or Sobol replicates for 'qmc' sampling.
+        """
+        if sampling == 'iid':
+            return torch.arange(S)
+        elif sampling == 'antithetic':
+            return torch.arange(S)%(S//2)
+
+        sizes = [len(ii) for ii in np.array_split(np.arange(S),
+                                                  num_replicates)]
+        return torch.repeat_interleave(torch.arange(num_replicates),
+                                       torch.tensor(sizes))
+
+    def _sample_waic2_posterior(self, S, sampling='iid', num_replicates=8,
+                                groups=None):
+        """Draws the posterior samples used by 'compute_waic2'.
+
+        Parameters
+        ----------
+        S : integer
+            Number of draws.
+
+        sampling : str, optional
+            'iid', 'antithetic' or 'qmc'. See 'compute_waic2'.
+
+        num_replicates : integer, optional
+            Number of independently scrambled Sobol sequences ('qmc' only).
+
+        groups : array, optional
+            Indices of the groups for which trajectory assignments are drawn.
+            By default, all groups (G below is then the number of groups
+            given).
+
+        Returns
+        -------
+        samples : dict
+            'traj' : tensor, shape ( G, S ), sampled trajectory of each group
+            (as an index into the active trajectories); 'w' : list over
+            targets of coefficient samples, each with shape ( T, S, M );
+            'prec' : list over targets of precision samples, each with shape
+            ( S, T ); 'ranef' : None (random effects are drawn a chunk of
+            groups at a time, see '_sample_ranefs'); 'ranef_seed' : seed for
+            the random effect draws, or None if the model has no random
+            effects; 'sampling' : the sampling scheme; 'blocks' : tensor,
+            shape ( S ), index of the independent block each draw belongs to.
+            T is the number of active trajectories.
+        """
+        traj_ids = np.where(self.sig_trajs_)[0]
+        use_ranefs = self.ranef_indices_ is not None
+
+        if sampling != 'iid':
+            uniform = lambda dim: self._get_uniform_samples(S, dim, sampling,
+                                                            num_replicates)[0]
+            std_normal = lambda dim: torch.special.ndtri(uniform(dim))
+
+        #-----------------------------------------------------------------------
+        # Get samples of trajectory assignments. We sample the traj
+        # assignments outside the loop over the target dimensions because the
+        # model assumes conditional independence.
+        #-----------------------------------------------------------------------
+        probs = self.R_[:, self.sig_trajs_][self.group_first_index_, :]
+        if groups is None:
+            groups = np.arange(probs.shape[0])
+        else:
+            probs = probs[groups]
+        G = probs.shape[0]
+
+        blocks = self._get_sample_blocks(S, sampling, num_replicates)
+        if sampling == 'iid':
+            traj = torch.multinomial(probs, num_samples=S, replacement=True)
+        else:
+            # One dimension per group: too many for Sobol sequences to help
+            if sampling == 'qmc':
+                eps = np.finfo(float).eps
+                u = torch.clamp(torch.rand(S, G, dtype=torch.float64), eps,
+                                1 - eps)
+            else:
+                u = self._get_uniform_samples(S, G, sampling,
+                                              num_replicates)[0]
+            cum_probs = torch.cumsum(probs.double(), 1)
+            traj = torch.searchsorted(cum_probs,
+                                      (u.T*cum_probs[:, -1:]).contiguous())
+            traj = torch.clamp(traj, max=traj_ids.shape[0] - 1)
+
+        w = []
+        prec = []
+        for dd in range(self.D_):
+            w_dd = []
+            for kk in traj_ids:
+                mu = self.w_mu_[:, dd, kk].expand(S, -1)
+                std = torch.sqrt(self.w_var_[:, dd, kk].expand(S, -1))
+                if sampling == 'iid':
+                    # The first draw is not used, but is kept so that the
+                    # random number stream matches earlier versions of
+                    # 'compute_waic2'
+                    torch.normal(mean=mu, std=std)
+                    w_dd.append(torch.normal(mean=mu, std=std))
+                else:
+                    w_dd.append(mu + std*std_normal(self.M_))
+
+            w.append(torch.stack(w_dd).double())
+
+            #-------------------------------------------------------------------
+            # Get samples from the gamma distribution over the precisions
+            #-------------------------------------------------------------------
+            lambda_b_ = self.lambda_b_[dd, traj_ids].unsqueeze(0)
+            lambda_a_ = self.lambda_a_[dd, traj_ids].unsqueeze(0)
+            if sampling == 'iid':
+                prec.append(\
+                    (torch.distributions.Gamma(lambda_a_, lambda_b_).\
+                     sample((S,))).squeeze(1).double())
+            else:
+                prec.append(torch.from_numpy(\
+                    gammaincinv(lambda_a_.double().numpy(),
+                                uniform(traj_ids.shape[0]).numpy())/\
+                    lambda_b_.double().numpy()))
+
+        ranef_seed = int(torch.randint(2**31 - 1, (1,))) if use_ranefs \
+            else None
+
+        return {'traj': traj, 'w': w, 'prec': prec, 'ranef': None,
+                'ranef_seed': ranef_seed, 'sampling': sampling,
+                'blocks': blocks}
+
+    def _get_ranef_generator(self, samples, g0):
+        """Returns the random number generator used to draw the random
+        effects of the chunk of groups starting at group 'g0' (see
+        '_sample_ranefs'), or None if the draws have no random effects.
+        """
+        if samples['ranef_seed'] is None:
+            return None
+
+        seed = np.random.SeedSequence([samples['ranef_seed'], int(g0)]).\
+            generate_state(1)[0]
+        return torch.Generator().manual_seed(int(seed))
+
+    def _sample_ranefs(self, samples, groups, generator=None):
+        """Draws the random effects of a chunk of groups for the posterior
+        draws made by '_sample_waic2_posterior'. With 'antithetic' sampling,
+        the draws come in antithetic pairs; otherwise they are independent.
+
+        Parameters
+        ----------
+        samples : dict
+            Posterior draws.
 
-        if not torch.is_tensor(self.X_):
-            X = torch.from_numpy(self.X_).double()
-        else:
-            X = self.X_
+        groups : array
+            Indices of the groups.
 
-        if not torch.is_tensor(self.R_):
-            R = torch.from_numpy(self.R_).double()
-        else:
-            R = self.R_
+        generator : torch.Generator, optional
+            Random number generator (see '_get_ranef_generator').
 
-        if not torch.is_tensor(self.w_mu_):
-            w_mu = torch.from_numpy(self.w_mu_).double()
-        else:
-            w_mu = self.w_mu_
+        Returns
+        -------
+        ranef : list or None
+            None if the model has no random effects. Otherwise, a list over
+            targets of lists over active trajectories of random effect
+            samples with shape ( len(groups), S, M ) (None for binary
+            targets).
+        """
+        if samples['ranef_seed'] is None:
+            return None
 
-        if 'G_' not in dir(self):
-            self.G_ = self.gb_.ngroups
+        S = samples['blocks'].shape[0]
+        G = len(groups)
+        ranef = []
+        for dd in range(self.D_):
+            ranef_dd = []
+            for kk in np.where(self.sig_trajs_)[0]:
+                if self.target_type_[dd] != 'gaussian':
+                    ranef_dd.append(None)
+                    continue
+
+                u_mu = self.u_mu_[groups, dd, kk][:, self.ranef_indices_].\
+                    double()
+                u_Sig = self.u_Sig_[groups, dd, kk][:, self.ranef_indices_, :]\
+                    [:, :, self.ranef_indices_].double()
+                R = u_mu.shape[1]
+                if samples['sampling'] == 'antithetic':
+                    z = torch.randn(G, S//2, R, dtype=torch.float64,
+                                    generator=generator)
+                    z = torch.cat([z, -z], 1)
+                else:
+                    z = torch.randn(G, S, R, dtype=torch.float64,
+                                    generator=generator)
+                L = torch.linalg.cholesky(u_Sig)
 
-        if 'N_to_G_index_map_' not in dir(self):            
-            self._set_N_to_G_index_map()
+                ranef_samples = torch.zeros(G, S, self.M_, dtype=torch.float64)
+                ranef_samples[:, :, self.ranef_indices_] = \
+                    u_mu.unsqueeze(1) + torch.einsum('gsr,glr->gsl', z, L)
+                ranef_dd.append(ranef_samples)
+            ranef.append(ranef_dd)
 
-        if 'ranef_indices_' not in dir(self):            
-            self.ranef_indices_ = None
-            
-        if not torch.is_tensor(self.lambda_a_):
-            lambda_a = torch.from_numpy(self.lambda_a_).double()
-            lambda_b = torch.from_numpy(self.lambda_b_).double()            
-        else:
-            lambda_a = self.lambda_a_
-            lambda_b = self.lambda_b_                        
+        return ranef
 
-        tmp_k = torch.zeros(self.N_, dtype=torch.float64)
-        for kk in range(self.K_):
-            tmp_d = torch.zeros(self.N_, dtype=torch.float64)
-            for dd in range(self.D_):
-                # Some of the target variables can be missing (NaNs). Exclude
-                # these from the computation.
-                ids = torch.isnan(Y[:, dd]) == 0
+    def _waic2_log_likelihood(self, samples, rows, s0, s1, groups=None):
+        """Computes the log likelihood of a chunk of data points under a chunk
+        of the posterior draws made by '_sample_waic2_posterior'. As in
+        earlier versions of 'compute_waic2', likelihoods are clipped below at
+        1e-45.
 
-                if ('u_mu_' not in dir(self)) or \
-                   (self.target_type_[dd] != 'gaussian'):
-                    u_mu = torch.zeros(self.G_, self.D_, self.K_, self.M_)
-                else:
-                    u_mu = self.u_mu_
-                                
-                if self.target_type_[dd] == 'gaussian':
-                    mu = torch.sum(self.X_ * \
-                        (self.w_mu_[:, dd, kk].unsqueeze(0) + \
-                         u_mu[self.N_to_G_index_map_, dd, kk, :]), 1)
-                    
-                    v = lambda_b[dd, kk]/lambda_a[dd, kk]
-                    co = torch.log(1/torch.sqrt(2.*torch.pi*v))
-    
-                    tmp_d[ids] += co - ((Y[ids, dd]-mu[ids])**2)/(2.*v)
-                else:
-                    # Target assumed to be binary
-                    prod = torch.sum(self.X_ * self.w_mu_[:, dd, kk], 1)
-                    tmp_d[ids] += prod[ids]*self.Y_[ids, dd] - \
-                        torch.log(1 + torch.exp(prod[ids]))
-                    
-            tmp_k = tmp_k + R[ids, kk]*tmp_d
-        log_likelihood = torch.sum(tmp_k)
-                
-        return log_likelihood
+        Parameters
+        ----------
+        samples : dict
+            Posterior draws.
 
+        rows : tensor
+            Indices of the data points.
+
+        s0, s1 : integer
+            The draws used are s0 to s1 - 1.
+
+        groups : tensor, optional
+            For each data point, the index of its group in the group-level
+            draws. By default, the index of its group in the model.
 
-    def bic(self):
-        """Computes the Bayesian Information Criterion according to formula 4.1 
-        in the reference. Assumes same number of parameters for each trajectory 
-        and for each target dimension.
-    
         Returns
         -------
-        bic_obs[, bic_groups] : float or tuple
-            The BIC values. It 'groupby' was specified during the fitting 
-            routine, the groups will indicate the number of individuals in the 
-            data set. In this case, two BIC values will be computed: one in 
-            which N is taken to be the number of observations (underestimates 
-            true BIC) and one in which N is taken to be the number of subjects 
-            (overstates true BIC). If the number of subjects can not be 
-            ascertained, a single BIC value (where N is taken to be the number 
-            of observations) is returned.
-    
-        References
-        ----------
-        Nagin DS, Group-based modeling of development. Harvard University Press; 
-        2005.
+        log_like : tensor, shape ( len(rows), D, s1 - s0 )
+            Log likelihoods. NaN where the target value is missing.
         """
-        self.cast_to_torch()
-        
-        ll = self.log_likelihood()
-        num_trajs = torch.sum(torch.sum(self.R_, 0) > 0.0)
-    
-        # The first term below tallies the number of predictors for each
-        # trajectory (means and variances) and for each target variable. Here we
-        # assume the same number of predictors for each trajectory and for each
-        # target variable. The second term tallies the number of parameters
-        # derived from the total number of trajectories (i.e. the trajectory
-        # weights). They must sum to one, that's why we subtract by one (the
-        # last parameter value is determined by the sum of the others). We also
-        # include the parameters estimated for each trajectory's residual
-        # variance (2 params estimated for each Gamma distribution)
-        num_params = (2*num_trajs*self.M_*self.D_) + (num_trajs - 1.) + \
-            2*num_trajs*(self.D_ - self.num_binary_targets_)
+        if groups is None:
+            groups = torch.as_tensor(self.N_to_G_index_map_)[rows]
+        traj = samples['traj'][groups, s0:s1]
+        draws = torch.arange(s1 - s0).unsqueeze(0)
+        X = self.X_[rows, :].double()
+
+        log_like = torch.zeros(rows.shape[0], self.D_, s1 - s0,
+                               dtype=torch.float64)
+        for dd in range(self.D_):
+            co_samples = samples['w'][dd][:, s0:s1, :][traj, draws, :]
+            if samples['ranef'] is not None and \
+               self.target_type_[dd] == 'gaussian':
+                for ii, rr in enumerate(samples['ranef'][dd]):
+                    co_samples = co_samples + (traj == ii).unsqueeze(-1)*\
+                        rr[groups, s0:s1, :]
+            pred_samples = torch.einsum('nsm,nm->ns', co_samples, X)
+
+            y = self.Y_[rows, dd].double().unsqueeze(-1)
+            if self.target_type_[dd] == 'gaussian':
+                prec_samples = samples['prec'][dd][s0:s1, :].T[traj, draws]
+                log_like[:, dd, :] = 0.5*torch.log(prec_samples/(2*torch.pi)) - \
+                    0.5*prec_samples*(y - pred_samples)**2
+            elif self.target_type_[dd] == 'binary':
+                log_like[:, dd, :] = y*pred_samples - \
+                    torch.logaddexp(pred_samples, torch.zeros_like(pred_samples))
+            else:
+                raise AttributeError('Unknown target type')
 
-        # Add estimates of random effects to the total number of parameters if
-        # needed
-        if self.ranef_indices_ is not None:
-            num_ranefs = np.sum(self.ranef_indices_)
-            num_params += num_trajs*num_ranefs*\
-                (self.D_ - self.num_binary_targets_)*self.G_
-        
-        # Per recommendation in the reference, two BICs are computed: one in
-        # which N is taken to be the number of observations (overstates true
-        # "N") and one in which N is taken to be the number of subjects
-        # (understates true "N"). Note that when we compute the total number of
-        # observations, we sum across each of the target variable dimensions,
-        # and for each dimension, we only consider those instances with
-        # non-NaN values.
-        num_obs_tally = 0
-        for d in range(self.D_):
-            num_obs_tally = num_obs_tally + \
-                torch.sum(torch.isnan(self.Y_[:, d]) == False)
-        
-        bic_obs = ll - 0.5*num_params*torch.log(num_obs_tally)
-        
-        if self.gb_ is not None:
-            num_subjects = self.gb_.ngroups
-            bic_groups = ll - 0.5*num_params*np.log(num_subjects)
-    
-            return (bic_obs, bic_groups)
-        else:
-            return bic_obs
+        return torch.clamp(log_like, min=np.log(1e-45))
 
-    def compute_waic2(self, S=100):
-        """Computes the Watanabe-Akaike (aka widely available) information
-        criterion, using the variance of individual terms in the log predictive
-        density summed over the n data points.
+    def iter_group_log_likelihood(self, S=1000, max_bytes=2**28):
+        """Generates posterior draws of the log likelihood of each group's
+        (subject's) data, a chunk of groups at a time: the sum over the
+        group's data points and observed targets of the log likelihood under
+        each draw of the group's trajectory assignment, random effects and
+        the trajectory parameters.
 
-        TODO: Test implementation of binary target accomodation
+        The draws of the trajectory parameters are shared by the groups in a
+        chunk but not across chunks. This does not matter for quantities
+        computed separately for each group, such as the terms of PSIS-LOO.
 
         Parameters
         ----------
         S : integer, optional
-            The number of draws from the posterior to use when computing the
-            required expectations.
+            The number of draws.
+
+        max_bytes : integer, optional
+            Approximate memory budget, in bytes, for the intermediate
+            quantities computed for a chunk of groups.
 
         Returns
         -------
-        waic2 : float
-            The Watanable-Akaike information criterion.
+        groups : array
+            Indices of the groups in the chunk (see 'group_first_index_').
+
+        log_like : array, shape ( len(groups), S )
+            Log likelihood draws of the groups in the chunk.
+        """
+        if getattr(self, 'N_to_G_index_map_', None) is None:
+            self._set_N_to_G_index_map()
+
+        N_to_G = np.asarray(self.N_to_G_index_map_)
+        G = int(np.sum(np.asarray(self.group_first_index_)))
+        order = np.argsort(N_to_G, kind='stable')
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(N_to_G,
+                                                            minlength=G))])
+
+        ranef_dim = 0 if self.ranef_indices_ is None else \
+            self.M_*np.sum(self.sig_trajs_.numpy())
+        elem_bytes = 8*(self.D_*(self.M_ + 8) + ranef_dim)
+        max_rows = int(np.maximum(max_bytes//(elem_bytes*S), 1))
+
+        g0 = 0
+        while g0 < G:
+            g1 = int(np.maximum(np.searchsorted(indptr, indptr[g0] + max_rows,
+                                                side='right') - 1, g0 + 1))
+            groups = np.arange(g0, g1)
+            rows = torch.from_numpy(order[indptr[g0]:indptr[g1]])
+            samples = self._sample_waic2_posterior(S, groups=groups)
+            samples['ranef'] = self._sample_ranefs(samples, groups,
+                self._get_ranef_generator(samples, g0))
+            local_groups = torch.from_numpy(N_to_G[rows.numpy()] - g0)
+            log_like = torch.sum(torch.nan_to_num(\
+                self._waic2_log_likelihood(samples, rows, 0, S,
+                                           local_groups)), 1)
+
+            yield groups, torch.zeros(g1 - g0, S, dtype=torch.float64).\
+                index_add_(0, local_groups, log_like).numpy()
+            g0 = g1
+
+    def compute_psis_loo(self, S=1000, max_bytes=2**28, seed=None):
+        """Computes Pareto smoothed importance sampling leave-one-out
+        cross-validation (PSIS-LOO) at the level of groups (subjects): the
+        predictive density of each subject's data under the model fit to the
+        other subjects. Log likelihood draws are generated a chunk of groups
+        at a time (see 'iter_group_log_likelihood'), and the Pareto tails of
+        all groups in a chunk are fit together.
+
+        Parameters
+        ----------
+        S : integer, optional
+            The number of draws from the posterior.
+
+        max_bytes : integer, optional
+            Approximate memory budget, in bytes, for the intermediate
+            quantities computed for a chunk of groups.
+
+        seed : integer, optional
+            If specified, the log likelihood draws are made with this random
+            seed, and the resulting per-group terms are cached (see
+            'get_posterior_samples'). The draws themselves are generated a
+            chunk at a time and are not kept.
+
+        Returns
+        -------
+        loo : float
+            Sum over groups of the leave-one-out log predictive densities.
+            -2*loo (LOOIC) is on the scale of WAIC2.
+
+        loos : array, shape ( G )
+            Leave-one-out log predictive density of each group.
+
+        ks : array, shape ( G )
+            Estimated Pareto tail index of each group. Estimates for groups
+            with k > 0.7 are unreliable.
 
         References
         ----------
-        Gelman et al, 'Bayesian Data Analysis, 3rd Edition'
+        Vehtari et al, 'Practical Bayesian model evaluation using
+        leave-one-out cross-validation and WAIC', Statistics and Computing,
+        2017
         """
-        if 'N_to_G_index_map_' not in dir(self):
-            self._set_N_to_G_index_map()            
-        
-        num_trajs = torch.sum(self.sig_trajs_)
-    
-        #-----------------------------------------------------------------------
-        # Get samples of trajectory assignments. We'll one-hot code these. We
-        # sample the traj assignments outside the loop over the target
-        # dimensions because the model assumes conditional independenc.
-        #-----------------------------------------------------------------------
-        traj_samples = torch.multinomial(\
-                        self.R_[:, self.sig_trajs_][self.group_first_index_, :],
-                    num_samples=S, replacement=True)[self.N_to_G_index_map_, :]
-            
-        traj_samples_one_hot = torch.zeros(self.N_, S, num_trajs,
-                                           dtype=torch.float32)
-        traj_samples_one_hot.scatter_(2, traj_samples.unsqueeze(-1), 1)
-    
-        #-----------------------------------------------------------------------
-        # Loop over the target dimensions and accumulate samples in
-        # 'likelihood_samples'
-        #-----------------------------------------------------------------------
-        likelihood_samples = torch.zeros(self.N_, self.D_, S)
-        for dd in range(self.D_):
-            co_x_preds = torch.zeros(self.N_, S, num_trajs)
-            for ii, kk in enumerate(np.where(self.sig_trajs_)[0]):
-                #---------------------------------------------------------------
-                # Get samples from the coefficients
-                #--------------------------------------------------------------
-                mus = torch.normal(mean=self.w_mu_[:, dd, kk].expand(S, -1),
-                    std=torch.sqrt(self.w_var_[:, dd, kk].expand(S, -1)))
-            
-                w_samples = \
-                    torch.normal(mean=self.w_mu_[:, dd, kk].expand(S, -1),
-                    std=torch.sqrt(self.w_var_[:, dd, kk].expand(S, -1)))
-            
-                #---------------------------------------------------------------
-                # Get samples from the random effects if specified
-                #---------------------------------------------------------------
-                if self.ranef_indices_ is not None and \
-                   self.target_type_[dd] == 'gaussian':
-                    u_mu_tmp = \
-                        self.u_mu_[:, dd, kk, self.ranef_indices_].unsqueeze(1)
-                    u_Sig_tmp = self.u_Sig_[:, dd, kk, self.ranef_indices_, :]\
-                        [:, :, self.ranef_indices_].unsqueeze(1)
-            
-                    mvn = MultivariateNormal(u_mu_tmp.expand(-1, S, -1),
-                                             u_Sig_tmp.expand(-1, S, -1, -1))
-                    ranef_samples = mvn.sample()[self.N_to_G_index_map_, :, :]
-                    ranef_samples_holder = \
-                        torch.zeros(self.N_, S, self.M_, dtype=torch.float64)
-                    ranef_samples_holder[:, :, self.ranef_indices_] = \
-                        ranef_samples
-            
-                    #-----------------------------------------------------------
-                    # Combine the fixed effect and random effect samples
-                    #-----------------------------------------------------------
-                    co_samples = w_samples + ranef_samples_holder
-                else:
-                    co_samples = w_samples.unsqueeze(0).repeat(self.N_, 1, 1)
-
-                assert co_samples.shape == (self.N_, S, self.M_)
-            
-                #---------------------------------------------------------------
-                # Now populate the co_x_preds tensor
-                #---------------------------------------------------------------
-                co_x_preds[:, :, ii] = \
-                    torch.einsum('nsm,nm->ns', co_samples, self.X_)        
-            
-            #-------------------------------------------------------------------
-            # Now mask the samples of co_x_preds based on the randomly chosen
-            # trajectory to get the actual predictions. Note that at this point,
-            # sanity-checking shows that the diffence between these predictions
-            # and the actual observed values is indeed normally distributed
-            # around 0.
-            #-------------------------------------------------------------------
-            pred_samples = (co_x_preds * traj_samples_one_hot).sum(dim=2) # NxS
-            
-            #-------------------------------------------------------------------
-            # Get samples from the gamma distribution over the precisions
-            #-------------------------------------------------------------------
-            lambda_b_ = \
-                self.lambda_b_[dd, np.where(self.sig_trajs_)[0]].unsqueeze(0)
-            lambda_a_ = \
-                self.lambda_a_[dd, np.where(self.sig_trajs_)[0]].unsqueeze(0)
-            samples_tmp = \
-                (torch.distributions.Gamma(lambda_a_, lambda_b_).sample((S,))).\
-                squeeze(1)
-            
-            prec_samples = \
-                (samples_tmp.unsqueeze(0) * traj_samples_one_hot).sum(dim=2) # 
-            
-            #-------------------------------------------------------------------
-            # Compute likelihood samples
-            #-------------------------------------------------------------------
-            if self.target_type_[dd] == 'gaussian':
-                likelihood_samples[:, dd, :] = \
-                ((prec_samples/(2*torch.pi))**0.5)*\
-                torch.exp(-0.5*prec_samples*(self.Y_[:, dd].unsqueeze(-1) - \
-                                             pred_samples)**2)
-            elif self.target_type_[dd] == 'binary':
-                likelihood_samples[:, dd, :] = \
-                    (torch.exp(pred_samples)**self.Y_[:, dd].unsqueeze(-1))/\
-                    (1+torch.exp(pred_samples))
-            else:
-                raise AttributeError('Unknown target type')
-        
-        #-----------------------------------------------------------------------
-        # Tally. Clip the likelihodd_samples to avoid infs
-        #-----------------------------------------------------------------------
-        likelihood_samples_clipped = torch.clamp(likelihood_samples, min=1e-45)
-        
-        lppd = \
-            torch.sum(torch.log(torch.nanmean(likelihood_samples_clipped, 2)))
-        pwaic = \
-            np.sum(np.nanvar(torch.log(likelihood_samples_clipped).numpy(), 2))
-        waic2 = -2*(lppd-pwaic)
+        if seed is None:
+            loos, ks = self._psis_loo_terms(S, max_bytes)
+        else:
+            loos, ks = self._get_posterior_cache().get(self, 'psis_loo', S,
+                seed, lambda: tuple([torch.from_numpy(vv) for vv in \
+                                     self._psis_loo_terms(S, max_bytes)]),
+                max_bytes=max_bytes)
+            loos = loos.numpy()
+            ks = ks.numpy()
+
+        return float(np.sum(loos)), loos, ks
+
+    def _psis_loo_terms(self, S, max_bytes):
+        """Computes the leave-one-out log predictive densities and Pareto
+        tail indices of all groups (see 'compute_psis_loo'), generating the
+        log likelihood draws a chunk of groups at a time.
+        """
+        loos = []
+        ks = []
+        for groups, log_like in self.iter_group_log_likelihood(S, max_bytes):
+            loo_chunk, loos_chunk, ks_chunk = psisloo(log_like.T)
+            loos.append(loos_chunk)
+            ks.append(ks_chunk)
 
-        return waic2        
+        return np.concatenate(loos), np.concatenate(ks)
 
     def init_traj_params(self, traj_probs=None):
         """Initializes trajectory parameters.
@@ -1577,10 +3843,20 @@ class MultDPRegression:
                 self.w_mu_[ids] = 0
 
         if self.lambda_a_ is None and self.lambda_b_ is None:
-            if self.gb_ is not None:
+            weights = getattr(self, 'subject_weights_', None)
+            if weights is not None:
+                # A weighted subset of subjects stands in for the total weight
+                # of its subjects
+                first = np.asarray(self.group_first_index_).astype(bool)
+                scale_factor = np.sum(np.asarray(weights)[first])
+            elif self.gb_ is not None:
                 scale_factor = self.gb_.ngroups
+            elif getattr(self, 'G_', None) is not None:
+                scale_factor = self.G_
             else:
                 scale_factor = self.N_
+            scale_factor = self._all_reduce(\
+                torch.tensor(float(scale_factor))).item()
             self.lambda_a_ = \
                 (scale_factor*torch.ones([self.D_, self.K_])).double()
             self.lambda_b_ = \
@@ -1611,9 +3887,39 @@ class MultDPRegression:
             self.w_mu_[:, :, traj_probs==0] = \
                 w_mu_tmp[:, :, traj_probs==0].double()
 
+        # Randomly initialized global parameters must agree across workers in
+        # a distributed fit
+        for tensor in [self.w_mu_, self.w_var_, self.lambda_a_,
+                       self.lambda_b_]:
+            self._broadcast(tensor)
+
+        for d in range(self.D_):
+            if self.target_type_[d] == 'binary':
+                for k in np.where(self.sig_trajs_)[0]:
+                    self.w_covmat_[:, :, d, k] = \
+                        torch.diag(self.w_var_[:, d, k]).double()
+
+        #-----------------------------------------------------------------------
+        # Initialize xi if needed. (A streaming fit has no data in memory at
+        # this point and initializes xi chunk by chunk instead.)
         #-----------------------------------------------------------------------
-        # Initialize xi if needed
-        #-----------------------------------------------------------------------            
+        if getattr(self, 'X_', None) is not None:
+            self.init_xi()
+
+    def init_xi(self, trajs=None):
+        """Allocates xi_ for the current data and, for binary targets, sets
+        its entries to their optimal values given the current coefficient
+        distributions.
+
+        Parameters
+        ----------
+        trajs : array, optional
+            Indices of the trajectories whose entries are set. The remaining
+            entries are 1. By default the significant trajectories are used.
+        """
+        if trajs is None:
+            trajs = np.where(self.sig_trajs_)[0]
+
         if self.num_binary_targets_ > 0:
             self.xi_ = \
                 torch.ones([self.N_, self.num_binary_targets_, self.K_]).\
@@ -1626,17 +3932,9 @@ class MultDPRegression:
             if self.target_type_[d] == 'binary':
                 d_bin += 1
 
-                for k in np.where(self.sig_trajs_)[0]:
+                for k in trajs:
                     non_nan_ids = ~torch.isnan(self.Y_[:, d])
-                    self.w_covmat_[:, :, d, k] = \
-                        torch.diag(self.w_var_[:, d, k]).double()
-
-                    self.xi_[non_nan_ids, d_bin, k] = \
-                        torch.sqrt(torch.sum((self.X_[non_nan_ids, :]*\
-                            torch.mm(self.w_covmat_[:, :, d, k],
-                                     self.X_[non_nan_ids, :].T).T), 1) + \
-                                   torch.mv(self.X_[non_nan_ids, :],
-                                            self.w_mu_[:, d, k])**2)
+                    self.update_xi(d, d_bin, k, non_nan_ids)
 
 
     def init_R_mat(self, traj_probs=None, traj_probs_weight=None):
@@ -1655,6 +3953,30 @@ class MultDPRegression:
             stick-breaking: 
             traj_probs_weight*traj_probs + (1-traj_probs_weight)*random_probs.
         """
+        init_traj_probs = self.get_init_traj_probs(traj_probs,
+                                                   traj_probs_weight)
+
+        self.R_ = torch.ones([self.N_, self.K_]).double()
+        self.R_[:] = init_traj_probs
+        self.sig_trajs_ = torch.max(self.R_, 0)[0] > self.prob_thresh_
+
+    def get_init_traj_probs(self, traj_probs=None, traj_probs_weight=None):
+        """Draws the initial trajectory probabilities that 'init_R_mat' assigns
+        to every data instance.
+
+        Parameters
+        ----------
+        traj_probs : torch.Tensor, shape ( K ), optional
+            A priori probabilitiey of each of the K trajectories.
+
+        traj_probs_weight : float, optional
+            Value between 0 and 1 inclusive. See 'init_R_mat'.
+
+        Returns
+        -------
+        init_traj_probs : torch.Tensor, shape ( K )
+            Initial probability of each trajectory.
+        """
         # Draw a weight vector from the stick-breaking process
         tmp = torch.distributions.Beta(1, self.alpha_).sample((self.K_,))
         one_tmp = 1. - tmp
@@ -1678,15 +4000,16 @@ class MultDPRegression:
         else:
             init_traj_probs = vec
 
+        init_traj_probs = self._broadcast(init_traj_probs.double())
+
         if torch.sum(init_traj_probs) < 0.95:
             warnings.warn("Initial trajectory probabilities sum to {}. \
             Alpha may be too high.".format(torch.sum(init_traj_probs)))
 
-        self.R_ = torch.ones([self.N_, self.K_]).double()
-        self.R_[:] = init_traj_probs
-        self.sig_trajs_ = torch.max(self.R_, 0)[0] > self.prob_thresh_
+        return init_traj_probs
 
-    def augment_df_with_traj_info(self, df, gb_col=None, test_data=False):
+    def augment_df_with_traj_info(self, df, gb_col=None, test_data=False,
+                                  inplace=True):
         """Compute the probability that each data instance belongs to each of
         the 'k' clusters. Note that 'X' and 'Y' can be "new" data; that is,
         data that was not necessarily used to train the model.
@@ -1706,6 +4029,10 @@ class MultDPRegression:
             on or a new (test) data set. This is required to properly handle
             presence or absence of random effects.
 
+        inplace : bool, optional
+            If true, the columns are added to 'df', which is returned.
+            Otherwise 'df' is left unchanged and a new frame is returned.
+
         Returns
         -------
         df_aug : pandas DataFrame
@@ -1716,19 +4043,93 @@ class MultDPRegression:
         """        
         R = self.get_R_matrix(df=df, gb_col=gb_col,
                               test_data=test_data).numpy()
-        N = df.shape[0]
-        # Now augment the dataframe with trajectory info
-        traj = []
-        for i in range(N):
-            traj.append(np.where(np.max(R[i, :]) == R[i, :])[0][0])
-        df['traj'] = traj
 
-        for s in np.where(self.sig_trajs_)[0]:
-            df['traj_{}'.format(s)] = R[:, s]
-
-        return df
+        return self._add_traj_columns(df, R, inplace)
         
             
+    def predict(self, X, trajs=None, return_std=True, num_quad_points=32):
+        """Computes the expected target values of each trajectory at the
+        specified predictor values, and optionally their predictive standard
+        deviations, for all requested trajectories and targets at once.
+
+        For Gaussian targets, the predictive distribution integrates over the
+        posterior of the coefficients and of the residual precision: its mean
+        is x^T E[w], and its variance is x^T Var[w] x + E[1/lambda] =
+        x^T Var[w] x + lambda_b/(lambda_a - 1) (the variance of the Student-t
+        obtained by integrating out the precision; infinite if lambda_a <= 1).
+        For binary targets, the mean is the posterior expectation of the
+        logistic function of x^T w, computed with Gauss-Hermite quadrature,
+        and the standard deviation is that of the corresponding Bernoulli
+        distribution.
+
+        Parameters
+        ----------
+        X : array, shape ( N, M ), or pandas DataFrame
+            Predictor values. If a data frame, the predictor columns are
+            selected by name.
+
+        trajs : array of int, optional
+            Trajectories for which to compute predictions. By default, all
+            active trajectories.
+
+        return_std : bool, optional
+            If true, predictive standard deviations are also returned.
+
+        num_quad_points : int, optional
+            Number of Gauss-Hermite quadrature points used for binary
+            targets.
+
+        Returns
+        -------
+        mean : array, shape ( N, D, T )
+            Expected value of each target under each of the T requested
+            trajectories.
+
+        std : array, shape ( N, D, T )
+            Predictive standard deviations. Only returned if 'return_std' is
+            true.
+        """
+        if isinstance(X, pd.DataFrame):
+            X = X[self.predictor_names_].values
+        X = torch.as_tensor(np.atleast_2d(np.asarray(X, dtype=float)))
+        assert X.shape[1] == self.M_, "Predictor dimension mismatch"
+
+        if trajs is None:
+            trajs = np.where(self.sig_trajs_)[0]
+        trajs = torch.as_tensor(np.atleast_1d(trajs), dtype=torch.long)
+
+        w_mu = self.w_mu_[:, :, trajs].double()
+        w_var = self.w_var_[:, :, trajs].double()
+
+        mean = torch.einsum('nm,mdt->ndt', X, w_mu)
+        var = torch.einsum('nm,mdt->ndt', X**2, w_var)
+        std = torch.zeros_like(mean)
+        for d in range(self.D_):
+            if self.target_type_[d] == 'gaussian':
+                lambda_a = self.lambda_a_[d, trajs].double()
+                lambda_b = self.lambda_b_[d, trajs].double()
+                resid_var = torch.where(lambda_a > 1,
+                    lambda_b/(lambda_a - 1),
+                    torch.tensor(np.inf, dtype=torch.float64))
+                std[:, d, :] = torch.sqrt(var[:, d, :] + resid_var)
+            else:
+                var_d = torch.einsum('nm,mlt,nl->nt', X,
+                    torch.nan_to_num(self.w_covmat_[:, :, d, trajs].double()),
+                    X)
+                nodes, weights = \
+                    np.polynomial.hermite_e.hermegauss(num_quad_points)
+                t = mean[:, d, :, None] + \
+                    torch.sqrt(torch.clamp(var_d, min=0))[:, :, None]*\
+                    torch.from_numpy(nodes)
+                mean[:, d, :] = torch.matmul(torch.sigmoid(t),
+                    torch.from_numpy(weights/np.sqrt(2*np.pi)))
+                std[:, d, :] = torch.sqrt(mean[:, d, :]*(1 - mean[:, d, :]))
+
+        if return_std:
+            return mean.numpy(), std.numpy()
+
+        return mean.numpy()
+
     def compute_lower_bound(self):
         """Compute the variational lower bound
 
@@ -1753,6 +4154,11 @@ class MultDPRegression:
         traj_probs : array, shape ( K )
             Each element is the probability of the corresponding trajectory.
         """
+        if self.R_ is None and \
+           getattr(self, 'data_summary_', None) is not None:
+            # Inference-only model (see bayes_traj.export_inference_model)
+            return np.array(self.data_summary_['traj_probs'])
+        
         if torch.is_tensor(self.R_):
             traj_probs = \
                 np.sum(self.R_.numpy()\
@@ -1766,52 +4172,101 @@ class MultDPRegression:
 
         return traj_probs
     
-    def to_df(self):
+    def to_df(self, inplace=True):
         """Adds to the current data frame columns containing trajectory 
         assignments and probabilities.
 
+        With 'inplace' true, repeated calls on an unchanged model return df_
+        without recomputing its trajectory columns. They are recomputed when
+        the assignment probabilities, the active trajectories or df_ are
+        replaced, or when the probabilities or active trajectories are
+        modified in place.
+
+        Parameters
+        ----------
+        inplace : bool, optional
+            If true, the columns are added to the model's data frame, df_,
+            which is returned. Otherwise df_ is left unchanged and a new frame
+            is returned.
+
         Returns
         -------
         df : Pandas dataframe
             Column 'traj' contains integer values indicating which trajectory
-            the data instance belongs to. If the current data frame already has 
-            a 'traj' column, the new columns will be called 'traj_'. 'traj_*' 
-            contain actual probabilities that the data instance belongs to a 
-            particular trajectory.
-        """
-        traj = []
-        for i in range(0, self.R_.shape[0]):
-            if torch.is_tensor(self.R_):
-                traj.append(where(max(self.R_.numpy()[i, :]) == \
-                                  self.R_.numpy()[i, :])[0][0])
-            else:
-                traj.append(where(max(self.R_[i, :]) == self.R_[i, :])[0][0])
+            the data instance belongs to. 'traj_*' contain actual
+            probabilities that the data instance belongs to a particular
+            trajectory. Existing columns with these names are replaced.
+        """
+        cache = getattr(self, 'traj_df_cache_', None)
+        if inplace and cache is not None and self._state_key_matches(\
+                self._get_state_key(['R_', 'sig_trajs_', 'df_']), cache[0]):
+            return cache[1]
+
+        if self.R_ is None:
+            raise RuntimeError("Trajectory assignment probabilities are not \
+            available (R_ is None)")
 
         # Older models might not have self.df_ defined at this point. If not,
-        # create it
-        try:
-            self.df_['traj'] = traj
-        except AttributeError as error:
-            self.df_ = pd.DataFrame()
-            self.df_['traj'] = traj
-            for ii, nn in enumerate(self.predictor_names_):
-                if torch.is_tensor(self.X_):
-                    self.df_[nn] = self.X_.numpy()[:, ii]
-                else:
-                    self.df_[nn] = self.X_[:, ii]
-            for ii, nn in enumerate(self.target_names_):
-                if torch.is_tensor(self.Y_):
-                    self.df_[nn] = self.Y_.numpy()[:, ii]
-                else:
-                    self.df_[nn] = self.Y_[:, ii]
-                    
-        for s in np.where(self.sig_trajs_)[0]:
-            if torch.is_tensor(self.R_):
-                self.df_['traj_{}'.format(s)] = self.R_.numpy()[:, s]
-            else:
-                self.df_['traj_{}'.format(s)] = self.R_[:, s]
-                
-        return self.df_  
+        # create it. Models fit with 'fit_streaming' re-read their data file.
+        df = getattr(self, 'df_', None)
+        if df is None and getattr(self, 'data_file_', None) is not None:
+            df = self._read_streamed_df()
+            if inplace:
+                self.df_ = df
+        elif df is None:
+            df = pd.concat([\
+                pd.DataFrame(np.asarray(self.X_),
+                             columns=self.predictor_names_),
+                pd.DataFrame(np.asarray(self.Y_),
+                             columns=self.target_names_)], axis=1)
+            if inplace:
+                self.df_ = df
+
+        df = self._add_traj_columns(df, self.R_, inplace)
+
+        # The key is taken after the columns are added: adding columns in
+        # place changes neither the model's tensors nor the identity of df_
+        if inplace:
+            self.traj_df_cache_ = \
+                (self._get_state_key(['R_', 'sig_trajs_', 'df_']), df)
+
+        return df
+
+    def _add_traj_columns(self, df, R, inplace=True):
+        """Adds trajectory assignment ('traj') and probability ('traj_<num>',
+        for each active trajectory) columns to a data frame in a single bulk
+        operation.
+
+        Parameters
+        ----------
+        df : pandas DataFrame
+            Data frame with a row for each row of R.
+
+        R : array or torch.Tensor, shape ( N, K )
+            Trajectory assignment probabilities.
+
+        inplace : bool, optional
+            If true, 'df' is modified and returned. Otherwise a new data frame
+            is returned.
+
+        Returns
+        -------
+        df : pandas DataFrame
+            Data frame with the trajectory columns. Existing columns with the
+            same names are replaced.
+        """
+        R = np.asarray(R)
+        columns = {'traj': np.argmax(R, 1)}
+        for s in np.where(np.asarray(self.sig_trajs_))[0]:
+            columns['traj_{}'.format(s)] = R[:, s]
+        df_traj = pd.DataFrame(columns, index=df.index)
+
+        if inplace:
+            df[list(df_traj.columns)] = df_traj
+            return df
+
+        return pd.concat([df.drop(columns=df_traj.columns, errors='ignore'),
+                          df_traj], axis=1)
 
     def plot(self, x_axis, y_axis, x_label=None, y_label=None, which_trajs=None,
              show=True, min_traj_prob=0, max_traj_prob=1, traj_map=None,
@@ -1892,13 +4347,28 @@ class MultDPRegression:
         """
         # Compute the probability vector for each trajectory
         traj_probs = self.get_traj_probs()
-        
-        df_traj = self.to_df()
+
+        # Inference-only models (see bayes_traj.export_inference_model) have
+        # no data to show, but keep a summary of it
+        summary = getattr(self, 'data_summary_', None) \
+            if self.df_ is None else None
+        if summary is not None:
+            hide_scatter = True
+            col_min = lambda cc: summary['min'][cc]
+            col_max = lambda cc: summary['max'][cc]
+            col_mean = lambda cc: summary['mean'][cc]
+        else:
+            from bayes_traj.fit_stats import FitStatistics
+            stats = FitStatistics(self)
+            # Models may be shared through bayes_traj.model_registry, so
+            # df_ is left as it is
+            df_traj = self.to_df(inplace=False)
+            col_min = lambda cc: np.min(df_traj[cc].values)
+            col_max = lambda cc: np.max(df_traj[cc].values)
+            col_mean = lambda cc: np.nanmean(df_traj[cc].values)
             
         num_dom_locs = 100
-        x_dom = np.linspace(np.min(df_traj[x_axis].values),
-                            np.max(df_traj[x_axis].values),
-                            num_dom_locs)
+        x_dom = np.linspace(col_min(x_axis), col_max(x_axis), num_dom_locs)
     
         target_index = np.where(np.array(self.target_names_) == y_axis)[0][0]
     
@@ -1911,20 +4381,18 @@ class MultDPRegression:
                 if x_axis in tmp_pow:                
                     X_tmp[:, inc] = x_dom**(int(tmp_pow[-1]))
                 else:                
-                    X_tmp[:, inc] = np.mean(df_traj[tmp_pow[0]].values)**\
-                        (int(tmp_pow[-1]))
+                    X_tmp[:, inc] = col_mean(tmp_pow[0])**(int(tmp_pow[-1]))
             elif len(tmp_int) > 1:
                 if x_axis in tmp_int:                
                     X_tmp[:, inc] = \
-                        x_dom**np.mean(df_traj[tmp_int[np.where(\
-                            np.array(tmp_int) != x_axis)[0][0]]].values)
+                        x_dom**col_mean(tmp_int[np.where(\
+                            np.array(tmp_int) != x_axis)[0][0]])
                 else:
-                    X_tmp[:, inc] = np.mean(df_traj[tmp_int[0]])*\
-                        np.mean(df_traj[tmp_int[1]])                    
+                    X_tmp[:, inc] = col_mean(tmp_int[0])*col_mean(tmp_int[1])
             elif pp == x_axis:
                 X_tmp[:, inc] = x_dom
             else:
-                X_tmp[:, inc] = np.nanmean(df_traj[tmp_pow[0]].values)
+                X_tmp[:, inc] = col_mean(tmp_pow[0])
 
         # Create a trajeectory mapping for internal uses. By default, this is
         # the trivial mapping whereby every trajectory maps to itself. Using
@@ -1946,7 +4414,7 @@ class MultDPRegression:
         else:
             traj_ids = np.where(self.sig_trajs_)[0]
     
-        cmap = plt.cm.get_cmap('tab20')
+        cmap = plt.get_cmap('tab20')
             
         # The following just maps trajectories to sequential integers starting
         # at 0. Otherwise, trajectory numbers greater than 19 will all be given
@@ -1979,8 +4447,8 @@ class MultDPRegression:
             if traj_probs[tt] >= min_traj_prob and \
                traj_probs[tt] <= max_traj_prob:
                 
-                ids_tmp = df_traj.traj.values == tt
                 if not hide_scatter:
+                    ids_tmp = stats.traj_ == tt
                     if traj_colors is not None:
                         color = traj_colors[traj_inc]
                     else:
@@ -1991,14 +4459,12 @@ class MultDPRegression:
                                color=color,
                                alpha=0.5)
 
-                if self.gb_ is None:
-                    n_traj = np.sum(df_traj.traj.values == tt)
-                    perc_traj = 100*n_traj/df_traj.shape[0]
+                if summary is not None:
+                    n_traj = summary['traj_counts'][tt]
+                    perc_traj = 100*n_traj/summary['num_units']
                 else:
-                    groupby_col = self.gb_.count().index.name                
-                    n_traj = df_traj[df_traj.traj.values == tt].\
-                        groupby(groupby_col).ngroups
-                    perc_traj = 100*n_traj/self.gb_.ngroups
+                    n_traj = stats.num_groups_[tt]
+                    perc_traj = 100*stats.props_[tt]
 
                 co = self.w_mu_[:, target_index, tt]
                 if self.target_type_[target_index] == 'gaussian':
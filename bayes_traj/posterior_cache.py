@@ -0,0 +1,226 @@
+import torch
+import numpy as np
+from collections import OrderedDict
+import pdb, os, hashlib, threading
+
+CACHE_FORMAT_VERSION = 1
+
+POSTERIOR_NAMES = ['sig_trajs_', 'w_mu_', 'w_var_', 'lambda_a_', 'lambda_b_',
+                   'R_', 'u_mu_', 'u_Sig_', 'ranef_indices_']
+
+def get_posterior_digest(mm):
+    """Computes a digest of the posterior quantities of a model that
+    posterior draws depend on. Used to tell whether cached draws belong to
+    the current state of a model.
+
+    The digest is kept in the model's 'posterior_digest_cache_' together with
+    a state key of the quantities (see MultDPRegression._get_state_key), and
+    is only recomputed once one of them is reassigned or modified in place.
+
+    Parameters
+    ----------
+    mm : MultDPRegression
+        Model instance.
+
+    Returns
+    -------
+    digest : str
+        SHA-1 digest.
+    """
+    # The random effect indices are set once and never modified in place
+    key = mm._get_state_key(POSTERIOR_NAMES,
+                            identity_names=['ranef_indices_'])
+    cache = getattr(mm, 'posterior_digest_cache_', None)
+    if cache is not None and mm._state_key_matches(key, cache[0]):
+        return cache[1]
+
+    h = hashlib.sha1()
+    for name in POSTERIOR_NAMES:
+        vv = getattr(mm, name, None)
+        h.update(name.encode())
+        if vv is not None:
+            h.update(np.ascontiguousarray(np.asarray(vv)).tobytes())
+    digest = h.hexdigest()
+
+    if key is not None:
+        mm.posterior_digest_cache_ = (key, digest)
+
+    return digest
+
+
+def get_nbytes(value):
+    """Returns the number of bytes held by the tensors and arrays in a value,
+    including those in (nested) lists, tuples and dictionaries.
+    """
+    if torch.is_tensor(value):
+        return value.element_size()*value.nelement()
+    elif isinstance(value, np.ndarray):
+        return value.nbytes
+    elif isinstance(value, (list, tuple)):
+        return sum([get_nbytes(vv) for vv in value])
+    elif isinstance(value, dict):
+        return sum([get_nbytes(vv) for vv in value.values()])
+    return 0
+
+
+def get_cache_file_name(model_file):
+    """Returns the name of the file that holds the persisted posterior draws
+    of a model file.
+    """
+    return model_file + '.samples.pt'
+
+
+class PosteriorSampleCache:
+    """Holds posterior draws of a model (coefficients, precisions,
+    trajectory assignments, random effects, per-group log likelihoods) so
+    that the consumers of a model -- information criteria, prior
+    generation, plotting -- can reuse them instead of drawing their own.
+
+    Draws are identified by a kind, the number of draws S, the random seed
+    they were made with, and any options of the consumer that affect them.
+    They are only cached when a seed is given, since only then are they
+    reproducible. Entries also record a digest of the model's posterior (see
+    'get_posterior_digest'), and are redrawn if the model has changed since
+    they were made.
+
+    Entries are kept in least-recently-used order, and the least recently
+    used ones are evicted when the cached draws exceed 'max_bytes'. Draws
+    larger than the budget are returned but not cached.
+
+    Parameters
+    ----------
+    max_bytes : int, optional
+        Memory budget for cached draws.
+
+    file_name : str, optional
+        File the cache is persisted to by 'save'. If it exists, its entries
+        are read when the cache is first used.
+    """
+    def __init__(self, max_bytes=2**30, file_name=None):
+        self.max_bytes_ = max_bytes
+        self.file_name_ = file_name
+        self.lock_ = threading.RLock()
+        self.entries_ = OrderedDict()
+        self.loaded_ = file_name is None or not os.path.exists(file_name)
+        self.hits_ = 0
+        self.misses_ = 0
+
+    def get(self, mm, kind, S, seed, draw, **options):
+        """Returns posterior draws, making them if they are not cached.
+
+        Parameters
+        ----------
+        mm : MultDPRegression
+            Model the draws are made from.
+
+        kind : str
+            Kind of draws, e.g. 'posterior' or 'group_log_likelihood'.
+
+        S : int
+            Number of draws.
+
+        seed : int or None
+            Random seed. If None, the draws are made with the current state
+            of the random number generator and are not cached.
+
+        draw : callable
+            Function, taking no arguments, that makes the draws. With a seed,
+            it is called with torch's random number generator seeded and
+            its state is restored afterwards.
+
+        options : keyword arguments
+            Further values that identify the draws.
+
+        Returns
+        -------
+        value : object
+            The draws.
+        """
+        if seed is None:
+            return draw()
+
+        key = (kind, int(S), int(seed), tuple(sorted(options.items())))
+        digest = get_posterior_digest(mm)
+        with self.lock_:
+            self._load()
+            entry = self.entries_.get(key)
+            if entry is not None and entry[0] == digest:
+                self.entries_.move_to_end(key)
+                self.hits_ += 1
+                return entry[1]
+            self.misses_ += 1
+
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(seed)
+            value = draw()
+
+        if get_nbytes(value) <= self.max_bytes_:
+            with self.lock_:
+                self.entries_[key] = (digest, value)
+                self.entries_.move_to_end(key)
+                self._evict()
+
+        return value
+
+    def _evict(self):
+        """Evicts least recently used entries until the cache fits the
+        memory budget.
+        """
+        while len(self.entries_) > 0 and self.nbytes() > self.max_bytes_:
+            self.entries_.popitem(last=False)
+
+    def nbytes(self):
+        """Returns the number of bytes held by the cached draws.
+        """
+        with self.lock_:
+            return sum([get_nbytes(ee[1]) for ee in self.entries_.values()])
+
+    def clear(self):
+        """Removes all entries.
+        """
+        with self.lock_:
+            self.entries_.clear()
+            self.loaded_ = True
+
+    def _load(self):
+        """Reads the persisted entries, if they have not been read yet.
+        Entries already in memory take precedence.
+        """
+        if self.loaded_:
+            return
+        self.loaded_ = True
+
+        state = torch.load(self.file_name_, weights_only=True)
+        if state['format_version'] > CACHE_FORMAT_VERSION:
+            raise RuntimeError("Unsupported posterior cache version in " + \
+                               self.file_name_)
+        for key, digest, value in state['entries']:
+            key = (key[0], key[1], key[2],
+                   tuple([tuple(oo) for oo in key[3]]))
+            if key not in self.entries_:
+                self.entries_[key] = (digest, value)
+                self.entries_.move_to_end(key, last=False)
+        self._evict()
+
+    def save(self, file_name=None):
+        """Writes the cached draws to a file, to be read by a cache created
+        with that 'file_name'.
+
+        Parameters
+        ----------
+        file_name : str, optional
+            Output file name. By default, the cache's 'file_name'.
+        """
+        if file_name is None:
+            file_name = self.file_name_
+        assert file_name is not None, "No file name specified"
+
+        with self.lock_:
+            self._load()
+            entries = [(list(kk[0:3]) + [[list(oo) for oo in kk[3]]],
+                        ee[0], ee[1]) for kk, ee in self.entries_.items()]
+
+        tmp_file_name = file_name + '.tmp'
+        torch.save({'format_version': CACHE_FORMAT_VERSION,
+                    'entries': entries}, tmp_file_name)
+        os.replace(tmp_file_name, file_name)
@@ -1,9 +1,10 @@
 import pickle
 import numpy as np
 from bayes_traj.mult_dp_regression import MultDPRegression
+from bayes_traj.model_registry import load_model
 from argparse import ArgumentParser
 
-def prior_from_model(mm):
+def prior_from_model(mm, S=10000, seed=None):
     """Computes and returns a MultDPRegression prior given an input model by 
     considering samples from non-zero trajectory posteriors.
 
@@ -12,6 +13,15 @@ def prior_from_model(mm):
     mm : MultDPRegression instance
         Model from which the prior will be estimated.
 
+    S : int, optional
+        Number of posterior draws of each trajectory's coefficients and
+        precisions.
+
+    seed : int, optional
+        If specified, the draws are made with this random seed and are
+        taken from (or added to) the model's posterior sample cache (see
+        MultDPRegression.get_posterior_samples).
+
     Returns
     -------
     prior : dict
@@ -19,53 +29,35 @@ def prior_from_model(mm):
     """
     traj_ids = np.where(mm.sig_trajs_)[0]
 
-    M = mm.M_
-    D = mm.D_
-
-    w_mu0_post = np.zeros([M, D])
-    w_var0_post = np.ones([M, D])
-
     # Compute the weights of each trajectory by marginalizing over individuals
-    traj_probs = np.sum(mm.R_, 0)/np.sum(mm.R_)        
+    traj_probs = np.sum(np.asarray(mm.R_), 0)/np.sum(np.asarray(mm.R_))
     
     # Each trajectory regression coefficient is a draw from the corresponding
     # prior. That prior is characterized by a mean (held in mm.w_mu0_) and
     # a variance (held in mm.w_var0_). We can examine the actual regression
     # coefficients found after the fitting routine to update our belief about
-    # what the prior should be. In order to do this, we'll draw samples from
-    # w_mu_ (the per-trajectory posterior mean) scaled by the variance in
-    # the posterior estimate w_var_ and marginalized over the probability
-    # of each trajectory. The mean and variance of the resulting sample
-    # provides an update for prior over coefficients.
-    num_traj_samples = np.random.multinomial(10000, traj_probs)
-
-    for m in range(M):
-        for d in range(D):
-            samples = []
-            for t in traj_ids:
-                samples.append(mm.w_mu_[m, d, t] + \
-                               np.sqrt(mm.w_var_[m, d, t])*\
-                               np.random.randn(num_traj_samples[t]))
+    # what the prior should be. In order to do this, we'll use draws from
+    # the posterior of each trajectory's coefficients, weighted by the
+    # probability of each trajectory. The mean and variance of the resulting
+    # sample provides an update for prior over coefficients.
+    samples = mm.get_posterior_samples(S, seed, group_level=False)
+    weights = traj_probs[traj_ids]/np.sum(traj_probs[traj_ids])
 
-            w_mu0_post[m, d] = np.mean(np.hstack(samples))
-            w_var0_post[m, d] = np.var(np.hstack(samples))
+    # 'w' holds, for each target, draws with shape ( T, S, M )
+    w = np.stack([ww.numpy() for ww in samples['w']], 2)
+    w_mu0_post = np.einsum('t,tsdm->md', weights, w)/S
+    w_var0_post = np.einsum('t,tsdm->md', weights,
+                            (w - w_mu0_post.T[None, None])**2)/S
 
     # For precision parameters, we'll use a similar sample-based procedure as
-    # was done for the coefficients
-    lambda_a0_post = np.ones(D)
-    lambda_b0_post = np.ones(D)
-    for d in range(D):
-        samples = []
-        for t in traj_ids:
-            scale_tmp = 1./mm.lambda_b_[d, t]
-            shape_tmp = mm.lambda_a_[d, t]
-            samples.append(np.random.gamma(shape_tmp, scale_tmp,
-                                           num_traj_samples[t]))
-    
-        lambda_a0_post[d] = np.mean(np.hstack(samples))**2/\
-            np.var(np.hstack(samples))
-        lambda_b0_post[d] = np.mean(np.hstack(samples))/\
-            np.var(np.hstack(samples))
+    # was done for the coefficients. 'prec' holds, for each target, draws with
+    # shape ( S, T ).
+    prec = np.stack([pp.numpy() for pp in samples['prec']])
+    prec_mean = np.einsum('t,dst->d', weights, prec)/S
+    prec_var = np.einsum('t,dst->d', weights,
+                         (prec - prec_mean[:, None, None])**2)/S
+    lambda_a0_post = prec_mean**2/prec_var
+    lambda_b0_post = prec_mean/prec_var
         
     prior = {'w_mu0': w_mu0_post, 'w_var0': w_var0_post,
              'lambda_a0': lambda_a0_post, 'lambda_b0': lambda_b0_post,
@@ -84,7 +76,7 @@ if __name__ == "__main__":
 
     op.parse_args()
     
-    mm = pickle.load(open(op.model, 'rb'))['MultDPRegression']
+    mm = load_model(op.model)
     prior = prior_from_model(mm)
     
     pickle.dump(prior, open(op.prior, 'wb'))
@@ -9,8 +9,13 @@ psislw
     Pareto smoothed importance sampling.
 gpdfitnew
     Estimate the paramaters for the Generalized Pareto Distribution (GPD).
+gpdfitnew_batch
+    Estimate the GPD parameters for several data sets at once.
 gpinv
     Inverse Generalised Pareto distribution function.
+gpinv_batch
+    Inverse Generalised Pareto distribution function for several parameter
+    values at once.
 sumlogs
     Sum of vector where numbers are represented by their logarithms.
 References
@@ -88,8 +93,14 @@ def psisloo(log_lik, **kwargs):
     return loo, loos, ks
 
 
-def psislw(lw, Reff=1.0, overwrite_lw=False):
+def psislw(lw, Reff=1.0, overwrite_lw=False, block_size=4096):
     """Pareto smoothed importance sampling (PSIS).
+
+    The generalized Pareto tails of all sets of log weights are fitted
+    together, 'block_size' sets at a time (see :meth:`gpdfitnew_batch()`).
+    Sets whose tail does not have the expected number of samples (because of
+    ties at the cutoff, or because the cutoff is clipped to the smallest
+    representable weight) are smoothed one at a time.
     Parameters
     ----------
     lw : ndarray
@@ -100,6 +111,8 @@ def psislw(lw, Reff=1.0, overwrite_lw=False):
     overwrite_lw : bool, optional
         If True, the input array `lw` is smoothed in-place, assuming the array
         is F-contiguous. By default, a new array is allocated.
+    block_size : int, optional
+        Number of sets of log weights smoothed together.
     Returns
     -------
     lw_out : ndarray
@@ -130,50 +143,56 @@ def psislw(lw, Reff=1.0, overwrite_lw=False):
     # precalculate constants
     cutoff_ind = - int(np.ceil(min(0.2 * n, 3 * np.sqrt(n / Reff)))) - 1
     cutoffmin = np.log(np.finfo(float).tiny)
-    logn = np.log(n)
     k_min = 1/3
+    n2 = - cutoff_ind - 1
+    sti = np.arange(0.5, n2)
+    sti /= n2
 
-    # loop over sets of log weights
-    for i, x in enumerate(lw_out.T if lw_out.ndim == 2 else lw_out[None, :]):
+    lw_2d = lw_out if lw_out.ndim == 2 else lw_out[:, None]
+    for j0 in range(0, m, block_size):
+        x = lw_2d[:, j0:j0 + block_size]
         # improve numerical accuracy
-        x -= np.max(x)
-        # sort the array
-        x_sort_ind = np.argsort(x)
+        x -= np.max(x, axis=0)
+        # sort the n2 + 1 largest values of each array
+        top_ind = np.argpartition(x, cutoff_ind, axis=0)[cutoff_ind:]
+        top = np.take_along_axis(x, top_ind, axis=0)
+        top_order = np.argsort(top, axis=0)
+        top_ind = np.take_along_axis(top_ind, top_order, axis=0)
+        top = np.take_along_axis(top, top_order, axis=0)
         # divide log weights into body and right tail
-        xcutoff = max(
-            x[x_sort_ind[cutoff_ind]],
-            cutoffmin
-        )
-        expxcutoff = np.exp(xcutoff)
-        tailinds, = np.where(x > xcutoff)
-        x2 = x[tailinds]
-        n2 = len(x2)
-        if n2 <= 4:
-            # not enough tail samples for gpdfitnew
-            k = np.inf
-        else:
-            # order of tail samples
-            x2si = np.argsort(x2)
-            # fit generalized Pareto distribution to the right tail samples
-            np.exp(x2, out=x2)
-            x2 -= expxcutoff
-            k, sigma = gpdfitnew(x2, sort=x2si)
-        if k >= k_min and not np.isinf(k):
+        xcutoff = np.maximum(top[0], cutoffmin)
+        regular = np.sum(x > xcutoff, axis=0) == n2
+
+        ks = np.full(x.shape[1], np.inf)
+        cols, = np.where(regular)
+        if n2 > 4 and cols.shape[0] > 0:
+            # fit generalized Pareto distributions to the right tail samples,
+            # which are the last n2 sorted samples
+            expxcutoff = np.exp(xcutoff[cols])
+            x2 = np.exp(top[1:, cols]) - expxcutoff
+            k, sigma = gpdfitnew_batch(x2)
+            ks[cols] = k
+
             # no smoothing if short tail or GPD fit failed
-            # compute ordered statistic for the fit
-            sti = np.arange(0.5, n2)
-            sti /= n2
-            qq = gpinv(sti, k, sigma)
-            qq += expxcutoff
-            np.log(qq, out=qq)
-            # place the smoothed tail into the output array
-            x[tailinds[x2si]] = qq
-            # truncate smoothed values to the largest raw weight 0
-            x[x > 0] = 0
+            smooth = (k >= k_min) & ~np.isinf(k)
+            if np.any(smooth):
+                qq = np.log(gpinv_batch(sti, k[smooth], sigma[smooth]) + \
+                            expxcutoff[smooth])
+                # place the smoothed tails into the output array, and
+                # truncate smoothed values to the largest raw weight 0
+                tail_ind = top_ind[1:, cols[smooth]]
+                x_smooth = x[:, cols[smooth]]
+                np.put_along_axis(x_smooth, tail_ind, qq, axis=0)
+                x_smooth[x_smooth > 0] = 0
+                x[:, cols[smooth]] = x_smooth
+
+        for jj in np.where(~regular)[0]:
+            ks[jj] = _psislw_column(x[:, jj], xcutoff[jj], k_min)
+
         # renormalize weights
-        x -= sumlogs(x)
-        # store tail index k
-        kss[i] = k
+        x -= sumlogs(x, axis=0)
+        # store tail indices k
+        kss[j0:j0 + block_size] = ks
 
     # If the provided input array is one dimensional, return kss as scalar.
     if lw_out.ndim == 1:
@@ -182,6 +201,40 @@ def psislw(lw, Reff=1.0, overwrite_lw=False):
     return lw_out, kss
 
 
+def _psislw_column(x, xcutoff, k_min):
+    """Smoothes the tail of a single set of log weights in-place. 'x' must
+    be shifted so that its maximum is 0. Returns the Pareto tail index.
+    """
+    expxcutoff = np.exp(xcutoff)
+    tailinds, = np.where(x > xcutoff)
+    x2 = x[tailinds]
+    n2 = len(x2)
+    if n2 <= 4:
+        # not enough tail samples for gpdfitnew
+        k = np.inf
+    else:
+        # order of tail samples
+        x2si = np.argsort(x2)
+        # fit generalized Pareto distribution to the right tail samples
+        np.exp(x2, out=x2)
+        x2 -= expxcutoff
+        k, sigma = gpdfitnew(x2, sort=x2si)
+    if k >= k_min and not np.isinf(k):
+        # no smoothing if short tail or GPD fit failed
+        # compute ordered statistic for the fit
+        sti = np.arange(0.5, n2)
+        sti /= n2
+        qq = gpinv(sti, k, sigma)
+        qq += expxcutoff
+        np.log(qq, out=qq)
+        # place the smoothed tail into the output array
+        x[tailinds[x2si]] = qq
+        # truncate smoothed values to the largest raw weight 0
+        x[x > 0] = 0
+
+    return k
+
+
 def gpdfitnew(x, sort=True, sort_in_place=False, return_quadrature=False):
     """Estimate the paramaters for the Generalized Pareto Distribution (GPD)
     Returns empirical Bayes estimate for the parameters of the two-parameter
@@ -296,6 +349,77 @@ def gpdfitnew(x, sort=True, sort_in_place=False, return_quadrature=False):
         return k, sigma
 
 
+def gpdfitnew_batch(x):
+    """Estimate the paramaters for the Generalized Pareto Distribution (GPD)
+    for several data sets at once. Equivalent to calling :meth:`gpdfitnew()`
+    on each column of `x`.
+    Parameters
+    ----------
+    x : ndarray
+        Array of size n x m containing m data sets of size n, each sorted in
+        ascending order.
+    Returns
+    -------
+    k, sigma : ndarray
+        estimated parameter values for each data set
+    """
+    if x.ndim != 2 or x.shape[0] <= 1:
+        raise ValueError("Invalid input array.")
+
+    n = x.shape[0]
+    PRIOR = 3
+    m = 30 + int(np.sqrt(n))
+
+    bs = np.arange(1, m + 1, dtype=float)
+    bs -= 0.5
+    bs = 1 - np.sqrt(m / bs)
+    bs = bs[:, None] / (PRIOR * x[int(n/4 + 0.5) - 1]) + 1 / x[-1]
+
+    # ks[i, j] is the mean over the data of log1p(-bs[i, j] * x[:, j])
+    ks = np.empty(bs.shape)
+    for ii in range(m):
+        ks[ii] = np.mean(np.log1p(-bs[ii] * x), axis=0)
+
+    L = n * (np.log(-bs / ks) - ks - 1)
+
+    w = np.empty(bs.shape)
+    for ii in range(m):
+        w[ii] = 1 / np.sum(np.exp(L - L[ii]), axis=0)
+
+    # remove negligible weights
+    w[w < 10 * np.finfo(float).eps] = 0
+    # normalise w
+    w /= np.sum(w, axis=0)
+
+    # posterior mean for b
+    b = np.sum(bs * w, axis=0)
+    # Estimate for k, note that we return a negative of Zhang and
+    # Stephens's k, because it is more common parameterisation.
+    k = np.mean(np.log1p((-b) * x), axis=0)
+    # estimate for sigma
+    sigma = -k / b
+    # weakly informative prior for k
+    a = 10
+    k = k * n / (n+a) + a * 0.5 / (n+a)
+
+    return k, sigma
+
+
+def gpinv_batch(p, k, sigma):
+    """Inverse Generalised Pareto distribution function for several
+    parameter values at once. `p` must lie in the open interval (0, 1).
+    Returns an array of size len(p) x len(k) whose columns are
+    ``gpinv(p, k[j], sigma[j])``.
+    """
+    p = p[:, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x = np.where(np.abs(k) < np.finfo(float).eps, -np.log1p(-p),
+                     np.expm1(-k * np.log1p(-p)) / k)
+    x *= sigma
+    x[:, sigma <= 0] = np.nan
+    return x
+
+
 def gpinv(p, k, sigma):
     """Inverse Generalised Pareto distribution function."""
     x = np.empty(p.shape)
@@ -6,7 +6,10 @@ import pdb
 import pickle
 from argparse import ArgumentParser
 from provenance_tools.write_provenance_data import write_provenance_data
-from bayes_traj.fit_stats import ave_pp, odds_correct_classification
+from bayes_traj.model_registry import load_model
+from bayes_traj.fit_stats import FitStatistics
+from bayes_traj.fit_stats import get_fit_metrics, get_looic
+from bayes_traj.posterior_cache import get_cache_file_name
 
 def main():
     desc = """"""
@@ -22,13 +25,29 @@ def main():
         for that trajectory. Value should be between 0 and 1 inclusive.', \
         type=float, default=0)
     parser.add_argument('--hide_ic', help='Use this flag to hide compuation \
-        and display of information criterai (BIC and WAIC2), which can take \
-        several moments to compute.', action="store_true")
+        and display of information criterai (BIC and WAIC2). These are read \
+        from the fit metrics saved with the model if they are current, and \
+        computed otherwise, which can take several moments.',
+        action="store_true")
+    parser.add_argument('--refresh_ic', help='Use this flag to recompute the \
+        information criteria and fit statistics even if current ones are \
+        saved with the model.', action="store_true")
+    parser.add_argument('--loo', help='Use this flag to display subject-level \
+        PSIS-LOO (as LOOIC, on the scale of WAIC2) and the number of subjects \
+        with unreliable estimates (Pareto k > 0.7). It is read from the fit \
+        metrics saved with the model (e.g. by bayes_traj_main --criterion \
+        loo) if they are current, and computed otherwise.',
+        action="store_true")
+    parser.add_argument('--seed', help='If specified, the posterior draws \
+        used to compute PSIS-LOO (and WAIC2, which is then computed by \
+        sampling rather than analytically, when it is not read from the \
+        model) are made with this random seed and saved alongside the model \
+        file (with a .samples.pt extension), so that later runs with the \
+        same seed reuse them.', type=int, default=None)
     
     op = parser.parse_args()
     
-    with open(op.model, 'rb') as f:
-        mm = pickle.load(f)['MultDPRegression']
+    mm = load_model(op.model)
 
     if torch.is_tensor(mm.R_):
         traj_probs = np.sum(mm.R_.numpy(), 0)/np.sum(mm.R_.numpy())
@@ -42,25 +61,40 @@ def main():
     
     all_traj_ids = np.where(mm.sig_trajs_)[0]
 
-    if op.hide_ic:
+    # Assignment-based fit stats
+    stats = FitStatistics(mm)
+
+    # Models fit by streaming the data (bayes_traj_main --chunksize) do not
+    # hold the data needed to compute information criteria
+    has_data = getattr(mm, 'X_', None) is not None
+    if not has_data and not op.hide_ic:
+        print("Model does not hold its training data; information criteria \
+are not computed.")
+    assert has_data or not op.loo, \
+        "--loo requires a model that holds its training data"
+
+    if op.hide_ic or not has_data:
         bic = None
         waic2 = None
+        ave_pps = stats.ave_pp_
+        occs = stats.occ_
     else:
-        bic = mm.bic()
-        waic2 = mm.compute_waic2()
-    
-    # Compute fit stats
-    ave_pps = ave_pp(mm)
-    occs = odds_correct_classification(mm)
-    
-    df_traj = mm.to_df()
+        metrics = get_fit_metrics(mm, refresh=op.refresh_ic,
+                                  S=None if op.seed is None else 100,
+                                  seed=op.seed)
+        bic = metrics['bic']
+        waic2 = metrics['waic2']['value']
+        ave_pps = metrics['ave_pp']
+        occs = metrics['occ']
+
+    if op.loo:
+        looic = get_looic(mm, refresh=op.refresh_ic, seed=op.seed)
+
+    if op.seed is not None and \
+       getattr(mm, 'posterior_cache_', None) is not None:
+        mm.posterior_cache_.save(get_cache_file_name(op.model))
     
-    # Get dataframe column that was used to create groups, if groups exist
-    if mm.gb_ is not None:
-        num_groups = mm.gb_.ngroups
-        groupby_col = mm.gb_.count().index.name               
-    else:
-        num_groups = df_traj.shape[0]
+    num_groups = stats.num_units_
         
     max_tar_name_len = 0
     for tar in mm.target_names_:
@@ -88,13 +122,19 @@ def main():
         "{}".format(','.join(list(all_traj_ids.astype('str')))).ljust(40)))
     
     print("{}{}".format("No. Observations:".ljust(20), "{}".\
-                        format(df_traj.shape[0]).ljust(15)))
+                        format(stats.traj_.shape[0]).ljust(15)))
     print("{}{}".format("No. Groups:".ljust(20), "{}".\
                         format(num_groups).ljust(15)))
 
     if waic2 is not None:
         print("{}{}".format("WAIC2:".ljust(20), "{}".\
                             format(int(waic2)).ljust(10))) 
+    if op.loo:
+        print("{}{}".format("LOOIC:".ljust(20), "{}".\
+                            format(int(looic['value'])).ljust(10)))
+        print("{}{}".format("Pareto k > 0.7:".ljust(20), "{} ({:.1f}%)".\
+            format(looic['num_bad_k'],
+                   100*looic['num_bad_k']/looic['num_groups']).ljust(10)))
     if bic is not None:
         if len(bic) == 2:
             print("{}{}".format("BIC1:".ljust(20), "{}".\
@@ -103,7 +143,7 @@ def main():
                                 format(int(bic[1])).ljust(10))) 
         else:
             print("{}{}".format("BIC:".ljust(20), "{}".\
-                                format(int(bic)).ljust(10)))         
+                                format(int(bic[0])).ljust(10)))         
         
     for traj in traj_ids:
         if traj_probs[traj] > op.min_traj_prob:
@@ -111,12 +151,8 @@ def main():
             print("Summary for Trajectory {}".format(traj).center(row_width))
             print("="*row_width)
         
-            num_obs_in_traj = sum(df_traj.traj.values == traj)
-            if mm.gb_ is not None:
-                num_groups_in_traj = df_traj[df_traj.traj.values == traj].\
-                    groupby(groupby_col).ngroups
-            else:
-                num_groups_in_traj = num_obs_in_traj
+            num_obs_in_traj = stats.num_obs_[traj]
+            num_groups_in_traj = stats.num_groups_[traj]
                 
             perc = 100*num_groups_in_traj/num_groups
 
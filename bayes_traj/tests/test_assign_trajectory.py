@@ -0,0 +1,40 @@
+import torch
+import numpy as np
+import pandas as pd
+from bayes_traj.assign_trajectory import assign_trajectory_chunked
+from bayes_traj.tests.test_assignment_engine import get_model_and_data
+import os, pickle, tempfile
+import pdb
+
+def test_assign_trajectory_chunked():
+    mm, df = get_model_and_data()
+
+    df_in = df.drop(columns=['traj'])
+    expected = mm.augment_df_with_traj_info(df_in.copy(), 'id',
+                                            test_data=True)
+    traj_map = {ii: ii for ii in np.where(mm.sig_trajs_)[0]}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        in_csv = os.path.join(tmp_dir, 'in.csv')
+        model_file = os.path.join(tmp_dir, 'model.p')
+        df_in.to_csv(in_csv, index=False)
+        pickle.dump({'MultDPRegression': mm}, open(model_file, 'wb'))
+
+        # Chunks that do not divide the subjects evenly, scored in this
+        # process and in worker processes
+        for model, num_workers in [(mm, 1), (model_file, 2)]:
+            out_csv = os.path.join(tmp_dir, 'out.csv')
+            assign_trajectory_chunked(model, in_csv, out_csv, 'id',
+                                      chunksize=37, traj_map=traj_map,
+                                      num_workers=num_workers)
+            df_out = pd.read_csv(out_csv)
+
+            assert list(df_out.columns) == list(expected.columns), \
+                "Unexpected columns"
+            assert np.array_equal(df_out.id.values, expected.id.values), \
+                "Rows out of order"
+            assert np.array_equal(df_out.traj.values, expected.traj.values), \
+                "Trajectory mismatch"
+            cols = [cc for cc in expected.columns if cc.startswith('traj_')]
+            assert np.allclose(df_out[cols].values, expected[cols].values,
+                               atol=1e-10), "Probability mismatch"
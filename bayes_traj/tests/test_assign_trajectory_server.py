@@ -0,0 +1,70 @@
+import torch
+import numpy as np
+import pandas as pd
+from bayes_traj.assign_trajectory_server import make_server
+from bayes_traj.tests.test_assignment_engine import get_model_and_data
+from concurrent.futures import ThreadPoolExecutor
+import urllib.request, urllib.error
+import os, json, threading
+import pdb
+
+def post(url, df):
+    body = ''.join([json.dumps(rr) + '\n' for rr in \
+                    json.loads(df.to_json(orient='records'))]).encode()
+    req = urllib.request.Request(url, data=body, method='POST',
+        headers={'Content-Type': 'application/x-ndjson'})
+    with urllib.request.urlopen(req) as resp:
+        return pd.DataFrame.from_records(\
+            [json.loads(ll) for ll in resp.read().decode().splitlines()])
+
+def test_assign_trajectory_server():
+    mm, df = get_model_and_data()
+    df_aug = mm.augment_df_with_traj_info(df.copy(), 'id', test_data=True)
+    cols = [cc for cc in df_aug.columns if cc.startswith('traj')]
+    expected = df_aug.groupby('id')[cols].first()
+
+    server = make_server(mm, groupby='id', num_workers=2, max_wait=0.05)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    try:
+        with urllib.request.urlopen(url + '/health') as resp:
+            health = json.loads(resp.read())
+        assert health['trajectories'] == \
+            np.where(mm.sig_trajs_)[0].tolist(), "Unexpected trajectories"
+
+        # Concurrent requests, each with a different subset of subjects,
+        # should be batched without mixing up their results
+        ids = df.id.unique()
+        subsets = [ids[ii::5] for ii in range(5)]
+        with ThreadPoolExecutor(5) as pool:
+            results = list(pool.map(lambda ss: post(url + '/assign',
+                df[df.id.isin(ss)].drop(columns=['traj'])), subsets))
+
+        for ss, res in zip(subsets, results):
+            assert set(res.id.values) == set(ss), "Unexpected subjects"
+            res = res.set_index('id').loc[expected.loc[ss].index]
+            assert np.array_equal(res.traj.values, expected.loc[ss].traj), \
+                "Trajectory mismatch"
+            assert np.allclose(res[cols[1:]].values,
+                               expected.loc[ss][cols[1:]].values,
+                               atol=1e-10), "Probability mismatch"
+
+        # Requests missing predictors are rejected
+        try:
+            post(url + '/assign', df[['id', 'y']])
+            assert False, "Request should have failed"
+        except urllib.error.HTTPError as e:
+            assert e.code == 400, "Unexpected error code"
+
+        # So are requests with missing subject identifiers
+        df_missing = df.drop(columns=['traj'])
+        df_missing.loc[df_missing.index[0], 'id'] = np.nan
+        try:
+            post(url + '/assign', df_missing)
+            assert False, "Request should have failed"
+        except urllib.error.HTTPError as e:
+            assert e.code == 400, "Unexpected error code"
+    finally:
+        server.shutdown()
+        server.server_close()
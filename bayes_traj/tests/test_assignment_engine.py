@@ -0,0 +1,191 @@
+import torch
+import numpy as np
+import pandas as pd
+from bayes_traj.mult_dp_regression import MultDPRegression
+from bayes_traj.assignment_engine import TrajAssignmentEngine
+import pytest
+import os, tempfile
+import pdb
+
+def get_model_and_data(binary=False, K=None, iters=10, seed=0):
+    """Fits a small model to one of the test data sets. Also used by the
+    tests of other modules that need a fitted model.
+
+    Parameters
+    ----------
+    binary : bool, optional
+        If true, the model is fit to a binary target ('binary_data_1.csv'),
+        otherwise to a continuous one ('trajectory_data_1.csv').
+
+    K : int, optional
+        Number of trajectories. By default 5 for the binary data and 10 for
+        the continuous data.
+
+    iters : int, optional
+        Number of fit iterations.
+
+    seed : int, optional
+        Random seed.
+
+    Returns
+    -------
+    mm : MultDPRegression
+        The fitted model.
+
+    df : pandas dataframe
+        The data, with subjects identified by the 'id' column.
+    """
+    data_dir = os.path.split(os.path.realpath(__file__))[0] + \
+        '/../resources/data/'
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+    if binary:
+        df = pd.read_csv(data_dir + 'binary_data_1.csv')
+        df['id'] = np.arange(df.shape[0])//5
+        preds = ['intercept', 'pred']
+        targets = ['target']
+        mm = MultDPRegression(np.zeros([2, 1]), 10*np.ones([2, 1]),
+                              np.ones(1), np.ones(1), 1, 1,
+                              K=5 if K is None else K)
+    else:
+        df = pd.read_csv(data_dir + 'trajectory_data_1.csv')
+        preds = ['intercept', 'age']
+        targets = ['y']
+        mm = MultDPRegression(np.zeros([2, 1]), 5*np.ones([2, 1]),
+                              100*np.ones(1), np.ones(1), 1, 1.,
+                              K=10 if K is None else K)
+    mm.fit(target_names=targets, predictor_names=preds, df=df, groupby='id',
+           iters=iters)
+
+    return mm, df
+
+def get_expected_probs(mm, df):
+    df_aug = mm.augment_df_with_traj_info(df.copy(), 'id', test_data=True)
+    cols = [cc for cc in df_aug.columns if cc.startswith('traj_')]
+
+    return df_aug.groupby('id')[cols].first()
+
+def test_add_visits_gaussian():
+    mm, df = get_model_and_data()
+    expected = get_expected_probs(mm, df)
+
+    engine = TrajAssignmentEngine(mm)
+    engine.add_visits(df, 'id')
+    probs = engine.get_probs(expected.index.tolist())
+
+    assert np.allclose(probs[expected.columns].values, expected.values,
+                       atol=1e-10), "Probability mismatch"
+    assert np.array_equal(probs.traj.values,
+                          mm.augment_df_with_traj_info(df.copy(), 'id', True).\
+                          groupby('id').traj.first().values), \
+        "Trajectory mismatch"
+
+def test_add_visit():
+    mm, df = get_model_and_data()
+    expected = get_expected_probs(mm, df)
+
+    engine = TrajAssignmentEngine(mm)
+    for ii in range(df.shape[0]):
+        probs = engine.add_visit(df.id.values[ii], df.iloc[ii])
+    assert probs.shape == (mm.K_,), "Unexpected shape"
+    assert np.isclose(np.sum(probs), 1), "Probabilities do not sum to 1"
+
+    assert np.allclose(engine.get_probs(expected.index.tolist())\
+                       [expected.columns].values, expected.values,
+                       atol=1e-10), "Probability mismatch"
+    assert np.sum(engine.num_visits_) == df.shape[0], \
+        "Unexpected visit count"
+
+    # The store grows geometrically rather than by one row per subject
+    num_subjects = len(engine.subject_ids_)
+    assert engine.log_like_.shape == (num_subjects, mm.K_) and \
+        engine._log_like_buf.shape[0] < 2*num_subjects, \
+        "Unexpected store size"
+
+def test_add_visits_binary():
+    mm, df = get_model_and_data(binary=True)
+    expected = get_expected_probs(mm, df)
+
+    engine = TrajAssignmentEngine(mm)
+    engine.add_visits(df, 'id')
+
+    # get_R_matrix uses Monte Carlo estimates for binary targets
+    assert np.allclose(engine.get_probs(expected.index.tolist())\
+                       [expected.columns].values, expected.values,
+                       atol=0.05), "Probability mismatch"
+
+def test_assign_missing_ids():
+    mm, df = get_model_and_data()
+    engine = TrajAssignmentEngine(mm)
+
+    probs = engine.assign(df, 'id')
+    assert np.array_equal(probs.index.values, df.id.unique()), \
+        "Unexpected subjects"
+
+    # Rows without a subject identifier must not be scored with another
+    # subject's rows
+    df_missing = df.copy()
+    df_missing.loc[df_missing.index[0], 'id'] = np.nan
+    with pytest.raises(RuntimeError):
+        engine.assign(df_missing, 'id')
+
+    df_missing['visit'] = 0
+    with pytest.raises(RuntimeError):
+        engine.assign(df_missing, ['visit', 'id'])
+
+    # Nor are they pooled into a single subject of the store
+    with pytest.raises(RuntimeError):
+        engine.add_visits(df_missing, 'id')
+    assert len(engine.subject_ids_) == 0, "Unexpected subjects in store"
+
+def test_save_load():
+    mm, df = get_model_and_data()
+
+    engine = TrajAssignmentEngine(mm)
+    engine.add_visits(df, 'id')
+    engine.remove_subject(df.id.values[0])
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = os.path.join(tmp_dir, 'store.npz')
+        engine.save(file_name)
+
+        engine_loaded = TrajAssignmentEngine(mm)
+        engine_loaded.load(file_name)
+        assert engine_loaded.subject_ids_ == engine.subject_ids_, \
+            "Subject mismatch"
+        assert np.array_equal(engine_loaded.get_probs().values,
+                              engine.get_probs().values), \
+            "Probability mismatch"
+
+        # A store cannot be used with a different model
+        mm.w_mu_[0, 0, 0] += 1
+        with pytest.raises(RuntimeError):
+            TrajAssignmentEngine(mm).load(file_name)
+
+def test_save_load_ids():
+    mm, df = get_model_and_data()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = os.path.join(tmp_dir, 'store.npz')
+
+        # Non-integer identifiers are read back unchanged
+        df['id'] = ['subject_{}'.format(ii) for ii in df.id.values]
+        engine = TrajAssignmentEngine(mm)
+        engine.add_visits(df, 'id')
+        engine.save(file_name)
+
+        engine_loaded = TrajAssignmentEngine(mm)
+        engine_loaded.load(file_name)
+        assert engine_loaded.subject_ids_ == engine.subject_ids_, \
+            "Subject mismatch"
+        visit = df.iloc[0]
+        assert np.allclose(engine_loaded.add_visit(visit.id, visit),
+                           engine.add_visit(visit.id, visit)), \
+            "Probability mismatch"
+        assert len(engine_loaded.subject_ids_) == len(engine.subject_ids_), \
+            "Existing subject added again"
+
+        # Mixed identifiers would not be, and are rejected
+        engine.add_visit(1, visit)
+        with pytest.raises(RuntimeError):
+            engine.save(file_name)
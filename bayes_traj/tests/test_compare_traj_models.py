@@ -0,0 +1,69 @@
+import torch
+import numpy as np
+import pandas as pd
+from bayes_traj.model_io import save_model
+from bayes_traj.fit_stats import get_fit_metrics, get_looic
+from bayes_traj.compare_traj_models import get_model_files, compare_models
+from bayes_traj.tests.test_assignment_engine import get_model_and_data
+import os, pickle, tempfile
+import pdb
+
+def test_compare_models():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Two models with saved metrics (one of them in a pickle file) and
+        # one without
+        mms = []
+        for ii, K in enumerate([1, 10, 10]):
+            mm, df = get_model_and_data(K=K, seed=ii)
+            if ii < 2:
+                get_fit_metrics(mm)
+            mms.append(mm)
+
+        save_model(mms[0], os.path.join(tmp_dir, 'model_0.btm'))
+        save_model(mms[1], os.path.join(tmp_dir, 'model_1.p'))
+        save_model(mms[2], os.path.join(tmp_dir, 'model_2.btm'))
+        df.to_csv(os.path.join(tmp_dir, 'data.csv'), index=False)
+
+        model_files = get_model_files([tmp_dir])
+        assert [os.path.basename(ff) for ff in model_files] == \
+            ['model_0.btm', 'model_1.p', 'model_2.btm'], \
+            "Unexpected model files"
+        assert get_model_files([os.path.join(tmp_dir, '*.btm')]) == \
+            [model_files[0], model_files[2]], "Unexpected model files"
+
+        # Scored in this process and in worker processes
+        for num_workers in [1, 2]:
+            df_cmp = compare_models(model_files, num_workers=num_workers,
+                                    loo=True, S=200, seed=0)
+            assert 'error' not in df_cmp.columns, "Unexpected error"
+            assert np.all(np.diff(df_cmp.looic.values) >= 0), \
+                "Table not sorted"
+
+            df_cmp = df_cmp.set_index(df_cmp.model.map(os.path.basename))
+            for ii, mm in enumerate(mms):
+                row = df_cmp.loc['model_{}.{}'.format(ii, \
+                    'p' if ii == 1 else 'btm')]
+                assert row.num_trajs == np.sum(mm.sig_trajs_.numpy()), \
+                    "Unexpected number of trajectories"
+                assert row.stored_metrics == (ii < 2), \
+                    "Unexpected use of saved metrics"
+                waic2, pointwise = mm.compute_waic2(method='analytic',
+                                                    return_pointwise=True)
+                assert np.isclose(row.waic2, waic2), "Unexpected WAIC2"
+                assert np.isclose(row.waic2_se, \
+                    np.sqrt(pointwise.shape[0]*np.var(pointwise))) and \
+                    row.waic2_se > 0, "Unexpected WAIC2 standard error"
+                assert row.bic_groups == float(mm.bic()[1]), \
+                    "Unexpected BIC"
+                assert row.iters == 10, "Unexpected number of iterations"
+
+        df_cmp = compare_models(model_files, sort_by='waic2',
+                                ascending=False, query='stored_metrics')
+        assert df_cmp.shape[0] == 2 and np.all(df_cmp.stored_metrics), \
+            "Unexpected filtering"
+        assert np.all(np.diff(df_cmp.waic2.values) <= 0), "Table not sorted"
+
+        # Files that are not models are reported rather than scored
+        df_cmp = compare_models([os.path.join(tmp_dir, 'data.csv')] + \
+                                model_files)
+        assert df_cmp.error.notna().sum() == 1, "Unexpected errors"
@@ -0,0 +1,103 @@
+import torch
+import numpy as np
+import pandas as pd
+from bayes_traj.mult_dp_regression import MultDPRegression
+from bayes_traj.coreset import *
+from bayes_traj.tests.test_mult_dp_regression import get_two_traj_df
+import pdb
+
+def test_get_subject_coefficients():
+    df = get_two_traj_df()
+    keys, coefs = get_subject_coefficients(df, ['y'], ['intercept', 'x'],
+                                           'sid', ridge=0)
+
+    assert np.array_equal(keys, np.arange(80)), "Unexpected keys"
+    for g in [0, 55]:
+        ids = df.sid.values == g
+        expected = np.linalg.lstsq(df[['intercept', 'x']].values[ids],
+                                   df.y.values[ids], rcond=None)[0]
+        assert np.allclose(coefs[g], expected), "Unexpected coefficients"
+
+def test_build_coreset():
+    df = get_two_traj_df()
+    df_coreset, weights = build_coreset(df, ['y'], ['intercept', 'x'], 'sid',
+                                        30, seed=0)
+
+    assert df_coreset.shape[0] == weights.shape[0], "Shape mismatch"
+    assert np.all(weights > 0), "Weights must be positive"
+    assert df_coreset.sid.nunique() <= 30, "Too many subjects in coreset"
+
+    # Weights must be constant within a subject
+    w_sd = pd.Series(weights).groupby(df_coreset.sid.values).std()
+    assert np.allclose(w_sd.values, 0), "Weights vary within subject"
+
+    # The weighted number of subjects is an unbiased estimate of the total
+    # number of subjects
+    w_subj = pd.Series(weights).groupby(df_coreset.sid.values).first()
+    assert np.abs(np.sum(w_subj.values) - 80) < 20, \
+        "Unexpected total subject weight"
+
+def test_fit_coreset():
+    df = get_two_traj_df()
+
+    K = 10
+    get_model = lambda: MultDPRegression(np.zeros([2, 1]),
+        100*np.ones([2, 1]), np.ones(1), np.ones(1), 1, 1., K=K)
+    torch.manual_seed(0)
+    np.random.seed(0)
+    mm = get_model()
+    error_info = fit_coreset(mm, ['y'], ['intercept', 'x'], df, 'sid', 30,
+                             coreset_iters=30, refine_iters=3,
+                             report_error=True, seed=0)
+
+    assert mm.N_ == df.shape[0], "Refinement not on full data"
+    assert mm.subject_weights_ is None, "Unexpected subject weights"
+    assert set(error_info.keys()) == \
+        {'waic2_full', 'waic2_coreset', 'waic2_refined', 'rel_error_coreset',
+         'rel_error_refined'}, "Unexpected error info"
+
+    # The errors are with respect to a full-data fit from the same
+    # initialization
+    torch.manual_seed(0)
+    np.random.seed(0)
+    mm_full = get_model()
+    mm_full.fit(target_names=['y'], predictor_names=['intercept', 'x'],
+                df=df, groupby='sid', iters=33)
+    waic2_full = mm_full.compute_waic2(method='analytic')
+    assert np.isclose(error_info['waic2_full'], waic2_full), \
+        "Unexpected reference WAIC2"
+    for name in ['coreset', 'refined']:
+        assert np.isclose(error_info['rel_error_' + name],
+            np.abs(error_info['waic2_' + name] - waic2_full)/\
+            np.abs(waic2_full)), "Unexpected relative error"
+    assert error_info['rel_error_refined'] < 0.01 and \
+        error_info['rel_error_refined'] < error_info['rel_error_coreset'], \
+        "Refined solution far from the full-data fit"
+    assert np.isclose(error_info['waic2_refined'],
+                      mm.compute_waic2(method='analytic')), \
+        "Unexpected refined WAIC2"
+
+    assert torch.sum(mm.sig_trajs_) == 2, "Unexpected number of trajectories"
+    traj = df.traj.values
+    assigned = torch.argmax(mm.R_, dim=1).numpy()
+    assert len(set(assigned[traj == 0])) == 1 and \
+        len(set(assigned[traj == 1])) == 1 and \
+        assigned[0] != assigned[-1], "Unexpected trajectory assignments"
+
+def test_weighted_lambda_init():
+    # The initial precision parameters scale with the total subject weight,
+    # not the number of subjects in the coreset
+    df = get_two_traj_df()
+    lambda_as = []
+    for weight in [1., 2.5]:
+        torch.manual_seed(0)
+        np.random.seed(0)
+        mm = MultDPRegression(np.zeros([2, 1]), 100*np.ones([2, 1]),
+                              np.ones(1), np.ones(1), 1, 1., K=5)
+        mm.fit(target_names=['y'], predictor_names=['intercept', 'x'], df=df,
+               groupby='sid', iters=0,
+               subject_weights=weight*np.ones(df.shape[0]))
+        lambda_as.append(mm.lambda_a_)
+
+    assert torch.allclose(2.5*lambda_as[0], lambda_as[1]), \
+        "Initial precisions not scaled by the total subject weight"
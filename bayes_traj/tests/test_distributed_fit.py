@@ -0,0 +1,91 @@
+import torch
+import numpy as np
+import pandas as pd
+from bayes_traj.mult_dp_regression import MultDPRegression
+from bayes_traj.distributed_fit import shard_groups
+from bayes_traj.utils import *
+import os
+import pdb
+
+def test_shard_groups():
+    df = pd.DataFrame({'id': [3, 3, 1, 2, 2, 2, 5, 4, 4],
+                       'y': np.arange(9)})
+    row_ids = shard_groups(df, 'id', 3)
+
+    assert len(row_ids) == 3, "Unexpected number of shards"
+    assert np.array_equal(np.sort(np.concatenate(row_ids)), np.arange(9)), \
+        "Shards do not partition the rows"
+
+    # Shards should hold contiguous blocks of sorted group keys, and no group
+    # should be split across shards
+    prev_max = -np.inf
+    for ids in row_ids:
+        assert ids.shape[0] > 0, "Empty shard"
+        keys = df['id'].values[ids]
+        assert np.min(keys) > prev_max, "Shard keys not contiguous"
+        prev_max = np.max(keys)
+
+def fit_model(df, targets, preds, K, R, num_workers):
+    M = len(preds)
+    D = len(targets)
+
+    mm = MultDPRegression(np.zeros([M, D]), 10*np.ones([M, D]), np.ones(D),
+                          np.ones(D), 1, 1, K=K)
+    mm.fit(target_names=targets, predictor_names=preds, df=df, groupby='id',
+           iters=10, R=R, w_mu=np.zeros([M, D, K]),
+           w_var=np.ones([M, D, K]), lambda_a=np.ones([D, K]),
+           lambda_b=np.ones([D, K]), v_a=np.ones(K), v_b=np.ones(K),
+           num_workers=num_workers)
+
+    return mm
+
+def test_fit_distributed_gaussian():
+    data_file_name = os.path.split(os.path.realpath(__file__))[0] + \
+        '/../resources/data/trajectory_data_1.csv'
+    df = pd.read_csv(data_file_name)
+    preds = ['intercept', 'age']
+    targets = ['y']
+
+    K = 3
+    R = 0.1*np.ones([df.shape[0], K])
+    R[np.arange(df.shape[0]), df.traj.values - 1] = 0.8
+
+    mm_single = fit_model(df, targets, preds, K, R, None)
+    mm_dist = fit_model(df, targets, preds, K, R, 2)
+
+    assert torch.allclose(mm_single.R_, mm_dist.R_, atol=1e-8), \
+        "R_ mismatch"
+    assert torch.allclose(mm_single.w_mu_, mm_dist.w_mu_, atol=1e-8), \
+        "w_mu_ mismatch"
+    assert torch.allclose(mm_single.w_var_, mm_dist.w_var_, atol=1e-8), \
+        "w_var_ mismatch"
+    assert torch.allclose(mm_single.lambda_b_, mm_dist.lambda_b_,
+                          rtol=1e-8), "lambda_b_ mismatch"
+    assert torch.allclose(mm_single.v_b_, mm_dist.v_b_, rtol=1e-8), \
+        "v_b_ mismatch"
+    assert mm_dist.N_ == df.shape[0], "Unexpected N_"
+
+def test_fit_distributed_binary():
+    data_file_name = os.path.split(os.path.realpath(__file__))[0] + \
+        '/../resources/data/binary_data_1.csv'
+    df = pd.read_csv(data_file_name)
+    df['id'] = np.arange(df.shape[0])//5
+    preds = ['intercept', 'pred']
+    targets = ['target']
+
+    K = 2
+    R = 0.5*np.ones([df.shape[0], K])
+    R[df.pred.values > np.median(df.pred.values), 0] = 0.9
+    R[:, 1] = 1 - R[:, 0]
+
+    mm_single = fit_model(df, targets, preds, K, R, None)
+    mm_dist = fit_model(df, targets, preds, K, R, 2)
+
+    # The binary likelihood terms in the R_ update are Monte Carlo estimates,
+    # so the single-process and distributed fits only agree to within MC error
+    assert torch.allclose(mm_single.R_, mm_dist.R_, atol=0.15), \
+        "R_ mismatch"
+    assert torch.allclose(mm_single.w_mu_, mm_dist.w_mu_, atol=0.1), \
+        "w_mu_ mismatch"
+    assert mm_dist.xi_.shape == mm_single.xi_.shape, "Unexpected xi_ shape"
+    assert torch.all(mm_dist.xi_ > 0), "Unexpected xi_ values"
@@ -0,0 +1,58 @@
+import torch
+import numpy as np
+import pandas as pd
+import matplotlib
+matplotlib.use('Agg')
+from bayes_traj.export_inference_model import export_inference_model
+from bayes_traj.assignment_engine import TrajAssignmentEngine
+from bayes_traj.model_io import save_model
+from bayes_traj.model_registry import load_model
+from bayes_traj.tests.test_assignment_engine import get_model_and_data
+import pytest
+import os, tempfile
+import pdb
+
+def test_export_inference_model():
+    mm, df = get_model_and_data(K=20, iters=20)
+    df = df.drop(columns=['traj'])
+    sig_trajs = np.where(mm.sig_trajs_)[0]
+
+    mm_inf = export_inference_model(mm)
+    assert mm_inf.K_ == sig_trajs[-1] + 1, "Unexpected number of trajectories"
+    assert mm_inf.df_ is None and mm_inf.R_ is None and mm_inf.X_ is None, \
+        "Training data not removed"
+    assert np.array_equal(np.where(mm_inf.sig_trajs_)[0], sig_trajs), \
+        "Trajectory numbers changed"
+
+    df_aug = mm.augment_df_with_traj_info(df.copy(), 'id', test_data=True)
+    cols = ['traj_{}'.format(tt) for tt in sig_trajs]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = os.path.join(tmp_dir, 'model.btm')
+        save_model(mm_inf, file_name, float32=True)
+        mm_read = load_model(file_name)
+
+        assert mm_read.w_mu_.dtype == torch.float64, "Not read as double"
+        df_inf = mm_read.augment_df_with_traj_info(df.copy(), 'id',
+                                                   test_data=True)
+        assert list(df_inf.columns) == list(df_aug.columns), \
+            "Unexpected columns"
+        assert np.array_equal(df_inf.traj.values, df_aug.traj.values), \
+            "Trajectory mismatch"
+        assert np.allclose(df_inf[cols].values, df_aug[cols].values,
+                           atol=1e-5), "Probability mismatch"
+
+        probs = TrajAssignmentEngine(mm_read).assign(df, 'id')
+        assert np.allclose(probs[cols].values,
+                           df_aug.groupby('id')[cols].first().values,
+                           atol=1e-5), "Probability mismatch"
+
+        # Plotting uses the stored summary of the training data
+        ax = mm_read.plot('age', 'y', show=False)
+        assert ax.get_legend_handles_labels()[1] == \
+            mm.plot('age', 'y', show=False).get_legend_handles_labels()[1], \
+            "Legend mismatch"
+
+    # A model without active trajectories cannot be exported
+    mm.sig_trajs_[:] = False
+    with pytest.raises(RuntimeError):
+        export_inference_model(mm)
@@ -323,3 +323,287 @@ def test_compute_waic2():
         pdb.set_trace()
     assert waic2_test > waic2_ref, "Error in WAIC computation"
 
+
+
+def compute_waic2_dense(mm, S=100):
+    """Reference implementation of MultDPRegression.compute_waic2 that holds
+    all N x D x S likelihood samples in memory at once.
+    """
+    if getattr(mm, 'N_to_G_index_map_', None) is None:
+        mm._set_N_to_G_index_map()
+
+    num_trajs = torch.sum(mm.sig_trajs_)
+    traj_samples = torch.multinomial(\
+        mm.R_[:, mm.sig_trajs_][mm.group_first_index_, :],
+        num_samples=S, replacement=True)[mm.N_to_G_index_map_, :]
+    one_hot = torch.zeros(mm.N_, S, num_trajs, dtype=torch.float64)
+    one_hot.scatter_(2, traj_samples.unsqueeze(-1), 1)
+
+    likelihood_samples = torch.zeros(mm.N_, mm.D_, S, dtype=torch.float64)
+    for dd in range(mm.D_):
+        co_x_preds = torch.zeros(mm.N_, S, num_trajs, dtype=torch.float64)
+        for ii, kk in enumerate(np.where(mm.sig_trajs_)[0]):
+            for jj in range(2):
+                w_samples = \
+                    torch.normal(mean=mm.w_mu_[:, dd, kk].expand(S, -1),
+                    std=torch.sqrt(mm.w_var_[:, dd, kk].expand(S, -1)))
+            co_samples = w_samples.unsqueeze(0).repeat(mm.N_, 1, 1)
+            if mm.ranef_indices_ is not None and \
+               mm.target_type_[dd] == 'gaussian':
+                u_mu = mm.u_mu_[:, dd, kk, mm.ranef_indices_].unsqueeze(1)
+                u_Sig = mm.u_Sig_[:, dd, kk, mm.ranef_indices_, :]\
+                    [:, :, mm.ranef_indices_].unsqueeze(1)
+                ranef_samples = torch.distributions.MultivariateNormal(\
+                    u_mu.expand(-1, S, -1), u_Sig.expand(-1, S, -1, -1)).\
+                    sample()[mm.N_to_G_index_map_, :, :]
+                co_samples[:, :, mm.ranef_indices_] += ranef_samples
+            co_x_preds[:, :, ii] = \
+                torch.einsum('nsm,nm->ns', co_samples, mm.X_.double())
+        pred_samples = (co_x_preds*one_hot).sum(dim=2)
+
+        ids = np.where(mm.sig_trajs_)[0]
+        prec = torch.distributions.Gamma(mm.lambda_a_[dd, ids].unsqueeze(0),
+            mm.lambda_b_[dd, ids].unsqueeze(0)).sample((S,)).squeeze(1)
+        prec_samples = (prec.unsqueeze(0)*one_hot).sum(dim=2)
+
+        y = mm.Y_[:, dd].unsqueeze(-1).double()
+        if mm.target_type_[dd] == 'gaussian':
+            likelihood_samples[:, dd, :] = \
+                ((prec_samples/(2*torch.pi))**0.5)*\
+                torch.exp(-0.5*prec_samples*(y - pred_samples)**2)
+        else:
+            likelihood_samples[:, dd, :] = \
+                (torch.exp(pred_samples)**y)/(1 + torch.exp(pred_samples))
+
+    likelihood_samples = torch.clamp(likelihood_samples, min=1e-45)
+    lppd = torch.sum(torch.log(torch.mean(likelihood_samples, 2))).item()
+    pwaic = np.sum(np.var(torch.log(likelihood_samples).numpy(), 2))
+
+    return -2*(lppd - pwaic)
+
+
+def test_compute_waic2_chunked():
+    for use_ranefs in [False, True]:
+        mm = get_gt_model(use_ranefs=use_ranefs)
+
+        torch.manual_seed(0)
+        waic2_ref = compute_waic2_dense(mm, S=50)
+
+        # A small memory budget forces several row and sample chunks.
+        # Random effects are drawn a chunk of groups at a time, so with them
+        # the estimate only agrees with the reference up to Monte Carlo error
+        for max_bytes in [2**28, 2000]:
+            torch.manual_seed(0)
+            waic2, se = mm.compute_waic2(S=50, max_bytes=max_bytes,
+                                         return_se=True)
+            if use_ranefs:
+                assert np.abs(waic2 - waic2_ref) < 4*se, \
+                    "Chunked WAIC2 does not match reference"
+                assert mm.compute_waic2(S=50, max_bytes=max_bytes, seed=1) == \
+                    mm.compute_waic2(S=50, max_bytes=max_bytes, seed=1), \
+                    "Chunked WAIC2 is not reproducible"
+            else:
+                assert np.isclose(waic2, waic2_ref, rtol=1e-6), \
+                    "Chunked WAIC2 does not match reference"
+
+def test_compute_waic2_ranef_memory():
+    # The random effects are drawn for a chunk of groups at a time, within
+    # the memory budget, rather than for all groups up front
+    mm = get_gt_model(use_ranefs=True)
+    sizes = []
+    sample_ranefs = mm._sample_ranefs
+    def record(samples, groups, generator=None):
+        ranef = sample_ranefs(samples, groups, generator)
+        sizes.append(sum([rr.numel() for rr_dd in ranef for rr in rr_dd \
+                          if rr is not None]))
+        return ranef
+    mm._sample_ranefs = record
+
+    S = 50
+    max_bytes = 2000
+    torch.manual_seed(0)
+    mm.compute_waic2(S=S, max_bytes=max_bytes)
+
+    G = mm.G_
+    T = int(torch.sum(mm.sig_trajs_))
+    group_size = S*mm.M_*T*mm.D_
+    assert len(sizes) > 1, "Random effects not drawn in chunks"
+    assert max(sizes) <= max(max_bytes//8, group_size) and \
+        max(sizes) < G*group_size, "Random effect draws exceed the budget"
+    assert sum(sizes) == G*group_size, "Every group needs its random effects"
+
+
+def test_compute_waic2_sampling():
+    # With random effects, most of the Monte Carlo error comes from their
+    # draws, which need variates for every group and are not drawn with
+    # Sobol sequences. Without them, it comes from the coefficients and
+    # precisions.
+    mm_ranefs = get_gt_model(use_ranefs=True)
+    mm_fixed = get_gt_model(use_ranefs=False)
+    mm_fixed.w_var_[:] = 1e-5
+    mm_fixed.lambda_a_[:] = 20.
+    mm_fixed.lambda_b_[:] = 20*0.05**2
+
+    for mm, reduced in [(mm_ranefs, ['antithetic']), (mm_fixed, ['qmc'])]:
+        waic2s = {}
+        for sampling in ['iid', 'antithetic', 'qmc']:
+            vals = []
+            for seed in range(10):
+                torch.manual_seed(seed)
+                waic2, se = compute_waic2(mm, S=64, sampling=sampling,
+                                          return_se=True)
+                assert se > 0, "Standard error should be positive"
+                vals.append(waic2)
+            waic2s[sampling] = (np.mean(vals), np.std(vals), se)
+
+        # All schemes estimate the same quantity, and the variance-reduced
+        # schemes are less noisy
+        for sampling in ['antithetic', 'qmc']:
+            assert np.abs(waic2s[sampling][0] - waic2s['iid'][0]) < \
+                3*waic2s['iid'][1], "Sampling schemes disagree"
+        for sampling in reduced:
+            assert waic2s[sampling][1] < waic2s['iid'][1], \
+                "No variance reduction"
+
+        # The standard error reflects the spread of the estimates
+        for sampling in waic2s.keys():
+            assert waic2s[sampling][1]/3 < waic2s[sampling][2] < \
+                3*waic2s[sampling][1], "Unexpected standard error"
+
+
+def test_compute_waic2_analytic():
+    for use_ranefs in [False, True]:
+        mm = get_gt_model(use_ranefs=use_ranefs)
+
+        # Make the second target binary, and leave a value out
+        mm.target_type_[1] = 'binary'
+        mm.Y_[:, 1] = (mm.Y_[:, 1] > 0).to(mm.Y_.dtype)
+        mm.w_var_[:, 1, :] = 0.3
+        mm.Y_[2, 0] = np.nan
+
+        waic2 = compute_waic2(mm, method='analytic')
+        assert np.isclose(waic2, compute_waic2(mm, method='analytic',
+                                               max_bytes=1000)), \
+            "Analytic WAIC2 should not depend on chunking"
+
+        torch.manual_seed(0)
+        waic2_mc, se = compute_waic2(mm, S=4096, sampling='qmc',
+                                     return_se=True)
+        assert np.abs(waic2 - waic2_mc) < 4*se + 1e-3, \
+            "Analytic and Monte Carlo WAIC2 disagree"
+
+        # Contributions of the groups
+        for method in ['analytic', 'mc']:
+            waic2_m, pointwise = compute_waic2(mm, S=200, seed=0,
+                method=method, return_pointwise=True)
+            assert pointwise.shape == (mm.G_,) and \
+                np.isclose(np.sum(pointwise), waic2_m), \
+                "Inconsistent WAIC2 contributions"
+
+
+def test_compute_psis_loo():
+    for use_ranefs in [False, True]:
+        mm = get_gt_model(use_ranefs=use_ranefs)
+
+        torch.manual_seed(0)
+        group_ll = get_group_log_likelihood_samples(mm, S=500)
+        assert group_ll.shape == (mm.G_, 500), "Unexpected shape"
+
+        torch.manual_seed(0)
+        loo, loos, ks = compute_psis_loo(mm, S=2000)
+        assert loos.shape == (mm.G_,) and ks.shape == (mm.G_,), \
+            "Unexpected shape"
+        assert np.isclose(loo, np.sum(loos)), "Inconsistent LOO terms"
+
+        # Chunks of a single group
+        torch.manual_seed(0)
+        loo_chunked, loos_chunked, ks_chunked = \
+            compute_psis_loo(mm, S=2000, max_bytes=1)
+        assert np.allclose(loos_chunked, loos, atol=0.5), \
+            "Chunked PSIS-LOO mismatch"
+
+    # For the well-specified model without random effects, LOOIC and WAIC2
+    # agree closely
+    mm = get_gt_model(use_ranefs=False)
+    torch.manual_seed(0)
+    loo, loos, ks = compute_psis_loo(mm, S=2000)
+    assert np.all(ks < 0.7), "Unexpectedly large Pareto k"
+    assert np.abs(-2*loo - compute_waic2(mm, method='analytic')) < 1, \
+        "PSIS-LOO and WAIC2 disagree"
+
+def test_fit_metrics(tmp_path):
+    from bayes_traj.model_io import save_model
+    from bayes_traj.model_registry import read_model_file
+
+    mm = get_gt_model()
+    mm.num_binary_targets_ = 0
+    mm.df_ = mm.gb_.obj.copy()
+    mm.predictor_names_ = ['intercept', 'x']
+    mm.target_names_ = ['y1', 'y2']
+    metrics = get_fit_metrics(mm)
+    assert np.isclose(metrics['waic2']['value'],
+                      mm.compute_waic2(method='analytic')), \
+        "Unexpected WAIC2"
+    assert metrics['waic2']['method'] == 'analytic', "Unexpected method"
+    pointwise = mm.compute_waic2(method='analytic', return_pointwise=True)[1]
+    assert metrics['waic2']['se'] == 0 and \
+        np.isclose(metrics['waic2']['pointwise_se'],
+                   np.sqrt(mm.G_*np.var(pointwise))) and \
+        metrics['waic2']['pointwise_se'] > 0, "Unexpected WAIC2 SE"
+    assert np.allclose(metrics['bic'], [float(bb) for bb in mm.bic()]), \
+        "Unexpected BIC"
+    assert metrics['ave_pp'].keys() == ave_pp(mm).keys(), \
+        "Unexpected trajectories"
+
+    # Stored metrics are reused while the model is unchanged
+    assert get_fit_metrics(mm) is metrics, "Metrics not reused"
+    assert get_fit_metrics(mm, refresh=True) is not metrics, \
+        "Metrics not refreshed"
+    metrics = mm.fit_metrics_
+    del metrics['waic2']['pointwise_se']
+    assert get_fit_metrics(mm) is not metrics, "Outdated metrics returned"
+    metrics = mm.fit_metrics_
+    mm.w_mu_[0, 0, 0] += 1.
+    assert get_fit_metrics(mm) is not metrics, "Stale metrics returned"
+
+    torch.manual_seed(0)
+    metrics = get_fit_metrics(mm, refresh=True, S=50, seed=3)
+    assert metrics['waic2']['method'] == 'mc' and \
+        metrics['waic2']['S'] == 50 and metrics['waic2']['seed'] == 3, \
+        "Unexpected WAIC2 options"
+
+    # The metrics are saved with the model
+    file_name = str(tmp_path/'model.btm')
+    save_model(mm, file_name)
+    mm_read = read_model_file(file_name)
+    for kk in ['digest', 'waic2', 'bic']:
+        assert mm_read.fit_metrics_[kk] == metrics[kk], "Metrics not saved"
+    assert get_fit_metrics(mm_read) is mm_read.fit_metrics_, \
+        "Saved metrics not reused"
+
+def test_fit_statistics():
+    mm = get_gt_model()
+    mm.R_[:, 0:2] = torch.tensor([0.9, 0.1]).double()
+    mm.R_[5::, 0:2] = torch.tensor([0.2, 0.8]).double()
+    mm.sig_trajs_ = torch.tensor([True, True, False, False, False])
+
+    stats = FitStatistics(mm)
+    assert np.array_equal(stats.traj_, [0, 0, 0, 0, 0, 1, 1, 1, 1]), \
+        "Unexpected assignments"
+    assert np.array_equal(stats.num_obs_, [5, 4, 0, 0, 0]) and \
+        np.array_equal(stats.num_groups_, [1, 1, 0, 0, 0]) and \
+        stats.num_units_ == 2, "Unexpected counts"
+
+    # Each subject counts once, regardless of its number of observations
+    assert np.allclose(stats.probs_[0:2], [0.55, 0.45]), \
+        "Unexpected trajectory probabilities"
+    assert np.isclose(stats.ave_pp_[0], 0.9) and \
+        np.isclose(stats.ave_pp_[1], 0.8), "Unexpected ave. pp"
+    assert np.isclose(stats.occ_[0], (0.9/0.1)/(0.55/0.45)) and \
+        np.isclose(stats.occ_[1], (0.8/0.2)/(0.45/0.55)), "Unexpected OCC"
+    assert np.allclose(stats.prob_prop_[1], (0.5, 0.45)), \
+        "Unexpected prob/prop"
+
+    assert ave_pp(mm) == stats.ave_pp_ and \
+        odds_correct_classification(mm) == stats.occ_ and \
+        prob_prop(mm) == stats.prob_prop_, "Inconsistent statistics"
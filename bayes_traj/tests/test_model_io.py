@@ -0,0 +1,94 @@
+import torch
+import numpy as np
+import pandas as pd
+from bayes_traj.model_io import *
+from bayes_traj.model_registry import load_model
+from bayes_traj.tests.test_assignment_engine import get_model_and_data
+import os, pickle, tempfile
+import pdb
+
+def get_model():
+    return get_model_and_data(iters=5)[0]
+
+def check_equal(vv1, vv2, name):
+    if torch.is_tensor(vv1) or isinstance(vv1, np.ndarray):
+        assert type(vv1) == type(vv2) or isinstance(vv2, type(vv1)), \
+            "Type mismatch for " + name
+        assert vv1.dtype == vv2.dtype, "dtype mismatch for " + name
+        assert np.array_equal(np.asarray(vv1), np.asarray(vv2),
+                              equal_nan=vv1.dtype.is_floating_point \
+                              if torch.is_tensor(vv1) else \
+                              vv1.dtype.kind == 'f'), \
+            "Value mismatch for " + name
+    elif isinstance(vv1, pd.DataFrame):
+        pd.testing.assert_frame_equal(vv1, vv2)
+    elif isinstance(vv1, dict):
+        assert list(vv1.keys()) == list(vv2.keys()), "Key mismatch for " + name
+        for kk in vv1.keys():
+            check_equal(vv1[kk], vv2[kk], name)
+    elif isinstance(vv1, pd.core.groupby.DataFrameGroupBy):
+        assert vv1.grouper.names == vv2.grouper.names, \
+            "Group mismatch for " + name
+        check_equal(vv1.indices, vv2.indices, name)
+    else:
+        assert vv1 == vv2, "Value mismatch for " + name
+
+def test_save_read_model():
+    mm = get_model()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = os.path.join(tmp_dir, 'model.btm')
+        save_model(mm, file_name)
+        assert is_model_file(file_name), "Not saved in model format"
+        assert read_model_header(file_name)['format_version'] == \
+            MODEL_FORMAT_VERSION, "Unexpected format version"
+
+        # Arrays are only read when accessed
+        mm_read = read_model(file_name)
+        assert 'R_' not in mm_read.__dict__ and \
+            'df_' not in mm_read.__dict__, "Attributes read eagerly"
+        assert mm_read.w_mu_.shape == mm.w_mu_.shape, "Shape mismatch"
+        assert 'R_' not in mm_read.__dict__, "Attributes read eagerly"
+
+        state = mm_read.__getstate__()
+        assert set(state.keys()) == set(mm.__dict__.keys()), \
+            "Attribute mismatch"
+        for kk, vv in mm.__dict__.items():
+            if kk != 'df_helper_':
+                check_equal(vv, state[kk], kk)
+
+        # The read model can be used and modified without changing the file,
+        # and pickled
+        mm_read.refine(2)
+        mm_read = pickle.loads(pickle.dumps(mm_read))
+        assert torch.equal(read_model(file_name).R_, mm.R_), "File modified"
+
+        # Data frames with an index
+        mm.df_ = mm.df_.set_index('data_names', drop=False)
+        save_model(mm, file_name)
+        pd.testing.assert_frame_equal(read_model(file_name, lazy=False).df_,
+                                      mm.df_)
+
+def test_convert_legacy_model():
+    mm = get_model()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pickle_file = os.path.join(tmp_dir, 'model.p')
+        model_file = os.path.join(tmp_dir, 'model.btm')
+        with open(pickle_file, 'wb') as f:
+            pickle.dump({'MultDPRegression': mm}, f)
+
+        mm_pickle = load_model(pickle_file, cache=False)
+        save_model(mm_pickle, model_file)
+        mm_model = load_model(model_file)
+
+        df = mm.df_.drop(columns=['traj'])
+        df_pickle = mm_pickle.augment_df_with_traj_info(df.copy(), 'id')
+        df_model = mm_model.augment_df_with_traj_info(df.copy(), 'id')
+        pd.testing.assert_frame_equal(df_pickle, df_model)
+
+        # And back
+        save_model(mm_model, pickle_file, format='pickle')
+        with open(pickle_file, 'rb') as f:
+            mm_back = pickle.load(f)['MultDPRegression']
+        assert torch.equal(mm_back.w_mu_, mm.w_mu_), "Value mismatch"
@@ -0,0 +1,97 @@
+import torch
+import numpy as np
+import pandas as pd
+from bayes_traj.mult_dp_regression import MultDPRegression
+from bayes_traj.model_registry import *
+from bayes_traj.generate_prior import PriorGenerator
+from concurrent.futures import ThreadPoolExecutor
+import os, pickle, tempfile
+import pdb
+
+def write_model(file_name, K):
+    mm = MultDPRegression(np.zeros([2, 1]), np.ones([2, 1]), np.ones(1),
+                          np.ones(1), 1, 1., K=K)
+    mm.R_ = torch.ones([1000, K], dtype=torch.float64)/K
+    with open(file_name, 'wb') as f:
+        pickle.dump({'MultDPRegression': mm}, f)
+
+def test_get_model_nbytes():
+    mm = MultDPRegression(np.zeros([2, 1]), np.ones([2, 1]), np.ones(1),
+                          np.ones(1), 1, 1., K=5)
+    nbytes = get_model_nbytes(mm)
+    mm.R_ = torch.ones([1000, 5], dtype=torch.float64)
+    assert get_model_nbytes(mm) == nbytes + 8*5000, "Unexpected size"
+
+def test_model_registry():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        files = [os.path.join(tmp_dir, 'model_{}.p'.format(ii)) \
+                 for ii in range(3)]
+        for ii, ff in enumerate(files):
+            write_model(ff, ii + 2)
+
+        registry = ModelRegistry()
+        registry.register('first', files[0])
+
+        mm = registry.get(files[0])
+        assert mm.K_ == 2, "Unexpected model"
+        assert registry.get('first') is mm, "Model not cached"
+        assert registry.get(os.path.join(tmp_dir, '.', 'model_0.p')) is mm, \
+            "Path not resolved"
+        assert registry.misses_ == 1 and registry.hits_ == 2, \
+            "Unexpected cache statistics"
+
+        # Touching the file without changing it keeps the cached model;
+        # changing it forces a reload
+        os.utime(files[0], ns=(0, 0))
+        assert registry.get(files[0]) is mm, "Model reloaded unnecessarily"
+        write_model(files[0], 7)
+        os.utime(files[0], ns=(10**9, 10**9))
+        assert registry.get(files[0]).K_ == 7, "Model not reloaded"
+        assert registry.misses_ == 2, "Unexpected cache statistics"
+
+        # Private instances are not cached
+        assert load_model(files[0], cache=False, registry=registry) is not \
+            registry.get(files[0]), "Private instance is shared"
+
+        # With room for two models, loading a third evicts the least
+        # recently used one
+        registry = ModelRegistry()
+        registry.max_bytes_ = sum([get_model_nbytes(registry.get(ff)) \
+                                   for ff in [files[0], files[2]]])
+        registry.evict()
+        for ff in [files[0], files[1], files[0], files[2]]:
+            registry.get(ff)
+        assert list(registry.entries_.keys()) == \
+            [os.path.realpath(ff) for ff in [files[0], files[2]]], \
+            "Unexpected eviction"
+
+def test_shared_model_not_modified():
+    model_file_name = os.path.split(os.path.realpath(__file__))[0] + \
+        '/../resources/models/model_1.p'
+
+    registry = ModelRegistry()
+    mm = registry.get(model_file_name)
+    columns = mm.df_.columns.tolist()
+    v_a = mm.v_a_.clone()
+
+    # Consumers of shared models leave them as they are
+    pg = PriorGenerator(['y'], ['intercept', 'age'])
+    pg.set_model(mm)
+    pg.prior_info_from_model('y')
+    mm.plot('age', 'y', show=False)
+    assert mm.df_.columns.tolist() == columns, "Shared data frame modified"
+    assert torch.equal(mm.v_a_, v_a), "Shared model modified"
+    assert registry.get(model_file_name) is mm, "Model not cached"
+
+def test_model_registry_threads():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = os.path.join(tmp_dir, 'model.p')
+        write_model(file_name, 3)
+
+        registry = ModelRegistry()
+        with ThreadPoolExecutor(8) as pool:
+            models = list(pool.map(lambda ii: registry.get(file_name),
+                                   range(32)))
+
+        assert all([mm is models[0] for mm in models]), "Model loaded twice"
+        assert registry.misses_ == 1, "Model loaded twice"
@@ -1,9 +1,12 @@
 import torch
 from bayes_traj.mult_dp_regression import MultDPRegression
+from bayes_traj.model_io import save_model
+from bayes_traj.model_registry import read_model_file
+from bayes_traj.fit_stats import FitStatistics
 import numpy as np
 import pandas as pd
 from bayes_traj.utils import *
-import pdb, os, pickle
+import pdb, os, pickle, tempfile, signal, copy
 import matplotlib.pyplot as plt # TODO DEB
 
 np.set_printoptions(precision = 10, suppress = True, threshold=1e6,
@@ -475,6 +478,32 @@ def test_to_df():
         df.traj.values[1] == df.traj.values[2], \
         "Traj assignments incorrect"
 
+
+    # Repeated calls return the same frame until the model changes. Frames
+    # returned with inplace=False are always new.
+    assert mm.to_df() is df, "Frame not reused"
+    df_new = mm.to_df(inplace=False)
+    assert df_new is not df and mm.to_df(inplace=False) is not df_new, \
+        "Frame reused"
+    mm.R_[0, :] = torch.tensor([0., 1.]).double()
+    df_new = mm.to_df(inplace=False)
+    assert np.array_equal(df_new.traj.values, [1, 1, 1]) and \
+        np.array_equal(df.traj.values, [0, 1, 1]), \
+        "Unexpected trajectory assignments"
+    assert mm.to_df() is df and \
+        np.array_equal(df.traj.values, [1, 1, 1]), \
+        "Data frame not updated"
+
+    # Reassigned probabilities are detected, even when the new tensor gets
+    # the id of the tensor it replaces
+    for ii in range(20):
+        mm.to_df()
+        mm.R_ = mm.R_.flip(1).clone()
+        mm.R_ = mm.R_.flip(1).clone()
+        mm.R_ = mm.R_.flip(1).clone()
+        assert np.array_equal(mm.to_df().traj.values,
+                              torch.argmax(mm.R_, 1).numpy()), \
+            "Stale trajectory assignments"
     
 def test_init_R_mat():
     """
@@ -738,6 +767,12 @@ def test_augment_df_with_traj_info():
     
     df_aug2 = mm.augment_df_with_traj_info(df)
 
+    df = get_gt_df()
+    df_aug3 = mm.augment_df_with_traj_info(df, 'sid', inplace=False)
+    assert 'traj' not in df.columns, "Input data frame modified"
+    assert np.array_equal(df_aug3['traj'].values, df_aug['traj'].values), \
+        "Incorrect traj assignment"
+
 def test_update_u():
     """
     """
@@ -940,3 +975,431 @@ def test_log_likelihood():
         torch.tensor(-1.8316561418, dtype=torch.float64)), \
         "Incorrect log-likelihood value"
     
+
+def test_log_likelihood_batched():
+    mm = get_gt_model()
+    torch.manual_seed(0)
+    mm.u_mu_ = 0.1*torch.randn(mm.u_mu_.shape, dtype=torch.float64)
+    mm.R_ = torch.rand(mm.R_.shape, dtype=torch.float64)
+    mm.R_ = mm.R_/torch.sum(mm.R_, 1, keepdim=True)
+    mm.Y_[2, 0] = torch.nan
+
+    def ll_ref():
+        ll = 0.
+        for kk in range(mm.K_):
+            for dd in range(mm.D_):
+                ids = ~torch.isnan(mm.Y_[:, dd])
+                mu = torch.sum(mm.X_*(mm.w_mu_[:, dd, kk].unsqueeze(0) + \
+                    mm.u_mu_[mm.N_to_G_index_map_, dd, kk, :]), 1)
+                v = mm.lambda_b_[dd, kk]/mm.lambda_a_[dd, kk]
+                ll += torch.sum(mm.R_[ids, kk]*\
+                    (-0.5*torch.log(2*torch.pi*v) - \
+                     (mm.Y_[ids, dd] - mu[ids])**2/(2*v)))
+        return ll
+
+    assert torch.isclose(mm.log_likelihood(), ll_ref()), \
+        "Incorrect log-likelihood value"
+
+    # The cached terms are reused until the model changes, including in
+    # place
+    terms = mm._get_log_likelihood_terms()[0]
+    assert mm._get_log_likelihood_terms()[0] is terms, "Terms not cached"
+    mm.w_mu_[0, 0, 1] += 1.
+    assert mm._get_log_likelihood_terms()[0] is not terms, \
+        "Stale terms returned"
+    assert torch.isclose(mm.log_likelihood(), ll_ref()), \
+        "Incorrect log-likelihood value"
+
+    # A reassigned tensor changes the key, even when it gets the id of the
+    # tensor it replaces, which is freed
+    for ii in range(50):
+        mm.log_likelihood()
+        mm.w_mu_ = mm.w_mu_.clone() + 0.5
+        mm.w_mu_ = mm.w_mu_.clone() + 0.5
+        assert torch.isclose(mm.log_likelihood(), ll_ref()), \
+            "Stale log-likelihood value"
+
+    # So do in-place changes of the target types
+    terms = mm._get_log_likelihood_terms()[0]
+    mm.target_type_[1] = 'binary'
+    assert mm._get_log_likelihood_terms()[0] is not terms, \
+        "Stale terms returned"
+    mm.target_type_[1] = 'gaussian'
+
+    bic_obs, bic_groups = mm.bic()
+    assert bic_obs < bic_groups, "Unexpected BIC values"
+
+
+def get_two_traj_df():
+    """Two well separated trajectories, 40 subjects each, 4 visits per subject
+    """
+    np.random.seed(0)
+    torch.manual_seed(0)
+
+    G = 80
+    x = np.tile(np.arange(4.), G)
+    sid = np.repeat(np.arange(G), 4)
+    traj = (sid >= G/2).astype(int)
+    y = np.where(traj == 0, 10 - 2*x, 2*x) + 0.3*np.random.randn(G*4)
+    df = pd.DataFrame({'intercept': 1., 'x': x, 'y': y, 'sid': sid,
+                       'traj': traj})
+
+    return df
+
+def check_two_traj_fit(mm, df):
+    """
+    """
+    assert torch.sum(mm.sig_trajs_) == 2, "Unexpected number of trajectories"
+
+    # Each ground truth trajectory should map to a single fitted trajectory
+    traj = df.traj.values
+    assigned = torch.argmax(mm.R_, dim=1).numpy()
+    assert len(set(assigned[traj == 0])) == 1 and \
+        len(set(assigned[traj == 1])) == 1 and \
+        assigned[0] != assigned[-1], "Unexpected trajectory assignments"
+
+    for k in np.where(mm.sig_trajs_)[0]:
+        ids = assigned == k
+        expected = np.array([10., -2.]) if traj[ids][0] == 0 else \
+            np.array([0., 2.])
+        assert np.allclose(mm.w_mu_[:, 0, k].numpy(), expected, atol=0.2), \
+            "Unexpected trajectory coefficients"
+
+def test_fit_svi():
+    df = get_two_traj_df()
+
+    K = 10
+    mm = MultDPRegression(np.zeros([2, 1]), 100*np.ones([2, 1]),
+                          np.ones(1), np.ones(1), 1, 1., K=K)
+    mm.fit(target_names=['y'], predictor_names=['intercept', 'x'], df=df,
+           groupby='sid', iters=10, batch_size=10)
+
+    check_two_traj_fit(mm, df)
+
+def test_fit_incremental():
+    df = get_two_traj_df()
+
+    K = 10
+    mm = MultDPRegression(np.zeros([2, 1]), 100*np.ones([2, 1]),
+                          np.ones(1), np.ones(1), 1, 1., K=K)
+    mm.fit(target_names=['y'], predictor_names=['intercept', 'x'], df=df,
+           groupby='sid', iters=10, num_blocks=4)
+
+    check_two_traj_fit(mm, df)
+
+    # The running totals should match statistics recomputed from scratch
+    stats = mm.compute_suff_stats()
+    for kk in stats.keys():
+        assert torch.allclose(mm.incremental_stats_[kk], stats[kk]), \
+            "Running totals differ from full recompute: {}".format(kk)
+
+    blocks = mm.get_group_blocks(3)
+    assert np.array_equal(np.sort(np.concatenate(blocks)),
+                          np.arange(df.shape[0])), \
+        "Blocks do not partition the data"
+    stats = mm.compute_suff_stats()
+    block_sum = sum([mm.compute_suff_stats(ids)['XX'] for ids in blocks])
+    assert torch.allclose(stats['XX'], block_sum), \
+        "Block statistics do not add up"
+
+    # With a binary target, the running totals include the xi_-dependent
+    # statistics, and the fit does not get worse from one pass to the next
+    df['yb'] = (df.y.values + np.random.randn(df.shape[0]) > 5).astype(float)
+    torch.manual_seed(0)
+    np.random.seed(0)
+    mm = MultDPRegression(np.zeros([2, 2]), 100*np.ones([2, 2]),
+                          np.ones(2), np.ones(2), 1, 1., K=K)
+    log_likes = []
+    end_iteration = mm._end_iteration
+    def record(inc):
+        log_likes.append(mm.log_likelihood().item())
+        end_iteration(inc)
+    mm._end_iteration = record
+    mm.fit(target_names=['y', 'yb'], predictor_names=['intercept', 'x'],
+           df=df, groupby='sid', iters=10, num_blocks=4)
+
+    stats = mm.compute_suff_stats()
+    for kk in stats.keys():
+        assert torch.allclose(mm.incremental_stats_[kk], stats[kk]), \
+            "Running totals differ from full recompute: {}".format(kk)
+    assert torch.any(stats['XZX'] != 0), "Missing binary statistics"
+    assert np.all(np.diff(log_likes) >= -1e-6*np.abs(log_likes[1:])), \
+        "Log likelihood decreased"
+
+def test_fit_streaming():
+    data_file_name = os.path.split(os.path.realpath(__file__))[0] + \
+        '/../resources/data/trajectory_data_1.csv'
+    df = pd.read_csv(data_file_name)
+    df['y2'] = -df['y'] + 0.3*np.random.randn(df.shape[0])
+    df.loc[3, 'y2'] = np.nan
+
+    targets = ['y', 'y2']
+    preds = ['intercept', 'age']
+    M = len(preds)
+    D = len(targets)
+    K = 10
+
+    mms = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        df.to_csv(os.path.join(tmp_dir, 'data.csv'), index=False)
+        for streaming in [False, True]:
+            torch.manual_seed(0)
+            np.random.seed(0)
+            mm = MultDPRegression(np.zeros([M, D]), 5*np.ones([M, D]),
+                                  100*np.ones(D), np.ones(D), 1, 1., K=K)
+            if streaming:
+                mm.fit_streaming(os.path.join(tmp_dir, 'data.csv'), targets,
+                                 preds, 'id', iters=10, chunksize=37,
+                                 R_file=os.path.join(tmp_dir, 'R.npy'))
+                R_streaming = np.array(mm.R_)
+                mm.to_csv_streaming(os.path.join(tmp_dir, 'data.csv'),
+                                    os.path.join(tmp_dir, 'out.csv'), 'id',
+                                    chunksize=37)
+                df_out = pd.read_csv(os.path.join(tmp_dir, 'out.csv'))
+
+                # Saved as bayes_traj_main does, without R_, which is
+                # re-attached from R_file_ when the model is read
+                R = mm.R_
+                mm.R_ = None
+                for ext in ['.p', '.btm']:
+                    model_file = os.path.join(tmp_dir, 'model' + ext)
+                    save_model(mm, model_file)
+                    mm_read = read_model_file(model_file)
+                    assert np.array_equal(np.asarray(mm_read.R_),
+                                          R_streaming), "R_ not re-attached"
+                    df_read = mm_read.to_df()
+                    assert df_read.shape[0] == df_out.shape[0] and \
+                        np.array_equal(df_read.traj.values,
+                                       df_out.traj.values), \
+                        "to_df mismatch after round trip"
+                    stats = FitStatistics(mm_read)
+                    assert stats.num_units_ == df.id.nunique(), \
+                        "Statistics not computed per group"
+                mm.R_ = R
+            else:
+                mm.fit(target_names=targets, predictor_names=preds, df=df,
+                       groupby='id', iters=10)
+            mms.append(mm)
+
+    # The streaming fit performs the same updates as the in-memory fit, up to
+    # the order of summation
+    for kk in ['w_mu_', 'w_var_', 'lambda_a_', 'lambda_b_', 'v_a_', 'v_b_']:
+        assert torch.allclose(getattr(mms[0], kk), getattr(mms[1], kk),
+                              rtol=1e-8), "Mismatch in " + kk
+    assert np.allclose(mms[0].R_.numpy(), R_streaming, atol=1e-8), \
+        "R_ mismatch"
+    assert np.array_equal(df_out.traj.values, mms[0].to_df().traj.values), \
+        "Trajectory assignment mismatch"
+
+def test_fit_checkpoint_resume(monkeypatch):
+    df = get_two_traj_df()
+
+    K = 10
+    mms = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        checkpoint_file = os.path.join(tmp_dir, 'checkpoint.p')
+        for interrupt in [False, True]:
+            torch.manual_seed(1)
+            np.random.seed(1)
+            mm = MultDPRegression(np.zeros([2, 1]), 100*np.ones([2, 1]),
+                                  np.ones(1), np.ones(1), 1, 1., K=K)
+            if not interrupt:
+                mm.fit(target_names=['y'], predictor_names=['intercept', 'x'],
+                       df=df, groupby='sid', iters=8)
+                mms.append(mm)
+                continue
+
+            # Deliver SIGINT during the 4th iteration. The iteration should be
+            # completed and checkpointed before the interrupt propagates.
+            update_v = MultDPRegression.update_v
+            calls = []
+            def interrupting_update_v(self, stats=None):
+                calls.append(1)
+                if len(calls) == 4:
+                    os.kill(os.getpid(), signal.SIGINT)
+                return update_v(self, stats)
+            monkeypatch.setattr(MultDPRegression, 'update_v',
+                                interrupting_update_v)
+
+            try:
+                mm.fit(target_names=['y'], predictor_names=['intercept', 'x'],
+                       df=df, groupby='sid', iters=8,
+                       checkpoint_file=checkpoint_file,
+                       checkpoint_interval=100)
+                assert False, "Fit was not interrupted"
+            except KeyboardInterrupt:
+                pass
+            monkeypatch.undo()
+
+            with open(checkpoint_file, 'rb') as f:
+                checkpoint = pickle.load(f)
+            assert checkpoint['MultDPRegression'].fit_state_['iter'] == 4, \
+                "Unexpected iteration count in checkpoint"
+
+            # Resuming restores the random number generator state, so the
+            # result should not depend on the current seed
+            torch.manual_seed(5)
+            np.random.seed(5)
+            mm = MultDPRegression(np.zeros([2, 1]), 100*np.ones([2, 1]),
+                                  np.ones(1), np.ones(1), 1, 1., K=K)
+            mm.fit(resume_from=checkpoint_file)
+            assert mm.fit_state_['iter'] == 8, "Fit did not run to completion"
+            mms.append(mm)
+
+    for kk in ['R_', 'w_mu_', 'w_var_', 'lambda_a_', 'lambda_b_', 'v_a_',
+               'v_b_']:
+        assert torch.equal(getattr(mms[0], kk), getattr(mms[1], kk)), \
+            "Mismatch in " + kk
+
+def test_update():
+    df = get_two_traj_df()
+
+    # The initial data lacks the last visit of the first 60 subjects and all
+    # visits of the remaining 20
+    in_first = (df.sid.values < 60) & (df.x.values < 3)
+    df_first = df[in_first].reset_index(drop=True)
+    df_new = df[~in_first].reset_index(drop=True)
+
+    K = 10
+    mm = MultDPRegression(np.zeros([2, 1]), 100*np.ones([2, 1]),
+                          np.ones(1), np.ones(1), 1, 1., K=K)
+    mm.fit(target_names=['y'], predictor_names=['intercept', 'x'],
+           df=df_first, groupby='sid', iters=20)
+
+    # Subjects without new data keep their responsibilities
+    R_first = mm.R_.clone()
+    mm.update(df_new[df_new.sid.isin([70, 71])], iters=2)
+    assert mm.N_ == df_first.shape[0] + 8, "Unexpected N_"
+    assert torch.equal(mm.R_[0:df_first.shape[0]], R_first), \
+        "Unaffected responsibilities changed"
+
+    mm.update(df_new[~df_new.sid.isin([70, 71])], iters=5)
+    assert mm.N_ == df.shape[0], "Unexpected N_"
+    assert mm.gb_.ngroups == 80, "Unexpected number of groups"
+
+    df_traj = mm.to_df()
+    assert np.all(df_traj.groupby('sid').traj.nunique().values == 1), \
+        "Inconsistent assignments within subject"
+    assert df_traj.groupby('traj').sid.nunique().shape[0] == 2, \
+        "Unexpected number of trajectories"
+
+    # The statistics behind the global parameters now cover all the data
+    for k in np.where(mm.sig_trajs_)[0]:
+        assert np.abs(torch.sum(mm.R_[:, k]).item() - 160) < 1e-6, \
+            "Unexpected trajectory counts"
+
+def test_update_reuses_stats():
+    df = get_two_traj_df()
+    in_first = (df.sid.values < 60) & (df.x.values < 3)
+    df_first = df[in_first].reset_index(drop=True)
+    df_new = df[~in_first].reset_index(drop=True)
+
+    mm = MultDPRegression(np.zeros([2, 1]), 100*np.ones([2, 1]),
+                          np.ones(1), np.ones(1), 1, 1., K=10)
+    mm.fit(target_names=['y'], predictor_names=['intercept', 'x'],
+           df=df_first, groupby='sid', iters=20)
+    mm.update(df_new[df_new.sid.isin([70, 71])], iters=2)
+
+    # The second update adds the last visits of subjects 0 and 1 and a new
+    # subject. Only the rows of these subjects are tallied.
+    df_second = df_new[df_new.sid.isin([0, 1, 72])]
+    affected = set(np.where(mm.df_.sid.isin([0, 1]))[0]) | \
+        set(range(mm.N_, mm.N_ + df_second.shape[0]))
+    tallied = []
+    compute_suff_stats = mm.compute_suff_stats
+    def record(ids=None):
+        tallied.append(ids)
+        return compute_suff_stats(ids)
+    mm.compute_suff_stats = record
+    storage = {name: getattr(mm, name).untyped_storage().data_ptr() \
+               for name in ['X_', 'Y_', 'R_', 'u_mu_', 'u_Sig_']}
+    mm.update(df_second, iters=3)
+    del mm.compute_suff_stats
+
+    # The appended rows fit in the buffers made by the first update, so the
+    # existing rows were not copied
+    for name, ptr in storage.items():
+        assert getattr(mm, name).untyped_storage().data_ptr() == ptr, \
+            "Rows of {} were copied".format(name)
+
+    assert len(tallied) > 0 and \
+        np.all([ids is not None and set(ids) <= affected \
+                for ids in tallied]), "Untouched subjects were tallied"
+
+    # The kept totals match statistics computed from scratch
+    stats = mm.compute_suff_stats()
+    for kk in stats.keys():
+        assert torch.allclose(mm.update_cache_['stats'][kk], stats[kk]), \
+            "Mismatch in " + kk
+    assert torch.equal(mm.sig_trajs_,
+                       torch.max(mm.R_, dim=0).values > mm.prob_thresh_), \
+        "Unexpected sig_trajs_"
+
+    # The data frame and group structures cover the appended rows
+    assert mm.df_.shape[0] == mm.N_ and mm.gb_.ngroups == mm.G_ == 63, \
+        "Unexpected data size"
+    assert np.array_equal(mm.df_.y.values, mm.Y_[:, 0].numpy()), \
+        "Data frame and Y_ disagree"
+    assert np.all(mm.df_.groupby(mm.N_to_G_index_map_).sid.nunique() == 1), \
+        "Inconsistent group index"
+    assert np.array_equal(np.where(mm.group_first_index_)[0],
+        np.sort([np.min(np.where(mm.N_to_G_index_map_ == gg)[0]) \
+                 for gg in range(mm.G_)])), "Inconsistent group first index"
+
+    # Copies of the model hold the data, not the buffers
+    mm_copy = copy.deepcopy(mm)
+    assert mm_copy.R_.untyped_storage().nbytes() == \
+        mm.R_.nelement()*mm.R_.element_size() and \
+        torch.equal(mm_copy.R_, mm.R_), "Buffer was copied"
+
+def test_predict():
+    torch.manual_seed(0)
+    np.random.seed(0)
+
+    M, D, K = 2, 2, 3
+    mm = MultDPRegression(np.zeros([M, D]), np.ones([M, D]), np.ones(D),
+                          np.ones(D), 1, 1., K=K)
+    mm.target_names_ = ['y', 'b']
+    mm.predictor_names_ = ['intercept', 'x']
+    mm.target_type_ = {0: 'gaussian', 1: 'binary'}
+    mm.sig_trajs_ = torch.tensor([True, False, True])
+    mm.w_mu_ = torch.randn([M, D, K], dtype=torch.float64)
+    mm.w_var_ = 0.1*torch.rand([M, D, K], dtype=torch.float64)
+    mm.w_covmat_ = torch.zeros([M, M, D, K], dtype=torch.float64)
+    for k in range(K):
+        A = 0.3*torch.randn([M, M], dtype=torch.float64)
+        mm.w_covmat_[:, :, 1, k] = A@A.T + 0.01*torch.eye(M)
+        mm.w_var_[:, 1, k] = torch.diag(mm.w_covmat_[:, :, 1, k])
+    mm.lambda_a_ = 2 + torch.rand([D, K], dtype=torch.float64)
+    mm.lambda_b_ = 1 + torch.rand([D, K], dtype=torch.float64)
+
+    df = pd.DataFrame({'x': np.linspace(-2, 2, 5), 'intercept': 1.})
+    mean, std = mm.predict(df)
+    assert mean.shape == (5, D, 2) and std.shape == (5, D, 2), \
+        "Unexpected shape"
+    assert np.allclose(mm.predict(df, trajs=[2], return_std=False),
+                       mean[:, :, 1:2]), "Trajectory selection mismatch"
+
+    # Compare with samples from the posterior predictive distribution
+    X = torch.from_numpy(df[mm.predictor_names_].values)
+    num_samples = 200000
+    for tt, k in enumerate([0, 2]):
+        w = mm.w_mu_[:, 0, k] + torch.sqrt(mm.w_var_[:, 0, k])*\
+            torch.randn([num_samples, M], dtype=torch.float64)
+        prec = torch.distributions.Gamma(mm.lambda_a_[0, k],
+                                         mm.lambda_b_[0, k]).\
+            sample((num_samples,))
+        y = w@X.T + torch.randn([num_samples, 5], dtype=torch.float64)/\
+            torch.sqrt(prec)[:, None]
+        assert np.allclose(mean[:, 0, tt], (X@mm.w_mu_[:, 0, k]).numpy()), \
+            "Gaussian mean mismatch"
+        assert np.allclose(std[:, 0, tt], torch.std(y, 0).numpy(),
+                           rtol=0.05), "Gaussian std mismatch"
+
+        w = torch.distributions.MultivariateNormal(mm.w_mu_[:, 1, k],
+            mm.w_covmat_[:, :, 1, k]).sample((num_samples,))
+        p = torch.mean(torch.sigmoid(w@X.T), 0).numpy()
+        assert np.allclose(mean[:, 1, tt], p, atol=0.005), \
+            "Binary mean mismatch"
+        assert np.allclose(std[:, 1, tt], np.sqrt(p*(1 - p)), atol=0.005), \
+            "Binary std mismatch"
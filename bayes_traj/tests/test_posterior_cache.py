@@ -0,0 +1,111 @@
+import torch
+import numpy as np
+import os, tempfile, hashlib
+from bayes_traj.posterior_cache import *
+from bayes_traj.model_registry import read_model_file
+from bayes_traj.model_io import save_model
+from bayes_traj.prior_from_model import prior_from_model
+from bayes_traj.tests.test_fit_stats import get_gt_model
+
+def test_posterior_sample_cache():
+    mm = get_gt_model()
+
+    samples = mm.get_posterior_samples(100, seed=1)
+    assert mm.get_posterior_samples(100, seed=1) is samples, \
+        "Draws should be cached"
+    assert mm.posterior_cache_.hits_ == 1, "Unexpected cache hits"
+
+    # The seed, the number of draws and the options identify the draws
+    assert mm.get_posterior_samples(100, seed=2) is not samples, \
+        "Different seeds should give different draws"
+    assert mm.get_posterior_samples(50, seed=1)['w'][0].shape[1] == 50, \
+        "Unexpected number of draws"
+    params = mm.get_posterior_samples(100, seed=1, group_level=False)
+    assert params['traj'].shape[0] == 0, "Unexpected group-level draws"
+
+    # Draws are reproducible and do not affect the random number generator
+    torch.manual_seed(0)
+    ref = torch.rand(1)
+    torch.manual_seed(0)
+    mm.posterior_cache_.clear()
+    samples_2 = mm.get_posterior_samples(100, seed=1)
+    assert torch.equal(torch.rand(1), ref), "Random state changed"
+    assert torch.equal(samples_2['w'][0], samples['w'][0]) and \
+        torch.equal(samples_2['traj'], samples['traj']), \
+        "Draws are not reproducible"
+
+    # Without a seed nothing is cached
+    num_entries = len(mm.posterior_cache_.entries_)
+    mm.get_posterior_samples(100)
+    assert len(mm.posterior_cache_.entries_) == num_entries, \
+        "Unseeded draws should not be cached"
+
+    # Consumers share the draws
+    assert mm.compute_waic2(S=100, seed=1) == mm.compute_waic2(S=100, seed=1)
+    prior_from_model(mm, S=100, seed=1)
+    assert mm.posterior_cache_.hits_ >= 3, "Draws were not reused"
+
+    # Draws are redrawn when the model changes
+    misses = mm.posterior_cache_.misses_
+    mm.w_mu_[0, 0, 0] += 1
+    mm.get_posterior_samples(100, seed=1)
+    assert mm.posterior_cache_.misses_ == misses + 1, \
+        "Stale draws were returned"
+
+    # Eviction
+    cache = PosteriorSampleCache(max_bytes=get_nbytes(samples) + 1)
+    for seed in range(3):
+        cache.get(mm, 'posterior', 100, seed,
+                  lambda: mm._sample_waic2_posterior(100))
+    assert len(cache.entries_) == 1 and \
+        list(cache.entries_.keys())[0][2] == 2, "Unexpected eviction"
+
+def test_posterior_cache_persistence():
+    mm = get_gt_model()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        model_file = os.path.join(tmp_dir, 'model.p')
+        save_model(mm, model_file)
+
+        loo, loos, ks = mm.compute_psis_loo(S=200, seed=3)
+        waic2 = mm.compute_waic2(S=200, seed=3)
+        mm.posterior_cache_.save(get_cache_file_name(model_file))
+
+        mm_2 = read_model_file(model_file)
+        assert mm_2.compute_waic2(S=200, seed=3) == waic2 and \
+            mm_2.compute_psis_loo(S=200, seed=3)[0] == loo, \
+            "Persisted draws were not used"
+        assert mm_2.posterior_cache_.hits_ == 2 and \
+            mm_2.posterior_cache_.misses_ == 0, "Unexpected cache misses"
+
+def test_posterior_digest_memoized():
+    mm = get_gt_model()
+    digest = get_posterior_digest(mm)
+    assert mm.posterior_digest_cache_[1] == digest, "Digest was not kept"
+
+    # Unchanged posterior: the kept digest is returned without rehashing
+    sha1 = hashlib.sha1
+    try:
+        hashlib.sha1 = None
+        assert get_posterior_digest(mm) == digest, "Unexpected digest"
+    finally:
+        hashlib.sha1 = sha1
+
+    # In-place updates and reassignments change the digest
+    mm.R_[0, 0] += 0.5
+    digest_2 = get_posterior_digest(mm)
+    assert digest_2 != digest, "Stale digest after in-place update"
+    mm.w_mu_ = mm.w_mu_.clone() + 1
+    assert get_posterior_digest(mm) != digest_2, \
+        "Stale digest after reassignment"
+
+def test_psis_loo_seeded_streaming():
+    mm = get_gt_model()
+    loo, loos, ks = mm.compute_psis_loo(S=200, max_bytes=2**16, seed=3)
+
+    # Only the per-group terms are cached, not the G x S draws
+    assert mm.posterior_cache_.nbytes() <= 2*8*mm.G_, \
+        "Log likelihood draws should not be cached"
+    mm.posterior_cache_.clear()
+    loo_2, loos_2, ks_2 = mm.compute_psis_loo(S=200, max_bytes=2**16, seed=3)
+    assert loo_2 == loo and np.array_equal(ks_2, ks), \
+        "Seeded PSIS-LOO is not reproducible"
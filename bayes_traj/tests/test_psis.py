@@ -0,0 +1,48 @@
+import numpy as np
+from bayes_traj.psis import *
+from bayes_traj.psis import _psislw_column
+
+def test_psislw():
+    rng = np.random.default_rng(0)
+    n, m = 500, 300
+    lw = rng.standard_t(3, size=(n, m))*rng.uniform(0.1, 3, m)
+
+    # Columns with ties at the cutoff and a column with a short tail
+    lw[:, 0] = 0.
+    lw[:, 1] = np.round(lw[:, 1])
+    lw[:-2, 2] = -1e4
+
+    lw_out, ks = psislw(lw, block_size=64)
+
+    # Reference: smooth each column on its own
+    cutoff_ind = - int(np.ceil(min(0.2 * n, 3 * np.sqrt(n)))) - 1
+    cutoffmin = np.log(np.finfo(float).tiny)
+    for jj in range(m):
+        x = lw[:, jj] - np.max(lw[:, jj])
+        xcutoff = max(np.sort(x)[cutoff_ind], cutoffmin)
+        k = _psislw_column(x, xcutoff, 1/3)
+        x -= sumlogs(x)
+        assert np.allclose(lw_out[:, jj], x), "Smoothed weights mismatch"
+        assert k == ks[jj] or np.isclose(k, ks[jj]), "Tail index mismatch"
+
+    assert np.isinf(ks[2]), "Short tail should not be fit"
+
+    # One dimensional input
+    lw_1, k_1 = psislw(lw[:, 3])
+    assert np.allclose(lw_1, lw_out[:, 3]) and np.isclose(k_1, ks[3]), \
+        "One dimensional input mismatch"
+
+def test_gpdfitnew_batch():
+    rng = np.random.default_rng(1)
+    x = np.sort(rng.pareto(2., size=(50, 20)), axis=0)
+    k, sigma = gpdfitnew_batch(x)
+    for jj in range(x.shape[1]):
+        k_ref, sigma_ref = gpdfitnew(x[:, jj], sort=False)
+        assert np.isclose(k[jj], k_ref) and np.isclose(sigma[jj], sigma_ref), \
+            "GPD fit mismatch"
+
+    p = (np.arange(10) + 0.5)/10
+    qq = gpinv_batch(p, k, sigma)
+    for jj in range(x.shape[1]):
+        assert np.allclose(qq[:, jj], gpinv(p, k[jj], sigma[jj])), \
+            "Inverse GPD mismatch"
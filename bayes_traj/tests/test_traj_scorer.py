@@ -0,0 +1,83 @@
+import torch
+import numpy as np
+import pandas as pd
+from bayes_traj.traj_scorer import build_scorer, save_scorer
+from bayes_traj.tests.test_assignment_engine import get_model_and_data
+import os, subprocess, sys, tempfile
+import pdb
+
+def get_expected_probs(mm, df):
+    df_aug = mm.augment_df_with_traj_info(df.copy(), 'id', test_data=True)
+    cols = ['traj_{}'.format(tt) for tt in np.where(mm.sig_trajs_)[0]]
+
+    return df_aug.groupby('id')[cols].first().values
+
+def get_csr(mm, df):
+    df = df.sort_values('id', kind='stable')
+    X = torch.from_numpy(df[mm.predictor_names_].values)
+    Y = torch.from_numpy(df[mm.target_names_].values)
+    counts = df.groupby('id').size().values
+    indptr = torch.from_numpy(np.concatenate([[0], np.cumsum(counts)]))
+
+    return X, Y, indptr
+
+def test_traj_scorer_gaussian():
+    mm, df = get_model_and_data()
+    expected = get_expected_probs(mm, df)
+    scorer = build_scorer(mm)
+    traj_ids = scorer.traj_ids
+
+    X, Y, indptr = get_csr(mm, df)
+    probs = scorer(X, Y, indptr)[:, traj_ids].numpy()
+    assert np.allclose(probs, expected, atol=1e-10), "Probability mismatch"
+
+    # Padded layout, with a missing target value
+    Y[0, 0] = np.nan
+    counts = (indptr[1:] - indptr[:-1]).numpy()
+    X_pad = torch.zeros([counts.shape[0], np.max(counts), X.shape[1]],
+                        dtype=torch.float64)
+    Y_pad = torch.zeros([counts.shape[0], np.max(counts), Y.shape[1]],
+                        dtype=torch.float64)
+    mask = torch.zeros([counts.shape[0], np.max(counts)], dtype=torch.bool)
+    for gg in range(counts.shape[0]):
+        X_pad[gg, 0:counts[gg]] = X[indptr[gg]:indptr[gg+1]]
+        Y_pad[gg, 0:counts[gg]] = Y[indptr[gg]:indptr[gg+1]]
+        mask[gg, 0:counts[gg]] = True
+    probs_pad = scorer.score_padded(X_pad, Y_pad, mask)
+    assert torch.allclose(probs_pad, scorer(X, Y, indptr), atol=1e-12), \
+        "Padded layout mismatch"
+    assert torch.allclose(scorer.score_subject(X[0:indptr[1]], Y[0:indptr[1]]),
+                          probs_pad[0], atol=1e-12), "Subject mismatch"
+
+def test_traj_scorer_binary():
+    mm, df = get_model_and_data(binary=True)
+    expected = get_expected_probs(mm, df)
+    scorer = build_scorer(mm)
+
+    # get_R_matrix uses Monte Carlo estimates for binary targets
+    probs = scorer(*get_csr(mm, df))[:, scorer.traj_ids].numpy()
+    assert np.allclose(probs, expected, atol=0.05), "Probability mismatch"
+
+def test_load_scorer_standalone():
+    mm, df = get_model_and_data()
+    X, Y, indptr = get_csr(mm, df)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = os.path.join(tmp_dir, 'scorer.pt')
+        save_scorer(mm, file_name)
+        torch.save({'X': X, 'Y': Y, 'indptr': indptr},
+                   os.path.join(tmp_dir, 'data.pt'))
+
+        # The scorer is loaded and run in a process that only imports torch
+        code = """import sys, torch
+scorer = torch.jit.load('scorer.pt')
+data = torch.load('data.pt')
+torch.save(scorer(data['X'], data['Y'], data['indptr']), 'probs.pt')
+assert not any([mm in sys.modules for mm in \
+                ['pandas', 'pyro', 'matplotlib', 'bayes_traj']])
+"""
+        subprocess.run([sys.executable, '-c', code], cwd=tmp_dir, check=True)
+        probs = torch.load(os.path.join(tmp_dir, 'probs.pt'))
+
+    assert torch.allclose(probs, build_scorer(mm, script=False)(X, Y, indptr),
+                          atol=1e-12), "Probability mismatch"
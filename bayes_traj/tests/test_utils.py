@@ -1,6 +1,8 @@
-from bayes_traj.utils import sample_cos, sample_precs
+from bayes_traj.utils import sample_cos, sample_precs, read_group_chunks
 import numpy as np
-import pdb
+import pandas as pd
+import pytest
+import pdb, os, tempfile
 
 def test_sample_cos():
     """
@@ -25,3 +27,30 @@ def test_sample_precs():
     assert np.sum(np.isclose(lambda_a0/lambda_b0, \
                              np.mean(precs, 1), atol=.01)) == 2, \
         "Unexpected precision"
+
+def test_read_group_chunks():
+    df = pd.DataFrame({'id': [1, 1, 1, 2, 3, 3, 4, 4, 4, 4, 5],
+                       'y': np.arange(11.)})
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_name = os.path.join(tmp_dir, 'data.csv')
+        df.to_csv(file_name, index=False)
+
+        chunks = list(read_group_chunks(file_name, 'id', chunksize=3))
+        assert np.array_equal(pd.concat(chunks).y.values, df.y.values), \
+            "Chunks do not reproduce the data"
+        for ii, chunk in enumerate(chunks):
+            for jj in range(ii + 1, len(chunks)):
+                assert len(set(chunk.id) & set(chunks[jj].id)) == 0, \
+                    "Group split across chunks"
+
+        # Each chunk is a frame of its own, which can be modified in place
+        # without affecting (or warning about) the frame it was cut from
+        with pd.option_context('mode.chained_assignment', 'raise'):
+            for chunk in read_group_chunks(file_name, 'id', chunksize=3):
+                chunk['traj'] = 0
+                chunk.replace({'traj': {0: 1}}, inplace=True)
+
+        df.iloc[::-1].to_csv(file_name, index=False)
+        with pytest.raises(RuntimeError):
+            list(read_group_chunks(file_name, 'id', chunksize=3))
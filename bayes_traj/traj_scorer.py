@@ -0,0 +1,333 @@
+"""Standalone, TorchScript-compiled trajectory assignment.
+
+'build_scorer' turns a fitted model into a 'TrajScorer': a torch module that
+holds the posterior quantities assignment depends on and computes subjects'
+trajectory probabilities with tensor operations only. Saved with
+'save_scorer', it can be loaded with 'torch.jit.load' (or 'load_scorer') in a
+process that imports nothing but torch -- not pandas, pyro, matplotlib or the
+rest of bayes_traj.
+
+Assignment follows MultDPRegression.augment_df_with_traj_info with
+test_data=True: only fixed effects are used, and for binary targets the
+expectation E[log(1 + exp(x^T w))] is computed with Gauss-Hermite quadrature
+rather than Monte Carlo sampling. bayes_traj.assignment_engine computes its
+probabilities with an uncompiled 'TrajScorer'.
+
+For the lowest single-subject latency, call 'torch.set_num_threads(1)' in
+the serving process: batches of a few observations do not benefit from
+intra-op parallelism.
+"""
+
+import torch
+import numpy as np
+import math
+from typing import List
+import pdb
+
+class TrajScorer(torch.nn.Module):
+    """Computes trajectory assignment probabilities of subjects from their
+    observations. Use 'build_scorer' to create a compiled instance from a
+    fitted model.
+
+    Observations can be passed in CSR layout ('forward': the observations of
+    all subjects stacked, with 'indptr' giving the first row of each
+    subject), padded layout ('score_padded') or for a single subject
+    ('score_subject'). Predictor and target columns are ordered as in
+    'predictor_names' and 'target_names'; NaN targets do not contribute.
+
+    Parameters
+    ----------
+    expec_ln_v_terms : torch.Tensor, shape ( K )
+        Expected log stick-breaking weight of each trajectory.
+
+    sig_trajs : torch.Tensor, shape ( K )
+        Boolean mask of active trajectories.
+
+    w_mu, w_var : torch.Tensor, shape ( M, D, K )
+        Posterior means and variances of the trajectory coefficients.
+
+    w_covmat : torch.Tensor, shape ( M, M, D, K )
+        Posterior coefficient covariances (used for binary targets).
+
+    prec, ln_prec_const : torch.Tensor, shape ( D, K )
+        Expected residual precisions, and E[log precision] - log(2 pi).
+
+    binary : list of bool
+        Whether each target is binary.
+
+    quad_nodes, quad_weights : torch.Tensor
+        Gauss-Hermite quadrature nodes and weights (for a standard normal).
+
+    prob_thresh : float
+        Probabilities at or below this value are set to 0.
+
+    predictor_names, target_names : list of str
+        Names of the predictor and target columns.
+    """
+    binary: List[bool]
+    predictor_names: List[str]
+    target_names: List[str]
+    prob_thresh: float
+
+    def __init__(self, expec_ln_v_terms, sig_trajs, w_mu, w_var, w_covmat,
+                 prec, ln_prec_const, binary, quad_nodes, quad_weights,
+                 prob_thresh, predictor_names, target_names):
+        super().__init__()
+        self.register_buffer('expec_ln_v_terms', expec_ln_v_terms)
+        self.register_buffer('sig_trajs', sig_trajs)
+        self.register_buffer('traj_ids', torch.where(sig_trajs)[0])
+        self.register_buffer('w_mu', w_mu)
+        self.register_buffer('w_var', w_var)
+        self.register_buffer('w_covmat', w_covmat)
+        self.register_buffer('prec', prec)
+        self.register_buffer('ln_prec_const', ln_prec_const)
+        self.register_buffer('quad_nodes', quad_nodes)
+        self.register_buffer('quad_weights', quad_weights)
+        self.binary = binary
+        self.prob_thresh = prob_thresh
+        self.predictor_names = predictor_names
+        self.target_names = target_names
+
+    @torch.jit.export
+    def log_likelihood(self, X: torch.Tensor,
+                       Y: torch.Tensor) -> torch.Tensor:
+        """Computes the expected log-likelihood of each observation under
+        each trajectory.
+
+        Parameters
+        ----------
+        X : torch.Tensor, shape ( n, M )
+            Predictor values.
+
+        Y : torch.Tensor, shape ( n, D )
+            Target values. NaN entries do not contribute.
+
+        Returns
+        -------
+        log_like : torch.Tensor, shape ( n, K )
+            Expected log-likelihoods.
+        """
+        X = X.to(torch.float64)
+        Y = Y.to(torch.float64)
+
+        log_like = torch.zeros([X.shape[0], self.w_mu.shape[2]],
+                               dtype=torch.float64)
+        for d in range(len(self.binary)):
+            valid = ~torch.isnan(Y[:, d])
+            y = torch.where(valid, Y[:, d], torch.zeros_like(Y[:, d]))
+            y = y.unsqueeze(1)
+
+            mu_x = torch.matmul(X, self.w_mu[:, d, :])
+            if self.binary[d]:
+                var_x = torch.einsum('nm,mlk,nl->nk', X,
+                                     self.w_covmat[:, :, d, :], X)
+                t = mu_x.unsqueeze(2) + \
+                    torch.sqrt(torch.clamp(var_x, min=0.)).unsqueeze(2)*\
+                    self.quad_nodes
+                expec_softplus = torch.matmul(\
+                    torch.logaddexp(t, torch.zeros_like(t)),
+                    self.quad_weights)
+                ll = y*mu_x - expec_softplus
+            else:
+                sq = mu_x**2 + torch.matmul(X**2, self.w_var[:, d, :])
+                ll = 0.5*(self.ln_prec_const[d, :] - \
+                          self.prec[d, :]*(sq - 2*y*mu_x + y**2))
+
+            log_like = log_like + \
+                torch.where(valid.unsqueeze(1), ll, torch.zeros_like(ll))
+
+        return log_like
+
+    @torch.jit.export
+    def normalize(self, log_like: torch.Tensor) -> torch.Tensor:
+        """Turns subjects' summed log-likelihoods into trajectory
+        probabilities.
+
+        Parameters
+        ----------
+        log_like : torch.Tensor, shape ( G, K )
+            Sum over each subject's observations of the expected
+            log-likelihoods.
+
+        Returns
+        -------
+        probs : torch.Tensor, shape ( G, K )
+            Trajectory probabilities. Inactive trajectories have probability
+            0.
+        """
+        ln_rho = (log_like + self.expec_ln_v_terms).\
+            masked_fill(~self.sig_trajs, -math.inf)
+        probs = torch.softmax(ln_rho, dim=1)
+        probs = torch.where(probs <= self.prob_thresh,
+                            torch.zeros_like(probs), probs)
+
+        return probs/torch.sum(probs, dim=1, keepdim=True)
+
+    def forward(self, X: torch.Tensor, Y: torch.Tensor,
+                indptr: torch.Tensor) -> torch.Tensor:
+        """Computes the trajectory probabilities of subjects whose
+        observations are given in CSR layout.
+
+        Parameters
+        ----------
+        X : torch.Tensor, shape ( n, M )
+            Predictor values of all observations, grouped by subject.
+
+        Y : torch.Tensor, shape ( n, D )
+            Target values of all observations. NaN entries do not contribute.
+
+        indptr : torch.Tensor, shape ( G + 1 )
+            The observations of subject g are rows indptr[g] to
+            indptr[g+1] - 1.
+
+        Returns
+        -------
+        probs : torch.Tensor, shape ( G, K )
+            Trajectory probabilities of each subject.
+        """
+        counts = indptr[1:] - indptr[:-1]
+        group = torch.repeat_interleave(\
+            torch.arange(counts.shape[0], device=counts.device), counts)
+        log_like = torch.zeros([counts.shape[0], self.w_mu.shape[2]],
+                               dtype=torch.float64).\
+            index_add_(0, group, self.log_likelihood(X, Y))
+
+        return self.normalize(log_like)
+
+    @torch.jit.export
+    def score_padded(self, X: torch.Tensor, Y: torch.Tensor,
+                     mask: torch.Tensor) -> torch.Tensor:
+        """Computes the trajectory probabilities of subjects whose
+        observations are given in padded layout.
+
+        Parameters
+        ----------
+        X : torch.Tensor, shape ( G, T, M )
+            Predictor values. Subject g has observations X[g, t] for the t at
+            which mask[g, t] is true.
+
+        Y : torch.Tensor, shape ( G, T, D )
+            Target values. NaN entries do not contribute.
+
+        mask : torch.Tensor, shape ( G, T )
+            Boolean mask of the observations that are present.
+
+        Returns
+        -------
+        probs : torch.Tensor, shape ( G, K )
+            Trajectory probabilities of each subject.
+        """
+        G = X.shape[0]
+        T = X.shape[1]
+        log_like = self.log_likelihood(X.reshape(G*T, X.shape[2]),
+                                       Y.reshape(G*T, Y.shape[2]))
+        log_like = torch.where(mask.reshape(G*T, 1), log_like,
+                               torch.zeros_like(log_like))
+
+        return self.normalize(log_like.reshape(G, T, -1).sum(1))
+
+    @torch.jit.export
+    def score_subject(self, X: torch.Tensor, Y: torch.Tensor) -> torch.Tensor:
+        """Computes the trajectory probabilities of a single subject.
+
+        Parameters
+        ----------
+        X : torch.Tensor, shape ( T, M )
+            Predictor values of the subject's observations.
+
+        Y : torch.Tensor, shape ( T, D )
+            Target values. NaN entries do not contribute.
+
+        Returns
+        -------
+        probs : torch.Tensor, shape ( K )
+            Trajectory probabilities.
+        """
+        return self.normalize(\
+            self.log_likelihood(X, Y).sum(0, keepdim=True))[0]
+
+
+def build_scorer(mm, num_quad_points=32, script=True):
+    """Builds a trajectory scorer from a fitted model.
+
+    Parameters
+    ----------
+    mm : MultDPRegression
+        Fitted trajectory model (or an inference-only export of one).
+
+    num_quad_points : int, optional
+        Number of Gauss-Hermite quadrature points used for binary targets.
+
+    script : bool, optional
+        If true, the scorer is compiled with TorchScript.
+
+    Returns
+    -------
+    scorer : TrajScorer or torch.jit.ScriptModule
+        The scorer.
+    """
+    to_tensor = lambda vv: torch.as_tensor(np.asarray(vv), dtype=torch.float64)
+
+    v_a = to_tensor(mm.v_a_)
+    v_b = to_tensor(mm.v_b_)
+    expec_ln_v = torch.digamma(v_a) - torch.digamma(v_a + v_b)
+    expec_ln_1_minus_v = torch.digamma(v_b) - torch.digamma(v_a + v_b)
+    expec_ln_v_terms = expec_ln_v + \
+        torch.cat([torch.zeros(1, dtype=torch.float64),
+                   torch.cumsum(expec_ln_1_minus_v, 0)[:-1]])
+
+    lambda_a = to_tensor(mm.lambda_a_)
+    lambda_b = to_tensor(mm.lambda_b_)
+
+    nodes, weights = np.polynomial.hermite_e.hermegauss(num_quad_points)
+
+    scorer = TrajScorer(expec_ln_v_terms,
+        torch.as_tensor(np.asarray(mm.sig_trajs_), dtype=torch.bool),
+        to_tensor(mm.w_mu_).clone(), to_tensor(mm.w_var_).clone(),
+        torch.nan_to_num(to_tensor(mm.w_covmat_)),
+        lambda_a/lambda_b,
+        torch.digamma(lambda_a) - torch.log(lambda_b) - math.log(2*math.pi),
+        [mm.target_type_[d] == 'binary' for d in range(mm.D_)],
+        to_tensor(nodes), to_tensor(weights/np.sqrt(2*np.pi)),
+        float(mm.prob_thresh_), list(mm.predictor_names_),
+        list(mm.target_names_))
+
+    if script:
+        scorer = torch.jit.script(scorer)
+
+    return scorer
+
+
+def save_scorer(mm, file_name, num_quad_points=32):
+    """Builds a compiled trajectory scorer from a fitted model and saves it.
+
+    Parameters
+    ----------
+    mm : MultDPRegression
+        Fitted trajectory model.
+
+    file_name : str
+        Output file name.
+
+    num_quad_points : int, optional
+        Number of Gauss-Hermite quadrature points used for binary targets.
+    """
+    torch.jit.save(build_scorer(mm, num_quad_points), file_name)
+
+
+def load_scorer(file_name):
+    """Loads a scorer saved with 'save_scorer'. Equivalent to
+    'torch.jit.load', which can be used directly where bayes_traj is not
+    installed.
+
+    Parameters
+    ----------
+    file_name : str
+        Scorer file name.
+
+    Returns
+    -------
+    scorer : torch.jit.ScriptModule
+        The scorer.
+    """
+    return torch.jit.load(file_name)
@@ -2,6 +2,8 @@
 
 from argparse import ArgumentParser
 from bayes_traj.mult_dp_regression import MultDPRegression
+from bayes_traj.model_registry import load_model
+from bayes_traj.model_io import save_model
 from provenance_tools.write_provenance_data import write_provenance_data
 import pdb, pickle, sys, warnings
 
@@ -21,21 +23,20 @@ def main():
     op = parser.parse_args()
     
     print("Reading model...")
-    with open(op.in_model, 'rb') as f:
-        mm_in = pickle.load(f)['MultDPRegression']
+    mm_in = load_model(op.in_model, cache=False)
 
-        print("Updating...")
-        mm_out = MultDPRegression(mm_in)
+    print("Updating...")
+    mm_out = MultDPRegression(mm_in)
         
-        if op.out_model is not None:
-            print("Saving updated model...")
-            pickle.dump({'MultDPRegression': mm_out}, open(op.out_model, 'wb'))
+    if op.out_model is not None:
+        print("Saving updated model...")
+        save_model(mm_out, op.out_model)
     
-            print("Saving model provenance info...")
-            provenance_desc = """ """
-            write_provenance_data(op.out_model, generator_args=op,
-                                  desc=provenance_desc,
-                                  module_name='bayes_traj')
+        print("Saving model provenance info...")
+        provenance_desc = """ """
+        write_provenance_data(op.out_model, generator_args=op,
+                              desc=provenance_desc,
+                              module_name='bayes_traj')
 
     print("DONE.")
     
@@ -1,5 +1,7 @@
 import pickle
+import os
 import numpy as np
+import pandas as pd
 from argparse import ArgumentParser
 
 def get_pred_names_from_prior_info(prior_info):
@@ -157,3 +159,59 @@ def sample_traj(w_mu0, var_covar0, lambda_a0, lambda_b0, num_samples):
     precs = sample_precs(lambda_a0, lambda_b0, num_samples)
 
     return w, precs
+
+def read_group_chunks(file_name, groupby, chunksize=100000, columns=None):
+    """Reads a data file in chunks such that all the rows of a group are
+    contained in a single chunk. The file must be sorted by the groupby
+    column. Supported formats are csv and, if pyarrow is installed, parquet
+    (files ending in '.parquet' or '.pq').
+
+    Parameters
+    ----------
+    file_name : str
+        Name of the data file to read.
+
+    groupby : str
+        Column name identifying the groups (subjects).
+
+    chunksize : int, optional
+        Number of rows to read at a time. A chunk can exceed this size by the
+        number of rows in the group that straddles a chunk boundary.
+
+    columns : list of strings, optional
+        Subset of columns to read. The groupby column must be included.
+
+    Returns
+    -------
+    chunks : generator of pandas DataFrame
+        Group-aligned chunks, each with a fresh RangeIndex.
+    """
+    if os.path.splitext(file_name)[1].lower() in ['.parquet', '.pq']:
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise RuntimeError("pyarrow is required to read parquet files")
+        reader = (bb.to_pandas() for bb in pq.ParquetFile(file_name).\
+                  iter_batches(batch_size=chunksize, columns=columns))
+    else:
+        reader = pd.read_csv(file_name, chunksize=chunksize, usecols=columns)
+
+    carry = None
+    for chunk in reader:
+        if carry is not None:
+            chunk = pd.concat([carry, chunk], ignore_index=True)
+        else:
+            chunk = chunk.reset_index(drop=True)
+
+        keys = chunk[groupby].values
+        if np.any(keys[1:] < keys[:-1]):
+            raise RuntimeError("Data must be sorted by " + groupby)
+
+        # Hold back the last group, which may continue in the next chunk
+        num_complete = np.searchsorted(keys, keys[-1], side='left')
+        carry = chunk.iloc[num_complete:]
+        if num_complete > 0:
+            yield chunk.iloc[0:num_complete].copy()
+
+    if carry is not None and carry.shape[0] > 0:
+        yield carry.reset_index(drop=True)
@@ -5,6 +5,8 @@ import numpy as np
 from scipy.special import gamma
 from scipy.special import loggamma
 import pickle, pdb
+from bayes_traj.model_registry import load_model
+from bayes_traj.fit_stats import FitStatistics
 from provenance_tools.write_provenance_data import write_provenance_data
 import matplotlib.pyplot as plt
 
@@ -39,7 +41,7 @@ def main():
     dist_info_list = []
     
     if op.model is not None:
-        mm = pickle.load(open(op.model, 'rb'))['MultDPRegression']
+        mm = load_model(op.model)
         if op.target is None:
             target = mm.target_names_[0]
         else:
@@ -62,24 +64,10 @@ def main():
         dist_info = [m, v, 'Prior']
         dist_info_list.append(dist_info)
             
-        df_traj = mm.to_df()
-        
-        # Get dataframe column that was used to create groups, if groups exist
-        if mm.gb_ is not None:
-            num_groups = mm.gb_.ngroups
-            groupby_col = mm.gb_.count().index.name               
-        else:
-            num_groups = df_traj.shape[0]    
+        stats = FitStatistics(mm)
     
         for traj in np.where(mm.sig_trajs_)[0]:
-            num_obs_in_traj = sum(df_traj.traj.values == traj)
-            if mm.gb_ is not None:
-                num_groups_in_traj = df_traj[df_traj.traj.values == traj].\
-                    groupby(groupby_col).ngroups
-            else:
-                num_groups_in_traj = num_obs_in_traj
-            
-            frac = num_groups_in_traj/num_groups
+            frac = stats.props_[traj]
             if frac > op.min_traj_prob:
                 m = mm.lambda_a_[target_index, traj]/\
                     mm.lambda_b_[target_index, traj]
@@ -43,7 +43,13 @@ setup(
                                         'assign_trajectory = bayes_traj.assign_trajectory:main',
                                         'update_model = bayes_traj.update_model:main',
                                         'get_alpha_estimate = bayes_traj.get_alpha_estimate:main',
-                                        'generate_prior = bayes_traj.generate_prior:main']},
+                                        'generate_prior = bayes_traj.generate_prior:main',
+                                        'bayes_traj_refiner = bayes_traj.bayes_traj_refiner:main',
+                                        'bayes_traj_update = bayes_traj.bayes_traj_update:main',
+                                        'assign_trajectory_server = bayes_traj.assign_trajectory_server:main',
+                                        'convert_traj_model = bayes_traj.convert_traj_model:main',
+                                        'export_inference_model = bayes_traj.export_inference_model:main',
+                                        'compare_traj_models = bayes_traj.compare_traj_models:main']},
     
     install_requires=[
         'provenance-tools >= 0.0.5',